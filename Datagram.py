@@ -1,9 +1,100 @@
 import struct
-from logger import logger
+from array import array
+from logger import get_logger, TracePoint
+import simp_compress
+
+logger = get_logger("datagram")
+trace = TracePoint(logger)
 
 # Used big endianess
 
+# precompiled header layout: type, operation, sequence, user, payload length
+HEADER = struct.Struct("!BBB32sI")
+HEADER_SIZE = HEADER.size
+
+# chat operation flags, high bits of the operation byte of chat datagrams
+CHAT_FRAGMENT = 0x10  # payload starts with a fragment sub-header (see simp_fragment)
+CHAT_BATCH = 0x20  # payload holds several length prefixed messages (see simp_batch)
+CHAT_COMPRESSED = 0x40  # payload is compressed with the codec negotiated for the session (see simp_compress)
+CHAT_FLAGS = CHAT_FRAGMENT | CHAT_BATCH | CHAT_COMPRESSED
+
+# any datagram of a session: payload starts with the receiver's 16 bit session id (see simp_sessions)
+SESSION_FLAG = 0x80
+SESSION_ID = struct.Struct("!H")
+
+# valid operations per datagram type, as ints for the fast path.
+# Control: ERR 1, SYN 2, ACK 4, ROUTES 5, SYN+ACK 6, FIN 8, RELAY 9, KEEPALIVE 10, GROUP 12, GROUP_ACK 13, KEEPALIVE+ACK 14
+# Chat: MESSAGE 1, GROUP 2 (a group message, never flagged, see simp_group)
+VALID_OPERATIONS = {
+    1: frozenset(operation | flags for operation in (1, 2, 4, 5, 6, 8, 9, 10, 12, 13, 14) for flags in (0, SESSION_FLAG)),  # control datagram
+    2: frozenset(1 | flags for flags in range(0, 256, 0x10) if flags & ~(CHAT_FLAGS | SESSION_FLAG) == 0) | {2},  # chat datagram
+}
+# 0/1 for stop-and-wait, windowed chats use the whole byte (see simp_window)
+VALID_SEQUENCES = frozenset(range(256))
+
+# single byte values, so the trusted path never calls int.to_bytes
+_BYTE = [bytes((i,)) for i in range(256)]
+
+# numpy dtype matching HEADER, for DatagramBatch.to_numpy
+NUMPY_HEADER_DTYPE = [("type", "u1"), ("operation", "u1"), ("sequence", "u1"), ("user", "S32"), ("length", ">u4")]
+
+
+def header_error(datagram_type: int, operation: int, sequence: int, user: bytes, length: int, payload_size: int):
+    '''
+    Validate unpacked header fields, return the reason as a string or None if the header is valid.
+    '''
+    valid_operations = VALID_OPERATIONS.get(datagram_type)
+    if valid_operations is None:
+        return f"Invalid type: {datagram_type}"
+    if operation not in valid_operations:
+        return f"Invalid operation {operation} for type {datagram_type}"
+    if sequence not in VALID_SEQUENCES:
+        return f"Invalid sequence: {sequence}"
+    if payload_size != length:
+        return f"Invalid datagram length: {length} (actual payload length: {payload_size})"
+    if not user.isascii():
+        return f"Invalid user, cannot decode 'ascii': {user}"
+    return None
+
+
+def encode_options(options: dict) -> bytes:
+    '''
+    Encode handshake options carried in the SYN / SYN+ACK payload as "KEY=value;KEY=value", in utf-8 for the
+    usernames (FROM), every other value is ascii.
+    '''
+    return ";".join(f"{key}={value}" for key, value in options.items()).encode("utf-8")
+
+
+def decode_options(payload) -> dict:
+    '''
+    Decode handshake options, an empty payload (older daemons) gives an empty dict.
+    '''
+    options = {}
+    for item in str(payload, "utf-8", "replace").split(";"):
+        if "=" in item:
+            key, value = item.split("=", 1)
+            options[key.strip().upper()] = value.strip()
+    return options
+
+
 class Datagram:
+    __slots__ = ("datagram_type", "operation", "sequence", "user", "payload", "length")
+
+    types = {
+        "control_datagram": b'\x01',
+        "chat_datagram": b'\x02',
+    }
+
+    operations = {
+        "ERR": b'\x01',
+        "SYN": b'\x02',
+        "ACK": b'\x04',
+        "FIN_ACK": b'\x06',
+        "FIN": b'\x08',
+        "KEEPALIVE": b'\x0a',
+        "KEEPALIVE_ACK": b'\x0e',
+    }
+
     def __init__(self, datagram_type:bytes, operation:bytes, sequence:bytes, user:bytes, payload:bytes, length:bytes) -> None:
         # can be bytes or regular data types(if yes convert to bytes)
         self.datagram_type = datagram_type if isinstance(datagram_type, bytes) else datagram_type.to_bytes(1, 'big')
@@ -11,29 +102,43 @@ class Datagram:
         self.sequence = sequence if isinstance(sequence, bytes) else sequence.to_bytes(1, 'big')
         self.user = user.encode('ascii').ljust(32, b'\x00')[:32] if isinstance(user, str) else user.ljust(32)[:32]
         self.payload = payload.encode('ascii') if isinstance(payload, str) else payload
-        
+
         if length is None:
             self.length = len(self.payload).to_bytes(4, 'big')
         else:
             self.length = length.to_bytes(4, 'big') if isinstance(length, int) else length
-        
-        self.types = {
-            "control_datagram": b'\x01',
-            "chat_datagram": b'\x02',
-        }
-        
-        self.operations = {
-            "ERR": b'\x01',
-            "SYN": b'\x02',
-            "ACK": b'\x04',
-            "FIN_ACK": b'\x06',
-            "FIN": b'\x08',
-        }
-        
+
         if not self.check_datagram():
             raise ValueError("Invalid datagram")
 
-        
+
+    @classmethod
+    def trusted(cls, datagram_type: int, operation: int, sequence: int, user: bytes, payload=b"", session_id=None, codec=None):
+        '''
+        Build a datagram the daemon creates itself, skipping re-validation.
+        user is the raw username (no padding needed), payload any bytes-like object.
+        With a session_id the datagram is flagged and the id is put in front of the payload.
+        With a codec a chat payload is compressed and flagged, if it is over the threshold and shrinks.
+        Fragments are left alone, the receiver reassembles before it decompresses.
+        '''
+        if codec is not None and datagram_type == 2 and not operation & (CHAT_COMPRESSED | CHAT_FRAGMENT):
+            compressed = simp_compress.maybe_compress(codec, payload)
+            if compressed is not None:
+                operation |= CHAT_COMPRESSED
+                payload = compressed
+        if session_id is not None:
+            operation |= SESSION_FLAG
+            payload = SESSION_ID.pack(session_id) + payload
+        datagram = cls.__new__(cls)
+        datagram.datagram_type = _BYTE[datagram_type]
+        datagram.operation = _BYTE[operation]
+        datagram.sequence = _BYTE[sequence]
+        datagram.user = user
+        datagram.payload = payload
+        datagram.length = len(payload).to_bytes(4, 'big')
+        return datagram
+
+
     def check_datagram(self):
         '''
         check validity of th datagram.
@@ -43,19 +148,19 @@ class Datagram:
             return False
 
         if self.datagram_type == b'\x01':  # control datagram
-            if self.operation not in (b'\x01', b'\x02', b'\x04', b'\x08', b'\x06'):
+            if self.operation[0] not in VALID_OPERATIONS[1]:
                 logger.error(f"Invalid operation for control datagram: {self.operation}")
                 return False
-            
+
         elif self.datagram_type == b'\x02':  # chat datagram
-            if self.operation != b'\x01':
+            if self.operation[0] not in VALID_OPERATIONS[2]:
                 logger.error(f"Invalid operation for chat datagram: {self.operation}")
                 return False
-            
-        if self.sequence not in (b'\x00', b'\x01'):
+
+        if len(self.sequence) != 1 or self.sequence[0] not in VALID_SEQUENCES:
             logger.error(f"Invalid sequence: {self.sequence}")
             return False
-        
+
         if int.from_bytes(self.length, 'big') != len(self.payload):
             logger.error(f"Invalid length, must be length of payload: {self.length}")
             return False
@@ -65,46 +170,256 @@ class Datagram:
         except UnicodeDecodeError:
             logger.error(f"Invalid user, cannot decode 'ascii': {self.user}")
             return False
-        
+
+        return True
+
+
+    def strip_session(self) -> int:
+        '''
+        Remove the session id from a flagged datagram and return it, unflagged datagrams belong to session 0.
+        '''
+        operation = self.operation[0]
+        if not operation & SESSION_FLAG:
+            return 0
+        if len(self.payload) < SESSION_ID.size:
+            raise ValueError("Session datagram without a session id")
+        session_id, = SESSION_ID.unpack_from(self.payload)
+        self.operation = _BYTE[operation & ~SESSION_FLAG]
+        self.payload = self.payload[SESSION_ID.size:]
+        self.length = len(self.payload).to_bytes(4, 'big')
+        return session_id
+
+
+    def decompress(self, codec, max_size: int = simp_compress.MAX_DECOMPRESSED) -> bool:
+        '''
+        Replace a compressed payload by the original one and clear the flag, return True if it was compressed.
+        Fragments are left alone, only the reassembled message can be decompressed. Raises ValueError like
+        simp_compress.decompress, or if the payload is flagged but no codec was negotiated.
+        '''
+        operation = self.operation[0]
+        if self.datagram_type[0] != 2 or not operation & CHAT_COMPRESSED or operation & CHAT_FRAGMENT:
+            return False
+        if codec is None:
+            raise ValueError("Compressed payload without a negotiated codec")
+        self.payload = simp_compress.decompress(codec, self.payload, max_size)
+        self.operation = _BYTE[operation & ~CHAT_COMPRESSED]
+        self.length = len(self.payload).to_bytes(4, 'big')
         return True
 
 
-    def to_bytes(self):    
+    def to_bytes(self):
         '''
             convert to bytes
         '''
-        user_fixed = self.user.ljust(32, b'\x00')[:32]
-        header = struct.pack(
-            "!BBB32sI",
+        header = HEADER.pack(
             self.datagram_type[0],
             self.operation[0],
             self.sequence[0],
-            user_fixed,
-            int.from_bytes(self.length, 'big')
+            self.user,
+            len(self.payload)
         )
-        logger.info(f"Datagram created: {header} {self.payload}")
+        if trace: trace("Datagram created: %s %s", header, self.payload)
         return header + self.payload
 
+
+    def pack_into(self, buffer, offset: int = 0) -> int:
+        '''
+            write header and payload straight into a caller-supplied buffer, return the number of bytes written
+        '''
+        size = len(self.payload)
+        HEADER.pack_into(buffer, offset, self.datagram_type[0], self.operation[0], self.sequence[0], self.user, size)
+        start = offset + HEADER_SIZE
+        buffer[start:start + size] = self.payload
+        return HEADER_SIZE + size
+
+
+    def __len__(self):
+        return HEADER_SIZE + len(self.payload)
+
+
     @classmethod
     def from_bytes(cls, data: bytes):
         '''
             convert from bytes
         '''
-        if len(data) < 38:
+        if len(data) < HEADER_SIZE:
             raise ValueError("Datagram is too short")
-        
-        datagram_type = data[0]
-        operation = data[1]
-        sequence = data[2]
-        user = data[3:35].rstrip(b'\x00')
-        length = int.from_bytes(data[35:39], 'big')
-        payload = data[39:]
+
+        datagram_type, operation, sequence, user, length = HEADER.unpack_from(data)
+        user = user.rstrip(b'\x00')
+        payload = data[HEADER_SIZE:]
 
         # Check length matches payload
         if len(payload) != length:
             logger.error(f"Invalid datagram length: {length} (actual payload length: {len(payload)})")
             raise ValueError("Invalid datagram")
 
-        logger.info(f"Datagram parsed: {datagram_type} {operation} {sequence} {user} {length} {payload}")
-        
-        return cls(datagram_type, operation, sequence, user, payload, length)
\ No newline at end of file
+        if trace: trace("Datagram parsed: %s %s %s %s %s %s", datagram_type, operation, sequence, user, length, payload)
+
+        return cls(datagram_type, operation, sequence, user, payload, length)
+
+
+    @classmethod
+    def from_buffer(cls, data):
+        '''
+            parse a received buffer without copying it, the payload is a memoryview into data.
+            Validation is done once on the unpacked ints, raises ValueError like from_bytes.
+        '''
+        view = memoryview(data)
+        if len(view) < HEADER_SIZE:
+            raise ValueError("Datagram is too short")
+
+        datagram_type, operation, sequence, user, length = HEADER.unpack_from(view)
+        user = user.rstrip(b'\x00')
+        error = header_error(datagram_type, operation, sequence, user, length, len(view) - HEADER_SIZE)
+        if error:
+            raise ValueError(error)
+
+        datagram = cls.__new__(cls)
+        datagram.datagram_type = _BYTE[datagram_type]
+        datagram.operation = _BYTE[operation]
+        datagram.sequence = _BYTE[sequence]
+        datagram.user = user
+        datagram.payload = view[HEADER_SIZE:]
+        datagram.length = length.to_bytes(4, 'big')
+        return datagram
+
+
+    @classmethod
+    def decode_many(cls, data, offsets=None):
+        '''
+            decode many datagrams in one pass, returns a DatagramBatch.
+            data is either a list of packets or one contiguous buffer. For a buffer, offsets are the start of
+            every datagram (each one ends where the next starts); without offsets the buffer is walked as a
+            stream of back-to-back datagrams using the length field. Invalid rows end up in batch.errors.
+        '''
+        batch = DatagramBatch()
+        if isinstance(data, (list, tuple)):
+            for packet in data:
+                view = memoryview(packet)
+                batch.add(view, 0, len(view))
+        elif offsets is not None:
+            view = memoryview(data)
+            ends = list(offsets[1:]) + [len(view)]
+            for start, end in zip(offsets, ends):
+                batch.add(view, start, end)
+        else:
+            view = memoryview(data)
+            start = 0
+            while start < len(view):
+                end = start + HEADER_SIZE
+                if end <= len(view):
+                    end += int.from_bytes(view[end - 4:end], 'big')
+                if end > len(view):
+                    # truncated capture, nothing after it can be framed
+                    batch.add(view, start, len(view))
+                    break
+                batch.add(view, start, end)
+                start = end
+        return batch
+
+
+    @classmethod
+    def encode_many(cls, datagrams):
+        '''
+            encode many datagrams into one contiguous bytearray, returns (buffer, offsets).
+            All headers are validated first and every invalid row is reported in a single ValueError.
+        '''
+        errors = []
+        for index, datagram in enumerate(datagrams):
+            error = header_error(datagram.datagram_type[0], datagram.operation[0], datagram.sequence[0],
+                                 datagram.user, int.from_bytes(datagram.length, 'big'), len(datagram.payload))
+            if error:
+                errors.append((index, error))
+        if errors:
+            raise ValueError(f"Invalid datagrams: {errors}")
+
+        offsets = array('I')
+        buffer = bytearray(sum(HEADER_SIZE + len(datagram.payload) for datagram in datagrams))
+        position = 0
+        for datagram in datagrams:
+            offsets.append(position)
+            position += datagram.pack_into(buffer, position)
+        return buffer, offsets
+
+
+class DatagramBatch:
+    '''
+    Column oriented view over many decoded datagrams. Header fields are kept in arrays, payloads are
+    memoryview slices of the decoded buffer, invalid rows are listed in errors as (row, reason).
+    '''
+    def __init__(self) -> None:
+        self.offsets = array('Q')
+        self.types = array('B')
+        self.operations = array('B')
+        self.sequences = array('B')
+        self.lengths = array('I')
+        self.users = []
+        self.payloads = []
+        self.valid = bytearray()
+        self.errors = []
+        # raw 39 byte headers back to back, used by to_numpy
+        self.headers = bytearray()
+
+
+    def add(self, view: memoryview, start: int, end: int):
+        '''
+        Decode the datagram in view[start:end] and append it as a new row.
+        '''
+        row = len(self.valid)
+        self.offsets.append(start)
+        if end - start < HEADER_SIZE:
+            self.types.append(0)
+            self.operations.append(0)
+            self.sequences.append(0)
+            self.lengths.append(0)
+            self.users.append(b"")
+            self.payloads.append(view[start:start])
+            self.headers += bytes(HEADER_SIZE)
+            self.valid.append(0)
+            self.errors.append((row, "Datagram is too short"))
+            return
+
+        datagram_type, operation, sequence, user, length = HEADER.unpack_from(view, start)
+        user = user.rstrip(b'\x00')
+        self.types.append(datagram_type)
+        self.operations.append(operation)
+        self.sequences.append(sequence)
+        self.lengths.append(length)
+        self.users.append(user)
+        self.payloads.append(view[start + HEADER_SIZE:end])
+        self.headers += view[start:start + HEADER_SIZE]
+
+        error = header_error(datagram_type, operation, sequence, user, length, end - start - HEADER_SIZE)
+        self.valid.append(error is None)
+        if error:
+            self.errors.append((row, error))
+
+
+    def __len__(self):
+        return len(self.valid)
+
+
+    def __getitem__(self, row: int) -> Datagram:
+        if not self.valid[row]:
+            raise ValueError(f"Invalid datagram at row {row}")
+        datagram = Datagram.trusted(self.types[row], self.operations[row], self.sequences[row], self.users[row], self.payloads[row])
+        return datagram
+
+
+    def datagrams(self):
+        '''
+        Yield every valid row as a Datagram.
+        '''
+        for row in range(len(self.valid)):
+            if self.valid[row]:
+                yield self[row]
+
+
+    def to_numpy(self):
+        '''
+        Headers as a numpy structured array, requires numpy. It is a copy: an array over the growing
+        headers buffer would keep add() from resizing it.
+        '''
+        import numpy
+        return numpy.frombuffer(self.headers, dtype=NUMPY_HEADER_DTYPE).copy()
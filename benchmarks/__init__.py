@@ -0,0 +1,3 @@
+'''
+Performance benchmarks of the daemon, run with "python -m benchmarks" from the repository root.
+'''
@@ -0,0 +1,48 @@
+import argparse
+import json
+import sys
+import logger
+from benchmarks import bench_codec, bench_daemon, bench_sim
+from benchmarks.results import report, load, save, compare
+
+SUITES = {"codec": bench_codec, "daemon": bench_daemon, "sim": bench_sim}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Benchmark the SIMP daemon.")
+    parser.add_argument("--quick", action="store_true", help="fewer iterations, for a smoke run")
+    parser.add_argument("--only", default=",".join(SUITES), help="comma separated suites to run: codec,daemon,sim")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--baseline", help="JSON results to compare against, exit status 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="relative change counted as a regression (default 0.10)")
+    args = parser.parse_args(argv)
+
+    # the daemons log every handshake at INFO
+    logger.set_level("daemon", "WARNING")
+
+    metrics = {}
+    for name in args.only.split(","):
+        suite = SUITES.get(name.strip())
+        if suite is None:
+            parser.error(f"unknown suite {name!r}, choose from {', '.join(SUITES)}")
+        print(f"Running {name} benchmarks...", file=sys.stderr)
+        metrics.update(suite.run(args.quick))
+
+    results = report(metrics, args.quick)
+    if args.output:
+        save(results, args.output)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    if not args.baseline:
+        return 0
+    regressions = 0
+    for name, base, value, change, regressed in compare(results, load(args.baseline), args.tolerance):
+        regressions += regressed
+        print(f"{name:28} {base:>14.3f} {value:>14.3f} {change:>+8.1%}{'  REGRESSION' if regressed else ''}", file=sys.stderr)
+    print(f"{regressions} regression(s) over {args.tolerance:.0%}.", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,27 @@
+import functools
+import timeit
+from Datagram import Datagram
+from benchmarks.results import metric
+
+
+def ns_per_op(function, repeat: int) -> float:
+    '''
+    Best of repeat runs of function, in nanoseconds per call. Each run lasts at least 0.2 s.
+    '''
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e9
+
+
+def run(quick: bool = False) -> dict:
+    '''
+    Encode and decode cost of a session chat datagram with a 64 byte payload.
+    '''
+    repeat = 3 if quick else 7
+    datagram = Datagram.trusted(2, 1, 0, b"alice", b"x" * 64, 1)
+    data = datagram.to_bytes()
+    return {
+        "codec.to_bytes_ns": metric(ns_per_op(datagram.to_bytes, repeat), "ns/op", "lower"),
+        "codec.from_bytes_ns": metric(ns_per_op(functools.partial(Datagram.from_bytes, data), repeat), "ns/op", "lower"),
+        "codec.from_buffer_ns": metric(ns_per_op(functools.partial(Datagram.from_buffer, data), repeat), "ns/op", "lower"),
+    }
@@ -0,0 +1,167 @@
+import statistics
+import threading
+import time
+from simp_daemon import Daemon
+from benchmarks.results import metric
+
+# loopback aliases of the README, linux routes all of 127.0.0.0/8 to lo
+INITIATOR_IP = "127.0.0.1"
+RECEIVER_IP = "127.0.0.2"
+
+# seconds a benchmark waits for a handshake or a message before giving up
+TIMEOUT = 10
+
+
+class NullConn:
+    '''
+    Client connection that drops every notification, benchmarks drive the daemons directly.
+    '''
+    def sendall(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def client(username: str) -> dict:
+    return {"conn": NullConn(), "username": username, "address": ("benchmark", username)}
+
+
+def start_daemons(**options) -> tuple:
+    '''
+    Start a daemon on each loopback alias, on the real ports, like two hosts.
+    '''
+    daemons = (Daemon(ip=INITIATOR_IP, **options), Daemon(ip=RECEIVER_IP, **options))
+    threads = [threading.Thread(target=daemon.start, daemon=True) for daemon in daemons]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.5)
+    return daemons, threads
+
+
+def stop_daemons(daemons: tuple, threads: list):
+    for daemon in daemons:
+        daemon.stop()
+    for thread in threads:
+        thread.join()
+
+
+def handshakes_per_second(daemon1: Daemon, daemon2: Daemon, count: int, concurrency: int) -> float:
+    '''
+    Complete count handshakes, concurrency of them in flight at once, each for another user of daemon2.
+    '''
+    receivers = [client(f"bench{i}") for i in range(count)]
+    initiators = [client(f"init{i}") for i in range(count)]
+    daemon2.clients.update((receiver["username"], receiver) for receiver in receivers)
+    try:
+        start = time.perf_counter()
+        for first in range(0, count, concurrency):
+            futures = [
+                daemon1.begin_handshake(daemon1.open_session(RECEIVER_IP, 7777, initiators[i], f"bench{i}"))
+                for i in range(first, min(first + concurrency, count))
+            ]
+            if not all(future.result(timeout=TIMEOUT) for future in futures):
+                raise RuntimeError("Handshake failed")
+        elapsed = time.perf_counter() - start
+    finally:
+        for initiator in initiators:
+            daemon1.disconnect_client(initiator, quit=True)
+        for receiver in receivers:
+            daemon2.disconnect_client(receiver, quit=True)
+    return count / elapsed
+
+
+def open_chat(daemon1: Daemon, daemon2: Daemon) -> tuple:
+    '''
+    Started chat from alice on daemon1 to bob on daemon2, returns (alice, bob).
+    '''
+    alice, bob = client("alice"), client("bob")
+    daemon1.clients["alice"] = alice
+    daemon2.clients["bob"] = bob
+    if not daemon1.begin_handshake(daemon1.open_session(RECEIVER_IP, 7777, alice, "bob")).result(timeout=TIMEOUT):
+        raise RuntimeError("Handshake failed")
+    daemon2.handle_client_chat_decision("ACCEPT", bob)
+    deadline = time.monotonic() + TIMEOUT
+    while alice["session"].state != "started":
+        if time.monotonic() > deadline:
+            raise RuntimeError("Chat was not started")
+        time.sleep(0.001)
+    return alice, bob
+
+
+def messages_per_second(daemon1: Daemon, daemon2: Daemon, session, count: int, size: int) -> float:
+    '''
+    Send count messages back to back and wait until daemon2 delivered the last one.
+    '''
+    received = [0]
+    done = threading.Event()
+    def deliver(session, sender, message):
+        received[0] += 1
+        if received[0] == count:
+            done.set()
+    daemon2.forward_message_to_client = deliver
+
+    message = "x" * size
+    start = time.perf_counter()
+    for _ in range(count):
+        daemon1.retransmit_message_to_other_daemon(session, message)
+    if not done.wait(TIMEOUT):
+        raise RuntimeError(f"Only {received[0]} of {count} messages delivered")
+    return count / (time.perf_counter() - start)
+
+
+def latencies(daemon1: Daemon, daemon2: Daemon, session, count: int, size: int) -> list:
+    '''
+    One way latency of count messages sent one at a time, from the send call to the delivery to the client,
+    in seconds. Both daemons run in this process, so both ends read the same clock.
+    '''
+    sent = [0.0]
+    samples = []
+    delivered = threading.Event()
+    def deliver(session, sender, message):
+        samples.append(time.perf_counter() - sent[0])
+        delivered.set()
+    daemon2.forward_message_to_client = deliver
+
+    message = "x" * size
+    for _ in range(count):
+        delivered.clear()
+        sent[0] = time.perf_counter()
+        daemon1.retransmit_message_to_other_daemon(session, message)
+        if not delivered.wait(TIMEOUT):
+            raise RuntimeError(f"Message {len(samples)} not delivered")
+    return samples
+
+
+def percentile(values: list, fraction: float) -> float:
+    '''
+    Nearest rank percentile of sorted values.
+    '''
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(quick: bool = False) -> dict:
+    '''
+    Handshake rate, message rate and latency between two daemons over loopback.
+    '''
+    handshakes = 200 if quick else 2000
+    messages = 2000 if quick else 20000
+    samples = 1000 if quick else 10000
+    # rates are the median of a few runs, loopback timings are noisy
+    runs = 3 if quick else 5
+    daemons, threads = start_daemons()
+    try:
+        daemon1, daemon2 = daemons
+        rate = statistics.median(handshakes_per_second(daemon1, daemon2, handshakes, concurrency=100) for _ in range(runs))
+        alice, _ = open_chat(daemon1, daemon2)
+        throughput = statistics.median(messages_per_second(daemon1, daemon2, alice["session"], messages, 64) for _ in range(runs))
+        latency = sorted(latencies(daemon1, daemon2, alice["session"], samples, 64))
+    finally:
+        stop_daemons(daemons, threads)
+    return {
+        "daemon.handshakes_per_s": metric(rate, "1/s", "higher"),
+        "daemon.messages_per_s": metric(throughput, "1/s", "higher"),
+        "daemon.latency_p50_us": metric(percentile(latency, 0.50) * 1e6, "us", "lower"),
+        "daemon.latency_p99_us": metric(percentile(latency, 0.99) * 1e6, "us", "lower"),
+        "daemon.latency_p999_us": metric(percentile(latency, 0.999) * 1e6, "us", "lower"),
+    }
@@ -0,0 +1,40 @@
+import time
+import simp_framing
+from simp_simulator import SimNetwork, SimClient
+from benchmarks.results import metric
+
+# the same network every run: what changes between two runs is the protocol, not the luck
+SEED = 1
+CONDITIONS = {"loss": 0.05, "delay": 0.01, "jitter": 0.005, "duplicate": 0.01, "reorder": 0.02}
+
+
+def run(quick: bool = False) -> dict:
+    '''
+    One chat on a simulated lossy network, on virtual time. The virtual seconds and the datagrams it takes
+    to deliver every message are exact, any change of them comes from the protocol. Events per second of wall
+    time is the cost of the daemon handlers.
+    '''
+    messages = 200 if quick else 2000
+    started = time.perf_counter()
+    with SimNetwork(seed=SEED, **CONDITIONS) as network:
+        alice = SimClient(network.daemon("127.0.0.1"), "alice")
+        bob = SimClient(network.daemon("127.0.0.2"), "bob")
+        alice.send(simp_framing.START_CHAT, "127.0.0.2 bob")
+        network.run_until(lambda: bob.notifications(b"Chat request from"), timeout=60.0)
+        bob.send(simp_framing.CHAT_DECISION, "ACCEPT")
+        network.run_until(lambda: alice.notifications(b"SUCCESS - Chat started"), timeout=60.0)
+        start = network.clock.now
+        sent = network.stats["sent"]
+        for i in range(messages):
+            alice.send(simp_framing.MESSAGE, f"message {i}")
+        if not network.run_until(lambda: len(bob.notifications(b"Message from alice")) >= messages, timeout=3600.0):
+            raise RuntimeError("Simulated chat did not deliver every message")
+        elapsed = network.clock.now - start
+        datagrams = network.stats["sent"] - sent
+        events = network.clock.events
+    wall = time.perf_counter() - started
+    return {
+        "sim.chat_virtual_s": metric(elapsed, "s", "lower"),
+        "sim.datagrams_per_message": metric(datagrams / messages, "1", "lower"),
+        "sim.events_per_s": metric(events / wall, "1/s", "higher"),
+    }
@@ -0,0 +1,47 @@
+import json
+import platform
+import time
+
+
+def metric(value: float, unit: str, better: str) -> dict:
+    '''
+    One measured value, better is "higher" (rates) or "lower" (times).
+    '''
+    return {"value": round(value, 3), "unit": unit, "better": better}
+
+
+def report(metrics: dict, quick: bool) -> dict:
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "quick": quick,
+        "metrics": metrics,
+    }
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(results: dict, path: str):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.10) -> list:
+    '''
+    Compare every metric found in both reports: [(name, baseline value, value, relative change, regressed)].
+    A metric regressed when it got worse by more than tolerance (0.10 is 10%).
+    '''
+    rows = []
+    for name, base in sorted(baseline["metrics"].items()):
+        current = results["metrics"].get(name)
+        if current is None or not base["value"]:
+            continue
+        change = (current["value"] - base["value"]) / base["value"]
+        worse = -change if base["better"] == "higher" else change
+        rows.append((name, base["value"], current["value"], change, worse > tolerance))
+    return rows
@@ -1,12 +1,80 @@
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+
+# below DEBUG, used for per packet trace points
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
+# records are handed to a queue, a background listener thread does the blocking stderr write
+_log_queue = queue.SimpleQueue()
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
+_listener = logging.handlers.QueueListener(_log_queue, _stream_handler)
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+# message is merged with its args in the caller thread, the listener applies the real format
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))
 
 logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s [%(levelname)s] %(message)s",
+    level=os.environ.get("SIMP_LOG_LEVEL", "INFO").upper(),
     handlers=[
         # logging.FileHandler("simp_daemon.log"),
-        logging.StreamHandler() 
+        _queue_handler
     ]
 )
+_listener.start()
+atexit.register(_listener.stop)
+
+logger = logging.getLogger("SIMPDaemon")
+
+
+def get_logger(subsystem: str) -> logging.Logger:
+    '''
+    Logger for one subsystem (e.g. "daemon", "datagram"), its level can be set on its own.
+    '''
+    return logger.getChild(subsystem)
+
+
+def set_level(subsystem: str, level):
+    '''
+    Set verbosity of one subsystem, level can be a name ("TRACE", "INFO") or a number.
+    '''
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    get_logger(subsystem).setLevel(level)
+
+
+def configure_levels(spec: str):
+    '''
+    Apply per subsystem levels from a spec like "datagram=TRACE,daemon=DEBUG".
+    '''
+    for item in spec.split(","):
+        if "=" in item:
+            subsystem, level = item.split("=", 1)
+            set_level(subsystem.strip(), level.strip())
+
+
+class TracePoint:
+    '''
+    Level guarded, lazily formatted log call. Test it before building any argument:
+
+        if trace: trace("Received datagram from %s: %s", address, datagram)
+
+    When the level is disabled this costs one cached isEnabledFor lookup and nothing is formatted.
+    '''
+    __slots__ = ("log", "level")
+
+    def __init__(self, log: logging.Logger, level: int = TRACE) -> None:
+        self.log = log
+        self.level = level
+
+    def __bool__(self):
+        return self.log.isEnabledFor(self.level)
+
+    def __call__(self, msg: str, *args):
+        self.log.log(self.level, msg, *args)
+
 
-logger = logging.getLogger("SIMPDaemon")
\ No newline at end of file
+configure_levels(os.environ.get("SIMP_LOG_LEVELS", ""))
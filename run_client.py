@@ -1,10 +1,144 @@
-from simp_client import Client
+import asyncio
+import sys
+from simp_async_client import AsyncClient
 
-def main():
-    daemon_ip = input("Enter the IP address of the daemon: ")
+# what is shown of each event, the others are printed as the daemon wrote them
+FORMATS = {
+    "message": lambda event: f"Message from {event.sender}: {event.text}",
+    "stored_message": lambda event: f"Stored message from {event.sender}: {event.text}",
+    "group_message": lambda event: f"[{event.group}] {event.sender}: {event.text}",
+}
+
+
+async def ask(prompt: str = "") -> str:
+    # input() blocks, it runs in a thread so the events keep coming meanwhile
+    return (await asyncio.to_thread(input, prompt)).strip()
+
+
+def show(event):
+    print(FORMATS.get(event.kind, lambda event: event.text.strip())(event), flush=True)
+
+
+async def print_events(client: AsyncClient, until: tuple):
+    '''
+    Print the events of the client until one of the kinds in until, which is returned.
+    '''
+    async for event in client:
+        show(event)
+        if event.kind in until:
+            return event
+    return None
+
+
+async def chat(client: AsyncClient):
+    '''
+    Every line typed is sent, the messages of the other user are printed as they come. 'quit' ends the chat.
+    '''
+    print("Chat started, type your messages or 'quit' to end it.")
+    reader = asyncio.create_task(print_events(client, ("chat_ended", "declined")))
+    # not after a quit, that cancels it
+    reader.add_done_callback(lambda task: task.cancelled() or print("The chat ended, press enter to go back to the menu.", flush=True))
+    while not reader.done():
+        line = await ask()
+        if reader.done():
+            break
+        if line.lower() == "quit":
+            # the daemon ends the chat with the connection
+            await client.quit()
+            sys.exit(0)
+        if line:
+            await client.send(line)
+
+
+async def start_chat(client: AsyncClient):
+    target_ip = await ask("Enter the IP address of the target daemon: ")
+    if not target_ip:
+        print("Target IP cannot be empty.")
+        return
+    # a daemon can host several users, name the one to chat with (empty for a daemon with a single user)
+    target_user = await ask("Enter the username on the target daemon (optional): ")
+    print("Waiting for the other user to accept...")
+    # the handshake notification comes before the answer
+    reader = asyncio.create_task(print_events(client, ()))
+    started = await client.start_chat(target_ip, target_user or None)
+    reader.cancel()
+    if started:
+        await chat(client)
+    else:
+        print("Chat declined or request timed out.")
+
+
+async def wait_for_chat(client: AsyncClient):
+    print("Waiting for an incoming chat request...")
+    event = await print_events(client, ("chat_request",))
+    if event is None:
+        return
+    answer = await ask(f"Do you want to accept the chat request from {event.peer} ? (y/n): ")
+    if answer.lower() == "y" and await client.accept():
+        await chat(client)
+    elif answer.lower() != "y":
+        await client.decline()
+
+
+async def show_history(client: AsyncClient):
+    words = await ask("Search for (empty for the last messages): ")
+    try:
+        lines = await client.history(f"search {words}" if words else "last")
+    except ValueError as e:
+        print(e)
+        return
+    print("\n".join(lines) if lines else "No messages.")
+
+
+async def group_chat(client: AsyncClient):
+    host_ip = await ask("Enter the IP address of the daemon hosting the group: ")
+    name = await ask("Enter the group name: ")
+    if not await client.join_group(host_ip, name):
+        print(f"Could not join group {name}.")
+        return
+    print(f"Joined group {name}, type your messages or 'quit' to leave.")
+    reader = asyncio.create_task(print_events(client, ("group_ended",)))
+    while not reader.done():
+        line = await ask()
+        if reader.done():
+            print("The group ended.")
+            break
+        if line.lower() == "quit":
+            reader.cancel()
+            await client.leave_group()
+            break
+        if line:
+            await client.say(line)
+
+
+async def main():
+    daemon_ip = await ask("Enter the IP address of the daemon: ")
+    try:
+        client = await AsyncClient.connect(daemon_ip)
+    except OSError as e:
+        print(f"Failed to connect to daemon: {e}")
+        sys.exit(1)
+    print(f"Connected to Daemon at {daemon_ip}:7778")
+    username = await ask("Enter your username: ")
+    if not username or not await client.set_username(username):
+        print("Failed to set username, please restart the client.")
+        sys.exit(1)
+
+    actions = {"1": start_chat, "2": wait_for_chat, "3": show_history, "4": group_chat}
+    while not client.closed:
+        print("\nMain Menu:\n1. Start Chat\n2. Wait for Chat\n3. History\n4. Group Chat\nq. Quit")
+        choice = await ask("Enter your choice: ")
+        if choice.lower() == "q":
+            break
+        if choice in actions:
+            await actions[choice](client)
+        else:
+            print("Invalid choice. Please try again.")
+    await client.quit()
 
-    client = Client(daemon_ip=daemon_ip)
-    client.run()
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    except (KeyboardInterrupt, EOFError):
+        pass
@@ -1,10 +1,52 @@
+import sys
 import threading
 import time
 from simp_daemon import Daemon
+from simp_async_daemon import AsyncDaemon
+from simp_batch import BATCH_DELAY
+from simp_compress import DEFAULT_CODECS
+from simp_workers import WorkerPool
 
 def main():
     daemon_ip = input("Enter the IP address of the daemon: ")
-    daemon = Daemon(ip=daemon_ip)
+    # python run_daemon.py --async runs the asyncio engine
+    engine = AsyncDaemon if "--async" in sys.argv else Daemon
+    # --batch coalesces bursts of small messages into fewer datagrams
+    # --lzma also offers lzma (preferred over zlib), --no-compress sends every payload raw
+    compression = () if "--no-compress" in sys.argv else ("lzma",) + DEFAULT_CODECS if "--lzma" in sys.argv else DEFAULT_CODECS
+    options = {"batch_delay": BATCH_DELAY if "--batch" in sys.argv else 0.0, "compression": compression}
+    # --metrics-file <path> rewrites a Prometheus text snapshot every few seconds,
+    # --metrics-socket <host:port|unix:path> serves it to whoever connects
+    # --outbox <dir> keeps messages for disconnected clients in segment files that survive a restart
+    # --history <dir> keeps the chat history, --no-search-index leaves out the word index
+    options["history_words"] = "--no-search-index" not in sys.argv
+    # --keepalive <seconds> probes a silent peer daemon after that long, 0 never does
+    if "--keepalive" in sys.argv:
+        value = sys.argv[sys.argv.index("--keepalive") + 1:][:1]
+        if value:
+            options["keepalive"] = float(value[0])
+    # --neighbors <ip,ip,...> are the daemons we reach directly and trust: routes to the others are learned from
+    # their announcements, and only they may relay datagrams to us
+    if "--neighbors" in sys.argv:
+        value = sys.argv[sys.argv.index("--neighbors") + 1:][:1]
+        if value:
+            options["neighbors"] = [ip.strip() for ip in value[0].split(",") if ip.strip()]
+    # --syn-rate <n> and --peer-rate <n> are the SYNs and datagrams per second a source ip may send, 0 for no limit
+    for flag, option in (("--syn-rate", "syn_rate"), ("--peer-rate", "peer_rate")):
+        value = sys.argv[sys.argv.index(flag) + 1:][:1] if flag in sys.argv else None
+        if value:
+            options[option] = float(value[0])
+    for flag, option in (("--metrics-file", "metrics_file"), ("--metrics-socket", "metrics_socket"), ("--outbox", "outbox_dir"),
+                         ("--history", "history_dir")):
+        value = sys.argv[sys.argv.index(flag) + 1:][:1] if flag in sys.argv else None
+        if value:
+            options[option] = value[0]
+    if "--workers" in sys.argv:
+        # --workers [n] runs n worker processes sharing the ports, one per core without n
+        count = sys.argv[sys.argv.index("--workers") + 1:][:1]
+        daemon = WorkerPool(daemon_ip, int(count[0]) if count and count[0].isdigit() else None, **options)
+    else:
+        daemon = engine(ip=daemon_ip, **options)
 
     daemon_thread = threading.Thread(target=daemon.start, daemon=True)
     daemon_thread.start()
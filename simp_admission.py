@@ -0,0 +1,167 @@
+import hashlib
+import hmac
+import secrets
+import struct
+import threading
+from collections import OrderedDict
+from simp_timers import monotonic
+
+# SYNs per second a source ip may send, and how many may come at once
+SYN_RATE = 5.0
+SYN_BURST = 10
+# datagrams per second a source ip may send, and the seconds of it that may come at once: what a peer has in flight,
+# retransmissions and a full window of fragments included. Anything over it is dropped before it is parsed.
+PEER_RATE = 2000.0
+PEER_BURST_SECONDS = 2.0
+# sources with a bucket, the least recently seen are dropped first (a full bucket again if they come back)
+MAX_SOURCES = 65536
+# incoming handshakes waiting for their ACK, past that SYNs are answered statelessly with a cookie
+MAX_HALF_OPEN = 1024
+# seconds an incoming handshake may wait for its ACK
+HALF_OPEN_TIMEOUT = 30.0
+# seconds a cookie is valid after its SYN+ACK left
+COOKIE_LIFETIME = 10
+
+# what a cookie remembers of the SYN: time, our session id, the peer's, window, flags, then
+# codec, target user and FROM in utf-8 each after its length, followed by the MAC
+COOKIE_STATE = struct.Struct("!IHHHB")
+COOKIE_NAME_LENGTH = struct.Struct("!H")
+COOKIE_MAC_SIZE = 16
+COOKIE_BATCH = 0x01
+COOKIE_KEEPALIVE = 0x02
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, now: float) -> None:
+        self.tokens = tokens
+        self.updated = now
+
+
+class RateLimiter:
+    '''
+    One token bucket per key (a source ip), refilled at rate tokens per second up to burst.
+    allow() is the whole per datagram cost: a dict lookup, a multiply and a compare under one lock.
+    The table keeps the capacity most recently seen keys, so spoofed sources cannot grow it.
+    '''
+    def __init__(self, rate: float, burst: float, capacity: int = MAX_SOURCES) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.capacity = capacity
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def allow(self, key, cost: float = 1.0, now: float = None) -> bool:
+        now = monotonic() if now is None else now
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(self.burst, now)
+                if len(self.buckets) > self.capacity:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+                bucket.updated = now
+            if bucket.tokens < cost:
+                return False
+            bucket.tokens -= cost
+            return True
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+class HalfOpenTable:
+    '''
+    Incoming handshakes we answered and wait the ACK of, by session key, at most capacity of them.
+    '''
+    def __init__(self, capacity: int = MAX_HALF_OPEN) -> None:
+        self.capacity = capacity
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def add(self, session) -> bool:
+        '''
+        Track a half-open session, False if the table is full.
+        '''
+        with self.lock:
+            if len(self.sessions) >= self.capacity:
+                return False
+            self.sessions[session.key] = session
+            return True
+
+    def remove(self, session) -> bool:
+        with self.lock:
+            if self.sessions.get(session.key) is session:
+                del self.sessions[session.key]
+                return True
+            return False
+
+    def full(self) -> bool:
+        return len(self.sessions) >= self.capacity
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+class CookieJar:
+    '''
+    SYN cookies: when the half-open table is full, the SYN+ACK carries everything the session needs, with a MAC
+    bound to the peer's address, and nothing is kept. The session is created when an ACK brings the cookie back.
+    '''
+    def __init__(self, lifetime: int = COOKIE_LIFETIME) -> None:
+        self.secret = secrets.token_bytes(32)
+        self.lifetime = lifetime
+
+    def mac(self, peer: tuple, state: bytes) -> bytes:
+        message = f"{peer[0]}:{peer[1]}".encode("ascii") + state
+        return hmac.new(self.secret, message, hashlib.sha256).digest()[:COOKIE_MAC_SIZE]
+
+    def make(self, peer: tuple, state: dict, now: float = None) -> str:
+        '''
+        Cookie for state: {"sid", "remote_id", "window", "batch", "keepalive", "codec", "user", "from"}.
+        '''
+        now = monotonic() if now is None else now
+        flags = (COOKIE_BATCH if state["batch"] else 0) | (COOKIE_KEEPALIVE if state["keepalive"] else 0)
+        packed = bytearray(COOKIE_STATE.pack(int(now) & 0xFFFFFFFF, state["sid"], state["remote_id"], state["window"], flags))
+        for name in (state["codec"] or "", state["user"], state["from"] or ""):
+            encoded = name.encode("utf-8")
+            packed += COOKIE_NAME_LENGTH.pack(len(encoded)) + encoded
+        return (packed + self.mac(peer, bytes(packed))).hex()
+
+    def open(self, peer: tuple, cookie: str, now: float = None):
+        '''
+        State of a cookie from peer, None if it is malformed, forged, for another address or too old.
+        '''
+        now = monotonic() if now is None else now
+        try:
+            data = bytes.fromhex(cookie)
+        except ValueError:
+            return None
+        if len(data) < COOKIE_STATE.size + COOKIE_MAC_SIZE:
+            return None
+        packed, mac = data[:-COOKIE_MAC_SIZE], data[-COOKIE_MAC_SIZE:]
+        if not hmac.compare_digest(mac, self.mac(peer, packed)):
+            return None
+        issued, sid, remote_id, window, flags = COOKIE_STATE.unpack_from(packed)
+        if not 0 <= (int(now) - issued) & 0xFFFFFFFF <= self.lifetime:
+            return None
+        names = []
+        offset = COOKIE_STATE.size
+        try:
+            for _ in range(3):
+                length, = COOKIE_NAME_LENGTH.unpack_from(packed, offset)
+                offset += COOKIE_NAME_LENGTH.size
+                if offset + length > len(packed):
+                    return None
+                names.append(packed[offset:offset + length].decode("utf-8"))
+                offset += length
+        except (struct.error, UnicodeDecodeError):
+            return None
+        if offset != len(packed):
+            return None
+        codec, user, sender = names
+        return {"sid": sid, "remote_id": remote_id, "window": window, "batch": bool(flags & COOKIE_BATCH),
+                "keepalive": bool(flags & COOKIE_KEEPALIVE), "codec": codec or None, "user": user, "from": sender or None}
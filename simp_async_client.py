@@ -0,0 +1,272 @@
+import asyncio
+from collections import deque
+import simp_framing
+from simp_framing import FrameParser, encode_frame
+from logger import get_logger
+
+logger = get_logger("client")
+
+# notifications a client keeps for its reader before it stops reading the socket, the daemon then
+# disconnects it once its own queue for the client is full (simp_framing.MAX_QUEUED)
+MAX_EVENTS = 10000
+
+# replies to the commands, the other notifications are events for the reader
+USERNAME_REPLIES = ("ok", "failed")
+CHAT_REPLIES = ("chat_started", "declined", "error")
+GROUP_REPLIES = ("group_joined", "failed")
+
+
+class ChatEvent:
+    '''
+    One notification of the daemon. kind is one of: ok, failed, error, declined, handshake, chat_request,
+    chat_started, message, stored_message, chat_ended, group_joined, group_message, group_left, group_ended,
+    history, stats, notice. sender, peer and group are set when the notification names them, text is the
+    message (or the whole notification).
+    '''
+    __slots__ = ("kind", "text", "sender", "peer", "group")
+
+    def __init__(self, kind: str, text: str, sender: str = None, peer: str = None, group: str = None) -> None:
+        self.kind = kind
+        self.text = text
+        self.sender = sender
+        self.peer = peer
+        self.group = group
+
+    def __eq__(self, other):
+        return isinstance(other, ChatEvent) and all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__[1:] if getattr(self, name) is not None)
+        return f"ChatEvent({self.kind}, {fields})"
+
+
+def parse_notification(text: str) -> ChatEvent:
+    '''
+    Event of a notification, see simp_daemon for the texts. Unknown texts are a notice.
+    '''
+    if text == "SUCCESS":
+        return ChatEvent("ok", text)
+    if text.startswith("SUCCESS - Chat started"):
+        return ChatEvent("chat_started", text)
+    if text.startswith("SUCCESS - Joined group "):
+        return ChatEvent("group_joined", text, group=text[len("SUCCESS - Joined group "):])
+    if text.startswith("Message from ") or text.startswith("Stored message from "):
+        kind = "message" if text.startswith("Message") else "stored_message"
+        sender, _, message = text.split(" from ", 1)[1].partition(": ")
+        return ChatEvent(kind, message, sender=sender)
+    if text.startswith("Group message from "):
+        header, _, message = text[len("Group message from "):].partition(": ")
+        sender, _, group = header.rpartition(" in ")
+        return ChatEvent("group_message", message, sender=sender, group=group)
+    if text.startswith("Chat request from: "):
+        # "<ip>" or "<ip> (<username>)"
+        peer, _, user = text[len("Chat request from: "):].partition(" (")
+        return ChatEvent("chat_request", text, sender=user[:-1] or None, peer=peer)
+    if text.startswith("FAILED"):
+        return ChatEvent("failed", text)
+    if text.startswith("DECLINED"):
+        return ChatEvent("declined", text)
+    if text.startswith("CHAT_ENDED"):
+        return ChatEvent("chat_ended", text)
+    if text.startswith("Transport handshake OK"):
+        return ChatEvent("handshake", text)
+    if text.startswith("LEFT group "):
+        return ChatEvent("group_left", text, group=text[len("LEFT group "):])
+    if text.startswith("GROUP_ENDED "):
+        return ChatEvent("group_ended", text, group=text[len("GROUP_ENDED "):])
+    if text.startswith("HISTORY"):
+        return ChatEvent("history", text)
+    if text.startswith("# "):
+        return ChatEvent("stats", text)
+    if text.startswith(("User already in another chat", "Cannot send message", "No pending chat request", "Set a username first")):
+        return ChatEvent("error", text.strip())
+    return ChatEvent("notice", text)
+
+
+class AsyncClient:
+    '''
+    Client of a daemon for programs: bots, services, load tests. No input() and no print(), every call is a
+    coroutine and any number of clients can share one event loop, each costs a connection and a reader task.
+    Commands that have a reply wait for it and return the outcome. Everything else the daemon sends comes out
+    of the client as ChatEvents: async for event in client, or next_event().
+    '''
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, max_events: int = MAX_EVENTS) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.parser = FrameParser()
+        self.username = None
+        self.events = asyncio.Queue(max_events)
+        # [(kinds, future)] of the commands waiting for their reply, oldest first
+        self.waiters = deque()
+        self.closed = False
+        self.read_task = asyncio.get_running_loop().create_task(self.read())
+
+    @classmethod
+    async def connect(cls, daemon_ip: str, daemon_port: int = 7778, username: str = None, **kwargs) -> "AsyncClient":
+        '''
+        Connect to a daemon, and set the username if given. ConnectionError if the daemon refuses it.
+        '''
+        reader, writer = await asyncio.open_connection(daemon_ip, daemon_port)
+        client = cls(reader, writer, **kwargs)
+        if username is not None and not await client.set_username(username):
+            await client.close()
+            raise ConnectionError(f"Username {username!r} refused by the daemon")
+        return client
+
+    async def read(self):
+        '''
+        Reader task: turn the frames of the daemon into events, a reply goes to the command waiting for it.
+        '''
+        try:
+            while True:
+                data = await self.reader.read(65535)
+                if not data:
+                    break
+                for code, payload in self.parser.feed(data):
+                    await self.dispatch(parse_notification(str(payload, "utf-8", "replace")))
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"Connection to the daemon lost: {e}")
+        finally:
+            self.closed = True
+            for _, future in self.waiters:
+                if not future.done():
+                    future.set_exception(ConnectionError("Daemon closed the connection"))
+            self.waiters.clear()
+            # None wakes a reader waiting for events, a full queue has none
+            if not self.events.full():
+                self.events.put_nowait(None)
+
+    async def dispatch(self, event: ChatEvent):
+        for waiter in self.waiters:
+            kinds, future = waiter
+            if event.kind in kinds and not future.done():
+                self.waiters.remove(waiter)
+                future.set_result(event)
+                return
+        await self.events.put(event)
+
+    async def command(self, code: int, payload: str = ""):
+        '''
+        Send one framed command, waits only for the socket buffer to drain.
+        '''
+        if self.closed:
+            raise ConnectionError("Daemon closed the connection")
+        self.writer.write(encode_frame(code, payload))
+        await self.writer.drain()
+
+    async def request(self, code: int, payload: str, kinds: tuple, timeout: float = None) -> ChatEvent:
+        '''
+        Send a command and wait for the first notification of one of kinds, its reply.
+        '''
+        future = asyncio.get_running_loop().create_future()
+        waiter = (kinds, future)
+        self.waiters.append(waiter)
+        try:
+            await self.command(code, payload)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+    async def set_username(self, username: str, timeout: float = None) -> bool:
+        reply = await self.request(simp_framing.USERNAME, username, USERNAME_REPLIES, timeout)
+        if reply.kind == "ok":
+            self.username = username
+        return reply.kind == "ok"
+
+    async def start_chat(self, daemon_ip: str, username: str = None, timeout: float = None) -> bool:
+        '''
+        Ask a user on another daemon for a chat, True once they accepted, False if declined or it failed.
+        '''
+        target = f"{daemon_ip} {username}" if username else daemon_ip
+        reply = await self.request(simp_framing.START_CHAT, target, CHAT_REPLIES, timeout)
+        return reply.kind == "chat_started"
+
+    async def accept(self, timeout: float = None) -> bool:
+        '''
+        Accept the pending chat request, see the chat_request events.
+        '''
+        reply = await self.request(simp_framing.CHAT_DECISION, "ACCEPT", CHAT_REPLIES, timeout)
+        return reply.kind == "chat_started"
+
+    async def decline(self, timeout: float = None):
+        await self.request(simp_framing.CHAT_DECISION, "DECLINE", CHAT_REPLIES, timeout)
+
+    async def send(self, message: str):
+        '''
+        Send a chat message, nothing is waited for: the daemon only answers with an error event.
+        '''
+        await self.command(simp_framing.MESSAGE, message)
+
+    async def history(self, query: str = "last", timeout: float = None) -> list:
+        '''
+        Lines of a history query, "last [n] ..." or "search [n] ... <words>". ValueError if the daemon refused it.
+        '''
+        reply = await self.request(simp_framing.HISTORY, query, ("history", "failed"), timeout)
+        if reply.kind == "failed":
+            raise ValueError(reply.text)
+        return reply.text.split("\n")[1:]
+
+    async def stats(self, timeout: float = None) -> str:
+        return (await self.request(simp_framing.STATS, "", ("stats",), timeout)).text
+
+    async def join_group(self, daemon_ip: str, name: str, timeout: float = None) -> bool:
+        reply = await self.request(simp_framing.GROUP, f"join {daemon_ip} {name}", GROUP_REPLIES, timeout)
+        return reply.kind == "group_joined"
+
+    async def say(self, message: str):
+        await self.command(simp_framing.GROUP, f"say {message}")
+
+    async def leave_group(self, timeout: float = None):
+        await self.request(simp_framing.GROUP, "leave", ("group_left", "failed"), timeout)
+
+    async def next_event(self, timeout: float = None):
+        '''
+        Next event, None once the connection is closed. asyncio.TimeoutError after timeout seconds.
+        '''
+        if self.closed and self.events.empty():
+            return None
+        event = await asyncio.wait_for(self.events.get(), timeout)
+        if event is None:
+            # for the next readers too
+            self.events.put_nowait(None)
+        return event
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> ChatEvent:
+        event = await self.next_event()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    async def quit(self):
+        '''
+        End the chat and the connection, the daemon sends a FIN to the peer.
+        '''
+        if not self.closed:
+            try:
+                await self.command(simp_framing.QUIT)
+            except ConnectionError:
+                pass
+        await self.close()
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+        # the reader task may wait for room in a full queue, what it holds is dropped
+        self.read_task.cancel()
+        try:
+            await self.read_task
+        except asyncio.CancelledError:
+            pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.quit()
@@ -0,0 +1,154 @@
+import asyncio
+from simp_daemon import Daemon, logger, HANDSHAKE_TIMEOUT, RECV_BUFFER_SIZE
+from simp_framing import FrameParser, encode_frame, NOTIFY, MAX_QUEUED
+
+
+class LoopTimers:
+    '''
+    Same schedule() interface as TimerWheel, backed by the event loop's own timer heap.
+    The returned asyncio.TimerHandle has cancel() like a wheel Timer.
+    '''
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+
+    def schedule(self, delay: float, callback, *args):
+        return self.loop.call_later(delay, callback, *args)
+
+
+class StreamConnection:
+    '''
+    Wraps a StreamWriter so the Daemon handlers can use it like a client socket.
+    sendall() only buffers the data as one NOTIFY frame, the event loop flushes it. The writer buffer is
+    the client's outbound queue, a client that lets it grow past max_queued bytes is disconnected.
+    '''
+    def __init__(self, writer: asyncio.StreamWriter, max_queued: int = MAX_QUEUED) -> None:
+        self.writer = writer
+        self.max_queued = max_queued
+
+    def sendall(self, data: bytes):
+        if self.writer.is_closing():
+            return
+        if self.writer.transport.get_write_buffer_size() > self.max_queued:
+            logger.warning(f"Client {self.writer.get_extra_info('peername')} is not reading, disconnecting it.")
+            self.writer.transport.abort()
+            return
+        self.writer.write(encode_frame(NOTIFY, data))
+
+    @property
+    def closed(self) -> bool:
+        return self.writer.is_closing()
+
+    def close(self):
+        self.writer.close()
+
+
+class DaemonProtocol(asyncio.DatagramProtocol):
+    '''
+    UDP endpoint on port 7777, hands every datagram to the daemon handlers.
+    '''
+    def __init__(self, daemon) -> None:
+        self.daemon = daemon
+
+    def datagram_received(self, data: bytes, address: tuple):
+        self.daemon.handle_incoming_datagram_from_daemon(data, address)
+
+    def error_received(self, exc: Exception):
+        logger.error(f"Daemon UDP endpoint error: {exc}")
+
+
+class AsyncDaemon(Daemon):
+    '''
+    Daemon engine running on one asyncio event loop: no listener threads, no socket timeouts, no thread per client.
+    Control and chat datagrams go through the same handlers as Daemon, only the I/O is replaced.
+    '''
+    def __init__(self, ip: str, port: int = 7777, **kwargs) -> None:
+        super().__init__(ip, port, **kwargs)
+        self.loop = None
+        self.transport = None
+        self.server = None
+        self.stopped = None
+
+    def start(self):
+        '''
+        Run the daemon until stop() is called, blocks the calling thread like Daemon.start.
+        '''
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            self.logger.info("Daemon shutting down via KeyboardInterrupt.")
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.timers = LoopTimers(self.loop)
+        self.reassembler.timers = self.timers
+
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: DaemonProtocol(self), local_addr=(self.ip_address, 7777))
+        self.server = await asyncio.start_server(self.handle_client, self.ip_address, 7778)
+        self.logger.info(f'Async daemon started on {self.ip_address}:{self.port}')
+        self.start_metrics_export()
+        self.start_keepalive()
+        self.start_routing()
+        if not self.running:
+            self.stopped.set()
+
+        try:
+            await self.stopped.wait()
+        finally:
+            self.transport.close()
+            self.server.close()
+            await self.server.wait_closed()
+            self.logger.info("Daemon sockets closed.")
+            self.outbox.close()
+            if self.history is not None:
+                self.history.close()
+            self.stop_metrics_export()
+
+    def stop(self):
+        '''
+        Stop the daemon, safe to call from any thread.
+        '''
+        self.running = False
+        if self.loop is not None and self.stopped is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def sendto_daemon(self, data: bytes, ip: str, port: int = 7777):
+        try:
+            self.transport.sendto(data, (ip, port))
+            self.metrics.datagram_sent(data[0], data[1], len(data))
+        except Exception as e:
+            self.logger.error(f"Failed to send datagram to daemon {ip}:{port}: {e}")
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        '''
+        One coroutine per client connection on port 7778, same commands as handle_incoming_command_from_client.
+        '''
+        client_addr = writer.get_extra_info("peername")
+        client = {"conn": StreamConnection(writer), "address": client_addr}
+        self.logger.info(f"Received connection from client {client_addr}")
+        parser = FrameParser()
+        self.metrics.client_connected()
+        try:
+            while True:
+                data = await reader.read(RECV_BUFFER_SIZE)
+                if not data:
+                    self.logger.info(f"Client {client_addr} disconnected.")
+                    break
+                if not self.handle_client_data(parser, data, client):
+                    break
+        except asyncio.CancelledError:
+            # daemon is stopping
+            pass
+        except Exception as e:
+            self.logger.error(f"Error handling commands from client {client_addr}: {e}")
+        finally:
+            self.disconnect_client(client)
+            self.metrics.client_disconnected()
+            self.logger.info(f"Finished handling commands from client {client_addr}.")
+
+    async def run_handshake(self, session, timeout: float = HANDSHAKE_TIMEOUT) -> bool:
+        '''
+        Handshake of an outgoing session as a coroutine, True once the SYN+ACK arrived.
+        '''
+        return await asyncio.wrap_future(self.begin_handshake(session, timeout))
@@ -0,0 +1,45 @@
+import struct
+from simp_fragment import MAX_PAYLOAD
+
+# batched chat payload: records back to back, each one a length and one message
+RECORD = struct.Struct("!H")
+
+# flush delay used when batching is switched on without an explicit delay
+BATCH_DELAY = 0.005
+
+
+def record_size(message) -> int:
+    return RECORD.size + len(message)
+
+
+def fits(message) -> bool:
+    '''
+    Whether a message can go in a batch at all, larger ones are sent on their own (or fragmented).
+    '''
+    return record_size(message) <= MAX_PAYLOAD
+
+
+def pack_records(messages) -> bytes:
+    '''
+    Pack messages into one batched payload, in order.
+    '''
+    return b"".join(RECORD.pack(len(message)) + message for message in messages)
+
+
+def unpack_records(payload) -> list:
+    '''
+    Messages of a batched payload, in order, as memoryview slices. Raises ValueError if a record is truncated.
+    '''
+    view = memoryview(payload)
+    messages = []
+    start = 0
+    while start < len(view):
+        if len(view) - start < RECORD.size:
+            raise ValueError("Truncated batch record header")
+        length, = RECORD.unpack_from(view, start)
+        start += RECORD.size
+        if start + length > len(view):
+            raise ValueError(f"Truncated batch record of {length} bytes")
+        messages.append(view[start:start + length])
+        start += length
+    return messages
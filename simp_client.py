@@ -1,6 +1,12 @@
 import socket
 import sys
-from logger import logger
+import threading
+from collections import deque
+import simp_framing
+from simp_framing import FrameParser, encode_frame
+from logger import get_logger
+
+logger = get_logger("client")
 
 class Client:
     def __init__(self, daemon_ip: str, daemon_port=7778):
@@ -20,6 +26,9 @@ class Client:
         self.is_sender = False
         
         self.daemon_tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # notifications already received from the daemon but not read yet
+        self.parser = FrameParser()
+        self.notifications = deque()
 
     def connect_to_daemon(self):
         '''
@@ -34,6 +43,31 @@ class Client:
             sys.exit(1)
 
 
+    def send_command(self, code: int, payload: str = ""):
+        '''
+        Send one framed command to the daemon, never waits for a reply so commands can be pipelined.
+        '''
+        self.daemon_tcp_socket.sendall(encode_frame(code, payload))
+
+
+    def receive(self) -> str:
+        '''
+        Next notification from the daemon, "" once the daemon closed the connection.
+        '''
+        while not self.notifications:
+            data = self.daemon_tcp_socket.recv(65535)
+            if not data:
+                return ""
+            for code, payload in self.parser.feed(data):
+                notification = str(payload, "utf-8", "replace")
+                if notification.startswith("Stored message from"):
+                    # sent while we were away, replayed by the daemon after the username
+                    print(notification, flush=True)
+                    continue
+                self.notifications.append(notification)
+        return self.notifications.popleft()
+
+
     def send_username(self):
         '''
         Send the username to the daemon, using '1 <username>' format. Wait for response
@@ -42,12 +76,12 @@ class Client:
         if not self.username:
             print("Username cannot be empty. Please restart the client.")
             sys.exit(1)
-        self.daemon_tcp_socket.sendall(f"1 {self.username}".encode("utf-8"))
-        response = self.daemon_tcp_socket.recv(1024).decode("utf-8")
+        self.send_command(simp_framing.USERNAME, self.username)
+        response = self.receive()
         if response == "SUCCESS":
             print("Username sent successfully.")
         else:
-            print("Failed to set username.")
+            print(f"Failed to set username: {response}")
             sys.exit(1)
 
 
@@ -59,6 +93,8 @@ class Client:
             print("\nMain Menu:")
             print("1. Start Chat")
             print("2. Wait for Chat")
+            print("3. History")
+            print("4. Group Chat")
             print("q. Quit")
             choice = input("Enter your choice: ").strip()
 
@@ -66,6 +102,10 @@ class Client:
                 self.start_chat()
             elif choice == "2":
                 self.wait_for_chat()
+            elif choice == "3":
+                self.show_history()
+            elif choice == "4":
+                self.group_chat()
             elif choice.lower() == "q":
                 self.quit()
             else:
@@ -81,10 +121,12 @@ class Client:
             print("Target IP cannot be empty.")
             return
 
-        self.daemon_tcp_socket.sendall(f"2 {target_ip}".encode("utf-8"))
+        # a daemon can host several users, name the one to chat with (empty for a daemon with a single user)
+        target_user = input("Enter the username on the target daemon (optional): ").strip()
+        self.send_command(simp_framing.START_CHAT, f"{target_ip} {target_user}".strip())
 
         while True:
-            response = self.daemon_tcp_socket.recv(1024).decode("utf-8")
+            response = self.receive()
 
             if response.startswith("DECLINED"):
                 print("Chat declined or request timed out. Returning to main menu.")
@@ -121,7 +163,7 @@ class Client:
         '''
         print("Waiting for an incoming chat request...")
         while True:
-            response = self.daemon_tcp_socket.recv(1024).decode("utf-8")
+            response = self.receive()
             if response.startswith("DECLINED"):
                 print("Chat declined or request timed out. Returning to main menu.")
                 break
@@ -149,14 +191,14 @@ class Client:
 
         accept = input(f"Do you want to accept the chat request from {requester_ip} ? (y/n): ").strip().lower()
         if accept == "y":
-            self.daemon_tcp_socket.sendall("3 ACCEPT".encode("utf-8"))
+            self.send_command(simp_framing.CHAT_DECISION, "ACCEPT")
             self.in_chat = True
             self.is_sender = False 
         else:
-            self.daemon_tcp_socket.sendall("3 DECLINE".encode("utf-8"))
+            self.send_command(simp_framing.CHAT_DECISION, "DECLINE")
             self.in_chat = False
 
-        final_response = self.daemon_tcp_socket.recv(1024).decode("utf-8")
+        final_response = self.receive()
 
         if final_response.startswith("SUCCESS"):
             print("Chat accepted. Chat started.")
@@ -181,7 +223,7 @@ class Client:
                 else:
                     self.wait_for_message()
         except KeyboardInterrupt:
-            self.daemon_tcp_socket.sendall("0".encode("utf-8"))
+            self.send_command(simp_framing.QUIT)
             self.in_chat = False
 
 
@@ -191,7 +233,7 @@ class Client:
         '''
         print("Waiting for a reply...", flush=True)
         try:
-            response = self.daemon_tcp_socket.recv(1024).decode("utf-8", errors="replace")
+            response = self.receive()
             if not response or response.startswith("CHAT_ENDED"):
                 print("Other user ended the chat. Returning to main menu.")
                 self.in_chat = False
@@ -211,21 +253,76 @@ class Client:
         '''
         message = input("Enter your message (or 'quit' to end chat): ").strip()
         if message.lower() == "quit":
-            self.daemon_tcp_socket.sendall("0".encode("utf-8"))
+            self.send_command(simp_framing.QUIT)
             print("Exiting chat...")
             self.in_chat = False
             return
         if message:
-            self.daemon_tcp_socket.sendall(f"4 {message}".encode("utf-8"))
+            self.send_command(simp_framing.MESSAGE, message)
             self.is_sender = False
         self.is_sender = False
 
 
+    def show_history(self):
+        '''
+        Print the last messages of our chats, or those holding some words.
+        '''
+        words = input("Search for (empty for the last messages): ").strip()
+        self.send_command(simp_framing.HISTORY, f"search {words}" if words else "last")
+        response = self.receive()
+        if response.startswith("HISTORY"):
+            lines = response.split("\n")[1:]
+            print("\n".join(lines) if lines else "No messages.")
+        else:
+            print(response)
+
+
+    def group_chat(self):
+        '''
+        Join a group, the daemon hosting it creates it if needed, and chat in it until 'quit'.
+        The messages of the group are printed as they come while we type.
+        '''
+        host_ip = input("Enter the IP address of the daemon hosting the group: ").strip()
+        name = input("Enter the group name: ").strip()
+        self.send_command(simp_framing.GROUP, f"join {host_ip} {name}")
+        response = self.receive()
+        if not response.startswith("SUCCESS"):
+            print(response or "Daemon closed the connection.")
+            return
+        print(f"Joined group {name}, type your messages or 'quit' to leave.")
+        reader = threading.Thread(target=self.print_group_messages, daemon=True)
+        reader.start()
+        while reader.is_alive():
+            message = input().strip()
+            if not reader.is_alive():
+                break
+            if message.lower() == "quit":
+                self.send_command(simp_framing.GROUP, "leave")
+                break
+            if message:
+                self.send_command(simp_framing.GROUP, f"say {message}")
+        reader.join()
+
+
+    def print_group_messages(self):
+        '''
+        Reader thread of a group chat, until we left the group or it ended.
+        '''
+        while True:
+            response = self.receive()
+            if not response or response.startswith("LEFT group"):
+                return
+            print(response, flush=True)
+            if response.startswith("GROUP_ENDED"):
+                print("The group ended, press enter to go back to the menu.", flush=True)
+                return
+
+
     def quit(self):
         '''
         Quit the client
         '''
-        self.daemon_tcp_socket.sendall("0".encode("utf-8"))
+        self.send_command(simp_framing.QUIT)
         self.daemon_tcp_socket.close()
         sys.exit(0)
 
@@ -0,0 +1,93 @@
+import zlib
+
+try:
+    import lzma
+except ImportError:  # python built without liblzma
+    lzma = None
+
+# payloads shorter than this are sent raw, compressing them costs more than it saves
+COMPRESS_THRESHOLD = 64
+
+# largest message a compressed payload may expand to, same cap as a reassembled message
+MAX_DECOMPRESSED = 1024 * 1024
+
+# preset dictionary shared by both daemons, deflate finds the common chat words in it even in a short message.
+# The most frequent strings go last, they get the shortest distances. Never change it: both peers must agree.
+CHAT_DICTIONARY = (
+    b"https://www. .com .org .net http:// "
+    b"INFO WARNING ERROR DEBUG CRITICAL Traceback (most recent call last): File line in "
+    b"error failed failure timeout timed out connection refused reset not found exception "
+    b"status request response server client user message chat started stopped "
+    b"please thanks thank you sorry okay ok sure yes no maybe "
+    b"tomorrow today tonight morning evening later soon now "
+    b"what when where which who why how can could would should will "
+    b"have has had was were are is be been do does did not "
+    b"hello hi hey bye see you good great nice "
+    b"I you he she it we they me my your our their this that there here "
+    b"the and for with from about just like know think "
+)
+
+# raw streams, no container header or checksum: the datagram layer has its own framing
+ZLIB_WBITS = -15
+LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 6, "dict_size": 64 * 1024}] if lzma is not None else None
+
+# what a corrupt payload raises, depending on the codec
+CORRUPT_ERRORS = (zlib.error, EOFError, lzma.LZMAError) if lzma is not None else (zlib.error, EOFError)
+
+# codecs this build can use, in order of preference
+CODECS = ("zlib", "lzma") if lzma is not None else ("zlib",)
+# codecs a daemon offers unless told otherwise, lzma compresses better but is several times slower
+DEFAULT_CODECS = ("zlib",)
+
+
+def negotiate(offer, supported) -> str:
+    '''
+    Codec to use from the peer's COMPRESS option ("zlib,lzma" in a SYN, the chosen one in a SYN+ACK):
+    the first of ours it names, None if there is none in common or the peer did not offer any.
+    '''
+    if not offer:
+        return None
+    offered = {name.strip().lower() for name in offer.split(",")}
+    return next((codec for codec in supported if codec in offered), None)
+
+
+def compress(codec: str, payload) -> bytes:
+    if codec == "zlib":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, ZLIB_WBITS, zdict=CHAT_DICTIONARY)
+        return compressor.compress(payload) + compressor.flush()
+    if codec == "lzma" and lzma is not None:
+        return lzma.compress(payload, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+def maybe_compress(codec: str, payload, threshold: int = COMPRESS_THRESHOLD):
+    '''
+    Compressed payload, or None if there is no codec, the payload is below threshold or does not shrink.
+    '''
+    if codec is None or len(payload) < threshold:
+        return None
+    compressed = compress(codec, payload)
+    return compressed if len(compressed) < len(payload) else None
+
+
+def decompress(codec: str, payload, max_size: int = MAX_DECOMPRESSED) -> bytes:
+    '''
+    Original payload. Raises ValueError for a corrupt payload or one that expands past max_size,
+    a peer cannot make us allocate more than that with a small datagram.
+    '''
+    try:
+        if codec == "zlib":
+            decompressor = zlib.decompressobj(ZLIB_WBITS, zdict=CHAT_DICTIONARY)
+            data = decompressor.decompress(payload, max_size)
+            if decompressor.unconsumed_tail or not decompressor.eof:
+                raise ValueError(f"Compressed payload is truncated or larger than {max_size} bytes")
+            return data
+        if codec == "lzma" and lzma is not None:
+            decompressor = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+            data = decompressor.decompress(payload, max_size)
+            if not decompressor.eof:
+                raise ValueError(f"Compressed payload is truncated or larger than {max_size} bytes")
+            return data
+    except CORRUPT_ERRORS as e:
+        raise ValueError(f"Corrupt compressed payload: {e}")
+    raise ValueError(f"Unknown compression codec: {codec}")
@@ -1,11 +1,44 @@
+import logging
 import socket
 import threading
-from Datagram import Datagram
-from logger import logger
+from collections import deque
+from concurrent.futures import Future
+from Datagram import Datagram, encode_options, decode_options, CHAT_FRAGMENT, CHAT_BATCH, CHAT_COMPRESSED
+import simp_window
+from simp_sessions import Session, SessionTable, LEGACY_SESSION_ID
+from simp_timers import TimerWheel, RttEstimator, monotonic
+from simp_fragment import Reassembler, split_message, MAX_PAYLOAD
+import simp_batch
+import simp_compress
+import simp_framing
+import simp_metrics
+import simp_outbox
+import simp_history
+import simp_liveness
+import simp_resume
+import simp_group
+import simp_relay
+import simp_admission
+from simp_framing import FrameParser, FramedConnection
+from logger import get_logger, TracePoint
 import time
 
+logger = get_logger("daemon")
+# hot path trace points, nothing is formatted unless the level is enabled
+trace = TracePoint(logger)
+debug = TracePoint(logger, logging.DEBUG)
+
+# large enough for any UDP datagram, so nothing is ever truncated
+RECV_BUFFER_SIZE = 65535
+# seconds an outgoing handshake waits for the SYN+ACK
+HANDSHAKE_TIMEOUT = 5
+
 class Daemon:
-    def __init__(self, ip: str, port: int = 7777) -> None:
+    def __init__(self, ip: str, port: int = 7777, window_size: int = 16, max_retries: int = 5, batch_delay: float = 0.0,
+                 compression=simp_compress.DEFAULT_CODECS, metrics_file: str = None, metrics_socket: str = None,
+                 outbox_dir: str = None, history_dir: str = None, history_words: bool = True,
+                 keepalive: float = simp_liveness.KEEPALIVE_IDLE, neighbors=(), syn_rate: float = simp_admission.SYN_RATE,
+                 peer_rate: float = simp_admission.PEER_RATE, max_half_open: int = simp_admission.MAX_HALF_OPEN) -> None:
         self.ip_address = ip
         self.port = port
         self.running = True
@@ -14,15 +47,74 @@ class Daemon:
         self.socket_client = None
 
         self.active_daemon_connection = {} # {"target_ip": ..., "target_port": ..., "state": ...}
-        self.active_client_connection = {} # {"conn": ..., "username": ..., "address": ...}
-        self.active_chat = {} # {"target_ip": ..., "target_port": ..., "state": ...}
-        
-        # track handshake status
-        self.handshake_status = {}
+        # local clients by username: {"conn": ..., "username": ..., "address": ..., "session": ...}
+        self.clients = {}
+
+        # every chat of this daemon, each session keeps its own handshake state, windows and client
+        self.sessions = SessionTable()
+        # last outgoing handshakes: {"peer": ..., "session": ..., "success": ..., "latency": ...}
+        self.handshake_attempts = deque(maxlen=256)
+        # largest window we offer, 1 means plain stop-and-wait
+        self.window_size = window_size
+        # seconds small messages may wait to share a datagram, 0 sends every message on its own
+        self.batch_delay = batch_delay
+        # compression codecs we offer, in order of preference, empty sends every payload raw
+        self.compression = tuple(compression or ())
+
+        # one timer wheel drives every retransmission, RTT is estimated per peer
+        self.timers = TimerWheel()
+        self.rtt_estimators = {}
+        self.max_retries = max_retries
+        # FINs of closed chats not ACKed yet, by (peer ip, peer port, our session id)
+        self.closing = {}
+
+        # resumption tickets we issued and those peers gave us, a chat with a peer we hold a ticket of
+        # skips the handshake round trip
+        self.tickets = simp_resume.TicketStore()
+        self.peer_tickets = simp_resume.TicketCache()
+
+        # group chats we host or joined, a hub relays every message to its member daemons
+        self.groups = simp_group.GroupTable()
+
+        # routes to the daemons we cannot reach directly, learned from the announcements of our neighbors
+        # (neighbors are ips, on port 7777 like us). Their datagrams go out wrapped in RELAY datagrams.
+        self.routes = simp_relay.RoutingTable((ip, port), [(neighbor, 7777) for neighbor in neighbors])
+
+        # admission control, per source ip: SYN rate, datagram rate (0 lets everything in), and the incoming
+        # handshakes waiting for their ACK. Past max_half_open SYNs get a stateless SYN+ACK carrying a cookie.
+        self.syn_limiter = simp_admission.RateLimiter(syn_rate, simp_admission.SYN_BURST) if syn_rate > 0 else None
+        self.peer_limiter = simp_admission.RateLimiter(peer_rate, peer_rate * simp_admission.PEER_BURST_SECONDS) if peer_rate > 0 else None
+        self.half_open = simp_admission.HalfOpenTable(max_half_open)
+        self.cookies = simp_admission.CookieJar()
+
+        # liveness of the peers we chat with: silent ones are probed after keepalive seconds, their chats are
+        # closed when the probes go unanswered. 0 only answers the probes of other daemons.
+        self.keepalive = keepalive
+        self.peers = simp_liveness.PeerTable(keepalive or simp_liveness.KEEPALIVE_IDLE)
+
+        # incomplete fragmented messages, dropped by the timer wheel when they time out
+        self.reassembler = Reassembler(self.timers)
+
+        # counters and histograms of the daemon, served by the STATS command and exported as text
+        self.metrics = simp_metrics.DaemonMetrics()
+        # file rewritten every EXPORT_INTERVAL seconds and socket serving the snapshot, both optional
+        self.metrics_file = metrics_file
+        self.metrics_socket = metrics_socket
+        self.metrics_server = None
+        # messages for users whose client is gone, replayed when it sends its username again.
+        # Segment files in outbox_dir survive a restart, without it they are kept in memory.
+        self.outbox = simp_outbox.Outbox(outbox_dir, lambda delay, callback: self.timers.schedule(delay, callback))
+        # started chats of clients whose connection broke, by username: (session, timer). They go on for
+        # away_timeout seconds, their messages kept in the outbox, and the next client of the user takes them back.
+        self.parked = {}
+        self.away_timeout = simp_outbox.AWAY_TIMEOUT
+        # chat history of the local users, kept only with a history_dir, history_words adds the search index
+        self.history = None
+        if history_dir:
+            self.history = simp_history.HistoryStore(history_dir, history_words, lambda delay, callback: self.timers.schedule(delay, callback))
 
         self.lock = threading.Lock()
         self.logger = logger
-        self.expected_sequence = 0
 
     def start(self):
         '''
@@ -36,6 +128,12 @@ class Daemon:
         client_thread = threading.Thread(target=self.listen_to_client_packets, daemon=True)
         client_thread.start()
 
+        timer_thread = threading.Thread(target=self.timers.run, args=(lambda: self.running,), daemon=True)
+        timer_thread.start()
+        self.start_metrics_export()
+        self.start_keepalive()
+        self.start_routing()
+
         try:
             while self.running:
                 time.sleep(1)
@@ -55,6 +153,72 @@ class Daemon:
         if self.socket_client:
             self.socket_client.close()
             self.logger.info("Daemon TCP socket closed.")
+        self.outbox.close()
+        if self.history is not None:
+            self.history.close()
+        self.stop_metrics_export()
+
+
+    def start_metrics_export(self):
+        '''
+        Write the metrics file now and every EXPORT_INTERVAL seconds, and serve the snapshot on the metrics socket.
+        '''
+        if self.metrics_file:
+            self.export_metrics_file()
+        if self.metrics_socket:
+            self.metrics_server = simp_metrics.MetricsServer(self.metrics.render, self.metrics_socket)
+            try:
+                self.metrics_server.start()
+            except OSError as e:
+                self.logger.error(f"Failed to serve metrics on {self.metrics_socket}: {e}")
+                self.metrics_server = None
+
+
+    def export_metrics_file(self):
+        '''
+        Timer callback, rewrite the metrics file and schedule the next export while the daemon runs.
+        '''
+        try:
+            self.metrics.registry.write_file(self.metrics_file)
+        except OSError as e:
+            self.logger.error(f"Failed to write metrics to {self.metrics_file}: {e}")
+        finally:
+            if self.running:
+                self.timers.schedule(simp_metrics.EXPORT_INTERVAL, self.export_metrics_file)
+
+
+    def stop_metrics_export(self):
+        '''
+        Stop serving metrics and leave the final snapshot in the metrics file.
+        '''
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        if self.metrics_file:
+            try:
+                self.metrics.registry.write_file(self.metrics_file)
+            except OSError as e:
+                self.logger.error(f"Failed to write metrics to {self.metrics_file}: {e}")
+
+
+    def bind_daemon_socket(self) -> socket.socket:
+        '''
+        UDP socket other daemons send to, on port 7777.
+        '''
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.ip_address, 7777))
+        return sock
+
+
+    def bind_client_socket(self) -> socket.socket:
+        '''
+        TCP socket clients connect to, on port 7778.
+        '''
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # a restarted daemon can bind while connections of the previous one are in TIME_WAIT
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.ip_address, 7778))
+        return sock
 
 
     def listen_to_daemon_packets(self):
@@ -62,18 +226,19 @@ class Daemon:
             Listen for other daemon, using custom SIMP UDP.
         '''
         try:
-            self.socket_daemon = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.socket_daemon.bind((self.ip_address, 7777))
+            self.socket_daemon = self.bind_daemon_socket()
             self.socket_daemon.settimeout(5)
             while self.running:
                 try:
-                    data, address = self.socket_daemon.recvfrom(1024)
-                    self.logger.info(f"Received packet from daemon {address}")
+                    data, address = self.socket_daemon.recvfrom(RECV_BUFFER_SIZE)
+                    if debug: debug("Received packet from daemon %s", address)
                     self.handle_incoming_datagram_from_daemon(data, address)
                 except socket.timeout:
                     continue
         except Exception as e:
-            self.logger.error(f"Daemon packet listener error: {e}")
+            # stop() closes the socket under a blocked recvfrom, that is not an error
+            if self.running:
+                self.logger.error(f"Daemon packet listener error: {e}")
         finally:
             if self.socket_daemon:
                 self.socket_daemon.close()
@@ -84,10 +249,9 @@ class Daemon:
         Listen for incoming TCP connections from the client.
         '''
         try:
-            self.socket_client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket_client.bind((self.ip_address, 7778))
+            self.socket_client = self.bind_client_socket()
             self.socket_client.settimeout(5)
-            self.socket_client.listen(1)
+            self.socket_client.listen(socket.SOMAXCONN)
             while self.running:
                 try:
                     conn, address = self.socket_client.accept()
@@ -97,7 +261,8 @@ class Daemon:
                 except socket.timeout:
                     continue
         except Exception as e:
-            self.logger.error(f"Client packet listener error: {e}")
+            if self.running:
+                self.logger.error(f"Client packet listener error: {e}")
         finally:
             if self.socket_client:
                 self.socket_client.close()
@@ -106,159 +271,846 @@ class Daemon:
     def handle_incoming_datagram_from_daemon(self, data: bytes, address: tuple):
         '''
         Handle incoming datagram from the daemon. Distinguish between control and chat datagram.
+        The session is found from the peer address and the session id the datagram carries.
         '''
         try:
-            logger.info(f"Active chat: {self.active_chat}")
-            datagram = Datagram.from_bytes(data)
+            if self.peer_limiter is not None and not self.peer_limiter.allow(address[0]):
+                # over its share, dropped before it costs anything
+                self.metrics.admission_dropped.labels("peer_rate").inc()
+                return
+            if data[0] == 1 and data[1] == 9:  # RELAY, its headers only are read
+                self.handle_relay(data, address)
+                return
+            datagram = Datagram.from_buffer(data)
             datagram_type = datagram.datagram_type[0]
-            self.logger.info(f"Received datagram from {address}: {datagram}")
+            self.metrics.datagram_received(datagram_type, datagram.operation[0], len(data))
+            self.peers.seen(address)
+            session_id = datagram.strip_session()
+            session = self.sessions.get(address[0], address[1], session_id)
+            if trace: trace("Received datagram from %s for %s: %s", address, session, datagram)
+            if session is None and datagram_type == 1 and datagram.operation[0] == 4 and self.fin_acked(address, session_id):
+                return
 
             if datagram_type == 1:  # Control
-                self.handle_control_datagram(datagram, address)
+                self.handle_control_datagram(datagram, address, session)
             elif datagram_type == 2:  # Chat
-                self.handle_chat_datagram(datagram, address)
+                if datagram.operation[0] == 2:  # GROUP, no session
+                    self.handle_group_datagram(datagram, address)
+                else:
+                    self.handle_chat_datagram(datagram, address, session)
             else:
+                self.metrics.invalid.inc()
                 self.logger.error(f"Invalid datagram type: {datagram_type}")
         except Exception as e:
+            self.metrics.invalid.inc()
             self.logger.error(f"Failed to handle incoming datagram from daemon {address}: {e}")
 
 
-    def handle_control_datagram(self, datagram: Datagram, address: tuple):
+    def handle_control_datagram(self, datagram: Datagram, address: tuple, session: Session = None):
         '''
         Handle incoming control datagram from the daemon. check its operation and proceed acordingly.
         '''
-        logger.info(f"Active chat: {self.active_chat}")
         operation = datagram.operation[0]
         sequence = datagram.sequence[0]
         ip, port = address
-        self.logger.info(f"Control datagram op: {operation} from {address}")
+        if debug: debug("Control datagram op: %s from %s for %s", operation, address, session)
 
         if operation == 1:  # ERR
-            self.logger.error(f"Error from {address}: {datagram.payload.decode('ascii')}")
+            options = decode_options(datagram.payload)
+            if session is not None and session.state == "started" and "LOST" in options:
+                # our chat datagrams arrived but their messages were dropped
+                self.handle_chat_error(session, sequence, options)
+                return
+            self.logger.error(f"Error from {address}: {str(datagram.payload, 'ascii', 'replace')}")
 
         # there is incomming chat request
-        elif operation == 2:  # SYN 
+        elif operation == 2:  # SYN
             self.logger.info(f"Received SYN from {address}.")
-            # Check if we are already in a chat
-            if self.is_already_in_chat():
-                self.send_control_datagram(1, 0, ip, port, "User already in another chat")
-                self.send_control_datagram(8, 0, ip, port)  # FIN
-            else:
-                self.send_control_datagram(6, 0, ip, port)  # SYN+ACK
-                self.handshake_status[(ip, port)] = "SYN_ACK_SENT"
-
-                self.active_chat = {"target_ip": ip, "target_port": port,
-                                    "state": "pending_user_acceptance"}
-                self.notify_client_chat_request(ip)
-
+            self.handle_syn(datagram, address)
 
         elif operation == 4:  # ACK
-            self.logger.info(f"Received ACK from {address}")
+            if debug: debug("Received ACK from %s", address)
+            if session is None and datagram.payload[:7] == b"COOKIE=":
+                # a handshake we answered statelessly, the session starts now
+                self.handle_cookie(datagram, address, sequence)
+                return
+            if session is not None and session.handshake == "SYN_ACK_SENT":
+                # last step of the three way handshake
+                session.handshake = "HANDSHAKE_COMPLETE"
+                self.release_half_open(session)
+                self.grant_ticket(session)
+                self.mark_connection_as_active(address, sequence)
+                if not datagram.payload:
+                    return
+
+            # ACK for a chat datagram, slide the send window
+            if session is not None and session.state == "started":
+                self.handle_chat_ack(session, datagram.sequence[0], simp_window.decode_sack(datagram.payload))
+                return
+
             # Mark connection with this daemon as active
             self.mark_connection_as_active(address, sequence)
-            
-            # additional check if target ip and port are set
-            if self.active_chat.get("target_ip") is None:
-                self.active_chat["target_ip"] = ip
-                self.active_chat["target_port"] = port
 
             #If we were in 'handshake_complete' state and got ACK, that means handshake done
-            if self.active_chat.get("state") == "handshake_complete":
-                self.active_chat["state"] = "started"
+            if session is not None and session.state == "handshake_complete":
+                session.state = "started"
                 # Notify client that the chat starte
-                if "conn" in self.active_client_connection:
-                    self.active_client_connection["conn"].sendall(b"SUCCESS - Chat started.")
-            #additional check and uppdate handshake_status if needed
-            if (ip, port) in self.handshake_status and self.handshake_status[(ip, port)] == "SYN_ACK_RECEIVED":
-                self.handshake_status[(ip, port)] = "handshake_complete"
+                if "conn" in session.client:
+                    session.client["conn"].sendall(b"SUCCESS - Chat started.")
 
         elif operation == 6:  # SYN+ACK
             self.logger.info(f"Received SYN+ACK from {address}")
+            options = decode_options(datagram.payload)
+            if session is None and "SID" not in options:
+                # older daemons neither echo our session id nor send theirs
+                session = next((s for s in self.sessions.for_peer(ip, port) if s.handshake == "SYN_SENT"), None)
             # If we sent SYN and now got SYN+ACK, we respond with ACK
-            if (ip, port) in self.handshake_status and self.handshake_status[(ip, port)] == "SYN_SENT":
-                self.send_control_datagram(4, sequence, ip, port)  # ACK
-                self.handshake_status[(ip, port)] = "SYN_ACK_RECEIVED"
+            if session is not None and session.handshake == "SYN_SENT":
+                remote_id = options.get("SID")
+                self.sessions.set_remote_id(session, int(remote_id) if remote_id is not None else None)
+                session.window = simp_window.negotiate_window(options, self.window_size)
+                session.peer_batch = options.get("BATCH") == "1"
+                session.codec = simp_compress.negotiate(options.get("COMPRESS"), self.compression)
+                session.handshake = "SYN_ACK_RECEIVED"
+                self.watch_peer(session, options.get("KEEPALIVE") == "1")
+                self.keep_ticket(session, options)
+                # windows are open before the ACK leaves, the peer's first chat datagram may follow right after it
+                self.handshake_acknowledged(session)
+                # a daemon under load kept nothing of our SYN, the ACK gives its cookie back
+                cookie = encode_options({"COOKIE": options["COOKIE"]}) if "COOKIE" in options else ""
+                self.send_session_control(session, 4, sequence, cookie)  # ACK
+            elif session is not None and session.handshake == "RESUMED":
+                self.resumption_answered(session, options, sequence)
+
+        elif operation == 10:  # KEEPALIVE
+            if debug: debug("Received KEEPALIVE from %s", address)
+            self.send_control_datagram(14, sequence, ip, port)  # KEEPALIVE+ACK
+            if datagram.payload:
+                # the peer's chats with us by our ids, those we do not know were closed without the peer hearing it
+                for session_id in decode_options(datagram.payload).get("SESSIONS", "").split(","):
+                    if session_id and self.sessions.get(ip, port, int(session_id)) is None:
+                        self.send_control_datagram(8, 0, ip, port, encode_options({"SID": int(session_id)}))  # FIN
+
+        elif operation == 5:  # ROUTES
+            self.handle_routes(datagram, address)
+
+        elif operation == 12:  # GROUP
+            self.handle_group_control(datagram, address)
+
+        elif operation == 13:  # GROUP_ACK
+            self.handle_group_ack(datagram, address)
+
+        elif operation == 14:  # KEEPALIVE+ACK
+            rtt = self.peers.answered(address, sequence)
+            if rtt is not None:
+                self.get_rtt_estimator(address).sample(rtt)
 
         elif operation == 8:  # FIN
             self.logger.info(f"Received FIN from {address}, sending ACK and closing.")
+            sender_id = decode_options(datagram.payload).get("SID") if datagram.payload else None
+            if sender_id is not None:
+                # the sender's id of the chat, it finds the session even when the FIN answers a datagram
+                # for a chat the sender does not know anymore
+                session = self.sessions.get_remote(ip, port, int(sender_id)) or session
              # Acknowledge the FIN
-            self.send_control_datagram(4, sequence, ip, port)
+            self.send_control_datagram(4, sequence, ip, port, "", int(sender_id) if sender_id is not None else
+                                       session.remote_id if session is not None else None)
             self.mark_connection_as_inactive(address)
 
-            # check FIN corresponds to our active chat, end the chat session
-            if self.active_chat.get("target_ip") == ip and self.active_chat.get("target_port") == port:
-                if "conn" in self.active_client_connection:
-                    self.active_client_connection["conn"].sendall(b"CHAT_ENDED")
-
-                # clean handhshake status
-                with self.lock:
-                    if (ip, port) in self.handshake_status:
-                        del self.handshake_status[(ip, port)]
-                # clean chat track dict
-                self.active_chat.clear()
+            # end the chat session the FIN belongs to
+            if session is not None:
+                self.close_session(session)
 
 
         else:
             self.logger.error(f"Unknown control operation: {operation}")
 
 
-    def handle_chat_datagram(self, datagram: Datagram, address: tuple):
-        logger.info(f"Active chat: {self.active_chat}")
+    def handle_syn(self, datagram: Datagram, address: tuple):
+        '''
+        Incoming chat request: open a session bound to the local client, or reject it if the client is busy.
+        A peer that negotiates session ids sends its own id as SID, older daemons get the legacy session id.
+        '''
+        ip, port = address
+        if self.syn_limiter is not None and not self.syn_limiter.allow(ip):
+            # no answer at all, an ERR or FIN would turn a flood into a reflection
+            self.metrics.admission_dropped.labels("syn_rate").inc()
+            return
+        options = decode_options(datagram.payload)
+        remote_id = int(options["SID"]) if "SID" in options else None
+        if remote_id is None:
+            existing = self.sessions.get(ip, port, LEGACY_SESSION_ID)
+        else:
+            existing = self.sessions.get_remote(ip, port, remote_id)
+
+        if existing is not None:
+            # retransmitted SYN, our SYN+ACK was lost (the user may have accepted meanwhile, no ACK came yet)
+            if existing.state == "pending_user_acceptance" or existing.resumed or existing.handshake == "SYN_ACK_SENT":
+                self.send_session_control(existing, 6, 0, self.handshake_options(existing))  # SYN+ACK
+            return
+
+        client = self.route_chat_request(datagram.user)
+        if client is None:
+            self.metrics.handshakes_rejected.inc()
+            self.logger.info(f"No client {datagram.user!r} connected to handle chat request.")
+            self.send_control_datagram(1, 0, ip, port, "No such user", remote_id)  # ERR
+            self.send_control_datagram(8, 0, ip, port, "", remote_id)  # FIN
+            return
+        params = None
+        if remote_id is not None and "TICKET" in options:
+            params = self.tickets.redeem(options["TICKET"], ip)
+        if params is None and self.half_open.full():
+            if remote_id is None:
+                # older daemons cannot give a cookie back
+                self.metrics.admission_dropped.labels("half_open_full").inc()
+            else:
+                self.send_cookie(datagram, address, options, remote_id)
+            return
+        if self.is_already_in_chat(client):
+            self.metrics.handshakes_rejected.inc()
+            self.send_control_datagram(1, 0, ip, port, "User already in another chat", remote_id)
+            self.send_control_datagram(8, 0, ip, port, "", remote_id)  # FIN
+            return
+
+        local_id = LEGACY_SESSION_ID if remote_id is None else self.sessions.allocate_id()
+        session = Session(ip, port, local_id, "pending_user_acceptance", client)
+        session.remote_id = remote_id
+        session.remote_user = options.get("FROM")
+        session.peer_batch = options.get("BATCH") == "1"
+        self.watch_peer(session, options.get("KEEPALIVE") == "1")
+        if params is not None:
+            # what was agreed last time holds, no ACK is waited for
+            session.resumed = True
+            session.codec = params["codec"]
+            session.handshake = "HANDSHAKE_COMPLETE"
+            session.open_windows(params["window"])
+        else:
+            session.codec = simp_compress.negotiate(options.get("COMPRESS"), self.compression)
+            session.handshake = "SYN_ACK_SENT"
+            session.open_windows(simp_window.negotiate_window(options, self.window_size))
+        if remote_id is not None:
+            # offered in the SYN+ACK, redeemable once the handshake completed and the user accepted (grant_ticket)
+            session.ticket = simp_resume.new_ticket()
+        self.sessions.add(session)
+        client["session"] = session
+        self.metrics.handshakes_accepted.inc()
+        if session.resumed:
+            self.metrics.resumptions_accepted.inc()
+            self.mark_connection_as_active(address, 0)
+        else:
+            self.track_half_open(session)
+
+        self.send_session_control(session, 6, 0, self.handshake_options(session))  # SYN+ACK
+        self.notify_client_chat_request(session)
+
+
+    def send_cookie(self, datagram: Datagram, address: tuple, options: dict, remote_id: int):
+        '''
+        The half-open table is full: answer the SYN with a SYN+ACK whose cookie holds what the session needs, and
+        keep nothing. The session id is picked, not reserved, the ACK bringing the cookie back creates the session.
+        '''
+        ip, port = address
+        local_id = self.sessions.allocate_id(reserve=False)
+        window = simp_window.negotiate_window(options, self.window_size)
+        codec = simp_compress.negotiate(options.get("COMPRESS"), self.compression)
+        cookie = self.cookies.make(address, {
+            "sid": local_id, "remote_id": remote_id, "window": window, "codec": codec,
+            "batch": options.get("BATCH") == "1", "keepalive": options.get("KEEPALIVE") == "1",
+            "user": datagram.user.decode("utf-8"), "from": options.get("FROM"),
+        })
+        answer = {"WINDOW": window, "SID": local_id, "BATCH": 1, "KEEPALIVE": 1}
+        if codec is not None:
+            answer["COMPRESS"] = codec
+        answer["COOKIE"] = cookie
+        self.metrics.cookies_sent.inc()
+        self.send_control_datagram(6, 0, ip, port, encode_options(answer), remote_id)  # SYN+ACK
+
+
+    def handle_cookie(self, datagram: Datagram, address: tuple, sequence: int):
+        '''
+        ACK of a handshake answered with a cookie: check it and create the session the SYN would have created.
+        '''
+        ip, port = address
+        state = self.cookies.open(address, decode_options(datagram.payload).get("COOKIE", ""))
+        if state is None:
+            self.metrics.admission_dropped.labels("bad_cookie").inc()
+            return
+        if self.sessions.get(ip, port, state["sid"]) is not None:
+            # ACK sent again, the session exists
+            return
+        client = self.route_chat_request(state["user"].encode("utf-8"))
+        if client is None or self.is_already_in_chat(client) or not self.sessions.reserve(state["sid"]):
+            self.metrics.handshakes_rejected.inc()
+            self.send_control_datagram(1, 0, ip, port, "User no longer available", state["remote_id"])  # ERR
+            self.send_control_datagram(8, 0, ip, port, "", state["remote_id"])  # FIN
+            return
+        session = Session(ip, port, state["sid"], "pending_user_acceptance", client)
+        session.remote_id = state["remote_id"]
+        session.remote_user = state["from"]
+        session.peer_batch = state["batch"]
+        self.watch_peer(session, state["keepalive"])
+        session.codec = state["codec"]
+        session.handshake = "HANDSHAKE_COMPLETE"
+        session.open_windows(state["window"])
+        self.sessions.add(session)
+        client["session"] = session
+        self.metrics.handshakes_accepted.inc()
+        self.metrics.cookies_accepted.inc()
+        self.mark_connection_as_active(address, sequence)
+        self.notify_client_chat_request(session)
+
+
+    def grant_ticket(self, session: Session):
+        '''
+        End of an incoming handshake: the ticket our SYN+ACK offered can be redeemed once the initiator ACKed it
+        and our user accepted the chat, whichever comes last. A SYN alone never makes a ticket valid.
+        '''
+        if session.ticket is not None and session.handshake == "HANDSHAKE_COMPLETE" and session.state == "started":
+            self.tickets.issue(session.peer_ip, {"window": session.window, "codec": session.codec}, session.ticket)
+
+
+    def track_half_open(self, session: Session):
+        '''
+        An incoming handshake waits for its ACK: count it, and close it if the ACK never comes.
+        '''
+        if self.half_open.add(session):
+            self.metrics.half_open.set(len(self.half_open))
+            session.handshake_timer = self.timers.schedule(simp_admission.HALF_OPEN_TIMEOUT, self.half_open_expired, session)
+
+
+    def release_half_open(self, session: Session):
+        if self.half_open.remove(session):
+            self.metrics.half_open.set(len(self.half_open))
+            if session.handshake_timer is not None:
+                session.handshake_timer.cancel()
+                session.handshake_timer = None
+
+
+    def half_open_expired(self, session: Session):
+        '''
+        Timer callback, the ACK of an incoming handshake never came: a spoofed SYN or a peer that went away.
+        '''
+        if session.handshake != "SYN_ACK_SENT":
+            return
+        self.logger.info(f"No ACK for the SYN+ACK of {session}, closing it.")
+        self.close_session(session)
+
+
+    def route_chat_request(self, user: bytes):
+        '''
+        Local client a SYN is for, from the user field of its header: one dict lookup.
+        '''
+        client = self.clients.get(user.decode("ascii", "replace"))
+        if client is None and user in (b"", b"Daemon") and len(self.clients) == 1:
+            # older daemons do not name the user, only a daemon with a single client can take their requests
+            client = next(iter(self.clients.values()))
+        return client
+
+
+    def handshake_options(self, session: Session) -> bytes:
+        '''
+        SYN / SYN+ACK options: window we offer (or agreed) and our session id, unless the peer is an older daemon.
+        Compression: the SYN offers our codecs, the SYN+ACK names the one chosen, if any.
+        '''
+        # our SYN offers, a resumed one too in case the peer does not take the ticket
+        offer = session.send_window is None or session.handshake == "RESUMED"
+        options = {"WINDOW": self.window_size if offer else session.window}
+        if session.local_id != LEGACY_SESSION_ID:
+            options["SID"] = session.local_id
+        # we always unpack batches, sending them is up to batch_delay
+        options["BATCH"] = 1
+        # we always answer keepalives
+        options["KEEPALIVE"] = 1
+        if offer and session.client.get("username"):
+            options["FROM"] = session.client["username"]
+        if offer and self.compression:
+            options["COMPRESS"] = ",".join(self.compression)
+        elif session.codec is not None:
+            options["COMPRESS"] = session.codec
+        # the ticket our SYN redeems, or the one our SYN+ACK issues
+        if session.ticket is not None:
+            options["TICKET"] = session.ticket
+        if session.resumed:
+            options["RESUMED"] = 1
+        return encode_options(options)
+
+
+    def handle_chat_datagram(self, datagram: Datagram, address: tuple, session: Session = None):
+        if session is None or session.recv_window is None:
+            self.metrics.drop("no_session")
+            self.logger.warning(f"Chat datagram from {address} without an active chat, dropping.")
+            return
+        if session.handshake == "RESUMED":
+            # the peer's session id comes with its SYN+ACK, nothing can be ACKed before, the peer sends it again
+            if debug: debug("Chat datagram for %s before its SYN+ACK, dropping.", session)
+            return
+
         # check if chat started to continue to process chat datagrams
-        if self.active_chat.get("state") == "waiting_for_first_message":
+        if session.state == "waiting_for_first_message":
             self.logger.info("Received first chat from remote => remote user accepted!")
-            self.active_chat["state"] = "started"
+            session.state = "started"
             # Let local client know that the chat is truly started
-            if "conn" in self.active_client_connection:
-                self.active_client_connection["conn"].sendall(b"SUCCESS - Chat started.\n")
-
+            if "conn" in session.client:
+                session.client["conn"].sendall(b"SUCCESS - Chat started.\n")
+
+        username = session.client.get("username")
+        if username is not None and not self.client_connected(session.client) \
+                and not self.outbox.has_room(username, len(datagram.user) + len(datagram.payload)):
+            # nowhere to keep it, no ACK: the peer sends it again or gives up on the chat
+            self.metrics.drop("outbox_full")
+            self.logger.warning(f"Outbox full for {username}, not accepting chat datagrams from {address}.")
+            return
 
         sender = datagram.user.decode("utf-8").strip()
-        message = datagram.payload.decode("utf-8")
         sequence = datagram.sequence[0]
-        
-        # skip acceptance message
-        if message.endswith(" accepted."):
-            self.logger.info("Skipping display of acceptance message.")
 
-        # check packet sequence to tarck order of messages
-        if sequence != self.expected_sequence:
-            self.logger.warning(f"Unexpected sequence. Expected: {self.expected_sequence}, got: {sequence}")
+        # window puts messages back in order, duplicates are only ACKed again
+        with self.lock:
+            status, delivered = session.recv_window.receive(sequence, (sender, datagram.operation[0], datagram.payload))
+            cumulative, bitmap = session.recv_window.sack()
+        if status == simp_window.OUT_OF_WINDOW:
+            self.metrics.out_of_window.inc()
+            self.logger.warning(f"Unexpected sequence {sequence}, outside of the receive window.")
             return
+        if status == simp_window.DUPLICATE:
+            self.metrics.duplicates.inc()
 
-        with self.lock:
-            # reverse sequence for next expected package
-            self.expected_sequence = (self.expected_sequence + 1) % 2
+        # why messages accepted into the window were thrown away, the peer gets an ERR instead of the ACK
+        lost = []
+        for sender, operation, payload in delivered:
+            if operation & CHAT_FRAGMENT:
+                try:
+                    payload = self.reassembler.add(session.key, payload)
+                except ValueError as e:
+                    self.metrics.drop("fragment")
+                    self.logger.warning(f"Dropping fragment from {address}: {e}")
+                    lost.append(f"bad fragment: {e}")
+                    continue
+                if payload is None:
+                    continue
 
-        self.logger.info(f"Received chat message from {sender}@{address}: {message}")
+            if operation & CHAT_COMPRESSED:
+                try:
+                    payload = simp_compress.decompress(session.codec, payload, self.reassembler.max_message)
+                except ValueError as e:
+                    self.metrics.drop("compression")
+                    self.logger.warning(f"Dropping compressed message from {address}: {e}")
+                    lost.append(f"bad compression: {e}")
+                    continue
 
-        # forward messafe to client
-        if "conn" in self.active_client_connection:
-            client_conn = self.active_client_connection["conn"]
-            try:
-                client_conn.sendall(f"Message from {sender}: {message}".encode("utf-8"))
-            except Exception as e:
-                self.logger.error(f"Failed to forward message to client: {e}")
-                self.disconnect_client(client_conn)
-        else:
-            self.logger.warning("No client connected, dropping message.")
+            if operation & CHAT_BATCH:
+                try:
+                    messages = simp_batch.unpack_records(payload)
+                except ValueError as e:
+                    self.metrics.drop("batch")
+                    self.logger.warning(f"Dropping batch from {address}: {e}")
+                    lost.append(f"bad batch: {e}")
+                    continue
+            else:
+                messages = (payload,)
+
+            for payload in messages:
+                message = str(payload, "utf-8", "replace")
+                # skip acceptance message
+                if message.endswith(" accepted."):
+                    self.logger.info("Skipping display of acceptance message.")
+                if debug: debug("Received chat message from %s@%s: %s", sender, address, message)
+                self.record_history(session, sender, simp_history.INCOMING, message)
+                if not self.forward_message_to_client(session, sender, message):
+                    lost.append("outbox full")
+        if lost:
+            # the window slides as for an ACK, but the sender learns its messages are gone
+            reason = f"Message lost, {lost[0]}".replace(";", ",")
+            self.send_session_control(session, 1, sequence, encode_options({"SACK": f"{cumulative},{bitmap}", "LOST": reason}))  # ERR
+            return
         #Send ACK back to the other daemon to confirm if it receivedthe  message
-        self.send_control_datagram(4, sequence, address[0], address[1])
+        self.send_session_control(session, 4, sequence, simp_window.encode_sack(cumulative, bitmap))
+
+
+    def forward_message_to_client(self, session: Session, sender: str, message: str) -> bool:
+        '''
+        Forward a chat message, already in order, to the client of the session, or to the outbox while it is away.
+        Return False if it was dropped, its datagram is then not ACKed.
+        '''
+        # a connection that closed since the check does not queue it
+        if self.client_connected(session.client) and \
+                session.client["conn"].sendall(f"Message from {sender}: {message}".encode("utf-8")) is not False:
+            return True
+        return self.store_message(session.client, sender, message)
+
+
+    def client_connected(self, client: dict) -> bool:
+        '''
+        Whether the client still has a connection that takes notifications.
+        '''
+        conn = client.get("conn")
+        return conn is not None and not getattr(conn, "closed", False)
+
+
+    def store_message(self, client: dict, sender: str, message: str) -> bool:
+        '''
+        Keep a message for a client that is not connected, it is replayed once the client's username is set again.
+        Return False if it was dropped.
+        '''
+        username = client.get("username")
+        if username is None:
+            self.metrics.drop("no_client")
+            self.logger.warning("No client connected, dropping message.")
+            return False
+        if not self.outbox.store(username, sender, message):
+            self.metrics.drop("outbox_full")
+            self.logger.warning(f"Outbox full for {username}, dropping message.")
+            return False
+        self.metrics.outbox_stored.inc()
+        if debug: debug("No client connected, stored message for %s.", username)
+        return True
+
+
+    def store_unsent(self, client: dict, payloads: list):
+        '''
+        Keep the chat messages a broken connection did not deliver, they are replayed with the ones stored after them.
+        '''
+        for payload in payloads:
+            text = str(payload, "utf-8", "replace")
+            for prefix in ("Message from ", "Stored message from "):
+                if text.startswith(prefix):
+                    sender, _, message = text[len(prefix):].partition(": ")
+                    self.store_message(client, sender, message)
+                    break
+
+
+    def replay_outbox(self, username: str, conn):
+        '''
+        Send a client the messages stored while it was away, in order, before anything newer.
+        '''
+        def deliver(sender, message):
+            conn.sendall(f"Stored message from {sender}: {message}".encode("utf-8"))
+        replayed = self.outbox.replay(username, deliver)
+        if replayed:
+            self.metrics.outbox_replayed.inc(replayed)
+            self.logger.info(f"Replayed {replayed} stored message(s) to {username}.")
+
+
+    def handle_chat_ack(self, session: Session, sequence: int, sack: tuple = None):
+        '''
+        ACK of one of our chat datagrams, with its SACK block (cumulative, bitmap) if any: slide the send window
+        and send whatever now fits in it.
+        '''
+        send_window = session.send_window
+        with self.lock:
+            if sack is None:
+                acked, ready = send_window.ack(sequence)
+            else:
+                acked, ready = send_window.ack(sequence, *sack)
+
+        now = monotonic()
+        rtt = self.get_rtt_estimator(session.peer)
+        for pending in acked:
+            pending["acked"] = True
+            pending["timer"].cancel()
+            # Karn's algorithm, a retransmitted datagram gives an ambiguous sample
+            if pending["retries"] == 0:
+                rtt.sample(now - pending["sent"])
+        if debug: debug("ACK acknowledged %s chat datagram(s), %s still in flight, rto %.3f", len(acked), len(send_window), rtt.rto)
+        self.send_chat_datagrams(session, ready)
+
+
+    def handle_chat_error(self, session: Session, sequence: int, options: dict):
+        '''
+        ERR in place of the ACK of a chat datagram: the peer took it into its window but dropped its message.
+        The window slides as for an ACK, the client is told the message did not arrive.
+        '''
+        reason = options["LOST"]
+        self.logger.warning(f"Chat datagram {sequence} to {session.peer_ip}:{session.peer_port} dropped by the peer: {reason}")
+        try:
+            sack = tuple(int(value) for value in options.get("SACK", "").split(","))
+        except ValueError:
+            sack = None
+        self.handle_chat_ack(session, sequence, sack if sack is not None and len(sack) == 2 else None)
+        if self.client_connected(session.client):
+            session.client["conn"].sendall(f"FAILED - {reason}".encode("utf-8"))
+
+
+    def get_rtt_estimator(self, address: tuple) -> RttEstimator:
+        '''
+        RTT estimator of a peer daemon, created on first use.
+        '''
+        rtt = self.rtt_estimators.get(address)
+        if rtt is None:
+            rtt = self.rtt_estimators[address] = RttEstimator()
+        return rtt
+
+
+    def retransmit_timeout(self, session: Session, pending: dict):
+        '''
+        Timer wheel callback, a chat datagram was not ACKed in time: resend it with backoff or give up on the chat.
+        '''
+        if pending.get("acked") or session.state == "closed":
+            return
+
+        if pending["retries"] >= self.max_retries:
+            self.logger.warning(f"No ACK from {session.peer_ip}:{session.peer_port} after {pending['retries']} retransmissions, closing chat.")
+            self.metrics.drop("retransmit_limit", len(session.send_window))
+            self.send_session_control(session, 1, 0, "Retransmission limit reached")  # ERR
+            self.send_fin(session)
+            self.close_session(session)
+            return
+
+        pending["retries"] += 1
+        self.metrics.retransmissions.inc()
+        rto = self.get_rtt_estimator(session.peer).backoff(pending["retries"])
+        if debug: debug("Retransmitting chat datagram to %s, attempt %s, next timeout %.3f", session, pending["retries"], rto)
+        pending["timer"] = self.timers.schedule(rto, self.retransmit_timeout, session, pending)
+        self.send_raw_to_daemon(pending["data"], session.peer_ip, session.peer_port)
+
+
+    def send_fin(self, session: Session):
+        '''
+        End a chat on the peer's side: the FIN, with our id of the chat, is sent again with backoff until the peer
+        ACKs it or max_retries. Also safe once the session is closed here.
+        '''
+        key = (session.peer_ip, session.peer_port, session.local_id)
+        pending = {"session": session, "retries": 0}
+        with self.lock:
+            previous = self.closing.pop(key, None)
+            self.closing[key] = pending
+        if previous is not None:
+            previous["timer"].cancel()
+        self.send_session_control(session, 8, 0, encode_options({"SID": session.local_id}))  # FIN
+        pending["timer"] = self.timers.schedule(self.get_rtt_estimator(session.peer).backoff(0), self.retransmit_fin, key, pending)
+
+
+    def retransmit_fin(self, key: tuple, pending: dict):
+        '''
+        Timer wheel callback, a FIN was not ACKed in time.
+        '''
+        with self.lock:
+            if self.closing.get(key) is not pending:
+                return
+            if pending["retries"] >= self.max_retries:
+                del self.closing[key]
+                self.logger.warning(f"No ACK for the FIN to {key[0]}:{key[1]} after {pending['retries']} retransmissions.")
+                return
+            pending["retries"] += 1
+        session = pending["session"]
+        self.metrics.retransmissions.inc()
+        self.send_session_control(session, 8, 0, encode_options({"SID": session.local_id}))  # FIN
+        pending["timer"] = self.timers.schedule(self.get_rtt_estimator(session.peer).backoff(pending["retries"]), self.retransmit_fin, key, pending)
+
+
+    def fin_acked(self, address: tuple, session_id: int) -> bool:
+        '''
+        ACK for a session we do not know, True if it is the ACK of the FIN of a chat we closed.
+        '''
+        with self.lock:
+            pending = self.closing.pop((address[0], address[1], session_id), None)
+        if pending is None:
+            return False
+        pending["timer"].cancel()
+        return True
 
 
-    def is_already_in_chat(self):
+    def open_session(self, target_ip: str, target_port: int, client: dict, target_user: str = None) -> Session:
         '''
-        Check if the user is already in a chat session.
+        New outgoing session for a client, registered in the table before the SYN is sent.
         '''
-        logger.info(f"Active chat: {self.active_chat}")
-        return self.active_chat.get("state") in ["handshake_complete", "started"]
+        session = Session(target_ip, target_port, self.sessions.allocate_id(), "syn_sent", client)
+        session.remote_user = target_user
+        session.handshake = "SYN_SENT"
+        session.handshake_future = Future()
+        self.sessions.add(session)
+        client["session"] = session
+        return session
+
+
+    def close_session(self, session: Session, notify: bool = True):
+        '''
+        End a chat locally: notify the client, cancel pending retransmissions and drop the session from the table.
+        '''
+        with self.lock:
+            if session.state == "closed":
+                return
+            started = session.state == "started"
+            # a resumed chat the peer never answered
+            unanswered = session.handshake == "RESUMED"
+            session.state = "closed"
+            session.handshake = None
+            self.release_half_open(session)
+            if session.handshake_timer is not None:
+                session.handshake_timer.cancel()
+            if session.batch_timer is not None:
+                session.batch_timer.cancel()
+            if session.send_window is not None:
+                for pending in session.send_window.in_flight.values():
+                    if "timer" in pending:
+                        pending["timer"].cancel()
+            self.sessions.remove(session)
+            if session.client.get("session") is session:
+                del session.client["session"]
+            parked = self.parked.get(session.client.get("username"))
+            if parked is not None and parked[0] is session:
+                del self.parked[session.client["username"]]
+                parked[1].cancel()
+            if session.handshake_future is not None and not session.handshake_future.done():
+                # timed out, rejected by the peer or abandoned by the client
+                self.record_handshake(session, False)
+                session.handshake_future.set_result(False)
+            elif unanswered:
+                self.record_handshake(session, False)
+
+        if not self.sessions.for_peer(session.peer_ip, session.peer_port):
+            # last chat with the peer, nothing left to keep alive
+            self.peers.forget(session.peer)
+
+        if notify and "conn" in session.client:
+            if started:
+                session.client["conn"].sendall(b"CHAT_ENDED")
+            else:
+                session.client["conn"].sendall(b"DECLINED - Chat closed by the other daemon, back to menu.")
+
+
+    def watch_peer(self, session: Session, keepalive: bool):
+        '''
+        Probe the peer of a new session when it goes quiet, if it said it answers keepalives (older daemons do not).
+        '''
+        if self.keepalive > 0 and keepalive:
+            self.peers.track(session.peer)
+
+
+    def start_keepalive(self):
+        if self.keepalive > 0:
+            self.timers.schedule(simp_liveness.SWEEP_INTERVAL, self.sweep_peers)
+
+
+    def sweep_peers(self, now: float = None):
+        '''
+        Timer callback, the only one for every peer: send keepalives to the peers that went quiet and close
+        the chats of those that stopped answering, then reclaim their state.
+        '''
+        try:
+            probes, dead = self.peers.sweep(self.probe_interval, now)
+            for (ip, port), sequence in probes:
+                if debug: debug("Sending KEEPALIVE to %s:%s", ip, port)
+                # our chats with the peer by its ids, it answers with a FIN for any it closed and we missed the FIN of
+                session_ids = [str(session.remote_id) for session in self.sessions.for_peer(ip, port)
+                               if session.state == "started" and session.remote_id is not None and session.handshake != "RESUMED"]
+                payload = encode_options({"SESSIONS": ",".join(session_ids)}) if session_ids else ""
+                self.send_control_datagram(10, sequence, ip, port, payload)  # KEEPALIVE
+            for peer, silent in dead:
+                self.logger.warning(f"No answer from {peer[0]}:{peer[1]} for {silent:.1f} s, closing its chats.")
+                self.metrics.peers_dead.inc()
+                for session in self.sessions.for_peer(*peer):
+                    # in case only the other way is broken, the peer closes its side too
+                    self.send_fin(session)
+                    self.close_session(session)
+                self.mark_connection_as_inactive(peer)
+                self.rtt_estimators.pop(peer, None)
+                self.peers.forget(peer)
+            self.metrics.peers_tracked.set(len(self.peers))
+        finally:
+            # the next sweep even if this one failed
+            if self.running:
+                self.timers.schedule(simp_liveness.SWEEP_INTERVAL, self.sweep_peers)
+
+
+    def peer_backoff(self, peer: tuple, retries: int) -> float:
+        return self.get_rtt_estimator(peer).backoff(retries)
+
+
+    def probe_interval(self, peer: tuple) -> float:
+        '''
+        Time between two probes of a peer: PROBE_INTERVAL, longer for a peer whose RTO is.
+        '''
+        rtt = self.rtt_estimators.get(peer)
+        return simp_liveness.PROBE_INTERVAL if rtt is None else max(simp_liveness.PROBE_INTERVAL, rtt.rto)
+
+
+    def start_routing(self):
+        self.timers.schedule(simp_relay.ANNOUNCE_INTERVAL, self.announce_routes)
+
+
+    def announce_routes(self, now: float = None):
+        '''
+        Timer callback: drop the routes that were not refreshed and announce ours to every neighbor.
+        '''
+        try:
+            expired = self.routes.expire(now)
+            if expired:
+                self.logger.info(f"{expired} route(s) expired.")
+            for ip, port in self.routes.neighbors():
+                for payload in simp_relay.encode_routes(self.routes.advertise((ip, port), now)):
+                    self.send_control_datagram(5, 0, ip, port, payload)  # ROUTES
+            self.metrics.routes.set(len(self.routes))
+        finally:
+            if self.running:
+                self.timers.schedule(simp_relay.ANNOUNCE_INTERVAL, self.announce_routes)
+
+
+    def handle_routes(self, datagram: Datagram, address: tuple) -> bool:
+        '''
+        Announcement of a neighbor. Only configured neighbors are listened to, anyone else could send our
+        traffic its way. Return whether it was taken.
+        '''
+        if not self.routes.is_trusted(address):
+            self.metrics.admission_dropped.labels("not_neighbor").inc()
+            if debug: debug("Routes from %s, not a neighbor, dropping.", address)
+            return False
+        changed = self.routes.learn(address, simp_relay.decode_routes(datagram.payload))
+        if changed:
+            self.logger.info(f"Routes from {address[0]}:{address[1]}: {changed} change(s), {len(self.routes)} route(s).")
+            self.metrics.routes.set(len(self.routes))
+        return True
+
+
+    def handle_relay(self, data, address: tuple):
+        '''
+        RELAY datagram from a configured neighbor: handle what it carries if it is for us, else send it on to the
+        next hop with the hop limit decremented. Only the daemon and relay headers are read, the payload passes
+        through. The origin is only the neighbor's word: RELAY datagrams from anyone else are dropped.
+        '''
+        try:
+            ttl, destination, origin = simp_relay.inspect(data)
+        except ValueError as e:
+            self.metrics.invalid.inc()
+            self.logger.warning(f"Invalid relay datagram from {address}: {e}")
+            return
+        self.metrics.datagram_received(1, 9, len(data))
+        if not self.routes.is_trusted(address):
+            self.metrics.relay_dropped.labels("not_neighbor").inc()
+            if debug: debug("Relay datagram from %s, not a neighbor, dropping.", address)
+            return
+        self.peers.seen(address)
+        if destination == (self.ip_address, self.port):
+            # the answers take the way back, unless we already talk to the origin directly
+            if origin in self.routes or not self.sessions.for_peer(*origin):
+                self.routes.learn_reverse(origin, address, simp_relay.RELAY_TTL - ttl + 1)
+            self.handle_incoming_datagram_from_daemon(memoryview(data)[simp_relay.RELAY_OFFSET:], origin)
+            return
+        if ttl <= 1:
+            self.metrics.relay_dropped.labels("ttl").inc()
+            self.logger.warning(f"Relay datagram from {origin} to {destination} out of hops, dropping.")
+            return
+        hop = self.routes.next_hop(destination) or destination
+        if hop == address:
+            self.metrics.relay_dropped.labels("loop").inc()
+            return
+        if trace: trace("Relaying datagram from %s to %s through %s", origin, destination, hop)
+        self.metrics.relayed.inc()
+        self.sendto_daemon(simp_relay.forwarded(data, ttl), *hop)
+
+
+    def is_already_in_chat(self, client: dict) -> bool:
+        '''
+        Check if the client already has a session, a client takes part in one chat at a time.
+        '''
+        if trace: trace("Client session: %s", client.get("session"))
+        return client.get("session") is not None
 
 
     def mark_connection_as_active(self, address: tuple, sequence: int):
         '''
         Mark the connection with the daemon as active.
         '''
-        logger.info(f"Active chat: {self.active_chat}")
         with self.lock:
             self.active_daemon_connection[address] = {
                 "state": "connected",
@@ -271,291 +1123,941 @@ class Daemon:
         '''
         Mark the connection with the daemon as inactive.
         '''
-        logger.info(f"Active chat: {self.active_chat}")
         with self.lock:
             if address in self.active_daemon_connection:
                 del self.active_daemon_connection[address]
                 self.logger.info(f"Connection with {address} terminated.")
 
 
-    def send_control_datagram(self, operation: int, sequence: int, target_ip: str, target_port: int, payload: str = ""):
+    def send_control_datagram(self, operation: int, sequence: int, target_ip: str, target_port: int, payload="", session_id=None):
         ''''
-        Send a control datagram to the daemon.
+        Send a control datagram to the daemon, flagged with the peer's session id if one is given.
         '''
-        logger.info(f"Active chat: {self.active_chat}")
         try:
-            control_datagram = Datagram(
-                datagram_type=1,
-                operation=operation,
-                sequence=sequence,
-                user="Daemon",
-                length=len(payload),
-                payload=payload
-            )
+            payload = payload if isinstance(payload, bytes) else payload.encode("ascii")
+            control_datagram = Datagram.trusted(1, operation, sequence, b"Daemon", payload, session_id)
             self.send_datagram_to_daemon(control_datagram, target_ip, target_port)
         except Exception as e:
             self.logger.error(f"Failed to send control datagram: {e}")
 
 
+    def send_session_control(self, session: Session, operation: int, sequence: int, payload=""):
+        '''
+        Send a control datagram to the peer of a session.
+        '''
+        self.send_control_datagram(operation, sequence, session.peer_ip, session.peer_port, payload, session.remote_id)
+
+
     def send_datagram_to_daemon(self, datagram: Datagram, ip: str, port: int = 7777):
         '''
         Send a datagram to the daemon.
         '''
-        logger.info(f"Active chat: {self.active_chat}")
         try:
-            serialized = datagram.to_bytes()
-            self.socket_daemon.sendto(serialized, (ip, port))
-            self.logger.info(f"Sent datagram to daemon {ip}:{port}")
+            self.send_raw_to_daemon(datagram.to_bytes(), ip, port)
         except Exception as e:
             self.logger.error(f"Failed to send datagram to daemon {ip}:{port}: {e}")
 
 
-    def notify_client_chat_request(self, requester_ip):
-        logger.info(f"Active chat: {self.active_chat}")
-        if "conn" in self.active_client_connection and self.active_client_connection.get("username"):
-            client_conn = self.active_client_connection["conn"]
-            message = f"Chat request from: {requester_ip}"
-            client_conn.sendall(message.encode("utf-8"))
-            self.logger.info("Notified client about incoming chat request.")
-        else:
-            self.logger.info("No client connected to handle chat request.")
-            self.send_control_datagram(8, 0, requester_ip, 7777)  # FIN
-            with self.lock:
-                if (requester_ip, 7777) in self.handshake_status:
-                    del self.handshake_status[(requester_ip, 7777)]
-            self.active_chat.clear()
+    def send_raw_to_daemon(self, data: bytes, ip: str, port: int = 7777):
+        '''
+        Send an already serialized datagram, used for retransmissions. A daemon we have a route to
+        gets it relayed by the next hop.
+        '''
+        hop = self.routes.next_hop((ip, port))
+        if hop is not None:
+            if debug: debug("Relaying datagram for %s:%s through %s", ip, port, hop)
+            data = simp_relay.wrap(data, (ip, port), (self.ip_address, self.port))
+            ip, port = hop
+        self.sendto_daemon(data, ip, port)
+
+
+    def sendto_daemon(self, data: bytes, ip: str, port: int = 7777):
+        '''
+        Put a datagram on the wire, to that very address.
+        '''
+        try:
+            self.socket_daemon.sendto(data, (ip, port))
+            self.metrics.datagram_sent(data[0], data[1], len(data))
+            if debug: debug("Sent datagram to daemon %s:%s", ip, port)
+        except Exception as e:
+            self.logger.error(f"Failed to send datagram to daemon {ip}:{port}: {e}")
+
+
+    def notify_client_chat_request(self, session: Session):
+        '''
+        Ask the client of a new incoming session to accept or decline it.
+        '''
+        requester = session.peer_ip if session.remote_user is None else f"{session.peer_ip} ({session.remote_user})"
+        session.client["conn"].sendall(f"Chat request from: {requester}".encode("utf-8"))
+        self.logger.info(f"Notified client about incoming chat request, {session}.")
 
 
-    def handle_incoming_command_from_client(self, client_conn, client_addr):
+    def handle_incoming_command_from_client(self, client_sock, client_addr):
         '''
-        Handle incoming commands from the client.
+        Handle incoming commands from one client, every client connection has its own thread and state.
+        Commands are framed, one recv() may carry several of them.
         '''
-        logger.info(f"Active chat: {self.active_chat}")
         self.logger.info(f"Started handling commands from client {client_addr}.")
-        self.active_client_connection["conn"] = client_conn
+        client = {"conn": FramedConnection(client_sock), "address": client_addr}
+        parser = FrameParser()
+        self.metrics.client_connected()
         try:
             while True:
-                data = client_conn.recv(1024)
+                data = client_sock.recv(RECV_BUFFER_SIZE)
                 if not data:
                     self.logger.info(f"Client {client_addr} disconnected.")
-                    self.disconnect_client(client_conn)
+                    break
+                if not self.handle_client_data(parser, data, client):
                     break
 
-                msg = data.decode("utf-8").strip()
-                parts = msg.split(" ", 1)
-                if len(parts) == 1:
-                    message_code_str = parts[0]
-                    args_str = ""
-                else:
-                    message_code_str, args_str = parts[0], parts[1]
+        except Exception as e:
+            self.logger.error(f"Error handling commands from client {client_addr}: {e}")
+        finally:
+            self.disconnect_client(client)
+            self.metrics.client_disconnected()
+            self.logger.info(f"Finished handling commands from client {client_addr}.")
 
-                try:
-                    message_code = int(message_code_str)
-                except ValueError:
-                    self.logger.warning(f"Invalid message code from client: {msg}")
-                    continue
 
-                if message_code == 1:
-                    # Set username of client
-                    username = args_str.strip()
-                    self.handle_client_username(username, client_conn)
-
-                elif message_code == 0:
-                    # Client wants to end the chat or quit
-                    if self.active_chat and self.active_chat.get("state") == "started":
-                        target_ip = self.active_chat["target_ip"]
-                        target_port = self.active_chat["target_port"]
-                        self.send_control_datagram(8, 0, target_ip, target_port)  # FIN
-                        self.active_chat.clear()
-
-                    # disconnect client
-                    self.disconnect_client(client_conn)
-                    break
+    def handle_client_data(self, parser: FrameParser, data: bytes, client: dict) -> bool:
+        '''
+        Feed received bytes to the client's frame parser and run every complete command, in order.
+        Return False once the client is disconnected.
+        '''
+        try:
+            frames = parser.feed(data)
+        except ValueError as e:
+            self.logger.warning(f"Invalid frame from client {client['address']}: {e}")
+            self.disconnect_client(client)
+            return False
+        for code, payload in frames:
+            if not self.handle_client_command(code, str(payload, "utf-8", "replace"), client):
+                return False
+        return True
+
+
+    def handle_client_command(self, message_code: int, args_str: str, client: dict) -> bool:
+        '''
+        Execute one command received from the client, return False once the client is disconnected.
+        '''
+        if message_code == simp_framing.USERNAME:
+            # Set username of client
+            username = args_str.strip()
+            self.handle_client_username(username, client)
+
+        elif message_code == simp_framing.QUIT:
+            # Client wants to end the chat or quit, disconnecting ends its session
+            self.disconnect_client(client, quit=True)
+            return False
+
+        elif message_code == simp_framing.STATS:
+            # Metrics snapshot, open to any client like the daemon's logs
+            client["conn"].sendall(self.metrics.render().encode("utf-8"))
+
+        elif not client.get("username"):
+            self.logger.warning(f"Command {message_code} from client {client['address']} before its username.")
+            client["conn"].sendall(b"Set a username first.\n")
+
+        elif message_code == simp_framing.START_CHAT:
+            # Start chat, "<ip>" or "<ip> <username>"
+            target = args_str.split()
+            if not target:
+                client["conn"].sendall(b"DECLINED - No target given, back to menu.")
+                return True
+            self.logger.info(f"Client {client['username']} requests to start chat with {args_str.strip()}")
+            self.start_chat_with_daemon(client, target[0], 7777, is_initiator=True,
+                                        target_user=target[1] if len(target) > 1 else None)
+
+        elif message_code == simp_framing.CHAT_DECISION:
+            # Chat request response (ACCEPT/DECLINE)
+            decision = args_str.upper().strip()
+            self.handle_client_chat_decision(decision, client)
+
+        elif message_code == simp_framing.MESSAGE:
+            # Client wants to send a message to the other , retransmit to other daemon
+            session = client.get("session")
+            if session is None or session.state != "started":
+                self.logger.warning("No active chat session. Cannot send message.")
+                client["conn"].sendall(b"Cannot send message: remote user has not accepted.\n")
+            elif len(args_str.encode("utf-8")) > self.reassembler.max_message:
+                # the peer would take all of its fragments and throw the message away
+                client["conn"].sendall(f"FAILED - Messages are at most {self.reassembler.max_message} bytes".encode("utf-8"))
+            else:
+                self.record_history(session, session.remote_user or session.peer_ip, simp_history.OUTGOING, args_str)
+                self.retransmit_message_to_other_daemon(session, args_str)
 
-                elif message_code == 2:
-                    # Start chat
-                    target_ip = args_str.strip()
-                    self.logger.info(f"Client requests to start chat with {target_ip}")
-                    self.start_chat_with_daemon(target_ip, 7777, is_initiator=True)
+        elif message_code == simp_framing.HISTORY:
+            # "last [n] [with <user>] [before <time>]" or "search [n] [with <user>] [before <time>] <words>"
+            self.handle_client_history(args_str, client)
 
-                elif message_code == 3:
-                    # Chat request response (ACCEPT/DECLINE)
-                    decision = args_str.upper().strip()
-                    self.handle_client_chat_decision(decision, client_conn)
+        elif message_code == simp_framing.GROUP:
+            # "join <ip> <name>", "say <message>" or "leave"
+            self.handle_client_group(args_str, client)
 
-                elif message_code == 4:
-                    # Client wants to send a message to the other , retransmit to other daemon
-                    self.retransmit_message_to_other_daemon(args_str)
+        else:
+            self.logger.warning(f"Unknown message code {message_code} from client {client['address']}.")
+        return True
 
-                else:
-                    self.logger.warning(f"Unknown message code {message_code} from client {client_addr}.")
 
-        except Exception as e:
-            self.logger.error(f"Error handling commands from client {client_addr}: {e}")
-        finally:
-            self.logger.info(f"Finished handling commands from client {client_addr}.")
+    def handle_client_history(self, args_str: str, client: dict):
+        '''
+        Answer a history query of the client with one notification, see simp_history.format_messages.
+        '''
+        if self.history is None:
+            client["conn"].sendall(b"FAILED - History is not kept by this daemon")
+            return
+        try:
+            query = simp_history.parse_query(args_str)
+        except ValueError as e:
+            client["conn"].sendall(f"FAILED - Invalid history query: {e}".encode("utf-8"))
+            return
+        messages = self.query_history(client["username"], query)
+        client["conn"].sendall(simp_history.format_messages(messages).encode("utf-8"))
+
+
+    def query_history(self, username: str, query: dict) -> list:
+        return self.history.query(username, query)
+
+
+    def record_history(self, session: Session, peer: str, direction: int, message: str):
+        '''
+        Keep a message of a local user's chat in the history, if the daemon keeps one.
+        '''
+        username = session.client.get("username")
+        if self.history is not None and username:
+            self.history.append(username, peer, direction, message)
+
+
+    def handle_client_group(self, args_str: str, client: dict):
+        '''
+        Group command of a client, a client is in one group at a time, next to its chat.
+        '''
+        command, _, rest = args_str.strip().partition(" ")
+        command = command.lower()
+        group = client.get("group")
+        if command == "join":
+            target = rest.split()
+            if len(target) != 2 or not simp_group.valid_name(target[1]):
+                client["conn"].sendall(b"FAILED - Usage: join <ip> <group name>, a name of letters, digits, '-' and '_'")
+            elif group is not None:
+                client["conn"].sendall(f"FAILED - Already in group {group.name}".encode("utf-8"))
+            else:
+                self.join_group(client, target[0], target[1])
+        elif command == "say":
+            if group is None:
+                client["conn"].sendall(b"FAILED - Not in a group")
+            elif group.state != "joined":
+                client["conn"].sendall(f"FAILED - Still joining group {group.name}".encode("utf-8"))
+            elif len(rest.encode("utf-8")) > simp_group.MAX_GROUP_MESSAGE:
+                client["conn"].sendall(f"FAILED - Group messages are at most {simp_group.MAX_GROUP_MESSAGE} bytes".encode("utf-8"))
+            else:
+                self.send_group_message(group, client["username"], rest)
+        elif command == "leave":
+            if group is None:
+                client["conn"].sendall(b"FAILED - Not in a group")
+            else:
+                self.leave_group(client)
+                client["conn"].sendall(f"LEFT group {group.name}".encode("utf-8"))
+        else:
+            client["conn"].sendall(f"FAILED - Unknown group command {command!r}".encode("utf-8"))
+
+
+    def join_group(self, client: dict, hub_ip: str, name: str):
+        '''
+        Put a client in the group name hosted by the daemon at hub_ip, this one included.
+        '''
+        username = client["username"]
+        if hub_ip == self.ip_address:
+            group = self.host_group(name)
+            if group is None:
+                client["conn"].sendall(b"FAILED - This daemon does not host groups")
+                return
+            created = False
+        else:
+            group, created = self.groups.member((hub_ip, 7777), name, self.peer_backoff)
+        with self.lock:
+            group.local.add(username)
+            client["group"] = group
+        self.logger.info(f"Client {username} joined {group}.")
+        if group.state == "joined":
+            client["conn"].sendall(f"SUCCESS - Joined group {name}".encode("utf-8"))
+        elif created:
+            self.send_group_join(group)
+        # otherwise the answer to the JOIN already sent tells this client too
+
+
+    def host_group(self, name: str):
+        '''
+        Group name hosted by this daemon, created on first use.
+        '''
+        return self.groups.host(name, self.peer_backoff)
+
+
+    def send_group_join(self, group):
+        ip, port = group.hub
+        self.send_control_datagram(12, 0, ip, port, encode_options({"JOIN": group.name}))  # GROUP
+        group.timer = self.timers.schedule(self.peer_backoff(group.hub, group.join_retries), self.group_join_timeout, group)
+
+
+    def group_join_timeout(self, group):
+        '''
+        Timer callback, the hub did not answer our JOIN: send it again with backoff or give up.
+        '''
+        if group.state != "joining":
+            return
+        if group.join_retries >= self.max_retries:
+            self.logger.warning(f"No answer from {group.hub[0]}:{group.hub[1]} to joining group {group.name}.")
+            self.end_group(group, f"FAILED - No answer from the host of group {group.name}")
+            return
+        group.join_retries += 1
+        self.send_group_join(group)
+
+
+    def leave_group(self, client: dict):
+        '''
+        Take a client out of its group. A member daemon leaves the hub with its last user, a hub keeps relaying
+        for its members until they are all gone.
+        '''
+        group = client.pop("group", None)
+        if group is None:
+            return
+        with self.lock:
+            group.local.discard(client.get("username"))
+            if group.local or (group.hub is None and len(group.fanout)):
+                return
+        if group.state == "joined" and group.hub is not None:
+            self.send_control_datagram(12, 0, *group.hub, encode_options({"LEAVE": group.group_id}))  # GROUP
+        self.end_group(group)
+
+
+    def end_group(self, group, notice: str = None):
+        '''
+        Forget a group, its local clients are told with notice.
+        '''
+        self.groups.remove(group)
+        with self.lock:
+            group.state = "closed"
+            if group.timer is not None:
+                group.timer.cancel()
+                group.timer = None
+            usernames = list(group.local)
+            group.local.clear()
+        self.logger.info(f"Group {group.name} closed.")
+        for username in usernames:
+            client = self.clients.get(username)
+            if client is None or client.get("group") is not group:
+                continue
+            del client["group"]
+            if notice and "conn" in client:
+                client["conn"].sendall(notice.encode("utf-8"))
+
+
+    def drop_member(self, group, peer: tuple):
+        group.fanout.remove(peer)
+        group.expected.pop(peer, None)
+        self.logger.info(f"Daemon {peer[0]}:{peer[1]} left group {group.name}.")
+        with self.lock:
+            if group.local or len(group.fanout):
+                return
+        self.end_group(group)
+
+
+    def handle_group_control(self, datagram: Datagram, address: tuple):
+        '''
+        Group membership: JOIN=name is answered by the hub with JOINED=name;ID=;SLOT=;NEXT= or FAILED=name;REASON=,
+        a member goes with LEAVE=id, a member the hub dropped is told with REMOVED=id.
+        '''
+        ip, port = address
+        options = decode_options(datagram.payload)
+        if "JOIN" in options:
+            name = options["JOIN"]
+            group = self.host_group(name) if simp_group.valid_name(name) else None
+            try:
+                if group is None:
+                    raise ValueError("Groups are not hosted here")
+                slot = group.fanout.add(address)
+            except ValueError as e:
+                self.send_control_datagram(12, 0, ip, port, encode_options({"FAILED": name, "REASON": e}))
+                return
+            # a JOIN again is a lost answer or a restarted member, either way it numbers its messages from 0
+            group.expected[address] = 0
+            self.logger.info(f"Daemon {ip}:{port} joined {group}.")
+            answer = {"JOINED": name, "ID": group.group_id, "SLOT": slot, "NEXT": group.fanout.position(address)}
+            self.send_control_datagram(12, 0, ip, port, encode_options(answer))
+
+        elif "JOINED" in options:
+            group = self.groups.joining.get((address, options["JOINED"]))
+            if group is None:
+                return
+            with self.lock:
+                if group.timer is not None:
+                    group.timer.cancel()
+                    group.timer = None
+            group.slot = int(options["SLOT"])
+            group.expected[address] = int(options["NEXT"])
+            group.fanout.add(address)
+            self.groups.joined_as(group, int(options["ID"]))
+            self.logger.info(f"Joined {group}.")
+            self.notify_group(group, f"SUCCESS - Joined group {group.name}")
+
+        elif "FAILED" in options:
+            group = self.groups.joining.get((address, options["FAILED"]))
+            if group is not None:
+                self.end_group(group, f"FAILED - {options.get('REASON', 'Rejected by the host')}")
+
+        elif "LEAVE" in options:
+            group = self.groups.hosted.get(int(options["LEAVE"]))
+            if group is not None and address in group.expected:
+                self.drop_member(group, address)
+
+        elif "REMOVED" in options:
+            group = self.groups.joined.get((address, int(options["REMOVED"])))
+            if group is not None:
+                self.end_group(group, f"GROUP_ENDED {group.name}")
+
+
+    def notify_group(self, group, notice: str, skip: str = None):
+        '''
+        Send a notification to the local clients of a group, but skip.
+        '''
+        data = notice.encode("utf-8")
+        for username in list(group.local):
+            client = self.clients.get(username)
+            conn = client.get("conn") if client is not None else None
+            if username != skip and conn is not None:
+                conn.sendall(data)
+
+
+    def send_group_message(self, group, username: str, message: str):
+        '''
+        Message of a local client: the hub delivers and relays it, a member sends it to the hub, whose relay
+        gives it its place in the group.
+        '''
+        user = username.encode("ascii", "replace")
+        payload = message.encode("utf-8")
+        if group.hub is None:
+            self.notify_group(group, f"Group message from {username} in {group.name}: {message}", skip=username)
+            self.fan_out(group, simp_group.FROM_HUB, user, payload, simp_group.HUB_ORIGIN)
+        else:
+            self.fan_out(group, simp_group.TO_HUB, user, payload, group.slot)
+
+
+    def fan_out(self, group, direction: int, user: bytes, payload: bytes, origin: int):
+        '''
+        Serialize a group message once and send the same bytes to every member daemon (to the hub for a member).
+        '''
+        prefix = simp_group.GROUP_HEADER
+        def build(number):
+            return Datagram.trusted(2, 2, direction, user, prefix.pack(group.group_id, number, origin) + payload).to_bytes()
+        number, data, peers = group.fanout.send(build, monotonic())
+        self.metrics.group_messages.inc()
+        self.metrics.group_deliveries.inc(len(peers))
+        if debug: debug("Group message %s of %s to %s daemon(s)", number, group, len(peers))
+        for ip, port in peers:
+            self.send_raw_to_daemon(data, ip, port)
+        self.arm_group_timer(group)
+
+
+    def arm_group_timer(self, group, now: float = None):
+        '''
+        One retransmission timer per group, for its earliest member deadline.
+        '''
+        deadline = group.fanout.next_deadline()
+        if deadline is None:
+            return
+        with self.lock:
+            if group.timer is not None or group.state == "closed":
+                return
+            delay = max(0.0, deadline - (monotonic() if now is None else now))
+            group.timer = self.timers.schedule(delay, self.group_timeout, group)
 
 
-    def handle_client_username(self, username: str, client_conn):
+    def group_timeout(self, group, now: float = None):
         '''
-        Handle the username sent by the client.
+        Timer callback: send again what the late members did not ACK, drop those that stopped answering.
+        A member whose hub stopped answering leaves the group.
         '''
-        logger.info(f"Active chat: {self.active_chat}")
-        self.active_client_connection["username"] = username
-        self.active_client_connection["address"] = (self.ip_address, 7778)
-        client_conn.sendall(b"SUCCESS")
+        with self.lock:
+            if group.timer is not None:
+                group.timer.cancel()
+                group.timer = None
+            if group.state == "closed":
+                return
+        now = monotonic() if now is None else now
+        resend, dead, _ = group.fanout.due(now, self.max_retries)
+        for (ip, port), messages in resend:
+            self.metrics.retransmissions.inc(len(messages))
+            for data in messages:
+                self.send_raw_to_daemon(data, ip, port)
+        for peer in dead:
+            if group.hub is not None:
+                self.logger.warning(f"No answer from the host of group {group.name}, leaving it.")
+                self.end_group(group, f"GROUP_ENDED {group.name}")
+                return
+            self.logger.warning(f"No answer from {peer[0]}:{peer[1]}, dropping it from group {group.name}.")
+            self.metrics.group_members_dropped.inc()
+            self.send_control_datagram(12, 0, *peer, encode_options({"REMOVED": group.group_id}))  # GROUP
+            self.drop_member(group, peer)
+        self.arm_group_timer(group, now)
+
+
+    def handle_group_datagram(self, datagram: Datagram, address: tuple):
+        '''
+        Group message, from a member (TO_HUB) or from the hub (FROM_HUB). Each sender's messages are taken in order
+        only, anything else waits for the retransmission, and ACKed cumulatively.
+        '''
+        direction = datagram.sequence[0]
+        payload = datagram.payload
+        if len(payload) < simp_group.GROUP_HEADER.size:
+            self.metrics.invalid.inc()
+            return
+        group_id, number, origin = simp_group.GROUP_HEADER.unpack_from(payload)
+        group = self.groups.get(address, group_id, direction)
+        with self.lock:
+            expected = group.expected.get(address) if group is not None and group.state != "closed" else None
+            if expected is not None and number == expected:
+                group.expected[address] = expected + 1
+        if expected is None:
+            self.metrics.drop("no_group")
+            if direction == simp_group.FROM_HUB and not self.groups.is_joining(address):
+                # the hub still counts us in a group we left
+                self.send_control_datagram(12, 0, *address, encode_options({"LEAVE": group_id}))  # GROUP
+            return
+        if number != expected:
+            if number < expected:
+                self.metrics.duplicates.inc()
+            else:
+                self.metrics.out_of_window.inc()
+            if expected > 0:
+                self.send_control_datagram(13, direction, *address, simp_group.GROUP_ACK.pack(group_id, expected - 1))  # GROUP_ACK
+            return
+        self.send_control_datagram(13, direction, *address, simp_group.GROUP_ACK.pack(group_id, number))  # GROUP_ACK
+
+        sender = datagram.user.decode("ascii", "replace").strip()
+        message = str(payload[simp_group.GROUP_HEADER.size:], "utf-8", "replace")
+        if direction == simp_group.TO_HUB:
+            self.notify_group(group, f"Group message from {sender} in {group.name}: {message}")
+            slot = group.fanout.slots.get(address)
+            if slot is not None:
+                self.fan_out(group, simp_group.FROM_HUB, bytes(datagram.user), bytes(payload[simp_group.GROUP_HEADER.size:]), slot)
+        else:
+            # our own users' messages come back from the hub in their place, the sender has seen it
+            skip = sender if origin == group.slot else None
+            self.notify_group(group, f"Group message from {sender} in {group.name}: {message}", skip=skip)
+
+
+    def handle_group_ack(self, datagram: Datagram, address: tuple):
+        '''
+        Cumulative ACK of group messages sent in the direction of its sequence byte.
+        '''
+        if len(datagram.payload) < simp_group.GROUP_ACK.size:
+            self.metrics.invalid.inc()
+            return
+        group_id, number = simp_group.GROUP_ACK.unpack_from(datagram.payload)
+        # messages from the hub are ACKed to the hub, and the other way
+        direction = simp_group.TO_HUB if datagram.sequence[0] == simp_group.FROM_HUB else simp_group.FROM_HUB
+        group = self.groups.get(address, group_id, direction)
+        if group is None:
+            return
+        rtt = group.fanout.ack(address, number, monotonic())
+        if rtt is not None:
+            self.get_rtt_estimator(address).sample(rtt)
+
+
+    def handle_client_username(self, username: str, client: dict):
+        '''
+        Register the client under its username, usernames are unique in the daemon.
+        '''
+        with self.lock:
+            other = self.clients.get(username)
+            if not username or (other is not None and other is not client):
+                taken = True
+            else:
+                taken = False
+                if client.get("username") and self.clients.get(client["username"]) is client:
+                    del self.clients[client["username"]]
+                client["username"] = username
+                self.clients[username] = client
+        if taken:
+            client["conn"].sendall(b"FAILED - Username already in use")
+            self.logger.info(f"Client {client['address']} asked for username '{username}', already in use.")
+            return
+        client["conn"].sendall(b"SUCCESS")
         self.logger.info(f"Client username set to '{username}'.")
+        self.replay_outbox(username, client["conn"])
+        self.resume_chat(username, client)
 
 
-    def handle_client_chat_decision(self, decision, client_conn):
-        logger.info(f"Active chat: {self.active_chat}")
-        
-        if not self.active_chat or self.active_chat.get("state") != "pending_user_acceptance":
+    def handle_client_chat_decision(self, decision, client: dict):
+        session = client.get("session")
+        if session is None or session.state != "pending_user_acceptance":
             self.logger.warning("No pending chat request.")
-            client_conn.sendall(b"No pending chat request.\n")
+            client["conn"].sendall(b"No pending chat request.\n")
             return
 
-        requester_ip = self.active_chat["target_ip"]
-        requester_port = self.active_chat["target_port"]
-
         if decision == "ACCEPT":
             self.logger.info("Client accepted the chat request.")
-            self.active_chat["state"] = "started"
-            client_conn.sendall(b"SUCCESS - Chat started.\n")
-            
+            session.state = "started"
+            self.grant_ticket(session)
+            client["conn"].sendall(b"SUCCESS - Chat started.\n")
+
             # send fake chat message to trigger chat start
-            acceptance_message = f"{self.active_client_connection.get('username', '???')} accepted."
-            self.retransmit_message_to_other_daemon(acceptance_message)
+            acceptance_message = f"{client.get('username', '???')} accepted."
+            self.retransmit_message_to_other_daemon(session, acceptance_message)
 
         else:
             self.logger.info("Client declined the chat request.")
-            self.send_control_datagram(8, 0, requester_ip, requester_port)  # FIN
-            
-            client_conn.sendall(b"DECLINED - Back to menu.\n")
-            
-            self.active_chat.clear()
-            with self.lock:
-                if (requester_ip, requester_port) in self.handshake_status:
-                    del self.handshake_status[(requester_ip, requester_port)]
+            self.send_fin(session)
+
+            client["conn"].sendall(b"DECLINED - Back to menu.\n")
+            self.close_session(session, notify=False)
 
 
 
-    def disconnect_client(self, client_conn):
+    def disconnect_client(self, client: dict, quit: bool = False):
         '''
-        Disconnect the client.
+        Disconnect the client. A QUIT ends its session with a FIN, the started chat of a connection that broke
+        is parked instead, what the connection did not deliver goes to the outbox. Safe to call more than once.
         '''
-        logger.info(f"Active chat: {self.active_chat}")
-        self.logger.info("Disconnecting client.")
         with self.lock:
-            self.active_client_connection.clear()
-        client_conn.close()
-        self.logger.info("Client disconnected.")
+            username = client.get("username")
+            if username is not None and self.clients.get(username) is client:
+                del self.clients[username]
+            conn = client.pop("conn", None)
+        unsent = None
+        if conn is not None:
+            self.logger.info(f"Disconnecting client {username or client.get('address')}.")
+            if quit or not hasattr(conn, "abort"):
+                conn.close()
+            else:
+                unsent = conn.abort()
+        if unsent:
+            self.store_unsent(client, unsent)
+        session = client.get("session")
+        if session is not None:
+            if not quit and username is not None and session.state == "started":
+                self.park_session(username, client)
+            else:
+                # the peer only knows the session once it answered the SYN
+                if session.handshake != "SYN_SENT":
+                    self.send_fin(session)
+                self.close_session(session, notify=False)
+        self.leave_group(client)
 
 
-    def start_chat_with_daemon(self, target_ip: str, target_port: int, is_initiator: bool = False):
-        logger.info(f"Active chat: {self.active_chat}")
-        if self.is_already_in_chat():
-            self.logger.info("User already in another chat. Cannot start a new one.")
-            if "conn" in self.active_client_connection:
-                self.active_client_connection["conn"].sendall(b"User already in another chat")
+    def park_session(self, username: str, client: dict):
+        '''
+        Keep the started chat of a client that went away without a QUIT, until the user is back or away_timeout.
+        '''
+        session = client.pop("session")
+        self.logger.info(f"Client of {username} is away, keeping its chat with {session.peer_ip}:{session.peer_port}.")
+        timer = self.timers.schedule(self.away_timeout, self.end_parked_session, username, session)
+        with self.lock:
+            previous = self.parked.pop(username, None)
+            self.parked[username] = (session, timer)
+        if previous is not None:
+            previous[1].cancel()
+            self.end_parked_session(username, previous[0])
+
+
+    def end_parked_session(self, username: str, session: Session):
+        '''
+        Timer wheel callback, the user of a parked chat did not come back: end it with a FIN.
+        '''
+        with self.lock:
+            parked = self.parked.get(username)
+            if parked is not None and parked[0] is session:
+                del self.parked[username]
+        if session.state == "closed":
+            return
+        self.logger.info(f"{username} did not come back, ending its chat with {session.peer_ip}:{session.peer_port}.")
+        self.send_fin(session)
+        self.close_session(session, notify=False)
+
+
+    def resume_chat(self, username: str, client: dict) -> bool:
+        '''
+        Give the chat parked for username to the user's new client, True if there was one.
+        '''
+        with self.lock:
+            if client.get("session") is not None or username not in self.parked:
+                return False
+            session, timer = self.parked.pop(username)
+            timer.cancel()
+            session.client = client
+            client["session"] = session
+        self.logger.info(f"{username} is back, resuming its chat with {session.peer_ip}:{session.peer_port}.")
+        client["conn"].sendall(b"SUCCESS - Chat started.\n")
+        return True
+
+
+    def start_chat_with_daemon(self, client: dict, target_ip: str, target_port: int, is_initiator: bool = False, target_user: str = None):
+        if self.reject_if_in_chat(client):
             return
 
         if is_initiator:
-            success = self.handshake_initiator(target_ip, target_port)
-            if success:
-                # Handshake succeeded, chat session started
-                self.logger.info("Handshake complete, now waiting for remote acceptance.")
-                if "conn" in self.active_client_connection:
-                    self.active_client_connection["conn"].sendall(
-                        b"Transport handshake OK. Waiting for remote user to accept...\n"
-                    )
-                self.active_chat["state"] = "waiting_for_first_message"
-            else:
-                self.logger.info("Handshake failed or timed out.")
+            self.begin_handshake(self.open_session(target_ip, target_port, client, target_user))
 
 
-    def handshake_initiator(self, target_ip: str, target_port: int, timeout=5):
-        logger.info(f"Active chat: {self.active_chat}")
-        self.handshake_status[(target_ip, target_port)] = "SYN_SENT"
-        self.send_control_datagram(2, 0, target_ip, target_port)  # SYN
+    def reject_if_in_chat(self, client: dict) -> bool:
+        '''
+        Tell the client it cannot start a new chat while in one, return True if it was rejected.
+        '''
+        if not self.is_already_in_chat(client):
+            return False
+        self.logger.info("User already in another chat. Cannot start a new one.")
+        client["conn"].sendall(b"User already in another chat")
+        return True
+
+
+    def handshake_finished(self, session: Session, success: bool):
+        if success:
+            # Handshake succeeded, chat session started
+            self.logger.info("Handshake complete, now waiting for remote acceptance.")
+            if "conn" in session.client:
+                session.client["conn"].sendall(
+                    b"Transport handshake OK. Waiting for remote user to accept...\n"
+                )
+            session.state = "waiting_for_first_message"
+        else:
+            self.logger.info("Handshake failed or timed out.")
 
-        start_time = time.time()
-        # Wait up to 5 seconds for SYN+ACK
-        while time.time() - start_time < timeout:
-            with self.lock:
-                state = self.handshake_status.get((target_ip, target_port))
-                if state == "SYN_ACK_RECEIVED":
-                    # Got SYN+ACK, send ACK and mark handshake complete
-                    self.send_control_datagram(4, 0, target_ip, target_port)
-                    self.handshake_status[(target_ip, target_port)] = "HANDSHAKE_COMPLETE"
-                    self.active_chat = {
-                        "target_ip": target_ip,
-                        "target_port": target_port,
-                        "state": "handshake_complete"
-                    }
-                    return True
-            time.sleep(0.3)
-        # If we reached here, handshake timed out
-        self.logger.warning("Handshake timed out.")
-        if "conn" in self.active_client_connection:
-            self.active_client_connection["conn"].sendall(b"DECLINED - Handshake timed out, back to menu.")
-
-
-        self.active_chat.clear()
+
+    def begin_handshake(self, session: Session, timeout: float = HANDSHAKE_TIMEOUT) -> Future:
+        '''
+        Send the SYN of an outgoing session and return its handshake future, nothing blocks while it runs.
+        The SYN+ACK handler or the timeout timer completes it, so any number of handshakes can be in flight.
+        '''
+        session.handshake_started = monotonic()
+        session.handshake_timer = self.timers.schedule(timeout, self.handshake_expired, session)
+        resumption = self.peer_tickets.take(session.peer)
+        if resumption is not None:
+            self.resume_handshake(session, *resumption)
+        self.retransmit_syn(session, 0)
+        return session.handshake_future
+
+
+    def resume_handshake(self, session: Session, ticket: str, params: dict):
+        '''
+        Outgoing chat with a ticket of the peer: the windows open for what was agreed last time and the handshake
+        completes right away, no round trip. The SYN carrying the ticket is resent until the SYN+ACK brings the
+        peer's session id, the peer's chat datagrams are only taken after it.
+        '''
+        session.ticket = ticket
+        session.window = params["window"]
+        session.peer_batch = params["batch"]
+        session.codec = params["codec"]
+        self.complete_handshake(session)
+        session.handshake = "RESUMED"
+        self.watch_peer(session, params["keepalive"])
+        self.handshake_finished(session, True)
         with self.lock:
-            if (target_ip, target_port) in self.handshake_status:
-                del self.handshake_status[(target_ip, target_port)]
+            if not session.handshake_future.done():
+                session.handshake_future.set_result(True)
 
-        return False
+
+    def resumption_answered(self, session: Session, options: dict, sequence: int):
+        '''
+        SYN+ACK of a resumed chat. If the peer did not take the ticket (it expired or the peer restarted) it
+        answered as to any SYN: the windows are opened again for what it agreed to and the ACK is sent.
+        '''
+        if session.handshake_timer is not None:
+            session.handshake_timer.cancel()
+        remote_id = options.get("SID")
+        self.sessions.set_remote_id(session, int(remote_id) if remote_id is not None else None)
+        session.handshake = "HANDSHAKE_COMPLETE"
+        self.record_handshake(session, True)
+        if options.get("RESUMED") == "1":
+            session.resumed = True
+            self.metrics.handshakes_resumed.inc()
+        else:
+            session.peer_batch = options.get("BATCH") == "1"
+            session.codec = simp_compress.negotiate(options.get("COMPRESS"), self.compression)
+            session.open_windows(simp_window.negotiate_window(options, self.window_size))
+            self.watch_peer(session, options.get("KEEPALIVE") == "1")
+            self.send_session_control(session, 4, sequence)  # ACK
+        self.keep_ticket(session, options)
 
 
-    def retransmit_message_to_other_daemon(self, message: str):
+    def keep_ticket(self, session: Session, options: dict):
         '''
-        Retransmit the message to the other daemon.
+        Cache the ticket of a SYN+ACK with what the handshake agreed, for the next chat with the peer.
         '''
-        logger.info(f"Active chat: {self.active_chat}")
-        logger.info(f"Retransmitting message to other daemon: {message}")
-        logger.info(f"Active chat: {self.active_chat}")
-        if not self.active_chat or self.active_chat["state"] != "started":
-            self.logger.warning("No active chat session. Cannot send message.")
-            # optionally also tell the local client:
-            if "conn" in self.active_client_connection:
-                self.active_client_connection["conn"].sendall(
-                    b"Cannot send message: remote user has not accepted.\n"
-                )
+        if "TICKET" in options:
+            self.peer_tickets.store(session.peer, options["TICKET"], {
+                "window": session.window,
+                "batch": session.peer_batch,
+                "codec": session.codec,
+                "keepalive": options.get("KEEPALIVE") == "1",
+            })
+
+
+    def handshake_acknowledged(self, session: Session):
+        '''
+        The SYN+ACK of an outgoing session arrived: complete the handshake and wake whoever waits on it.
+        '''
+        if session.handshake_timer is not None:
+            session.handshake_timer.cancel()
+        self.record_handshake(session, True)
+        self.complete_handshake(session)
+        self.handshake_finished(session, True)
+        with self.lock:
+            if session.handshake_future is not None and not session.handshake_future.done():
+                session.handshake_future.set_result(True)
+
+
+    def handshake_expired(self, session: Session):
+        '''
+        Timer callback, no SYN+ACK within the handshake timeout.
+        '''
+        if session.handshake not in ("SYN_SENT", "RESUMED"):
+            return
+        self.handshake_timed_out(session)
+        self.handshake_finished(session, False)
+
+
+    def record_handshake(self, session: Session, success: bool):
+        '''
+        Keep the outcome and latency of an outgoing handshake attempt.
+        '''
+        if session.handshake_started is None:
+            return
+        session.handshake_latency = monotonic() - session.handshake_started
+        self.handshake_attempts.append({
+            "peer": session.peer,
+            "session": session.local_id,
+            "success": success,
+            "latency": session.handshake_latency,
+        })
+        self.metrics.handshake(success, session.handshake_latency)
+        self.logger.info(f"Handshake with {session.peer_ip}:{session.peer_port} {'completed' if success else 'failed'} in {session.handshake_latency * 1000:.1f} ms.")
+
+
+    def complete_handshake(self, session: Session):
+        '''
+        Got SYN+ACK, mark handshake complete and open the windows for the agreed size
+        '''
+        session.handshake = "HANDSHAKE_COMPLETE"
+        session.state = "handshake_complete"
+        session.open_windows(session.window)
+
+
+    def handshake_timed_out(self, session: Session):
+        self.logger.warning(f"Handshake timed out, {session}.")
+        if "conn" in session.client:
+            session.client["conn"].sendall(b"DECLINED - Handshake timed out, back to menu.")
+        self.close_session(session, notify=False)
+
+
+    def retransmit_syn(self, session: Session, retries: int):
+        '''
+        Send the SYN and keep resending it from the timer wheel, with backoff, until the SYN+ACK arrives.
+        '''
+        if session.handshake not in ("SYN_SENT", "RESUMED") or retries > self.max_retries:
             return
+        # the header's user field names the user we want to chat with on the peer daemon
+        user = b"Daemon" if session.remote_user is None else session.remote_user.encode("ascii", "replace")
+        syn = Datagram.trusted(1, 2, 0, user, self.handshake_options(session))
+        self.send_datagram_to_daemon(syn, session.peer_ip, session.peer_port)  # SYN
+        rto = self.get_rtt_estimator(session.peer).backoff(retries)
+        self.timers.schedule(rto, self.retransmit_syn, session, retries + 1)
 
-        target_ip = self.active_chat["target_ip"]
-        target_port = self.active_chat["target_port"]
 
+    def retransmit_message_to_other_daemon(self, session: Session, message: str):
+        '''
+        Retransmit the message to the other daemon of the session.
+        '''
+        if debug: debug("Retransmitting message to other daemon: %s", message)
+        if session.state != "started":
+            self.logger.warning(f"Chat not started, cannot send message, {session}.")
+            return
+
+        user = session.client.get("username", "Unknown").encode("ascii", "replace")
+        payload = message.encode("utf-8")
+        operation = 1
+        if len(payload) > MAX_PAYLOAD:
+            # compress the whole message, it may fit in one datagram then or at least need fewer fragments.
+            # Smaller payloads are compressed per datagram, batches included, by Datagram.trusted
+            compressed = simp_compress.maybe_compress(session.codec, payload)
+            if compressed is not None:
+                payload, operation = compressed, 1 | CHAT_COMPRESSED
+
+        # the window hands out sequence numbers, messages past the window wait for ACKs
         with self.lock:
-             # neext sequence number
-            seq = self.expected_sequence
-            self.expected_sequence = (self.expected_sequence + 1) % 2
-
-        username = self.active_client_connection.get("username", "Unknown")
-
-        # make chat datagram to send to other daemon
-        chat_datagram = Datagram(
-            datagram_type=2,
-            operation=1,
-            sequence=seq,
-            user=username,
-            length=len(message),
-            payload=message
-        )
-        self.send_datagram_to_daemon(chat_datagram, target_ip, target_port)
-        
-        
-    def notify_client_chat_request(self, requester_ip):
-        logger.info(f"Active chat: {self.active_chat}")
-        if "conn" in self.active_client_connection and self.active_client_connection.get("username"):
-            client_conn = self.active_client_connection["conn"]
-            requester_username = self.active_client_connection.get("username", "Unknown")
-            message = f"Chat request from: {requester_ip}, {requester_username}"
-            client_conn.sendall(message.encode("utf-8"))
-            self.logger.info("Notified client about incoming chat request.")
+            send_window = session.send_window
+            if self.batch_delay > 0 and session.peer_batch and operation == 1 and simp_batch.fits(payload):
+                ready = self.add_to_batch(session, user, payload)
+            elif len(payload) <= MAX_PAYLOAD:
+                ready = self.flush_batch(session, user)
+                ready += send_window.submit({"user": user, "payload": payload, "operation": operation})
+            else:
+                # too big for one datagram, every fragment goes through the window on its own
+                ready = self.flush_batch(session, user)
+                message_id = session.next_message_id
+                session.next_message_id = (message_id + 1) & 0xFFFF
+                for fragment in split_message(payload, message_id):
+                    ready += send_window.submit({"user": user, "payload": fragment, "operation": operation | CHAT_FRAGMENT})
+        self.send_chat_datagrams(session, ready)
+
+
+    def add_to_batch(self, session: Session, user: bytes, payload: bytes) -> list:
+        '''
+        Queue a small message in the session's batch, called with the lock held. The batch goes out when
+        the next message would not fit in the datagram or batch_delay after its first message.
+        Return [(sequence, pending)] ready to send.
+        '''
+        ready = []
+        if session.batch_size + simp_batch.record_size(payload) > MAX_PAYLOAD:
+            ready = self.flush_batch(session, user)
+        session.batch.append(payload)
+        session.batch_size += simp_batch.record_size(payload)
+        if session.batch_timer is None:
+            session.batch_timer = self.timers.schedule(self.batch_delay, self.batch_timeout, session, user)
+        return ready
+
+
+    def flush_batch(self, session: Session, user: bytes) -> list:
+        '''
+        Put the queued messages in the send window as one datagram, called with the lock held.
+        '''
+        if session.batch_timer is not None:
+            session.batch_timer.cancel()
+            session.batch_timer = None
+        if not session.batch:
+            return []
+        if len(session.batch) == 1:
+            item = {"user": user, "payload": session.batch[0]}
         else:
-            self.logger.info("No client connected to handle chat request.")
-            self.send_control_datagram(8, 0, requester_ip, 7777)  # FIN
-            self.active_chat.clear()
+            item = {"user": user, "payload": simp_batch.pack_records(session.batch), "operation": 1 | CHAT_BATCH}
+        if debug: debug("Flushing %s message(s) in one datagram, %s", len(session.batch), session)
+        session.batch = []
+        session.batch_size = 0
+        return session.send_window.submit(item)
+
+
+    def batch_timeout(self, session: Session, user: bytes):
+        '''
+        Timer callback, the oldest queued message waited batch_delay: send the batch as it is.
+        '''
+        with self.lock:
+            if session.state == "closed":
+                return
+            session.batch_timer = None
+            ready = self.flush_batch(session, user)
+        self.send_chat_datagrams(session, ready)
+
+
+    def send_chat_datagrams(self, session: Session, ready: list):
+        '''
+        Send chat datagrams that just entered the send window and arm their retransmission timers.
+        ready is [(sequence, pending)], pending is the dict the window keeps until the datagram is ACKed.
+        '''
+        rtt = self.get_rtt_estimator(session.peer)
+        for seq, pending in ready:
+            # make chat datagram to send to other daemon
+            chat_datagram = Datagram.trusted(2, pending.get("operation", 1), seq, pending["user"], pending["payload"],
+                                            session.remote_id, session.codec)
+            pending["data"] = chat_datagram.to_bytes()
+            pending["retries"] = 0
+            pending["sent"] = monotonic()
+            pending["timer"] = self.timers.schedule(rtt.rto, self.retransmit_timeout, session, pending)
+            self.send_raw_to_daemon(pending["data"], session.peer_ip, session.peer_port)
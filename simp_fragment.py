@@ -0,0 +1,112 @@
+import struct
+import threading
+from Datagram import HEADER_SIZE, SESSION_ID
+from logger import get_logger
+
+logger = get_logger("fragment")
+
+# fragment sub-header at the start of a fragmented chat payload: message id, index, count, total message size
+FRAGMENT = struct.Struct("!HHHI")
+
+# keep every datagram below a typical 1500 byte MTU so IP never fragments it
+MAX_DATAGRAM_SIZE = 1200
+# chat payload that fits in one datagram, session id included
+MAX_PAYLOAD = MAX_DATAGRAM_SIZE - HEADER_SIZE - SESSION_ID.size
+MAX_FRAGMENT_DATA = MAX_PAYLOAD - FRAGMENT.size
+
+
+def fragment_size(total: int, count: int) -> int:
+    '''
+    Size of every fragment but the last one, both sides derive it from the total size and fragment count.
+    '''
+    return -(-total // count)
+
+
+def split_message(payload: bytes, message_id: int, max_data: int = MAX_FRAGMENT_DATA) -> list:
+    '''
+    Split a payload into fragment payloads (sub-header + chunk) that each fit in one datagram.
+    '''
+    total = len(payload)
+    count = -(-total // max_data)
+    size = fragment_size(total, count)
+    view = memoryview(payload)
+    return [
+        FRAGMENT.pack(message_id, index, count, total) + view[index * size:(index + 1) * size]
+        for index in range(count)
+    ]
+
+
+class Reassembler:
+    '''
+    Rebuilds fragmented messages in buffers preallocated from the total size in the fragment header.
+    Memory used by incomplete messages is capped, they are dropped after timeout seconds by the timer wheel.
+    '''
+    def __init__(self, timers=None, timeout: float = 30.0, max_bytes: int = 4 * 1024 * 1024, max_message: int = 1024 * 1024) -> None:
+        self.timers = timers
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_message = max_message
+        self.partial = {}  # key -> {"buffer": ..., "received": ..., "remaining": ...}
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def add(self, key, fragment):
+        '''
+        Add one fragment payload, key identifies the sender (the message id comes from the fragment).
+        Return the complete message or None. Raises ValueError for malformed fragments or when the memory cap is reached.
+        '''
+        if len(fragment) < FRAGMENT.size:
+            raise ValueError("Fragment is too short")
+        message_id, index, count, total = FRAGMENT.unpack_from(fragment)
+        data = fragment[FRAGMENT.size:]
+        if count == 0 or index >= count or total > self.max_message:
+            raise ValueError(f"Invalid fragment {index}/{count} of {total} bytes")
+
+        size = fragment_size(total, count)
+        offset = index * size
+        if len(data) != min(size, total - offset):
+            raise ValueError(f"Invalid fragment size {len(data)} for fragment {index}/{count}")
+
+        if count == 1:
+            return bytes(data)
+
+        key = (key, message_id)
+        with self.lock:
+            entry = self.partial.get(key)
+            if entry is None:
+                if self.used + total > self.max_bytes:
+                    raise ValueError(f"Reassembly memory cap reached, dropping message {message_id}")
+                entry = self.partial[key] = {"buffer": bytearray(total), "received": bytearray(count), "remaining": count}
+                self.used += total
+                if self.timers is not None:
+                    entry["timer"] = self.timers.schedule(self.timeout, self.expire, key)
+            elif len(entry["buffer"]) != total or len(entry["received"]) != count:
+                raise ValueError(f"Fragment {index}/{count} does not match message {message_id}")
+
+            if not entry["received"][index]:
+                entry["buffer"][offset:offset + len(data)] = data
+                entry["received"][index] = 1
+                entry["remaining"] -= 1
+
+            if entry["remaining"] != 0:
+                return None
+            del self.partial[key]
+            self.used -= total
+        if "timer" in entry:
+            entry["timer"].cancel()
+        return entry["buffer"]
+
+    def expire(self, message_key) -> bool:
+        '''
+        Drop an incomplete message, return True if it was still waiting for fragments.
+        '''
+        with self.lock:
+            entry = self.partial.pop(message_key, None)
+            if entry is None:
+                return False
+            self.used -= len(entry["buffer"])
+        logger.warning(f"Dropping incomplete message {message_key}, {entry['remaining']} fragment(s) missing.")
+        return True
+
+    def __len__(self):
+        return len(self.partial)
@@ -0,0 +1,179 @@
+import socket
+import struct
+import threading
+from collections import deque
+from logger import get_logger
+
+logger = get_logger("framing")
+
+# every frame on the client <-> daemon TCP channel: payload length, command code, utf-8 payload
+FRAME = struct.Struct("!IB")
+FRAME_SIZE = FRAME.size
+
+# largest accepted payload, enough for any chat message the daemon can fragment
+MAX_FRAME = 1024 * 1024
+
+# bytes a daemon queues for one client before it gives up on it
+MAX_QUEUED = 4 * 1024 * 1024
+# seconds abort() waits for the writer thread of a broken connection
+ABORT_TIMEOUT = 1.0
+
+# client -> daemon command codes
+QUIT = 0
+USERNAME = 1
+START_CHAT = 2
+CHAT_DECISION = 3
+MESSAGE = 4
+# metrics snapshot of the daemon, answered with one NOTIFY in the Prometheus text format
+STATS = 5
+# last messages or search of the user's chat history, answered with one NOTIFY
+HISTORY = 6
+# group chat, "join <ip> <name>" (the group is created on that daemon if it has none), "say <message>" or "leave"
+GROUP = 7
+# daemon -> client, payload is the notification text ("SUCCESS", "Message from ...", ...)
+NOTIFY = 16
+
+
+def encode_frame(code: int, payload=b"") -> bytes:
+    '''
+    Frame one command, payload can be str (sent as utf-8) or bytes.
+    '''
+    payload = payload.encode("utf-8") if isinstance(payload, str) else payload
+    if len(payload) > MAX_FRAME:
+        raise ValueError(f"Frame payload too large: {len(payload)} bytes")
+    return FRAME.pack(len(payload), code) + payload
+
+
+class FrameParser:
+    '''
+    Incremental frame decoder: feed it whatever recv() returned, it buffers partial frames
+    and returns every complete one, so coalesced or split TCP reads are handled the same way.
+    '''
+    def __init__(self, max_frame: int = MAX_FRAME) -> None:
+        self.buffer = bytearray()
+        self.max_frame = max_frame
+
+    def feed(self, data) -> list:
+        '''
+        Add received bytes, return [(code, payload)] for the frames completed by them.
+        Raises ValueError for a frame larger than max_frame, the stream cannot be resynchronised after it.
+        '''
+        self.buffer += data
+        frames = []
+        view = memoryview(self.buffer)
+        start = 0
+        try:
+            while len(view) - start >= FRAME_SIZE:
+                length, code = FRAME.unpack_from(view, start)
+                if length > self.max_frame:
+                    raise ValueError(f"Frame too large: {length} bytes")
+                end = start + FRAME_SIZE + length
+                if end > len(view):
+                    break
+                frames.append((code, bytes(view[start + FRAME_SIZE:end])))
+                start = end
+        finally:
+            view.release()
+        if start:
+            del self.buffer[:start]
+        return frames
+
+    def __len__(self):
+        return len(self.buffer)
+
+
+class FramedConnection:
+    '''
+    Client socket as seen by the daemon handlers: sendall() queues the data as one NOTIFY frame.
+    Every client has its own outbound queue drained by a writer thread, so a slow client never blocks
+    the daemon threads. A client that lets more than max_queued bytes pile up is disconnected.
+    The frames a broken connection could not send are kept until abort() takes them.
+    '''
+    def __init__(self, sock, max_queued: int = MAX_QUEUED) -> None:
+        self.sock = sock
+        self.max_queued = max_queued
+        self.queue = deque()
+        self.queued = 0
+        self.closed = False
+        self.ready = threading.Condition()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def sendall(self, data: bytes) -> bool:
+        '''
+        Queue data for the client, return False if the connection was closed already and it was not queued.
+        '''
+        frame = encode_frame(NOTIFY, data)
+        with self.ready:
+            if self.closed:
+                return False
+            self.queue.append(frame)
+            self.queued += len(frame)
+            if self.queued > self.max_queued:
+                logger.warning(f"Client outbound queue over {self.max_queued} bytes, disconnecting it.")
+                # the queued frames, this one too, are kept for abort()
+                self.closed = True
+                try:
+                    # the writer thread may be blocked in sendall on this client
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self.ready.notify()
+        return True
+
+    def write_loop(self):
+        '''
+        Writer thread: send everything queued in one sendall, until closed and flushed.
+        '''
+        while True:
+            with self.ready:
+                while not self.queue and not self.closed:
+                    self.ready.wait()
+                if not self.queue:
+                    break
+                frames = b"".join(self.queue)
+                self.queue.clear()
+                self.queued = 0
+            try:
+                self.sock.sendall(frames)
+            except OSError:
+                with self.ready:
+                    # the client may not have any of them, abort() hands them back
+                    self.closed = True
+                    self.queue.appendleft(frames)
+                    self.queued += len(frames)
+                break
+        try:
+            # also wakes up the thread blocked in recv() on this socket
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def close(self):
+        '''
+        Close once the queued frames are sent.
+        '''
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+
+    def abort(self, timeout: float = ABORT_TIMEOUT) -> list:
+        '''
+        Close a connection that broke without flushing it, return the payloads of the NOTIFY frames the client
+        did not get, in order. The frames the writer was sending when it broke are in them, the client may have some.
+        '''
+        try:
+            # nothing goes out anymore, a writer blocked in sendall gives its frames back
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+        self.writer.join(timeout)
+        with self.ready:
+            data = b"".join(self.queue)
+            self.queue.clear()
+            self.queued = 0
+        return [payload for code, payload in FrameParser(MAX_QUEUED).feed(data) if code == NOTIFY]
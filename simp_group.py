@@ -0,0 +1,287 @@
+import struct
+import threading
+from array import array
+from collections import deque
+from itertools import islice
+from simp_fragment import MAX_PAYLOAD
+
+# payload of a group chat datagram: group id given by the hub, message number, origin slot, then the message
+GROUP_HEADER = struct.Struct("!IQH")
+# payload of a GROUP_ACK: group id, every message up to this number was received
+GROUP_ACK = struct.Struct("!IQ")
+# longest message of a group, a group message is never fragmented
+MAX_GROUP_MESSAGE = MAX_PAYLOAD - GROUP_HEADER.size
+# origin of the messages written on the hub, and of every message a member sends to its hub
+HUB_ORIGIN = 0xFFFF
+# sequence byte of group datagrams and ACKs: the way the message goes
+FROM_HUB = 0
+TO_HUB = 1
+# member daemons of a group, slots are 16 bit and HUB_ORIGIN is taken
+MAX_MEMBERS = 0xFFFE
+# messages a member can lag behind before the hub drops it, bounds what the hub keeps for a slow member
+MAX_BACKLOG = 256
+
+
+def valid_name(name: str) -> bool:
+    '''
+    Group names travel in the options of GROUP datagrams: letters, digits, '-' and '_', at most 32 of them.
+    '''
+    return 0 < len(name) <= 32 and name.isascii() and name.replace("-", "").replace("_", "").isalnum()
+
+
+class FanOut:
+    '''
+    Sending side of a group session: our messages to every member daemon (a hub) or to the hub (a member).
+    A message is serialized once and the same bytes go to every member, again for every retransmission.
+    Members have a slot, their state is one entry in each parallel array: last message ACKed, retransmissions in
+    a row and retransmission deadline (0 when nothing is outstanding). A free slot goes to the next member.
+    Messages are kept until every member ACKed them, ACKs are cumulative and go back N on a loss.
+    '''
+    def __init__(self, timeout) -> None:
+        # timeout(peer, retries) -> seconds to wait for the ACK of a member, retransmissions so far given
+        self.timeout = timeout
+        self.peers = []  # slot -> (ip, port), None for a free slot
+        self.slots = {}  # (ip, port) -> slot
+        self.free = []
+        self.acked = array("q")
+        self.retries = array("B")
+        self.deadline = array("d")
+        # [data, sent, members left to ACK] of the messages not ACKed by every member, number first is first
+        self.messages = deque()
+        self.first = 0
+        self.next_number = 0
+        self.lock = threading.Lock()
+
+    def add(self, peer: tuple) -> int:
+        '''
+        Slot of a member, new members get the messages sent from now on. ValueError if the group is full.
+        '''
+        with self.lock:
+            slot = self.slots.get(peer)
+            if slot is not None:
+                return slot
+            if self.free:
+                slot = self.free.pop()
+                self.peers[slot] = peer
+                self.acked[slot] = self.next_number - 1
+                self.retries[slot] = 0
+                self.deadline[slot] = 0.0
+            elif len(self.peers) >= MAX_MEMBERS:
+                raise ValueError("Group is full")
+            else:
+                slot = len(self.peers)
+                self.peers.append(peer)
+                self.acked.append(self.next_number - 1)
+                self.retries.append(0)
+                self.deadline.append(0.0)
+            self.slots[peer] = slot
+            return slot
+
+    def remove(self, peer: tuple):
+        with self.lock:
+            slot = self.slots.pop(peer, None)
+            if slot is None:
+                return
+            self.release(slot, self.next_number)
+            self.peers[slot] = None
+            self.deadline[slot] = 0.0
+            self.free.append(slot)
+            self.collect()
+
+    def send(self, build, now: float) -> tuple:
+        '''
+        Number the next message and serialize it once, build(number) returns its datagram bytes.
+        Return (number, data, [member peers]) to send the data to.
+        '''
+        with self.lock:
+            number = self.next_number
+            self.next_number += 1
+            data = build(number)
+            peers = [peer for peer in self.peers if peer is not None]
+            if not peers:
+                self.first = self.next_number
+                return number, data, peers
+            self.messages.append([data, now, len(peers)])
+            for peer in peers:
+                slot = self.slots[peer]
+                if self.deadline[slot] == 0.0:
+                    self.deadline[slot] = now + self.timeout(peer, 0)
+            return number, data, peers
+
+    def ack(self, peer: tuple, number: int, now: float):
+        '''
+        Cumulative ACK of a member, return an RTT sample (Karn: none after a retransmission) or None.
+        '''
+        with self.lock:
+            slot = self.slots.get(peer)
+            if slot is None or number <= self.acked[slot] or number >= self.next_number:
+                return None
+            sample = None
+            if self.retries[slot] == 0 and number >= self.first:
+                sample = now - self.messages[number - self.first][1]
+            self.release(slot, number + 1)
+            self.acked[slot] = number
+            self.retries[slot] = 0
+            self.deadline[slot] = 0.0 if number == self.next_number - 1 else now + self.timeout(peer, 0)
+            self.collect()
+            return sample
+
+    def due(self, now: float, max_retries: int) -> tuple:
+        '''
+        ([(peer, [data])] to send again, [dead member peers], next deadline or None). A member is dead when it
+        missed max_retries retransmissions or lags more than MAX_BACKLOG messages, it is left to the caller to remove.
+        '''
+        resend, dead = [], []
+        following = None
+        with self.lock:
+            for slot, deadline in enumerate(self.deadline):
+                if deadline == 0.0:
+                    continue
+                if deadline > now:
+                    following = deadline if following is None else min(following, deadline)
+                    continue
+                peer = self.peers[slot]
+                if self.retries[slot] >= max_retries or self.next_number - 1 - self.acked[slot] > MAX_BACKLOG:
+                    dead.append(peer)
+                    self.deadline[slot] = 0.0
+                    continue
+                self.retries[slot] += 1
+                deadline = self.deadline[slot] = now + self.timeout(peer, self.retries[slot])
+                following = deadline if following is None else min(following, deadline)
+                start = self.acked[slot] + 1 - self.first
+                resend.append((peer, [message[0] for message in islice(self.messages, start, None)]))
+        return resend, dead, following
+
+    def release(self, slot: int, end: int):
+        '''
+        The member of slot no longer needs the messages before end, called with the lock held.
+        '''
+        for index in range(max(self.acked[slot] + 1, self.first) - self.first, end - self.first):
+            self.messages[index][2] -= 1
+
+    def collect(self):
+        '''
+        Drop the messages every member ACKed, called with the lock held.
+        '''
+        while self.messages and self.messages[0][2] <= 0:
+            self.messages.popleft()
+            self.first += 1
+
+    def next_deadline(self):
+        with self.lock:
+            deadlines = [deadline for deadline in self.deadline if deadline]
+        return min(deadlines) if deadlines else None
+
+    def position(self, peer: tuple) -> int:
+        '''
+        Number of the next message a member expects.
+        '''
+        return self.acked[self.slots[peer]] + 1
+
+    def __len__(self):
+        return len(self.slots)
+
+
+class GroupSession:
+    '''
+    One group chat as this daemon sees it. The hub is the daemon the group was created on, it numbers the group
+    and relays every message to the member daemons, so every member sees the same order. A member sends the
+    messages of its users to the hub only. hub is None on the hub.
+    '''
+    __slots__ = ("group_id", "name", "hub", "slot", "state", "local", "fanout", "expected", "timer", "join_retries")
+
+    def __init__(self, group_id: int, name: str, hub: tuple, timeout) -> None:
+        self.group_id = group_id
+        self.name = name
+        self.hub = hub
+        # our slot at the hub, HUB_ORIGIN on the hub
+        self.slot = HUB_ORIGIN
+        # "joining" until the hub answers our JOIN, then "joined"
+        self.state = "joined" if hub is None else "joining"
+        # usernames of the local clients in the group
+        self.local = set()
+        self.fanout = FanOut(timeout)
+        # (ip, port) -> number of the next message expected from that daemon
+        self.expected = {}
+        # retransmission timer of the fanout, one for the whole group
+        self.timer = None
+        self.join_retries = 0
+
+    def __repr__(self):
+        where = "hub" if self.hub is None else f"{self.hub[0]}:{self.hub[1]}"
+        return f"GroupSession({self.name!r} #{self.group_id} at {where}, {self.state}, {len(self.fanout)} member(s))"
+
+
+class GroupTable:
+    '''
+    The groups of a daemon: those it hosts by id and by name, those it joined by (hub, group id) and
+    those it is joining by (hub, name).
+    '''
+    def __init__(self) -> None:
+        self.hosted = {}
+        self.names = {}
+        self.joined = {}
+        self.joining = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def host(self, name: str, timeout) -> GroupSession:
+        '''
+        Hosted group of that name, created if there is none.
+        '''
+        with self.lock:
+            group = self.names.get(name)
+            if group is None:
+                group = GroupSession(self.next_id, name, None, timeout)
+                self.next_id = (self.next_id + 1) & 0xFFFFFFFF or 1
+                self.hosted[group.group_id] = self.names[name] = group
+            return group
+
+    def member(self, hub: tuple, name: str, timeout) -> tuple:
+        '''
+        (group, created) of the group of that name hosted by hub, joined or being joined.
+        '''
+        with self.lock:
+            group = self.joining.get((hub, name))
+            if group is None:
+                group = next((group for (peer, _), group in self.joined.items() if peer == hub and group.name == name), None)
+            if group is not None:
+                return group, False
+            group = self.joining[hub, name] = GroupSession(0, name, hub, timeout)
+            return group, True
+
+    def joined_as(self, group: GroupSession, group_id: int):
+        with self.lock:
+            self.joining.pop((group.hub, group.name), None)
+            group.group_id = group_id
+            group.state = "joined"
+            self.joined[group.hub, group_id] = group
+
+    def is_joining(self, hub: tuple) -> bool:
+        '''
+        True while we wait for hub to answer a JOIN, its first messages may come before the answer.
+        '''
+        with self.lock:
+            return any(peer == hub for peer, _ in self.joining)
+
+    def get(self, peer: tuple, group_id: int, direction: int):
+        '''
+        Group of a datagram from peer: a hosted one for TO_HUB, a joined one for FROM_HUB.
+        '''
+        if direction == TO_HUB:
+            return self.hosted.get(group_id)
+        return self.joined.get((peer, group_id))
+
+    def remove(self, group: GroupSession):
+        with self.lock:
+            if group.hub is None:
+                self.hosted.pop(group.group_id, None)
+                if self.names.get(group.name) is group:
+                    del self.names[group.name]
+            else:
+                self.joining.pop((group.hub, group.name), None)
+                if self.joined.get((group.hub, group.group_id)) is group:
+                    del self.joined[group.hub, group.group_id]
+
+    def __len__(self):
+        return len(self.hosted) + len(self.joined) + len(self.joining)
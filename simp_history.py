@@ -0,0 +1,336 @@
+import hashlib
+import os
+import re
+import struct
+import threading
+import time
+from collections import OrderedDict
+from logger import get_logger
+
+logger = get_logger("history")
+
+DATA_FILE = "messages.log"
+# one message: time, direction, owner, peer and text lengths, then the three utf-8 strings
+RECORD = struct.Struct("!dBHHI")
+INCOMING = 0
+OUTGOING = 1
+# time index of a user (all.idx), of a user and peer (peer-<key>.idx) and of a user and word, the postings of
+# the inverted index (word-<hash>.idx): (time, record offset), in time order
+ENTRY = struct.Struct("!dQ")
+WORD = re.compile(r"\w+")
+# words of one message that are indexed
+MAX_WORDS = 64
+
+# appends are buffered, written out this often and before every lookup
+FLUSH_INTERVAL = 1.0
+# index files kept open for appends, the least recently used is closed past it
+MAX_OPEN_FILES = 256
+# messages one lookup returns at most, and by default
+MAX_RESULTS = 200
+DEFAULT_RESULTS = 20
+
+
+def file_key(name: str) -> str:
+    '''
+    File name safe key of a username.
+    '''
+    return hashlib.sha1(name.encode("utf-8")).hexdigest()[:20]
+
+
+def word_hash(word: str) -> int:
+    return int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def message_words(text: str) -> list:
+    return list(dict.fromkeys(WORD.findall(text.lower())))[:MAX_WORDS]
+
+
+def parse_query(args: str) -> dict:
+    '''
+    History command arguments: "last [n] [with <peer>] [before <time>]" or
+    "search [n] [with <peer>] [before <time>] <words>". Raises ValueError for anything else.
+    '''
+    tokens = args.split()
+    if not tokens or tokens[0] not in ("last", "search"):
+        raise ValueError("Expected 'last' or 'search'")
+    query = {"kind": tokens[0], "count": DEFAULT_RESULTS, "peer": None, "before": None, "words": []}
+    rest = tokens[1:]
+    if rest and rest[0].isdigit():
+        query["count"] = min(int(rest.pop(0)), MAX_RESULTS)
+        if query["count"] == 0:
+            raise ValueError("Expected at least 1 message")
+    while rest:
+        token = rest.pop(0)
+        if token in ("with", "before") and rest:
+            value = rest.pop(0)
+            query["peer" if token == "with" else "before"] = value if token == "with" else float(value)
+        else:
+            query["words"].append(token)
+    if query["kind"] == "search" and not message_words(" ".join(query["words"])):
+        raise ValueError("Nothing to search for")
+    if query["kind"] == "last" and query["words"]:
+        raise ValueError(f"Unexpected {' '.join(query['words'])!r}")
+    return query
+
+
+def format_messages(messages: list) -> str:
+    '''
+    Reply of the history command: a "HISTORY <count>" line, then one "<time> <direction> <peer>: <text>" line
+    per message, oldest first, ">" for sent and "<" for received. Pass the oldest time as before for the previous page.
+    '''
+    lines = [f"HISTORY {len(messages)}"]
+    for timestamp, direction, peer, text in messages:
+        arrow = ">" if direction == OUTGOING else "<"
+        # one line per message
+        text = text.replace("\\", "\\\\").replace("\n", "\\n")
+        lines.append(f"{timestamp:.6f} {arrow} {peer}: {text}")
+    return "\n".join(lines)
+
+
+class HistoryStore:
+    '''
+    Chat history of the users of a daemon. Messages are appended to one data file, every lookup goes through
+    fixed size index entries: a time index per user and per user and peer, binary searched for pages, and an
+    optional inverted index per user, one time index per word, so a search page reads the entries of its page only.
+    Nothing is ever scanned or loaded at startup, a lookup costs a few reads whatever the size of the history.
+    A readonly store reads the files of another process (a sibling worker).
+    '''
+    def __init__(self, directory: str, words: bool = True, schedule=None, readonly: bool = False) -> None:
+        self.directory = directory
+        self.words = words
+        self.schedule = schedule
+        self.readonly = readonly
+        self.data_path = os.path.join(directory, DATA_FILE)
+        self.data = None
+        self.size = 0
+        # (owner, index name) -> file open for appends, least recently used first
+        self.files = OrderedDict()
+        # file keys of the usernames seen, hashed once
+        self.keys = {}
+        self.last_time = 0.0
+        self.flush_scheduled = False
+        self.lock = threading.Lock()
+        if not readonly:
+            os.makedirs(directory, exist_ok=True)
+            self.data = open(self.data_path, "ab")
+            self.size = self.data.tell()
+
+    def user_path(self, owner: str, name: str) -> str:
+        return os.path.join(self.directory, "users", file_key(owner), name)
+
+    def key(self, name: str) -> str:
+        key = self.keys.get(name)
+        if key is None:
+            if len(self.keys) >= 65536:
+                self.keys.clear()
+            key = self.keys[name] = file_key(name)
+        return key
+
+    def append(self, owner: str, peer: str, direction: int, text: str):
+        '''
+        Record one message of owner's chat with peer.
+        '''
+        owner_bytes, peer_bytes, text_bytes = owner.encode("utf-8"), peer.encode("utf-8"), text.encode("utf-8")
+        with self.lock:
+            if self.data is None:
+                return
+            # strictly increasing, a time is a cursor for exactly one message
+            timestamp = self.last_time = max(time.time(), self.last_time + 1e-6)
+            offset = self.size
+            record = RECORD.pack(timestamp, direction, len(owner_bytes), len(peer_bytes), len(text_bytes))
+            self.data.write(record + owner_bytes + peer_bytes + text_bytes)
+            self.size += len(record) + len(owner_bytes) + len(peer_bytes) + len(text_bytes)
+
+            entry = ENTRY.pack(timestamp, offset)
+            self.write(owner, "all.idx", entry)
+            self.write(owner, f"peer-{self.key(peer)}.idx", entry)
+            if self.words:
+                for word in message_words(text):
+                    self.write(owner, f"word-{word_hash(word):016x}.idx", entry)
+
+            if self.schedule is not None and not self.flush_scheduled:
+                self.flush_scheduled = True
+                self.schedule(FLUSH_INTERVAL, self.flush)
+
+    def write(self, owner: str, name: str, data: bytes):
+        '''
+        Append to one of owner's index files.
+        '''
+        f = self.files.pop((owner, name), None)
+        if f is None:
+            directory = os.path.join(self.directory, "users", self.key(owner))
+            os.makedirs(directory, exist_ok=True)
+            f = open(os.path.join(directory, name), "ab")
+            torn = f.tell() % ENTRY.size
+            if torn:
+                # the last entry of a crashed run, the next ones must stay aligned
+                f.truncate(f.tell() - torn)
+                f.seek(0, os.SEEK_END)
+            if len(self.files) >= MAX_OPEN_FILES:
+                # an index entry never reaches the disk before its record
+                self.data.flush()
+                self.files.popitem(last=False)[1].close()
+        self.files[owner, name] = f
+        f.write(data)
+
+    def flush(self):
+        with self.lock:
+            self.flush_scheduled = False
+            self.flush_locked()
+
+    def flush_locked(self):
+        if self.data is not None:
+            self.data.flush()
+            for f in self.files.values():
+                f.flush()
+
+    def close(self):
+        with self.lock:
+            if self.data is None:
+                return
+            self.flush_locked()
+            for f in self.files.values():
+                f.close()
+            self.files.clear()
+            self.data.close()
+            self.data = None
+
+    def snapshot(self, owner: str, names: list) -> list:
+        '''
+        Sizes of owner's index files, None for a missing one, once what was appended so far is written out.
+        Files only grow and a record is written before its index entries: a lookup reads up to these sizes
+        without the lock, appends go on meanwhile.
+        '''
+        sizes = []
+        with self.lock:
+            self.flush_locked()
+            for name in names:
+                try:
+                    sizes.append(os.stat(self.user_path(owner, name)).st_size)
+                except FileNotFoundError:
+                    sizes.append(None)
+        return sizes
+
+    def last(self, owner: str, count: int, peer: str = None, before: float = None) -> list:
+        '''
+        Last count messages of owner (with peer only, if given) older than before, oldest first:
+        a binary search of the time index and one read of the entries.
+        '''
+        name = "all.idx" if peer is None else f"peer-{file_key(peer)}.idx"
+        size, = self.snapshot(owner, [name])
+        if size is None:
+            return []
+        try:
+            index = os.open(self.user_path(owner, name), os.O_RDONLY)
+        except FileNotFoundError:
+            return []
+        try:
+            total = size // ENTRY.size
+            end = total if before is None else self.bisect(index, total, before)
+            start = max(0, end - count)
+            data = os.pread(index, (end - start) * ENTRY.size, start * ENTRY.size)
+        finally:
+            os.close(index)
+        return self.read_records(owner, [offset for _, offset in ENTRY.iter_unpack(data)])
+
+    def bisect(self, index: int, total: int, before: float) -> int:
+        '''
+        Position of the first entry at or after before, log2(total) reads of one entry.
+        '''
+        low, high = 0, total
+        while low < high:
+            middle = (low + high) // 2
+            timestamp, _ = ENTRY.unpack(os.pread(index, ENTRY.size, middle * ENTRY.size))
+            if timestamp < before:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def search(self, owner: str, words: list, count: int, peer: str = None, before: float = None) -> list:
+        '''
+        Last count messages of owner holding every word, oldest first. The time index of the rarest word, or of
+        the peer, is read backwards a page at a time, an entry is kept if the other indexes have its time too,
+        a binary search in each. The records are only read for the entries every index has.
+        '''
+        words = message_words(" ".join(words))
+        if not words or count <= 0:
+            return []
+        names = [f"word-{word_hash(word):016x}.idx" for word in words]
+        if peer is not None:
+            names.append(f"peer-{file_key(peer)}.idx")
+        sizes = self.snapshot(owner, names)
+        if None in sizes:
+            return []
+        indexes = []
+        try:
+            for name, size in zip(names, sizes):
+                indexes.append((os.open(self.user_path(owner, name), os.O_RDONLY), size // ENTRY.size))
+        except FileNotFoundError:
+            for index, _ in indexes:
+                os.close(index)
+            return []
+        try:
+            indexes.sort(key=lambda item: item[1])
+            (driver, total), others = indexes[0], indexes[1:]
+            end = total if before is None else self.bisect(driver, total, before)
+
+            # newest first until count messages really match, a hash collision is skipped
+            found = []
+            while end > 0 and len(found) < count:
+                start = max(0, end - count)
+                data = os.pread(driver, (end - start) * ENTRY.size, start * ENTRY.size)
+                end = start
+                offsets = [offset for timestamp, offset in ENTRY.iter_unpack(data)
+                           if all(self.contains(index, other_total, timestamp) for index, other_total in others)]
+                for message in reversed(self.read_records(owner, offsets)):
+                    timestamp, _, message_peer, text = message
+                    if peer is not None and message_peer != peer:
+                        continue
+                    if set(words) <= set(message_words(text)) and len(found) < count:
+                        found.append(message)
+        finally:
+            for index, _ in indexes:
+                os.close(index)
+        return found[::-1]
+
+    def contains(self, index: int, total: int, timestamp: float) -> bool:
+        '''
+        Whether a time index has the entry of the message at timestamp, times are unique.
+        '''
+        position = self.bisect(index, total, timestamp)
+        return position < total and ENTRY.unpack(os.pread(index, ENTRY.size, position * ENTRY.size))[0] == timestamp
+
+    def read_records(self, owner: str, offsets: list) -> list:
+        '''
+        [(time, direction, peer, text)] of the records at offsets, skipping any not fully written or of another owner.
+        '''
+        messages = []
+        try:
+            data = os.open(self.data_path, os.O_RDONLY)
+        except FileNotFoundError:
+            return messages
+        try:
+            for offset in offsets:
+                header = os.pread(data, RECORD.size, offset)
+                if len(header) < RECORD.size:
+                    continue
+                timestamp, direction, owner_length, peer_length, text_length = RECORD.unpack(header)
+                body = os.pread(data, owner_length + peer_length + text_length, offset + RECORD.size)
+                if len(body) < owner_length + peer_length + text_length:
+                    continue
+                if str(body[:owner_length], "utf-8", "replace") != owner:
+                    continue
+                peer = str(body[owner_length:owner_length + peer_length], "utf-8", "replace")
+                messages.append((timestamp, direction, peer, str(body[owner_length + peer_length:], "utf-8", "replace")))
+        finally:
+            os.close(data)
+        return messages
+
+    def query(self, owner: str, query: dict) -> list:
+        '''
+        Run a query from parse_query.
+        '''
+        if query["kind"] == "search":
+            return self.search(owner, query["words"], query["count"], query["peer"], query["before"])
+        return self.last(owner, query["count"], query["peer"], query["before"])
@@ -0,0 +1,93 @@
+import threading
+from simp_timers import monotonic
+
+# seconds without any datagram from a peer before it is probed, traffic of any kind counts
+KEEPALIVE_IDLE = 2.0
+# unanswered probes in a row before the peer is dead
+KEEPALIVE_PROBES = 3
+# shortest time between two probes of a peer, its RTO when that is longer
+PROBE_INTERVAL = 1.0
+# one timer sweeps the whole table this often
+SWEEP_INTERVAL = 0.5
+
+
+class PeerState:
+    '''
+    Liveness of one peer daemon: when we last heard from it and the probe we are waiting an answer for.
+    '''
+    __slots__ = ("last_seen", "probes", "last_probe", "probe_sequence", "probe_sent")
+
+    def __init__(self, now: float) -> None:
+        self.last_seen = now
+        # probes sent since the peer was last heard from, and when the last one left
+        self.probes = 0
+        self.last_probe = None
+        # the last probe, until its answer gives an RTT sample
+        self.probe_sequence = 0
+        self.probe_sent = None
+
+
+class PeerTable:
+    '''
+    Peer daemons we have chats with that answer keepalives, by (ip, port). Every datagram from a peer marks it
+    seen, a sweep run by a single timer probes the peers silent for idle seconds, at most once per interval,
+    and returns those that missed max_probes probes in a row. A peer that keeps sending is never probed.
+    '''
+    def __init__(self, idle: float = KEEPALIVE_IDLE, max_probes: int = KEEPALIVE_PROBES) -> None:
+        self.idle = idle
+        self.max_probes = max_probes
+        self.peers = {}
+        self.lock = threading.Lock()
+
+    def track(self, peer: tuple):
+        with self.lock:
+            if peer not in self.peers:
+                self.peers[peer] = PeerState(monotonic())
+
+    def forget(self, peer: tuple):
+        with self.lock:
+            self.peers.pop(peer, None)
+
+    def seen(self, peer: tuple):
+        '''
+        A datagram arrived from peer, called for every one: a dict lookup and two stores, no lock.
+        '''
+        state = self.peers.get(peer)
+        if state is not None:
+            state.last_seen = monotonic()
+            state.probes = 0
+
+    def answered(self, peer: tuple, sequence: int, now: float = None):
+        '''
+        Round trip of the last probe of peer if sequence is its answer, None for an older probe or no probe.
+        '''
+        state = self.peers.get(peer)
+        if state is None or state.probe_sent is None or sequence != state.probe_sequence:
+            return None
+        rtt = (monotonic() if now is None else now) - state.probe_sent
+        state.probe_sent = None
+        return rtt
+
+    def sweep(self, interval, now: float = None) -> tuple:
+        '''
+        ([(peer, probe sequence)] to send a keepalive to, [(peer, seconds silent)] of dead peers).
+        interval(peer) is the time to wait between two probes of peer.
+        '''
+        now = monotonic() if now is None else now
+        probes, dead = [], []
+        with self.lock:
+            for peer, state in self.peers.items():
+                silent = now - state.last_seen
+                if silent < self.idle or (state.probes and now - state.last_probe < interval(peer)):
+                    continue
+                if state.probes >= self.max_probes:
+                    dead.append((peer, silent))
+                    continue
+                state.probes += 1
+                state.probe_sequence = (state.probe_sequence + 1) & 0xFF
+                state.last_probe = state.probe_sent = now
+                probes.append((peer, state.probe_sequence))
+        return probes, dead
+
+    def __len__(self):
+        return len(self.peers)
@@ -0,0 +1,323 @@
+import math
+import os
+import socket
+import threading
+from bisect import bisect_left
+from logger import get_logger
+
+logger = get_logger("metrics")
+
+# handshake latency buckets in seconds, loopback to intercontinental
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# seconds between two snapshots written to the metrics file
+EXPORT_INTERVAL = 10
+
+# header names of the datagrams, for the labels
+TYPE_NAMES = {1: "control", 2: "chat"}
+OPERATION_NAMES = {1: {1: "ERR", 2: "SYN", 4: "ACK", 5: "ROUTES", 6: "SYN_ACK", 8: "FIN", 9: "RELAY", 10: "KEEPALIVE", 12: "GROUP",
+                       13: "GROUP_ACK", 14: "KEEPALIVE_ACK"},
+                   2: {1: "MESSAGE", 2: "GROUP"}}
+# low bits of the operation byte, without the session and chat flags
+OPERATION_MASK = 0x0F
+
+
+class Counter:
+    '''
+    Value that only goes up. inc() is what the hot path pays: one uncontended lock and an add.
+    '''
+    __slots__ = ("value", "lock")
+
+    def __init__(self) -> None:
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Gauge(Counter):
+    '''
+    Value that goes up and down.
+    '''
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    '''
+    Count of observations per bucket (value <= bound), plus their sum and count.
+    '''
+    __slots__ = ("bounds", "counts", "sum", "count", "lock")
+
+    def __init__(self, bounds: tuple) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> tuple:
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+
+class MetricFamily:
+    '''
+    All metrics of one name, one per set of label values. Resolve the labels once and keep the metric,
+    labels() is a dict lookup but the hot path should not even pay that.
+    '''
+    def __init__(self, name: str, help_text: str, kind: str, labelnames: tuple, factory) -> None:
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.labelnames = labelnames
+        self.factory = factory
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {values}")
+        values = tuple(str(value) for value in values)
+        metric = self.children.get(values)
+        if metric is None:
+            with self.lock:
+                metric = self.children.setdefault(values, self.factory())
+        return metric
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        return "+Inf" if value == math.inf else repr(value)
+    return str(value)
+
+
+class MetricsRegistry:
+    '''
+    Metrics of one daemon, rendered in the Prometheus text format.
+    '''
+    def __init__(self) -> None:
+        self.families = {}
+
+    def add(self, name: str, help_text: str, kind: str, labelnames: tuple, factory) -> MetricFamily:
+        if name in self.families:
+            raise ValueError(f"Metric {name} already registered")
+        family = self.families[name] = MetricFamily(name, help_text, kind, tuple(labelnames), factory)
+        return family
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> MetricFamily:
+        return self.add(name, help_text, "counter", labelnames, Counter)
+
+    def gauge(self, name: str, help_text: str, labelnames: tuple = ()) -> MetricFamily:
+        return self.add(name, help_text, "gauge", labelnames, Gauge)
+
+    def histogram(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> MetricFamily:
+        return self.add(name, help_text, "histogram", labelnames, lambda: Histogram(buckets))
+
+    def get(self, name: str, *labels):
+        '''
+        Current value of a counter or gauge, 0 if it was never updated. Meant for tests and tools.
+        '''
+        family = self.families[name]
+        metric = family.children.get(tuple(str(label) for label in labels))
+        return 0 if metric is None else metric.value
+
+    def render(self) -> str:
+        '''
+        Text snapshot of every metric, one "name{labels} value" line each.
+        '''
+        lines = []
+        for family in self.families.values():
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for values, metric in sorted(family.children.items()):
+                if family.kind != "histogram":
+                    lines.append(f"{family.name}{format_labels(family.labelnames, values)} {format_value(metric.value)}")
+                    continue
+                counts, total, count = metric.snapshot()
+                cumulative = 0
+                for bound, bucket in zip(metric.bounds + (math.inf,), counts):
+                    cumulative += bucket
+                    labels = format_labels(family.labelnames, values, f'le="{format_value(float(bound))}"')
+                    lines.append(f"{family.name}_bucket{labels} {cumulative}")
+                lines.append(f"{family.name}_sum{format_labels(family.labelnames, values)} {format_value(total)}")
+                lines.append(f"{family.name}_count{format_labels(family.labelnames, values)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, path: str):
+        '''
+        Write a snapshot to path atomically, readers (e.g. a node exporter textfile collector) never see half of it.
+        '''
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as f:
+            f.write(self.render())
+        os.replace(temporary, path)
+
+
+class DaemonMetrics:
+    '''
+    The metrics a daemon updates, resolved once so the hot path only calls inc() or observe().
+    '''
+    def __init__(self, registry: MetricsRegistry = None) -> None:
+        self.registry = registry = registry or MetricsRegistry()
+        received = registry.counter("simp_datagrams_received_total", "Datagrams received from other daemons.", ("type", "operation"))
+        sent = registry.counter("simp_datagrams_sent_total", "Datagrams sent to other daemons, retransmissions included.", ("type", "operation"))
+        bytes_received = registry.counter("simp_bytes_received_total", "Datagram bytes received, headers included.", ("type",))
+        bytes_sent = registry.counter("simp_bytes_sent_total", "Datagram bytes sent, headers included.", ("type",))
+        # (type, operation) -> (datagram counter, byte counter)
+        self.received = {}
+        self.sent = {}
+        for datagram_type, operations in OPERATION_NAMES.items():
+            type_name = TYPE_NAMES[datagram_type]
+            for operation, operation_name in operations.items():
+                self.received[datagram_type, operation] = (received.labels(type_name, operation_name), bytes_received.labels(type_name))
+                self.sent[datagram_type, operation] = (sent.labels(type_name, operation_name), bytes_sent.labels(type_name))
+
+        self.invalid = registry.counter("simp_datagrams_invalid_total", "Datagrams that could not be parsed or handled.").labels()
+        mismatches = registry.counter("simp_sequence_mismatches_total", "Chat datagrams with an unexpected sequence number.", ("kind",))
+        self.duplicates = mismatches.labels("duplicate")
+        self.out_of_window = mismatches.labels("out_of_window")
+        self.dropped = registry.counter("simp_messages_dropped_total", "Chat messages that will never reach a client.", ("reason",))
+        self.outbox_stored = registry.counter("simp_outbox_stored_total", "Chat messages kept for a client that was not connected.").labels()
+        self.outbox_replayed = registry.counter("simp_outbox_replayed_total", "Stored chat messages sent to a client that came back.").labels()
+        self.retransmissions = registry.counter("simp_retransmissions_total", "Chat datagrams sent again after an RTO.").labels()
+        self.peers_tracked = registry.gauge("simp_peers_tracked", "Peer daemons watched with keepalives.").labels()
+        self.peers_dead = registry.counter("simp_peers_dead_total", "Peer daemons that stopped answering keepalives, their chats closed.").labels()
+        self.group_messages = registry.counter("simp_group_messages_total", "Group messages sent, serialized once whatever the number of members.").labels()
+        self.group_deliveries = registry.counter("simp_group_datagrams_fanned_out_total", "Copies of group messages sent to member daemons, first sends only.").labels()
+        self.relayed = registry.counter("simp_datagrams_relayed_total", "RELAY datagrams forwarded to the next hop for other daemons.").labels()
+        self.relay_dropped = registry.counter("simp_relay_dropped_total", "RELAY datagrams that could not be forwarded.", ("reason",))
+        self.routes = registry.gauge("simp_routes", "Routes to other daemons, neighbors included.").labels()
+        self.group_members_dropped = registry.counter("simp_group_members_dropped_total", "Member daemons dropped from a group we host for not ACKing.").labels()
+        self.admission_dropped = registry.counter("simp_admission_dropped_total", "Datagrams and SYNs refused by admission control, before any work.", ("reason",))
+        self.half_open = registry.gauge("simp_half_open_handshakes", "Incoming handshakes waiting for their ACK.").labels()
+        cookies = registry.counter("simp_syn_cookies_total", "SYN+ACKs sent with a cookie while the half-open table was full, and cookies redeemed.", ("outcome",))
+        self.cookies_sent = cookies.labels("sent")
+        self.cookies_accepted = cookies.labels("accepted")
+
+        handshakes = registry.counter("simp_handshakes_total", "Handshakes by direction and outcome.", ("direction", "outcome"))
+        self.handshake_outcomes = {True: handshakes.labels("outgoing", "success"), False: handshakes.labels("outgoing", "failure")}
+        self.handshakes_accepted = handshakes.labels("incoming", "accepted")
+        self.handshakes_rejected = handshakes.labels("incoming", "rejected")
+        resumed = registry.counter("simp_handshakes_resumed_total", "Handshakes skipped with a resumption ticket.", ("direction",))
+        self.handshakes_resumed = resumed.labels("outgoing")
+        self.resumptions_accepted = resumed.labels("incoming")
+        self.handshake_latency = registry.histogram("simp_handshake_latency_seconds", "SYN to SYN+ACK time of outgoing handshakes.").labels()
+
+        self.clients_connected = registry.gauge("simp_clients_connected", "Clients connected on port 7778.").labels()
+        self.client_connections = registry.counter("simp_client_connections_total", "Client connections accepted on port 7778.").labels()
+
+    def datagram_received(self, datagram_type: int, operation: int, size: int):
+        counters = self.received.get((datagram_type, operation & OPERATION_MASK))
+        if counters is not None:
+            counters[0].inc()
+            counters[1].inc(size)
+
+    def datagram_sent(self, datagram_type: int, operation: int, size: int):
+        counters = self.sent.get((datagram_type, operation & OPERATION_MASK))
+        if counters is not None:
+            counters[0].inc()
+            counters[1].inc(size)
+
+    def drop(self, reason: str, count: int = 1):
+        self.dropped.labels(reason).inc(count)
+
+    def handshake(self, success: bool, latency: float):
+        self.handshake_outcomes[success].inc()
+        if success:
+            self.handshake_latency.observe(latency)
+
+    def client_connected(self):
+        self.client_connections.inc()
+        self.clients_connected.inc()
+
+    def client_disconnected(self):
+        self.clients_connected.dec()
+
+    def render(self) -> str:
+        return self.registry.render()
+
+
+class MetricsServer:
+    '''
+    Serves the current snapshot to every connection on a local socket and closes it, read it with e.g.
+    "nc 127.0.0.1 9100" or "socat - UNIX-CONNECT:/run/simp.sock". address is "host:port" or "unix:/path".
+    '''
+    def __init__(self, render, address: str) -> None:
+        self.render = render
+        self.address = address
+        self.sock = None
+        self.running = False
+
+    def start(self):
+        if self.address.startswith("unix:"):
+            path = self.address[len("unix:"):]
+            if os.path.exists(path):
+                os.unlink(path)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(path)
+        else:
+            host, port = self.address.rsplit(":", 1)
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind((host, int(port)))
+        self.sock.listen(socket.SOMAXCONN)
+        self.running = True
+        threading.Thread(target=self.serve, daemon=True).start()
+        logger.info(f"Serving metrics on {self.address}.")
+
+    def serve(self):
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            try:
+                with conn:
+                    conn.sendall(self.render().encode("utf-8"))
+            except OSError as e:
+                logger.warning(f"Failed to send metrics: {e}")
+
+    def stop(self):
+        self.running = False
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+
+def worker_target(target: str, index: int) -> str:
+    '''
+    Metrics file or socket address of one worker process: "daemon.prom" -> "daemon.2.prom", "host:9100" -> "host:9102".
+    '''
+    if target is None:
+        return None
+    if target.startswith("unix:") or ":" not in target:
+        root, extension = os.path.splitext(target)
+        return f"{root}.{index}{extension}"
+    host, port = target.rsplit(":", 1)
+    return f"{host}:{int(port) + index}"
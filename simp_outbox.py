@@ -0,0 +1,316 @@
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import deque
+from logger import get_logger
+
+logger = get_logger("outbox")
+
+# segments are preallocated to this size, a record never spans two of them
+SEGMENT_SIZE = 8 * 1024 * 1024
+SEGMENT_SUFFIX = ".seg"
+# disk (memory without a directory) every segment together may take, messages past it are dropped
+MAX_BYTES = 256 * 1024 * 1024
+# messages kept for one user
+MAX_MESSAGES = 10000
+# seconds a chat waits for its user whose client went away, its messages are kept here meanwhile
+AWAY_TIMEOUT = 60.0
+
+# appends within this many seconds share one msync
+SYNC_DELAY = 0.05
+# unsynced bytes that are flushed right away
+SYNC_BYTES = 1024 * 1024
+
+# every record: crc32 of kind and body, body length, kind
+RECORD = struct.Struct("!IIB")
+# body: user, sender (each a 2 byte length and utf-8), message bytes
+MESSAGE = 1
+# body: user, then segment number and offset of the last message of the user that was delivered
+DELIVERED = 2
+STRING_LENGTH = struct.Struct("!H")
+POSITION = struct.Struct("!QI")
+
+
+def pack_string(value: str) -> bytes:
+    data = value.encode("utf-8")
+    return STRING_LENGTH.pack(len(data)) + data
+
+
+def unpack_string(body: bytes, offset: int) -> tuple:
+    '''
+    String at offset and the offset after it.
+    '''
+    (length,) = STRING_LENGTH.unpack_from(body, offset)
+    start = offset + STRING_LENGTH.size
+    return str(body[start:start + length], "utf-8", "replace"), start + length
+
+
+class Segment:
+    '''
+    One append-only, memory-mapped segment, a file in the outbox directory or anonymous memory without one.
+    '''
+    __slots__ = ("number", "path", "map", "end", "live")
+
+    def __init__(self, number: int, path: str = None) -> None:
+        self.number = number
+        self.path = path
+        if path is None:
+            self.map = mmap.mmap(-1, SEGMENT_SIZE)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if os.fstat(fd).st_size < SEGMENT_SIZE:
+                    os.ftruncate(fd, SEGMENT_SIZE)
+                self.map = mmap.mmap(fd, SEGMENT_SIZE)
+            finally:
+                os.close(fd)
+        self.end = 0
+        # messages in this segment not delivered yet
+        self.live = 0
+
+    def append(self, kind: int, body: bytes):
+        '''
+        Offset of the new record, None if it does not fit.
+        '''
+        offset = self.end
+        end = offset + RECORD.size + len(body)
+        if end > SEGMENT_SIZE:
+            return None
+        RECORD.pack_into(self.map, offset, zlib.crc32(body, kind), len(body), kind)
+        self.map[offset + RECORD.size:end] = body
+        # zero the next header, recovery stops there even over the leftovers of a torn write
+        self.map[end:min(end + RECORD.size, SEGMENT_SIZE)] = bytes(min(RECORD.size, SEGMENT_SIZE - end))
+        self.end = end
+        return offset
+
+    def read(self, offset: int) -> tuple:
+        '''
+        (kind, body) of the record at offset.
+        '''
+        _, length, kind = RECORD.unpack_from(self.map, offset)
+        start = offset + RECORD.size
+        return kind, self.map[start:start + length]
+
+    def records(self):
+        '''
+        Scan the segment from the start, yield (offset, kind, body) up to the first empty or corrupt record.
+        '''
+        offset = 0
+        while offset + RECORD.size <= SEGMENT_SIZE:
+            crc, length, kind = RECORD.unpack_from(self.map, offset)
+            start = offset + RECORD.size
+            if kind == 0 or start + length > SEGMENT_SIZE:
+                break
+            body = self.map[start:start + length]
+            if zlib.crc32(body, kind) != crc:
+                logger.warning(f"Outbox segment {self.number} is corrupt at offset {offset}, ignoring the rest of it.")
+                break
+            yield offset, kind, body
+            offset = start + length
+        self.end = offset
+
+    def flush(self):
+        if self.path is not None:
+            self.map.flush()
+
+    def close(self, delete: bool = False):
+        self.map.close()
+        if delete and self.path is not None:
+            os.unlink(self.path)
+
+
+class Outbox:
+    '''
+    Messages for users with no client connected, replayed in order when the user's client is back.
+    Records are appended to memory-mapped segments, memory only holds a (segment, offset) per pending message.
+    A replay appends a DELIVERED record instead of rewriting anything, segments are deleted oldest first once
+    none of their messages is pending, so a restarted daemon rebuilds the same state by scanning them.
+    Appends are msync'ed in batches: schedule(delay, callback) runs the flush SYNC_DELAY after the first one.
+    '''
+    def __init__(self, directory: str = None, schedule=None, max_bytes: int = MAX_BYTES, max_messages: int = MAX_MESSAGES) -> None:
+        self.directory = directory
+        self.schedule = schedule
+        self.max_segments = max(1, max_bytes // SEGMENT_SIZE)
+        self.max_messages = max_messages
+        # oldest first, the last one takes the appends
+        self.segments = deque()
+        # username -> deque of (segment, offset) of its pending messages, in order
+        self.pending = {}
+        self.next_number = 0
+        self.dirty = set()
+        self.unsynced = 0
+        self.sync_scheduled = False
+        self.closed = False
+        self.lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.recover()
+
+    def segment_path(self, number: int) -> str:
+        return os.path.join(self.directory, f"{number:016d}{SEGMENT_SUFFIX}")
+
+    def recover(self):
+        '''
+        Rebuild the pending messages from the segments left by a previous run.
+        '''
+        numbers = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                         if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+        for number in numbers:
+            segment = Segment(number, self.segment_path(number))
+            self.segments.append(segment)
+            for offset, kind, body in segment.records():
+                user, rest = unpack_string(body, 0)
+                if kind == MESSAGE:
+                    self.pending.setdefault(user, deque()).append((segment, offset))
+                elif kind == DELIVERED:
+                    last = POSITION.unpack_from(body, rest)
+                    queue = self.pending.get(user, ())
+                    while queue and (queue[0][0].number, queue[0][1]) <= last:
+                        queue.popleft()
+        self.pending = {user: queue for user, queue in self.pending.items() if queue}
+        for queue in self.pending.values():
+            for segment, _ in queue:
+                segment.live += 1
+        self.next_number = numbers[-1] + 1 if numbers else 0
+        self.collect()
+        if self.pending:
+            logger.info(f"Outbox recovered {len(self)} message(s) for {len(self.pending)} user(s) from {self.directory}.")
+
+    def append(self, kind: int, body: bytes, bounded: bool = True):
+        '''
+        Append a record, rolling to a new segment when the last one is full. Returns (segment, offset),
+        None if the record does not fit or bounded and every segment allowed is taken.
+        '''
+        if self.segments:
+            offset = self.segments[-1].append(kind, body)
+            if offset is not None:
+                return self.written(self.segments[-1], offset, body)
+        if bounded and len(self.segments) >= self.max_segments:
+            return None
+        path = None if self.directory is None else self.segment_path(self.next_number)
+        segment = Segment(self.next_number, path)
+        self.next_number += 1
+        self.segments.append(segment)
+        offset = segment.append(kind, body)
+        return None if offset is None else self.written(segment, offset, body)
+
+    def written(self, segment: Segment, offset: int, body: bytes) -> tuple:
+        '''
+        Account for an append, the msync is batched with the next ones.
+        '''
+        if segment.path is not None:
+            self.dirty.add(segment)
+            self.unsynced += RECORD.size + len(body)
+            if self.unsynced >= SYNC_BYTES or self.schedule is None:
+                self.flush()
+            elif not self.sync_scheduled:
+                self.sync_scheduled = True
+                self.schedule(SYNC_DELAY, self.sync)
+        return segment, offset
+
+    def store(self, user: str, sender: str, message: str) -> bool:
+        '''
+        Keep a message for user, False if the user's queue or the outbox is full.
+        '''
+        with self.lock:
+            if self.closed:
+                return False
+            queue = self.pending.get(user)
+            if queue is not None and len(queue) >= self.max_messages:
+                return False
+            position = self.append(MESSAGE, pack_string(user) + pack_string(sender) + message.encode("utf-8"))
+            if position is None:
+                return False
+            self.pending.setdefault(user, deque()).append(position)
+            position[0].live += 1
+            return True
+
+    def has_room(self, user: str, size: int) -> bool:
+        '''
+        Whether a message of about size bytes for user would be kept.
+        '''
+        with self.lock:
+            if self.closed or len(self.pending.get(user, ())) >= self.max_messages:
+                return False
+            if len(self.segments) < self.max_segments:
+                return True
+            return self.segments[-1].end + RECORD.size + len(user) + size <= SEGMENT_SIZE
+
+    def replay(self, user: str, deliver) -> int:
+        '''
+        Call deliver(sender, message) for every message kept for user, in order, and forget them.
+        Messages after one deliver fails on stay in the outbox. Returns the number delivered.
+        '''
+        with self.lock:
+            if self.closed:
+                return 0
+            queue = self.pending.pop(user, None)
+            if not queue:
+                return 0
+            messages = []
+            for segment, offset in queue:
+                _, body = segment.read(offset)
+                _, rest = unpack_string(body, 0)
+                sender, rest = unpack_string(body, rest)
+                messages.append((sender, str(body[rest:], "utf-8", "replace")))
+
+        delivered = 0
+        for sender, message in messages:
+            try:
+                deliver(sender, message)
+            except Exception as e:
+                logger.error(f"Failed to replay stored messages to {user}: {e}")
+                break
+            delivered += 1
+
+        with self.lock:
+            done, remaining = list(queue)[:delivered], list(queue)[delivered:]
+            if remaining:
+                # kept ahead of whatever was stored while replaying
+                self.pending[user] = deque(remaining + list(self.pending.get(user, ())))
+            if done and not self.closed:
+                last_segment, last_offset = done[-1]
+                self.append(DELIVERED, pack_string(user) + POSITION.pack(last_segment.number, last_offset), bounded=False)
+                for segment, _ in done:
+                    segment.live -= 1
+                self.collect()
+        return delivered
+
+    def collect(self):
+        '''
+        Delete the oldest segments while none of their messages is pending, never the one taking appends.
+        '''
+        while len(self.segments) > 1 and self.segments[0].live == 0:
+            segment = self.segments.popleft()
+            self.dirty.discard(segment)
+            segment.close(delete=True)
+
+    def flush(self):
+        for segment in self.dirty:
+            segment.flush()
+        self.dirty.clear()
+        self.unsynced = 0
+
+    def sync(self):
+        '''
+        Timer callback, msync every segment written since the last flush.
+        '''
+        with self.lock:
+            self.sync_scheduled = False
+            if not self.closed:
+                self.flush()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.flush()
+            for segment in self.segments:
+                segment.close()
+            self.segments.clear()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.pending.values())
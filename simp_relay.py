@@ -0,0 +1,209 @@
+import socket
+import struct
+import threading
+from Datagram import HEADER, HEADER_SIZE
+from simp_fragment import MAX_DATAGRAM_SIZE
+from simp_timers import monotonic
+
+# RELAY control datagram (operation 9): daemon header, its sequence byte is the hop limit, then this relay header
+# (destination ip and port, origin ip and port) and the relayed datagram, bytes for bytes
+RELAY = struct.Struct("!4sH4sH")
+RELAY_OFFSET = HEADER_SIZE + RELAY.size
+# hops a relayed datagram may take
+RELAY_TTL = 8
+# ROUTES control datagram (operation 5): records of a destination daemon and its distance in hops
+ROUTE_RECORD = struct.Struct("!4sHB")
+# distance of an unreachable destination, also sent back to the neighbor a route goes through (poisoned reverse)
+INFINITY = 16
+# seconds between two announcements to every neighbor, a learned route lives for ROUTE_TTL
+ANNOUNCE_INTERVAL = 5.0
+ROUTE_TTL = 3 * ANNOUNCE_INTERVAL
+# routes announced per datagram
+ROUTES_PER_DATAGRAM = (MAX_DATAGRAM_SIZE - HEADER_SIZE) // ROUTE_RECORD.size
+
+
+class Route:
+    __slots__ = ("next_hop", "hops", "expires")
+
+    def __init__(self, next_hop: tuple, hops: int, expires) -> None:
+        self.next_hop = next_hop
+        self.hops = hops
+        # None for a configured neighbor, it never expires
+        self.expires = expires
+
+
+class RoutingTable:
+    '''
+    Distance vector routes to other daemons by (ip, port). Neighbors are reached directly, in 1 hop: only
+    the configured ones are trusted, routes are learned from their announcements and RELAY datagrams are only
+    taken from them. Every neighbor announces what it reaches, a destination we do not reach directly is relayed
+    through the neighbor closest to it. Learned routes are cached for ttl seconds and refreshed by every
+    announcement, a destination missing from the table is sent to directly.
+    '''
+    def __init__(self, local: tuple, neighbors=(), ttl: float = ROUTE_TTL) -> None:
+        self.local = local
+        self.ttl = ttl
+        self.routes = {}
+        self.trusted = frozenset(neighbors)
+        self.lock = threading.Lock()
+        for neighbor in neighbors:
+            self.routes[neighbor] = Route(neighbor, 1, None)
+
+    def next_hop(self, destination: tuple, now: float = None):
+        '''
+        Neighbor to relay a datagram for destination through, None to send it directly.
+        Called for every datagram sent: a dict lookup, no lock.
+        '''
+        route = self.routes.get(destination)
+        if route is None or route.next_hop == destination:
+            return None
+        if route.expires is not None and (monotonic() if now is None else now) > route.expires:
+            return None
+        return route.next_hop
+
+    def is_neighbor(self, peer: tuple) -> bool:
+        route = self.routes.get(peer)
+        return route is not None and route.next_hop == peer
+
+    def is_trusted(self, peer: tuple) -> bool:
+        '''
+        A configured neighbor, the only daemons whose announcements and RELAY datagrams are taken.
+        '''
+        return peer in self.trusted
+
+    def neighbors(self) -> list:
+        with self.lock:
+            return [destination for destination, route in self.routes.items() if route.next_hop == destination]
+
+    def learn(self, neighbor: tuple, records, now: float = None) -> int:
+        '''
+        Announcement of a neighbor, [(destination, hops)]. Return the number of routes added or changed.
+        '''
+        expires = (monotonic() if now is None else now) + self.ttl
+        changed = 0
+        with self.lock:
+            route = self.routes.get(neighbor)
+            if route is None or route.next_hop != neighbor:
+                changed += 1
+                self.routes[neighbor] = Route(neighbor, 1, expires)
+            elif route.expires is not None:
+                route.expires = expires
+            for destination, hops in records:
+                if destination == self.local or destination == neighbor:
+                    continue
+                hops = min(hops + 1, INFINITY)
+                route = self.routes.get(destination)
+                if route is None:
+                    if hops < INFINITY:
+                        self.routes[destination] = Route(neighbor, hops, expires)
+                        changed += 1
+                elif route.next_hop == neighbor:
+                    # the neighbor we go through has the last word, worse or gone included
+                    if hops >= INFINITY:
+                        del self.routes[destination]
+                        changed += 1
+                    else:
+                        changed += route.hops != hops
+                        route.hops = hops
+                        route.expires = expires
+                elif hops < route.hops:
+                    self.routes[destination] = Route(neighbor, hops, expires)
+                    changed += 1
+        return changed
+
+    def learn_reverse(self, origin: tuple, previous_hop: tuple, hops: int, now: float = None):
+        '''
+        A relayed datagram came from origin through previous_hop: answer the same way, unless we know better.
+        The caller leaves out the origins it talks to directly, a relayed datagram never takes them over.
+        '''
+        now = monotonic() if now is None else now
+        with self.lock:
+            route = self.routes.get(origin)
+            if route is None or (route.expires is not None and now > route.expires):
+                self.routes[origin] = Route(previous_hop, min(hops, INFINITY - 1), now + self.ttl)
+            elif route.next_hop == previous_hop and route.expires is not None:
+                # the way back lives as long as the origin sends through it
+                route.expires = now + self.ttl
+
+    def advertise(self, neighbor: tuple, now: float = None) -> list:
+        '''
+        [(destination, hops)] to announce to neighbor, ourselves first. Routes through that neighbor are
+        announced unreachable, so it never sends us back what we would send to it.
+        '''
+        now = monotonic() if now is None else now
+        records = [(self.local, 0)]
+        with self.lock:
+            for destination, route in self.routes.items():
+                if destination == neighbor or (route.expires is not None and now > route.expires):
+                    continue
+                records.append((destination, INFINITY if route.next_hop == neighbor else route.hops))
+        return records
+
+    def expire(self, now: float = None) -> int:
+        '''
+        Drop the routes not refreshed in time, return how many.
+        '''
+        now = monotonic() if now is None else now
+        with self.lock:
+            expired = [destination for destination, route in self.routes.items() if route.expires is not None and now > route.expires]
+            for destination in expired:
+                del self.routes[destination]
+        return len(expired)
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __contains__(self, destination: tuple):
+        return destination in self.routes
+
+
+def encode_routes(records) -> list:
+    '''
+    Payloads of the ROUTES datagrams announcing records, [(destination, hops)].
+    '''
+    payloads = []
+    for start in range(0, len(records), ROUTES_PER_DATAGRAM):
+        payloads.append(b"".join(ROUTE_RECORD.pack(socket.inet_aton(ip), port, hops)
+                                 for (ip, port), hops in records[start:start + ROUTES_PER_DATAGRAM]))
+    return payloads
+
+
+def decode_routes(payload) -> list:
+    '''
+    [(destination, hops)] of a ROUTES payload, ValueError if it is not a whole number of records.
+    '''
+    if len(payload) % ROUTE_RECORD.size:
+        raise ValueError(f"Invalid routes payload length: {len(payload)}")
+    return [((socket.inet_ntoa(ip), port), hops) for ip, port, hops in ROUTE_RECORD.iter_unpack(payload)]
+
+
+def wrap(data, destination: tuple, origin: tuple, ttl: int = RELAY_TTL) -> bytes:
+    '''
+    RELAY datagram carrying data, an already serialized datagram, from origin to destination.
+    '''
+    header = HEADER.pack(1, 9, ttl, b"Daemon", RELAY.size + len(data))
+    relay = RELAY.pack(socket.inet_aton(destination[0]), destination[1], socket.inet_aton(origin[0]), origin[1])
+    return b"".join((header, relay, data))
+
+
+def inspect(data) -> tuple:
+    '''
+    (hop limit, destination, origin) of a RELAY datagram from its headers only, the relayed datagram is not parsed.
+    ValueError if the headers are truncated or the length does not match.
+    '''
+    if len(data) < RELAY_OFFSET:
+        raise ValueError(f"Relay datagram too short: {len(data)} bytes")
+    _, _, ttl, _, length = HEADER.unpack_from(data)
+    if length != len(data) - HEADER_SIZE:
+        raise ValueError(f"Invalid relay datagram length: {length} (actual payload length: {len(data) - HEADER_SIZE})")
+    destination_ip, destination_port, origin_ip, origin_port = RELAY.unpack_from(data, HEADER_SIZE)
+    return ttl, (socket.inet_ntoa(destination_ip), destination_port), (socket.inet_ntoa(origin_ip), origin_port)
+
+
+def forwarded(data, ttl: int) -> bytearray:
+    '''
+    Copy of a RELAY datagram for the next hop, only the hop limit changes.
+    '''
+    out = bytearray(data)
+    out[2] = ttl - 1
+    return out
@@ -0,0 +1,96 @@
+import secrets
+import threading
+from collections import OrderedDict, deque
+from simp_timers import monotonic
+
+# seconds a ticket can be redeemed after it was issued
+TICKET_LIFETIME = 300.0
+# tickets a responder keeps, and peers an initiator keeps tickets for, the least recently used go first
+MAX_TICKETS = 4096
+# tickets an initiator keeps per peer, one per chat it can resume at the same time
+TICKETS_PER_PEER = 8
+
+
+def new_ticket() -> str:
+    return secrets.token_hex(16)
+
+
+class TicketStore:
+    '''
+    Responder side: tickets issued at the end of a handshake, bound to the initiator's ip and to what was agreed
+    ({"window": ..., "codec": ...}). A ticket is redeemed once, a SYN carrying it skips the rest of the handshake.
+    '''
+    def __init__(self, lifetime: float = TICKET_LIFETIME, capacity: int = MAX_TICKETS) -> None:
+        self.lifetime = lifetime
+        self.capacity = capacity
+        # ticket -> (peer ip, agreed parameters, expiry), least recently issued first
+        self.tickets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def issue(self, peer_ip: str, params: dict, ticket: str = None) -> str:
+        '''
+        Make ticket (a new one for None) redeemable by peer_ip, return it.
+        '''
+        if ticket is None:
+            ticket = new_ticket()
+        with self.lock:
+            self.tickets[ticket] = (peer_ip, params, monotonic() + self.lifetime)
+            if len(self.tickets) > self.capacity:
+                self.tickets.popitem(last=False)
+        return ticket
+
+    def redeem(self, ticket: str, peer_ip: str):
+        '''
+        Agreed parameters of ticket, None if it is unknown, expired or was issued to another ip.
+        '''
+        with self.lock:
+            entry = self.tickets.pop(ticket, None)
+        if entry is None:
+            return None
+        issued_to, params, expires = entry
+        if issued_to != peer_ip or monotonic() > expires:
+            return None
+        return params
+
+    def __len__(self):
+        return len(self.tickets)
+
+
+class TicketCache:
+    '''
+    Initiator side: tickets received from each peer with what the handshake agreed on
+    ({"window": ..., "batch": ..., "codec": ..., "keepalive": ...}), most recent last.
+    '''
+    def __init__(self, lifetime: float = TICKET_LIFETIME, capacity: int = MAX_TICKETS) -> None:
+        self.lifetime = lifetime
+        self.capacity = capacity
+        # (ip, port) -> deque of (ticket, agreed parameters, expiry), least recently used peer first
+        self.peers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def store(self, peer: tuple, ticket: str, params: dict):
+        with self.lock:
+            tickets = self.peers.pop(peer, None)
+            if tickets is None:
+                tickets = deque(maxlen=TICKETS_PER_PEER)
+            tickets.append((ticket, params, monotonic() + self.lifetime))
+            self.peers[peer] = tickets
+            if len(self.peers) > self.capacity:
+                self.peers.popitem(last=False)
+
+    def take(self, peer: tuple):
+        '''
+        (ticket, agreed parameters) of the newest valid ticket of peer, removed from the cache, or None.
+        '''
+        now = monotonic()
+        with self.lock:
+            tickets = self.peers.get(peer)
+            while tickets:
+                ticket, params, expires = tickets.pop()
+                if now <= expires:
+                    return ticket, params
+            self.peers.pop(peer, None)
+        return None
+
+    def __len__(self):
+        return len(self.peers)
@@ -0,0 +1,160 @@
+import threading
+import simp_window
+from simp_window import SendWindow, ReceiveWindow
+from simp_timers import monotonic
+
+# session ids are 16 bit, 0 is reserved for peers that do not negotiate ids (older daemons)
+LEGACY_SESSION_ID = 0
+MAX_SESSION_ID = 0xFFFF
+
+
+class Session:
+    '''
+    One chat between a local client and a peer daemon.
+    local_id is allocated by us and unique in this daemon, the peer puts it on every datagram it sends us.
+    remote_id is the peer's id for the same chat, None if the peer does not negotiate session ids.
+    '''
+    __slots__ = ("peer_ip", "peer_port", "local_id", "remote_id", "state", "handshake", "window",
+                 "send_window", "recv_window", "next_message_id", "client", "remote_user", "created",
+                 "handshake_future", "handshake_timer", "handshake_started", "handshake_latency",
+                 "peer_batch", "batch", "batch_size", "batch_timer", "codec", "ticket", "resumed")
+
+    def __init__(self, peer_ip: str, peer_port: int, local_id: int, state: str, client: dict) -> None:
+        self.peer_ip = peer_ip
+        self.peer_port = peer_port
+        self.local_id = local_id
+        self.remote_id = None
+        self.state = state
+        self.handshake = None
+        self.window = 1
+        self.send_window = None
+        self.recv_window = None
+        self.next_message_id = 0
+        self.client = client
+        # username on the peer daemon, None if the peer did not say
+        self.remote_user = None
+        self.created = monotonic()
+        # outgoing handshake: future resolved with True/False, timeout timer, start time and latency in seconds
+        self.handshake_future = None
+        self.handshake_timer = None
+        self.handshake_started = None
+        self.handshake_latency = None
+        # messages waiting to be sent together, only if the peer said it can unpack batches
+        self.peer_batch = False
+        self.batch = []
+        self.batch_size = 0
+        self.batch_timer = None
+        # compression codec agreed in the handshake, None sends and expects raw payloads
+        self.codec = None
+        # resumption ticket, redeemed by our SYN or issued in our SYN+ACK, see simp_resume
+        self.ticket = None
+        # the handshake was skipped with a ticket
+        self.resumed = False
+
+    @property
+    def peer(self) -> tuple:
+        return self.peer_ip, self.peer_port
+
+    @property
+    def key(self) -> tuple:
+        return self.peer_ip, self.peer_port, self.local_id
+
+    def open_windows(self, window: int):
+        '''
+        Create the send/receive windows once the window size is agreed.
+        '''
+        self.window = window
+        size, modulus = simp_window.window_params(window)
+        self.send_window = SendWindow(size, modulus)
+        self.recv_window = ReceiveWindow(size, modulus)
+
+    def __repr__(self):
+        return f"Session({self.peer_ip}:{self.peer_port} #{self.local_id}->{self.remote_id} {self.state})"
+
+
+class SessionTable:
+    '''
+    Sessions indexed by (peer ip, peer port, local id) for the per datagram lookup, by the peer's id to
+    recognise retransmitted SYNs, and by peer address for cleanup. Every lookup is a dict access.
+    '''
+    def __init__(self) -> None:
+        self.by_key = {}
+        self.by_remote = {}
+        self.by_peer = {}
+        self.ids = set()
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def allocate_id(self, reserve: bool = True) -> int:
+        '''
+        Next free local session id, ids are unique in the daemon whatever the peer.
+        reserve=False only picks it, for a SYN cookie: the id is reserved when the cookie comes back.
+        '''
+        with self.lock:
+            for _ in range(MAX_SESSION_ID):
+                session_id = self.next_id
+                self.next_id = self.next_id % MAX_SESSION_ID + 1
+                if session_id not in self.ids:
+                    if reserve:
+                        self.ids.add(session_id)
+                    return session_id
+        raise ValueError("No free session id")
+
+    def reserve(self, session_id: int) -> bool:
+        '''
+        Take a given session id, False if it is in use.
+        '''
+        with self.lock:
+            if session_id in self.ids:
+                return False
+            self.ids.add(session_id)
+            return True
+
+    def add(self, session: Session):
+        with self.lock:
+            self.by_key[session.key] = session
+            if session.remote_id is not None:
+                self.by_remote[session.peer + (session.remote_id,)] = session
+            self.by_peer.setdefault(session.peer, set()).add(session)
+
+    def set_remote_id(self, session: Session, remote_id):
+        '''
+        Record the peer's id, None means the peer is an older daemon: the session moves to the legacy id.
+        '''
+        with self.lock:
+            session.remote_id = remote_id
+            if remote_id is not None:
+                self.by_remote[session.peer + (remote_id,)] = session
+            elif session.local_id != LEGACY_SESSION_ID:
+                del self.by_key[session.key]
+                self.ids.discard(session.local_id)
+                session.local_id = LEGACY_SESSION_ID
+                self.by_key[session.key] = session
+
+    def get(self, peer_ip: str, peer_port: int, session_id: int):
+        return self.by_key.get((peer_ip, peer_port, session_id))
+
+    def get_remote(self, peer_ip: str, peer_port: int, remote_id: int):
+        return self.by_remote.get((peer_ip, peer_port, remote_id))
+
+    def for_peer(self, peer_ip: str, peer_port: int) -> list:
+        return list(self.by_peer.get((peer_ip, peer_port), ()))
+
+    def remove(self, session: Session):
+        with self.lock:
+            if self.by_key.get(session.key) is session:
+                del self.by_key[session.key]
+                self.ids.discard(session.local_id)
+            if session.remote_id is not None and self.by_remote.get(session.peer + (session.remote_id,)) is session:
+                del self.by_remote[session.peer + (session.remote_id,)]
+            sessions = self.by_peer.get(session.peer)
+            if sessions is not None:
+                sessions.discard(session)
+                if not sessions:
+                    del self.by_peer[session.peer]
+
+    def __len__(self):
+        return len(self.by_key)
+
+    def __iter__(self):
+        return iter(list(self.by_key.values()))
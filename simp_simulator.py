@@ -0,0 +1,268 @@
+import heapq
+import random
+from itertools import count
+import simp_timers
+from simp_daemon import Daemon
+from simp_framing import FrameParser, encode_frame, USERNAME
+from simp_timers import Timer
+
+# seconds a datagram takes on a link unless told otherwise
+DELAY = 0.005
+# a reordered datagram is held back this many link delays, the datagrams sent after it overtake it
+REORDER_HOLD = 3
+
+
+class VirtualClock:
+    '''
+    Time of a simulation: a heap of timers run in deadline order, time jumps from one to the next, nothing sleeps.
+    Same schedule() interface as TimerWheel, its Timer handles have cancel(). Timers due at the same time run in the
+    order they were scheduled, so a run only depends on what it was given. Called, it returns the current time.
+    '''
+    def __init__(self, now: float = 0.0) -> None:
+        self.now = now
+        self.heap = []
+        self.order = count()
+        self.events = 0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def schedule(self, delay: float, callback, *args) -> Timer:
+        timer = Timer(self.now + max(0.0, delay), callback, args)
+        heapq.heappush(self.heap, (timer.expires, next(self.order), timer))
+        return timer
+
+    def step(self, until: float = None) -> bool:
+        '''
+        Run the next timer, unless it is due after until. False when there was nothing to run.
+        '''
+        while self.heap:
+            expires, _, timer = self.heap[0]
+            if until is not None and expires > until:
+                return False
+            heapq.heappop(self.heap)
+            if timer.cancelled:
+                continue
+            self.now = max(self.now, expires)
+            self.events += 1
+            timer.callback(*timer.args)
+            return True
+        return False
+
+    def run(self, until: float = None) -> int:
+        '''
+        Run every timer due up to until (all of them for None) and leave the clock at until. Return how many ran.
+        '''
+        ran = 0
+        while self.step(until):
+            ran += 1
+        if until is not None:
+            self.now = max(self.now, until)
+        return ran
+
+    def __len__(self):
+        return len(self.heap)
+
+
+class Link:
+    '''
+    What the network does to the datagrams from one ip to another: loss, duplication and reordering are
+    probabilities per datagram, a datagram takes delay seconds plus up to jitter more.
+    '''
+    __slots__ = ("loss", "delay", "jitter", "duplicate", "reorder")
+
+    def __init__(self, loss: float = 0.0, delay: float = DELAY, jitter: float = 0.0, duplicate: float = 0.0,
+                 reorder: float = 0.0) -> None:
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.duplicate = duplicate
+        self.reorder = reorder
+
+
+class SimNetwork:
+    '''
+    In-process network between simulated daemons, on a virtual clock. Every random draw comes from one generator
+    seeded by seed, in the order datagrams are sent: the same seed and the same inputs give the same run.
+    Used as a context manager, every timestamp the daemons take (simp_timers.monotonic) is virtual time.
+    '''
+    def __init__(self, seed: int = 0, clock: VirtualClock = None, **conditions) -> None:
+        self.clock = clock or VirtualClock()
+        self.random = random.Random(seed)
+        self.default = Link(**conditions)
+        # (source ip, destination ip) -> Link, the default link for the others
+        self.links = {}
+        # (ip, port) -> daemon receiving what is sent there
+        self.hosts = {}
+        self.stats = {"sent": 0, "delivered": 0, "lost": 0, "duplicated": 0, "reordered": 0, "unreachable": 0}
+        self.previous_clock = None
+
+    def __enter__(self):
+        self.previous_clock = simp_timers.set_clock(self.clock)
+        return self
+
+    def __exit__(self, *exc):
+        simp_timers.set_clock(self.previous_clock)
+        for daemon in list(self.hosts.values()):
+            daemon.stop()
+
+    def daemon(self, ip: str, port: int = 7777, **kwargs) -> "SimDaemon":
+        '''
+        New daemon on this network, started: Daemon options as keyword arguments.
+        '''
+        daemon = SimDaemon(self, ip, port, **kwargs)
+        daemon.start()
+        return daemon
+
+    def link(self, ip1: str, ip2: str, both: bool = True, **conditions):
+        '''
+        Conditions of the link from ip1 to ip2, and back unless both is False.
+        '''
+        self.links[ip1, ip2] = Link(**conditions)
+        if both:
+            self.links[ip2, ip1] = Link(**conditions)
+
+    def partition(self, ip1: str, ip2: str):
+        self.link(ip1, ip2, loss=1.0)
+
+    def heal(self, ip1: str, ip2: str):
+        self.links.pop((ip1, ip2), None)
+        self.links.pop((ip2, ip1), None)
+
+    def transmit(self, source: tuple, destination: tuple, data: bytes):
+        '''
+        A datagram leaves source: lost, or delivered to destination once or twice after the delay of the link.
+        '''
+        link = self.links.get((source[0], destination[0]), self.default)
+        draw = self.random.random
+        self.stats["sent"] += 1
+        if link.loss and draw() < link.loss:
+            self.stats["lost"] += 1
+            return
+        copies = 1
+        if link.duplicate and draw() < link.duplicate:
+            self.stats["duplicated"] += 1
+            copies = 2
+        for _ in range(copies):
+            delay = link.delay + (link.jitter * draw() if link.jitter else 0.0)
+            if link.reorder and draw() < link.reorder:
+                self.stats["reordered"] += 1
+                delay += REORDER_HOLD * link.delay
+            self.clock.schedule(delay, self.deliver, destination, data, source)
+
+    def deliver(self, destination: tuple, data: bytes, source: tuple):
+        daemon = self.hosts.get(destination)
+        if daemon is None:
+            self.stats["unreachable"] += 1
+            return
+        self.stats["delivered"] += 1
+        daemon.handle_incoming_datagram_from_daemon(data, source)
+
+    def run(self, duration: float) -> int:
+        '''
+        Let duration seconds of virtual time pass, return the number of timers run.
+        '''
+        return self.clock.run(self.clock.now + duration)
+
+    def run_until(self, condition, timeout: float) -> bool:
+        '''
+        Run until condition() is true, at most timeout seconds of virtual time. Return condition().
+        '''
+        deadline = self.clock.now + timeout
+        while not condition():
+            if not self.clock.step(deadline):
+                self.clock.now = max(self.clock.now, deadline)
+                return condition()
+        return True
+
+
+class SimDaemon(Daemon):
+    '''
+    Daemon engine on a SimNetwork: no socket and no thread, datagrams go through the links of the network and
+    timers run on its virtual clock. Control and chat datagrams go through the same handlers as Daemon.
+    stop() without a FIN to anyone is a crash, the peers only notice through their timeouts.
+    '''
+    def __init__(self, network: SimNetwork, ip: str, port: int = 7777, **kwargs) -> None:
+        super().__init__(ip, port, **kwargs)
+        self.network = network
+        self.timers = network.clock
+        self.reassembler.timers = self.timers
+
+    def start(self):
+        self.running = True
+        self.network.hosts[self.ip_address, self.port] = self
+        self.start_keepalive()
+        self.start_routing()
+
+    def stop(self):
+        self.running = False
+        if self.network.hosts.get((self.ip_address, self.port)) is self:
+            del self.network.hosts[self.ip_address, self.port]
+        self.outbox.close()
+        if self.history is not None:
+            self.history.close()
+
+    def sendto_daemon(self, data: bytes, ip: str, port: int = 7777):
+        if not self.running:
+            return
+        self.network.transmit((self.ip_address, self.port), (ip, port), bytes(data))
+        self.metrics.datagram_sent(data[0], data[1], len(data))
+
+
+class SimClient:
+    '''
+    Client connection to a SimDaemon: commands are framed as on port 7778 and reach the daemon delay seconds of
+    virtual time later, its notifications are kept in received as (time, bytes).
+    '''
+    addresses = count(1)
+
+    def __init__(self, daemon: SimDaemon, username: str = None, delay: float = 0.0) -> None:
+        self.daemon = daemon
+        self.clock = daemon.timers
+        self.delay = delay
+        self.parser = FrameParser()
+        self.client = {"conn": self, "address": ("sim", next(self.addresses))}
+        self.received = []
+        self.connected = True
+        daemon.metrics.client_connected()
+        if username is not None:
+            self.send(USERNAME, username)
+
+    def send(self, code: int, payload: str = ""):
+        self.clock.schedule(self.delay, self.arrive, encode_frame(code, payload))
+
+    def arrive(self, data: bytes):
+        if self.connected and not self.daemon.handle_client_data(self.parser, data, self.client):
+            self.disconnected()
+
+    def disconnect(self):
+        '''
+        The client goes away without a QUIT, as if its connection broke.
+        '''
+        self.clock.schedule(self.delay, self.gone)
+
+    def gone(self):
+        if self.connected:
+            self.daemon.disconnect_client(self.client)
+            self.disconnected()
+
+    def disconnected(self):
+        self.connected = False
+        self.daemon.metrics.client_disconnected()
+
+    # the daemon's side of the connection
+    def sendall(self, data: bytes):
+        if self.delay:
+            self.clock.schedule(self.delay, self.received.append, (self.clock.now + self.delay, bytes(data)))
+        else:
+            self.received.append((self.clock.now, bytes(data)))
+
+    def close(self):
+        pass
+
+    def notifications(self, prefix: bytes = b"") -> list:
+        return [data for _, data in self.received if data.startswith(prefix)]
+
+    @property
+    def last(self):
+        return self.received[-1][1] if self.received else None
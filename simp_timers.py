@@ -0,0 +1,168 @@
+import math
+import threading
+import time
+from logger import get_logger
+
+logger = get_logger("timers")
+
+# hierarchical wheel: LEVELS levels of SLOTS slots, each level covers SLOTS times the range of the one below
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+LEVELS = 4
+
+# where every timestamp of the daemon comes from, a simulation runs the daemons on its virtual clock (simp_simulator)
+clock = time.monotonic
+
+
+def monotonic() -> float:
+    return clock()
+
+
+def set_clock(new_clock=None):
+    '''
+    Read the time from new_clock() from now on, time.monotonic for None. Return the clock it replaces.
+    '''
+    global clock
+    previous, clock = clock, time.monotonic if new_clock is None else new_clock
+    return previous
+
+
+class Timer:
+    '''
+    Handle returned by TimerWheel.schedule, cancel() is O(1) (the wheel drops it when its slot comes up).
+    '''
+    __slots__ = ("expires", "callback", "args", "cancelled")
+
+    def __init__(self, expires: int, callback, args: tuple) -> None:
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    '''
+    Hierarchical timer wheel, one instance drives every timer of a daemon from a single thread.
+    With the default 10 ms tick level 0 covers 0.64 s, level 1 41 s, level 2 44 min and level 3 about 2 days.
+    Scheduling and cancelling are O(1), advancing costs one slot visit per tick plus cascades.
+    '''
+    def __init__(self, tick: float = 0.01, now: float = None) -> None:
+        self.tick = tick
+        self.start = monotonic() if now is None else now
+        self.current = 0  # ticks processed so far
+        self.wheels = [[[] for _ in range(SLOTS)] for _ in range(LEVELS)]
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def schedule(self, delay: float, callback, *args) -> Timer:
+        '''
+        Call callback(*args) after delay seconds (rounded up to the next tick).
+        '''
+        with self.lock:
+            ticks = max(1, math.ceil(delay / self.tick))
+            timer = Timer(self.current + ticks, callback, args)
+            self.place(timer)
+            self.count += 1
+        return timer
+
+    def place(self, timer: Timer):
+        delta = timer.expires - self.current
+        for level in range(LEVELS):
+            if delta < 1 << (SLOT_BITS * (level + 1)) or level == LEVELS - 1:
+                # timers beyond the last level wait in its furthest slot and are cascaded again
+                expires = min(timer.expires, self.current + (1 << (SLOT_BITS * (level + 1))) - 1)
+                self.wheels[level][(expires >> (SLOT_BITS * level)) & SLOT_MASK].append(timer)
+                return
+
+    def cascade(self, level: int) -> int:
+        '''
+        Move the timers of the current slot of level down to the lower levels, return the slot index.
+        '''
+        index = (self.current >> (SLOT_BITS * level)) & SLOT_MASK
+        timers = self.wheels[level][index]
+        self.wheels[level][index] = []
+        for timer in timers:
+            if not timer.cancelled:
+                self.place(timer)
+            else:
+                self.count -= 1
+        return index
+
+    def advance(self, now: float = None):
+        '''
+        Process every tick up to now and run the expired callbacks, outside of the wheel lock. A callback that
+        raises is logged and the next ones still run.
+        '''
+        now = monotonic() if now is None else now
+        target = int((now - self.start) / self.tick)
+        expired = []
+        with self.lock:
+            while self.current < target:
+                self.current += 1
+                index = self.current & SLOT_MASK
+                level = 1
+                while index == 0 and level < LEVELS:
+                    index = self.cascade(level)
+                    level += 1
+                slot = self.wheels[0][self.current & SLOT_MASK]
+                if slot:
+                    self.wheels[0][self.current & SLOT_MASK] = []
+                    for timer in slot:
+                        if timer.expires <= self.current:
+                            self.count -= 1
+                            if not timer.cancelled:
+                                expired.append(timer)
+                        else:
+                            self.place(timer)
+        for timer in expired:
+            # the wheel thread drives every timer of the daemon, one failing callback must not stop the others
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception(f"Timer callback {getattr(timer.callback, '__qualname__', timer.callback)} failed")
+        return len(expired)
+
+    def run(self, running):
+        '''
+        Drive the wheel until running() returns False, used as the daemon's timer thread.
+        '''
+        while running():
+            time.sleep(self.tick)
+            self.advance()
+
+    def __len__(self):
+        return self.count
+
+
+class RttEstimator:
+    '''
+    Jacobson/Karels round trip estimation (RFC 6298) for one peer.
+    '''
+    def __init__(self, initial_rto: float = 1.0, min_rto: float = 0.2, max_rto: float = 10.0) -> None:
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+
+    def sample(self, rtt: float):
+        '''
+        Feed one measured round trip, only for datagrams that were not retransmitted (Karn's algorithm).
+        '''
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(self.max_rto, max(self.min_rto, self.srtt + 4 * self.rttvar))
+
+    def backoff(self, retries: int) -> float:
+        '''
+        Timeout for a datagram already retransmitted retries times (exponential backoff).
+        '''
+        return min(self.max_rto, self.rto * (2 ** retries))
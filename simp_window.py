@@ -0,0 +1,161 @@
+import struct
+from collections import deque
+
+# stop-and-wait is a window of one over the alternating bit
+STOP_AND_WAIT = (1, 2)
+# windowed mode uses the whole sequence byte, selective repeat needs window <= space / 2
+SEQUENCE_SPACE = 256
+MAX_WINDOW = 64
+
+# ACK payload for chat datagrams: next expected sequence + bitmap of buffered sequences after it
+SACK = struct.Struct("!BQ")
+
+# results of ReceiveWindow.receive
+ACCEPTED = "accepted"
+DUPLICATE = "duplicate"
+OUT_OF_WINDOW = "out_of_window"
+
+
+def window_params(size: int):
+    '''
+    Return (window size, sequence modulus) for a requested window size.
+    '''
+    if size <= 1:
+        return STOP_AND_WAIT
+    return min(size, MAX_WINDOW), SEQUENCE_SPACE
+
+
+def negotiate_window(options: dict, local_size: int) -> int:
+    '''
+    Window size agreed from the peer's handshake options, a peer that offers no WINDOW gets stop-and-wait.
+    '''
+    try:
+        offered = int(options.get("WINDOW", 1))
+    except ValueError:
+        offered = 1
+    return max(1, min(offered, local_size, MAX_WINDOW))
+
+
+def encode_sack(cumulative: int, bitmap: int) -> bytes:
+    return SACK.pack(cumulative, bitmap)
+
+
+def decode_sack(payload):
+    '''
+    Return (cumulative, bitmap) from an ACK payload, or None if the ACK carries no SACK block.
+    '''
+    if len(payload) != SACK.size:
+        return None
+    return SACK.unpack_from(payload)
+
+
+class SendWindow:
+    '''
+    Sender side of a selective repeat window. Items get a sequence number when they enter the window,
+    items that do not fit wait in the backlog until ACKs slide the window.
+    Internally sequences are absolute counters, on the wire they are taken modulo the sequence space.
+    '''
+    def __init__(self, size: int = 1, modulus: int = 2) -> None:
+        self.size = size
+        self.modulus = modulus
+        self.base = 0  # oldest unacknowledged
+        self.next = 0  # next to assign
+        self.in_flight = {}  # absolute sequence -> item
+        self.backlog = deque()
+
+    def submit(self, item):
+        '''
+        Queue an item, return [(sequence, item)] that may be sent right now.
+        '''
+        self.backlog.append(item)
+        return self.fill()
+
+    def fill(self):
+        ready = []
+        while self.backlog and self.next - self.base < self.size:
+            item = self.backlog.popleft()
+            self.in_flight[self.next] = item
+            ready.append((self.next % self.modulus, item))
+            self.next += 1
+        return ready
+
+    def absolute(self, sequence: int):
+        '''
+        Map a wire sequence to the absolute sequence of an item in flight, None if it is not in the window.
+        '''
+        offset = (sequence - self.base) % self.modulus
+        if offset < self.next - self.base:
+            return self.base + offset
+        return None
+
+    def ack(self, sequence: int, cumulative: int = None, bitmap: int = 0):
+        '''
+        Apply an ACK. Without a SACK block only sequence is acknowledged, with one everything before
+        cumulative plus the sequences flagged in bitmap is. Return (acked items, [(sequence, item)] now ready).
+        '''
+        acked = []
+        if cumulative is None:
+            number = self.absolute(sequence)
+            if number is not None and number in self.in_flight:
+                acked.append(self.in_flight.pop(number))
+        else:
+            count = (cumulative - self.base) % self.modulus
+            if count <= self.next - self.base:
+                for number in range(self.base, self.base + count):
+                    if number in self.in_flight:
+                        acked.append(self.in_flight.pop(number))
+                start = self.base + count + 1
+                while bitmap:
+                    if bitmap & 1 and start in self.in_flight:
+                        acked.append(self.in_flight.pop(start))
+                    bitmap >>= 1
+                    start += 1
+
+        # slide past everything acknowledged
+        while self.base < self.next and self.base not in self.in_flight:
+            self.base += 1
+        return acked, self.fill()
+
+    def __len__(self):
+        return len(self.in_flight)
+
+
+class ReceiveWindow:
+    '''
+    Receiver side of a selective repeat window, buffers out of order items and releases them in order.
+    '''
+    def __init__(self, size: int = 1, modulus: int = 2) -> None:
+        self.size = size
+        self.modulus = modulus
+        self.base = 0  # next expected, absolute
+        self.buffered = {}  # absolute sequence -> item
+
+    def receive(self, sequence: int, item):
+        '''
+        Return (status, items delivered in order). Duplicates must still be ACKed, out of window items dropped.
+        '''
+        offset = (sequence - self.base) % self.modulus
+        if offset >= self.size:
+            if offset >= self.modulus - self.size:
+                return DUPLICATE, []
+            return OUT_OF_WINDOW, []
+
+        number = self.base + offset
+        if number in self.buffered:
+            return DUPLICATE, []
+        self.buffered[number] = item
+
+        delivered = []
+        while self.base in self.buffered:
+            delivered.append(self.buffered.pop(self.base))
+            self.base += 1
+        return ACCEPTED, delivered
+
+    def sack(self):
+        '''
+        Return (cumulative, bitmap) describing what has been received.
+        '''
+        bitmap = 0
+        for number in self.buffered:
+            bitmap |= 1 << (number - self.base - 1)
+        return self.base % self.modulus, bitmap
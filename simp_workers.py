@@ -0,0 +1,443 @@
+import ctypes
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import struct
+import threading
+from multiprocessing.managers import SyncManager
+import simp_framing
+import simp_history
+import simp_metrics
+import simp_relay
+from simp_daemon import Daemon
+from logger import get_logger
+
+logger = get_logger("workers")
+
+# linux only, not exported by the socket module
+SO_ATTACH_REUSEPORT_CBPF = 51
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+# classic BPF run by the kernel for every datagram on the port: A = source ipv4 address, return A % workers,
+# the index of the socket (in bind order) that gets the datagram. Same result as peer_worker().
+BPF_INSTRUCTION = struct.Struct("HBBI")
+SKF_NET_OFF = -0x100000
+BPF_LD_W_ABS = 0x20
+BPF_ALU_MOD_K = 0x94
+BPF_RET_A = 0x16
+
+
+def peer_worker(ip: str, workers: int) -> int:
+    '''
+    Worker owning every session with a peer daemon: its ipv4 address modulo the number of workers.
+    '''
+    return int.from_bytes(socket.inet_aton(ip), "big") % workers
+
+
+def attach_peer_affinity(sock: socket.socket, workers: int) -> bool:
+    '''
+    Make the kernel deliver each datagram to the socket of peer_worker(source ip), return False if it cannot
+    (not linux or an old kernel): workers then forward misdelivered datagrams to the owner themselves.
+    '''
+    program = [(BPF_LD_W_ABS, 0, 0, (SKF_NET_OFF + 12) & 0xFFFFFFFF), (BPF_ALU_MOD_K, 0, 0, workers), (BPF_RET_A, 0, 0, 0)]
+    instructions = ctypes.create_string_buffer(b"".join(BPF_INSTRUCTION.pack(*instruction) for instruction in program))
+    try:
+        # struct sock_fprog: instruction count and a pointer to them
+        sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, struct.pack("HP", len(program), ctypes.addressof(instructions)))
+    except OSError as e:
+        logger.warning(f"Kernel cannot steer datagrams by peer ({e}), workers will forward them.")
+        return False
+    return True
+
+
+def bind_worker_sockets(ip: str, workers: int, port: int = 7777) -> list:
+    '''
+    One UDP socket per worker sharing the port, bound in worker order so the steering program's index is the worker.
+    '''
+    sockets = []
+    for _ in range(workers):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind((ip, port))
+        sockets.append(sock)
+    attach_peer_affinity(sockets[0], workers)
+    return sockets
+
+
+class ControlPlane:
+    '''
+    State shared by the workers: the home worker of every username (the one holding its TCP connection), the
+    worker holding the chat of every busy username, and one inbox per worker for the messages between them.
+    With a manager the tables live in its server process, without one everything stays in this process.
+    '''
+    def __init__(self, workers: int, manager: SyncManager = None) -> None:
+        if manager is None:
+            self.users, self.chats, self.lock = {}, {}, threading.Lock()
+            self.inboxes = [queue.Queue() for _ in range(workers)]
+        else:
+            self.users, self.chats, self.lock = manager.dict(), manager.dict(), multiprocessing.Lock()
+            self.inboxes = [multiprocessing.Queue() for _ in range(workers)]
+
+    def claim(self, table, key: str, worker: int) -> bool:
+        '''
+        Take key for worker in table, True if it was free or already the worker's.
+        '''
+        with self.lock:
+            owner = table.get(key)
+            if owner is not None and owner != worker:
+                return False
+            table[key] = worker
+            return True
+
+    def release(self, table, key: str, worker: int):
+        with self.lock:
+            if table.get(key) == worker:
+                del table[key]
+
+    def send(self, worker: int, *message):
+        self.inboxes[worker].put(message)
+
+
+class RemoteConnection:
+    '''
+    Connection of a client held by another worker: notifications go to that worker's inbox.
+    '''
+    def __init__(self, control: ControlPlane, home: int, username: str) -> None:
+        self.control = control
+        self.home = home
+        self.username = username
+
+    def sendall(self, data: bytes):
+        self.control.send(self.home, "notify", self.username, bytes(data))
+
+    def close(self):
+        pass
+
+
+class WorkerDaemon(Daemon):
+    '''
+    One worker of a multi-process daemon. Every worker has its own UDP socket on the shared port, the kernel gives
+    it the datagrams of the peers it owns (peer_worker), so all sessions with a peer live in one worker.
+    A client connects to any worker, its home. Its commands for a chat held by another worker are forwarded there,
+    that worker sees it as a proxy client whose notifications are sent back to the home worker.
+    '''
+    def __init__(self, ip: str, index: int, control: ControlPlane, udp_socket: socket.socket = None, **kwargs) -> None:
+        if kwargs.get("outbox_dir"):
+            # every worker keeps the messages of the chats it holds in its own segments
+            kwargs["outbox_dir"] = os.path.join(kwargs["outbox_dir"], f"worker-{index}")
+        history_dir = kwargs.get("history_dir")
+        if history_dir:
+            # and writes the history of those chats in its own files, reading those of the others
+            kwargs["history_dir"] = os.path.join(history_dir, f"worker-{index}")
+        super().__init__(ip, **kwargs)
+        self.index = index
+        self.control = control
+        self.workers = len(control.inboxes)
+        self.udp_socket = udp_socket
+        # proxies of clients whose home is another worker, by username
+        self.remote_clients = {}
+        self.sibling_histories = []
+        if history_dir:
+            self.sibling_histories = [simp_history.HistoryStore(os.path.join(history_dir, f"worker-{worker}"), readonly=True)
+                                      for worker in range(self.workers) if worker != index]
+        # every worker exports its own metrics, STATS answers with those of the client's home worker
+        self.metrics_file = simp_metrics.worker_target(self.metrics_file, index)
+        self.metrics_socket = simp_metrics.worker_target(self.metrics_socket, index)
+
+    def start(self):
+        inbox_thread = threading.Thread(target=self.read_inbox, daemon=True)
+        inbox_thread.start()
+        super().start()
+
+    def bind_daemon_socket(self) -> socket.socket:
+        if self.udp_socket is not None:
+            return self.udp_socket
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind((self.ip_address, 7777))
+        return sock
+
+    def bind_client_socket(self) -> socket.socket:
+        # every worker accepts clients, the kernel spreads the connections
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind((self.ip_address, 7778))
+        return sock
+
+    def read_inbox(self):
+        '''
+        Inbox thread: run the messages other workers send us until told to stop.
+        '''
+        inbox = self.control.inboxes[self.index]
+        while True:
+            message = inbox.get()
+            try:
+                if not self.handle_worker_message(message):
+                    break
+            except Exception as e:
+                self.logger.error(f"Worker {self.index} failed to handle {message[0]} message: {e}")
+
+    def handle_worker_message(self, message: tuple) -> bool:
+        '''
+        One message from another worker, return False for stop.
+        '''
+        kind = message[0]
+        if kind == "datagram":
+            # misdelivered by the kernel, this worker owns the peer
+            super().handle_incoming_datagram_from_daemon(message[1], message[2])
+        elif kind == "command":
+            _, username, code, args_str, home = message
+            self.handle_client_command(code, args_str, self.remote_client(username, home))
+        elif kind == "notify":
+            _, username, data = message
+            client = self.clients.get(username)
+            conn = client.get("conn") if client is not None else None
+            if conn is not None:
+                conn.sendall(data)
+        elif kind == "chat":
+            # the chat of one of our clients moved to a worker, or ended there (worker None)
+            _, username, worker, sender = message
+            client = self.clients.get(username)
+            if client is not None and (worker is not None or client.get("chat_worker") == sender):
+                client["chat_worker"] = worker
+        elif kind == "routes":
+            # announcement received by the worker owning that neighbor
+            _, neighbor, records = message
+            self.routes.learn(neighbor, records)
+        elif kind == "replay":
+            # a client is back on another worker, send it what this one stored for it and its parked chat
+            _, username, home = message
+            self.replay_outbox(username, RemoteConnection(self.control, home, username))
+            if username in self.parked:
+                self.resume_chat(username, self.remote_client(username, home))
+        elif kind == "disconnect":
+            _, username, quit = message
+            with self.lock:
+                proxy = self.remote_clients.pop(username, None)
+            if proxy is not None:
+                self.disconnect_client(proxy, quit)
+        elif kind == "stop":
+            self.stop()
+            return False
+        return True
+
+    def remote_client(self, username: str, home: int) -> dict:
+        '''
+        Proxy client for a username whose connection is held by worker home.
+        '''
+        with self.lock:
+            proxy = self.remote_clients.get(username)
+            if proxy is None or proxy["home"] != home:
+                proxy = self.remote_clients[username] = {
+                    "conn": RemoteConnection(self.control, home, username),
+                    "username": username, "address": ("worker", home), "home": home,
+                }
+            return proxy
+
+    def handle_incoming_datagram_from_daemon(self, data: bytes, address: tuple):
+        owner = peer_worker(address[0], self.workers)
+        if owner != self.index:
+            self.control.send(owner, "datagram", bytes(data), address)
+            return
+        super().handle_incoming_datagram_from_daemon(data, address)
+
+    def start_routing(self):
+        # every worker learns every announcement, the first one announces for all of them
+        if self.index == 0:
+            super().start_routing()
+
+    def handle_routes(self, datagram, address: tuple) -> bool:
+        if not super().handle_routes(datagram, address):
+            return False
+        records = simp_relay.decode_routes(datagram.payload)
+        for worker in range(self.workers):
+            if worker != self.index:
+                self.control.send(worker, "routes", address, records)
+        return True
+
+    def route_chat_request(self, user: bytes):
+        client = super().route_chat_request(user)
+        if client is not None:
+            return client
+        username = user.decode("ascii", "replace")
+        if user in (b"", b"Daemon"):
+            # older daemons name nobody, like Daemon: only a daemon with a single client takes their requests
+            users = self.control.users.copy()
+            if len(users) != 1:
+                return None
+            username = next(iter(users))
+        home = self.control.users.get(username)
+        if home is None or home == self.index:
+            return None
+        return self.remote_client(username, home)
+
+    def is_already_in_chat(self, client: dict) -> bool:
+        # a free client is claimed for this worker, a chat held by another worker makes it busy
+        if super().is_already_in_chat(client):
+            return True
+        return not self.control.claim(self.control.chats, client["username"], self.index)
+
+    def open_session(self, target_ip: str, target_port: int, client: dict, target_user: str = None):
+        session = super().open_session(target_ip, target_port, client, target_user)
+        self.announce_chat(client, self.index)
+        return session
+
+    def notify_client_chat_request(self, session):
+        # the home worker must forward the client's answer here, tell it before asking the client
+        self.announce_chat(session.client, self.index)
+        super().notify_client_chat_request(session)
+
+    def close_session(self, session, notify: bool = True):
+        super().close_session(session, notify)
+        client = session.client
+        username = client.get("username")
+        if username is None or client.get("session") is not None:
+            return
+        self.control.release(self.control.chats, username, self.index)
+        if "home" in client:
+            self.announce_chat(client, None)
+            with self.lock:
+                if self.remote_clients.get(username) is client:
+                    del self.remote_clients[username]
+
+    def announce_chat(self, client: dict, worker):
+        if "home" in client:
+            self.control.send(client["home"], "chat", client["username"], worker, self.index)
+
+    def handle_client_command(self, message_code: int, args_str: str, client: dict) -> bool:
+        worker = self.command_worker(message_code, args_str, client)
+        if worker != self.index:
+            self.control.send(worker, "command", client["username"], message_code, args_str, self.index)
+            return True
+        return super().handle_client_command(message_code, args_str, client)
+
+    def command_worker(self, message_code: int, args_str: str, client: dict) -> int:
+        '''
+        Worker that runs a command of a local client: the owner of the target daemon for a new chat,
+        the worker holding the chat for an answer or a message, this one for everything else.
+        '''
+        if not client.get("username") or "home" in client:
+            return self.index
+        if message_code == simp_framing.START_CHAT:
+            target = args_str.split()
+            try:
+                return peer_worker(target[0], self.workers) if target else self.index
+            except OSError:
+                # not an ipv4 address, sending the SYN fails here like in a single daemon
+                return self.index
+        if message_code in (simp_framing.CHAT_DECISION, simp_framing.MESSAGE):
+            worker = client.get("chat_worker")
+            return self.index if worker is None else worker
+        return self.index
+
+    def handle_client_username(self, username: str, client: dict):
+        # usernames are unique across the workers, the control plane has the last word
+        if username and not self.control.claim(self.control.users, username, self.index):
+            client["conn"].sendall(b"FAILED - Username already in use")
+            self.logger.info(f"Client {client['address']} asked for username '{username}', used on another worker.")
+            return
+        previous = client.get("username")
+        super().handle_client_username(username, client)
+        if previous and previous != client.get("username"):
+            self.control.release(self.control.users, previous, self.index)
+        if username and client.get("username") == username:
+            for worker in range(self.workers):
+                if worker != self.index:
+                    self.control.send(worker, "replay", username, self.index)
+
+    def handle_client_group(self, args_str: str, client: dict):
+        # a group lives in one worker but its members' datagrams are spread over all of them
+        client["conn"].sendall(b"FAILED - Group chats are not available on a daemon with workers")
+
+    def host_group(self, name: str):
+        return None
+
+    def query_history(self, username: str, query: dict) -> list:
+        # a user's chats may have been held by any worker, newest of all of them
+        messages = super().query_history(username, query)
+        for history in self.sibling_histories:
+            messages += history.query(username, query)
+        return sorted(messages)[-query["count"]:] if query["count"] > 0 else []
+
+    def forward_message_to_client(self, session, sender: str, message: str) -> bool:
+        client = session.client
+        if "home" in client and self.control.users.get(client["username"]) != client["home"]:
+            # the client left its home worker, its notifications would be lost there
+            return self.store_message(client, sender, message)
+        return super().forward_message_to_client(session, sender, message)
+
+    def resume_chat(self, username: str, client: dict) -> bool:
+        if not super().resume_chat(username, client):
+            return False
+        # the new home worker forwards the client's messages here
+        self.announce_chat(client, self.index)
+        return True
+
+    def disconnect_client(self, client: dict, quit: bool = False):
+        username = client.get("username")
+        if "home" not in client:
+            worker = client.pop("chat_worker", None)
+            if username and worker is not None and worker != self.index:
+                self.control.send(worker, "disconnect", username, quit)
+        super().disconnect_client(client, quit)
+        if "home" not in client and username and username not in self.clients:
+            self.control.release(self.control.users, username, self.index)
+
+
+def run_worker(index: int, ip: str, control: ControlPlane, udp_socket: socket.socket, options: dict):
+    '''
+    Worker process entry point.
+    '''
+    daemon = WorkerDaemon(ip, index, control, udp_socket, **options)
+    daemon.logger.info(f"Worker {index} started, pid {os.getpid()}.")
+    daemon.start()
+
+
+class WorkerPool:
+    '''
+    Daemon spread over worker processes sharing ports 7777 and 7778 with SO_REUSEPORT, one per core by default.
+    start() and stop() behave like Daemon's.
+    '''
+    def __init__(self, ip: str, workers: int = None, **options) -> None:
+        self.ip_address = ip
+        self.port = 7777
+        self.workers = workers or os.cpu_count() or 1
+        self.options = options
+        self.manager = None
+        self.control = None
+        self.processes = []
+
+    def start(self):
+        '''
+        Start the workers and wait for them to exit.
+        '''
+        self.manager = SyncManager()
+        # Ctrl+C is for the workers, the manager must outlive them
+        self.manager.start(signal.signal, (signal.SIGINT, signal.SIG_IGN))
+        self.control = ControlPlane(self.workers, self.manager)
+        sockets = bind_worker_sockets(self.ip_address, self.workers, self.port)
+        for index, sock in enumerate(sockets):
+            process = multiprocessing.Process(target=run_worker, args=(index, self.ip_address, self.control, sock, self.options),
+                                              name=f"simp-worker-{index}", daemon=True)
+            process.start()
+            self.processes.append(process)
+        for sock in sockets:
+            sock.close()
+        logger.info(f"{self.workers} workers started on {self.ip_address}:{self.port}.")
+        try:
+            for process in self.processes:
+                process.join()
+        except KeyboardInterrupt:
+            self.stop()
+            for process in self.processes:
+                process.join()
+        finally:
+            self.manager.shutdown()
+
+    def stop(self):
+        if self.control is not None:
+            for worker in range(self.workers):
+                self.control.send(worker, "stop")
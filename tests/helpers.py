@@ -0,0 +1,65 @@
+'''
+Helpers shared by the tests: a client connection that keeps what it is sent and daemons wired in memory.
+Tests of clients chatting through two daemons use simp_simulator's SimNetwork and SimClient instead.
+'''
+import simp_framing
+from Datagram import Datagram
+from simp_framing import FrameParser, encode_frame
+
+
+class FakeConn:
+    def __init__(self):
+        self.sent = []
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def close(self):
+        pass
+
+
+def connect(daemon1, daemon2):
+    """Wire two daemons back to back in memory, every send is handled synchronously by the other one."""
+    daemon1.send_raw_to_daemon = lambda data, ip, port: daemon2.handle_incoming_datagram_from_daemon(bytes(data), (daemon1.ip_address, 7777))
+    daemon2.send_raw_to_daemon = lambda data, ip, port: daemon1.handle_incoming_datagram_from_daemon(bytes(data), (daemon2.ip_address, 7777))
+
+
+def queued(*daemons):
+    """Wire daemons in memory through a queue of (daemon, data, source), returns (queue, deliver). deliver() handles
+    the queued datagrams in order, those they cause too, and returns their operations. Datagrams to any other ip are lost."""
+    by_ip = {daemon.ip_address: daemon for daemon in daemons}
+    queue = []
+    for daemon in daemons:
+        def send(data, ip, port, source=daemon.ip_address):
+            if ip in by_ip:
+                queue.append((by_ip[ip], bytes(data), (source, 7777)))
+        daemon.send_raw_to_daemon = send
+
+    def deliver():
+        delivered = []
+        while queue:
+            daemon, data, address = queue.pop(0)
+            delivered.append(Datagram.from_buffer(data).operation[0] & 0x7F)
+            daemon.handle_incoming_datagram_from_daemon(data, address)
+        return delivered
+    return queue, deliver
+
+
+def started_chat(daemon1, daemon2, client: dict = None, user: str = "bob"):
+    """Chat of client (alice, with no connection, by default) on connected daemon1 with user, a client of daemon2,
+    started on both sides without waiting for the user to accept. Returns the session of daemon1."""
+    session = daemon1.open_session(daemon2.ip_address, 7777, client or {"username": "alice"}, user)
+    assert daemon1.begin_handshake(session).result(timeout=0)
+    session.state = "started"
+    daemon2.clients[user]["session"].state = "started"
+    return session
+
+
+def login(daemon, username: str) -> dict:
+    client = {"conn": FakeConn(), "address": (daemon.ip_address, len(daemon.clients))}
+    assert daemon.handle_client_data(FrameParser(), encode_frame(simp_framing.USERNAME, username), client)
+    return client
+
+
+def command(daemon, client: dict, code: int, payload: str = "") -> bool:
+    return daemon.handle_client_data(FrameParser(), encode_frame(code, payload), client)
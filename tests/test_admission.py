@@ -0,0 +1,126 @@
+from Datagram import Datagram, encode_options, decode_options
+from simp_daemon import Daemon
+from simp_admission import RateLimiter, CookieJar, SYN_BURST, HALF_OPEN_TIMEOUT
+from simp_timers import TimerWheel
+from helpers import FakeConn, queued
+
+PEER = ("127.0.0.2", 7777)
+
+def test_rate_limiter():
+    limiter = RateLimiter(rate=10.0, burst=3, capacity=2)
+    assert [limiter.allow("a", now=0.0) for _ in range(4)] == [True, True, True, False]
+    # 0.1 s gives one token back
+    assert limiter.allow("a", now=0.1) and not limiter.allow("a", now=0.1)
+    assert limiter.allow("b", now=0.1)
+    # a third source pushes out the least recently seen, which starts over with a full bucket
+    assert limiter.allow("c", now=0.1)
+    assert len(limiter) == 2 and "a" not in limiter.buckets
+    assert [limiter.allow("a", now=0.1) for _ in range(4)] == [True, True, True, False]
+
+def test_cookie():
+    jar = CookieJar(lifetime=10)
+    state = {"sid": 42, "remote_id": 7, "window": 8, "batch": True, "keepalive": False,
+             "codec": "zlib", "user": "bob", "from": "alice"}
+    cookie = jar.make(PEER, state, now=100.0)
+    assert jar.open(PEER, cookie, now=105.0) == state
+    # bound to the peer address, the secret and a lifetime
+    assert jar.open(("127.0.0.3", 7777), cookie, now=105.0) is None
+    assert jar.open(PEER, cookie, now=111.0) is None
+    assert CookieJar().open(PEER, cookie, now=105.0) is None
+    tampered = cookie[:20] + ("0" if cookie[20] != "0" else "1") + cookie[21:]
+    assert jar.open(PEER, tampered, now=105.0) is None
+    assert jar.open(PEER, "not hex", now=105.0) is None
+    # usernames are utf-8, a name may hold any character, zero bytes included
+    state = dict(state, codec=None, user="zoë", **{"from": "renée\0李"})
+    assert jar.open(PEER, jar.make(PEER, state, now=100.0), now=100.0) == state
+
+def syn(sid: int, user: bytes = b"bob") -> bytes:
+    return Datagram.trusted(1, 2, 0, user, encode_options({"SID": sid, "WINDOW": 4, "FROM": "alice"})).to_bytes()
+
+def test_syn_flood_gets_no_answer():
+    daemon = Daemon(ip="127.0.0.1")
+    daemon.timers = TimerWheel(now=0.0)
+    sent = []
+    daemon.send_raw_to_daemon = lambda data, ip, port: sent.append(Datagram.from_buffer(bytes(data)))
+    # unknown user, every answer is an ERR and a FIN: only the burst is answered
+    for sid in range(1, 101):
+        daemon.handle_incoming_datagram_from_daemon(syn(sid, b"nobody"), PEER)
+    assert len(sent) == 2 * SYN_BURST
+    assert daemon.metrics.registry.get("simp_admission_dropped_total", "syn_rate") == 100 - SYN_BURST
+    # another source has its own bucket
+    daemon.handle_incoming_datagram_from_daemon(syn(1, b"nobody"), ("127.0.0.3", 7777))
+    assert len(sent) == 2 * SYN_BURST + 2
+
+    flooded = Daemon(ip="127.0.0.1", peer_rate=100.0)
+    flooded.send_raw_to_daemon = lambda data, ip, port: None
+    keepalive = Datagram.trusted(1, 10, 0, b"Daemon").to_bytes()
+    for _ in range(1000):
+        flooded.handle_incoming_datagram_from_daemon(keepalive, PEER)
+    assert flooded.metrics.registry.get("simp_datagrams_received_total", "control", "KEEPALIVE") < 1000
+    assert flooded.metrics.registry.get("simp_admission_dropped_total", "peer_rate") > 0
+
+def test_full_half_open_table_answers_with_cookies():
+    alice_daemon = Daemon(ip="127.0.0.1")
+    bob_daemon = Daemon(ip="127.0.0.2", max_half_open=1)
+    for daemon in (alice_daemon, bob_daemon):
+        daemon.timers = TimerWheel(now=0.0)
+    queue, deliver = queued(alice_daemon, bob_daemon)
+    bob = bob_daemon.clients["bob"] = {"conn": FakeConn(), "username": "bob"}
+    carol = bob_daemon.clients["carol"] = {"conn": FakeConn(), "username": "carol"}
+
+    # a SYN from a spoofed address takes the only half-open slot, its ACK never comes
+    bob_daemon.handle_incoming_datagram_from_daemon(syn(9, b"carol"), ("10.9.9.9", 7777))
+    assert len(bob_daemon.half_open) == 1 and len(bob_daemon.sessions) == 1
+
+    alice = {"conn": FakeConn(), "username": "alice"}
+    session = alice_daemon.open_session("127.0.0.2", 7777, alice, "bob")
+    future = alice_daemon.begin_handshake(session)
+    queue[0][0].handle_incoming_datagram_from_daemon(queue.pop(0)[1], ("127.0.0.1", 7777))
+    # the SYN+ACK left with a cookie, nothing was kept
+    assert len(bob_daemon.sessions) == 1 and "session" not in bob
+    assert "COOKIE" in decode_options(Datagram.from_buffer(queue[0][1]).payload)
+    deliver()
+    assert future.result(timeout=0)
+    # the ACK brought the cookie back, the session is the one the SYN would have created
+    chat = bob["session"]
+    assert chat.remote_id == session.local_id and session.remote_id == chat.local_id
+    assert chat.remote_user == "alice" and chat.window == session.window and chat.codec == session.codec
+    assert bob["conn"].sent[-1].startswith(b"Chat request from: 127.0.0.1 (alice)")
+    assert bob_daemon.metrics.registry.get("simp_syn_cookies_total", "accepted") == 1
+
+    bob_daemon.handle_client_chat_decision("ACCEPT", bob)
+    deliver()
+    alice_daemon.retransmit_message_to_other_daemon(session, "hello through a cookie")
+    deliver()
+    assert bob["conn"].sent[-1] == b"Message from alice: hello through a cookie"
+
+    # the spoofed handshake is closed when its ACK is overdue, which frees its slot
+    bob_daemon.timers.advance(HALF_OPEN_TIMEOUT + 1)
+    assert len(bob_daemon.half_open) == 0 and "session" not in carol
+    assert bob_daemon.metrics.registry.get("simp_half_open_handshakes") == 0
+
+def test_cookie_for_a_non_ascii_user():
+    daemon = Daemon(ip="127.0.0.1", max_half_open=1)
+    daemon.timers = TimerWheel(now=0.0)
+    sent = []
+    daemon.send_raw_to_daemon = lambda data, ip, port: sent.append(Datagram.from_buffer(bytes(data)))
+    bob = daemon.clients["bob"] = {"conn": FakeConn(), "username": "bob"}
+    daemon.clients["carol"] = {"conn": FakeConn(), "username": "carol"}
+    daemon.handle_incoming_datagram_from_daemon(syn(9, b"carol"), ("10.9.9.9", 7777))
+
+    # the table is full, zoë's SYN is answered with a cookie
+    payload = encode_options({"SID": 5, "WINDOW": 4, "FROM": "zoë"})
+    daemon.handle_incoming_datagram_from_daemon(Datagram.trusted(1, 2, 0, b"bob", payload).to_bytes(), PEER)
+    options = decode_options(sent[-1].payload)
+    assert "COOKIE" in options and "session" not in bob
+    ack = Datagram.trusted(1, 4, 0, b"Daemon", encode_options({"COOKIE": options["COOKIE"]}), session_id=int(options["SID"]))
+    daemon.handle_incoming_datagram_from_daemon(ack.to_bytes(), PEER)
+    assert bob["session"].remote_user == "zoë"
+    assert bob["conn"].sent[-1] == "Chat request from: 127.0.0.2 (zoë)".encode("utf-8")
+
+if __name__ == "__main__":
+    test_rate_limiter()
+    test_cookie()
+    test_syn_flood_gets_no_answer()
+    test_full_half_open_table_answers_with_cookies()
+    test_cookie_for_a_non_ascii_user()
@@ -0,0 +1,76 @@
+import asyncio
+from simp_async_daemon import AsyncDaemon
+from simp_async_client import AsyncClient, ChatEvent, parse_notification
+
+def test_parse_notification():
+    assert parse_notification("SUCCESS") == ChatEvent("ok", "SUCCESS")
+    assert parse_notification("Message from alice: hi: there") == ChatEvent("message", "hi: there", sender="alice")
+    assert parse_notification("Stored message from bob: later").sender == "bob"
+    event = parse_notification("Group message from alice in team: hello")
+    assert (event.kind, event.sender, event.group, event.text) == ("group_message", "alice", "team", "hello")
+    event = parse_notification("Chat request from: 127.0.0.1 (alice)")
+    assert (event.kind, event.peer, event.sender) == ("chat_request", "127.0.0.1", "alice")
+    assert parse_notification("Chat request from: 127.0.0.1").sender is None
+    assert parse_notification("No pending chat request.\n") == ChatEvent("error", "No pending chat request.")
+    assert parse_notification("CHAT_ENDED").kind == "chat_ended"
+    assert parse_notification("something new").kind == "notice"
+
+def test_many_clients_in_one_loop():
+    """Pairs of clients on two async daemons chat from one event loop, with no input() and no threads."""
+    pairs, messages = 10, 20
+
+    async def pair(i):
+        alice = await AsyncClient.connect("127.0.0.1", username=f"alice{i}")
+        bob = await AsyncClient.connect("127.0.0.2", username=f"bob{i}")
+        async with alice, bob:
+            started = asyncio.create_task(alice.start_chat("127.0.0.2", f"bob{i}", timeout=10.0))
+            request = await bob.next_event(timeout=10.0)
+            assert (request.kind, request.peer, request.sender) == ("chat_request", "127.0.0.1", f"alice{i}")
+            assert await bob.accept(timeout=10.0)
+            assert await started
+            for n in range(messages):
+                await alice.send(f"message {n}")
+            received = []
+            async for event in bob:
+                if event.kind == "message":
+                    received.append(event.text)
+                if len(received) == messages:
+                    break
+            assert received == [f"message {n}" for n in range(messages)]
+            await bob.send("bye")
+            # the daemon of bob starts the chat with a "bob accepted." message
+            texts = []
+            while "bye" not in texts:
+                event = await alice.next_event(timeout=10.0)
+                if event.kind == "message":
+                    assert event.sender == f"bob{i}"
+                    texts.append(event.text)
+            assert texts == [f"bob{i} accepted.", "bye"]
+        # quit closed both connections
+        assert alice.closed and await alice.next_event() is None
+
+    async def scenario():
+        daemon1 = AsyncDaemon(ip="127.0.0.1")
+        daemon2 = AsyncDaemon(ip="127.0.0.2")
+        tasks = [asyncio.create_task(daemon.serve()) for daemon in (daemon1, daemon2)]
+        await asyncio.sleep(0.2)
+        try:
+            taken = await AsyncClient.connect("127.0.0.1", username="alice0")
+            await asyncio.gather(*(pair(i) for i in range(1, pairs + 1)))
+            # a username in use is refused
+            try:
+                await AsyncClient.connect("127.0.0.1", username="alice0")
+                assert False, "username taken twice"
+            except ConnectionError:
+                pass
+            await taken.quit()
+        finally:
+            daemon1.stop()
+            daemon2.stop()
+            await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+if __name__ == "__main__":
+    test_parse_notification()
+    test_many_clients_in_one_loop()
@@ -0,0 +1,39 @@
+import asyncio
+from simp_async_daemon import AsyncDaemon
+
+def test_async_handshake_and_chat():
+    """Two async daemons on loopback aliases complete the handshake and exchange a chat message."""
+    async def scenario():
+        daemon1 = AsyncDaemon(ip="127.0.0.1")
+        daemon2 = AsyncDaemon(ip="127.0.0.2")
+        tasks = [asyncio.create_task(daemon.serve()) for daemon in (daemon1, daemon2)]
+        await asyncio.sleep(0.2)
+        try:
+            received = []
+            daemon2.clients["bob"] = {"conn": None, "username": "bob"}
+            daemon2.notify_client_chat_request = lambda session: None
+            daemon1.forward_message_to_client = lambda session, sender, message: received.append((sender, message)) or True
+
+            session1 = daemon1.open_session("127.0.0.2", 7777, {"username": "alice"}, "bob")
+            await daemon1.run_handshake(session1)
+            session2 = daemon2.sessions.get_remote("127.0.0.1", 7777, session1.local_id)
+            assert session1.state == "waiting_for_first_message"
+            assert session2.state == "pending_user_acceptance"
+            assert session1.remote_id == session2.local_id
+            assert session1.send_window.size == 16
+
+            session2.state = "started"
+            daemon2.retransmit_message_to_other_daemon(session2, "hello")
+            await asyncio.sleep(0.2)
+            assert received == [("bob", "hello")]
+            assert session1.state == "started"
+            assert len(session2.send_window) == 0  # ACKed
+        finally:
+            daemon1.stop()
+            daemon2.stop()
+            await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+if __name__ == "__main__":
+    test_async_handshake_and_chat()
@@ -0,0 +1,76 @@
+from Datagram import Datagram, CHAT_BATCH
+from simp_batch import pack_records, unpack_records, fits, BATCH_DELAY
+from simp_fragment import MAX_DATAGRAM_SIZE, MAX_PAYLOAD
+from simp_daemon import Daemon
+from simp_timers import TimerWheel
+from helpers import FakeConn, connect, started_chat
+
+def test_records_round_trip():
+    messages = [b"hello", b"", "é".encode("utf-8"), b"x" * 300]
+    assert [bytes(message) for message in unpack_records(pack_records(messages))] == messages
+    assert unpack_records(b"") == []
+    assert fits(b"x" * (MAX_PAYLOAD - 2)) and not fits(b"x" * (MAX_PAYLOAD - 1))
+    for truncated in (b"\x00", pack_records([b"hello"])[:-1]):
+        try:
+            unpack_records(truncated)
+            assert False, "truncated batch accepted"
+        except ValueError:
+            pass
+
+def chat(batch_delay, peer_batch=True):
+    """Two daemons wired in memory with a started chat, returns (sender, session, datagrams sent, messages received)."""
+    daemon1 = Daemon(ip="127.0.0.1", batch_delay=batch_delay)
+    daemon2 = Daemon(ip="127.0.0.2")
+    daemon1.timers = TimerWheel(now=0.0)
+    connect(daemon1, daemon2)
+    datagrams, received = [], []
+    forward = daemon1.send_raw_to_daemon
+    def send1(data, ip, port):
+        datagrams.append(Datagram.from_buffer(data))
+        forward(data, ip, port)
+    daemon1.send_raw_to_daemon = send1
+    daemon2.clients["bob"] = {"conn": FakeConn(), "username": "bob"}
+    daemon2.forward_message_to_client = lambda session, sender, message: received.append(message) or True
+
+    session = started_chat(daemon1, daemon2)
+    session.peer_batch = session.peer_batch and peer_batch
+    del datagrams[:]
+    return daemon1, session, datagrams, received
+
+def test_burst_is_coalesced():
+    daemon, session, datagrams, received = chat(BATCH_DELAY)
+    assert session.peer_batch
+    messages = [f"message {i}" for i in range(200)]
+    for message in messages:
+        daemon.retransmit_message_to_other_daemon(session, message)
+    # full datagrams leave right away, the rest waits for the flush timer
+    assert 0 < len(datagrams) < 10
+    daemon.timers.advance(BATCH_DELAY + 0.02)
+    assert received == messages
+
+    chats = [datagram for datagram in datagrams if datagram.datagram_type[0] == 2]
+    assert all(datagram.operation[0] & CHAT_BATCH for datagram in chats)
+    assert all(len(datagram) <= MAX_DATAGRAM_SIZE for datagram in chats)
+    assert len(chats) <= 5
+
+def test_large_message_keeps_order():
+    daemon, session, datagrams, received = chat(BATCH_DELAY)
+    daemon.retransmit_message_to_other_daemon(session, "first")
+    daemon.retransmit_message_to_other_daemon(session, "x" * 5000)
+    daemon.retransmit_message_to_other_daemon(session, "last")
+    daemon.timers.advance(BATCH_DELAY + 0.02)
+    assert received == ["first", "x" * 5000, "last"]
+
+def test_no_batches_unless_enabled_and_supported():
+    for batch_delay, peer_batch in ((0.0, True), (BATCH_DELAY, False)):
+        daemon, session, datagrams, received = chat(batch_delay, peer_batch)
+        for i in range(10):
+            daemon.retransmit_message_to_other_daemon(session, f"m{i}")
+        assert received == [f"m{i}" for i in range(10)]
+        assert len([datagram for datagram in datagrams if datagram.datagram_type[0] == 2]) == 10
+
+if __name__ == "__main__":
+    test_records_round_trip()
+    test_burst_is_coalesced()
+    test_large_message_keeps_order()
+    test_no_batches_unless_enabled_and_supported()
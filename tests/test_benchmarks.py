@@ -0,0 +1,33 @@
+from benchmarks.results import metric, report, compare
+from benchmarks import bench_codec, bench_sim
+
+def test_compare_flags_regressions():
+    baseline = report({
+        "rate": metric(1000, "1/s", "higher"),
+        "latency": metric(50, "us", "lower"),
+        "codec": metric(500, "ns/op", "lower"),
+        "gone": metric(1, "1/s", "higher"),
+    }, quick=True)
+    results = report({
+        "rate": metric(850, "1/s", "higher"),  # 15% slower
+        "latency": metric(40, "us", "lower"),  # better
+        "codec": metric(540, "ns/op", "lower"),  # within tolerance
+    }, quick=True)
+    rows = {name: regressed for name, base, value, change, regressed in compare(results, baseline, 0.10)}
+    assert rows == {"codec": False, "latency": False, "rate": True}
+
+def test_codec_benchmark_reports_ns_per_op():
+    metrics = bench_codec.run(quick=True)
+    assert set(metrics) == {"codec.to_bytes_ns", "codec.from_bytes_ns", "codec.from_buffer_ns"}
+    assert all(value["value"] > 0 and value["better"] == "lower" for value in metrics.values())
+
+def test_sim_benchmark_is_exact():
+    first, second = bench_sim.run(quick=True), bench_sim.run(quick=True)
+    # virtual time and datagram counts do not depend on the machine
+    for name in ("sim.chat_virtual_s", "sim.datagrams_per_message"):
+        assert first[name] == second[name] and first[name]["value"] > 0
+
+if __name__ == "__main__":
+    test_compare_flags_regressions()
+    test_codec_benchmark_reports_ns_per_op()
+    test_sim_benchmark_is_exact()
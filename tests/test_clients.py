@@ -0,0 +1,110 @@
+import socket
+import simp_framing
+from simp_framing import FrameParser, FramedConnection
+from simp_daemon import Daemon
+from simp_simulator import SimNetwork, SimClient
+from helpers import FakeConn, login, command
+
+def test_usernames_are_unique():
+    daemon = Daemon(ip="127.0.0.1")
+    alice = login(daemon, "alice")
+    assert alice["conn"].sent == [b"SUCCESS"]
+    other = {"conn": FakeConn(), "address": ("127.0.0.1", 99)}
+    command(daemon, other, simp_framing.USERNAME, "alice")
+    assert other["conn"].sent[-1].startswith(b"FAILED")
+    assert daemon.clients == {"alice": alice}
+
+def test_chats_routed_by_username():
+    with SimNetwork() as network:
+        daemon1, daemon2 = network.daemon("127.0.0.1"), network.daemon("127.0.0.2")
+        alice, dave = SimClient(daemon1, "alice"), SimClient(daemon1, "dave")
+        bob, carol = SimClient(daemon2, "bob"), SimClient(daemon2, "carol")
+
+        alice.send(simp_framing.START_CHAT, "127.0.0.2 bob")
+        dave.send(simp_framing.START_CHAT, "127.0.0.2 carol")
+        network.run(1.0)
+        assert bob.last == b"Chat request from: 127.0.0.1 (alice)"
+        assert carol.last == b"Chat request from: 127.0.0.1 (dave)"
+        bob.send(simp_framing.CHAT_DECISION, "ACCEPT")
+        carol.send(simp_framing.CHAT_DECISION, "ACCEPT")
+        network.run(1.0)
+        assert alice.client["session"].state == dave.client["session"].state == "started"
+        assert len(daemon1.sessions) == len(daemon2.sessions) == 2
+
+        alice.send(simp_framing.MESSAGE, "hi bob")
+        dave.send(simp_framing.MESSAGE, "hi carol")
+        carol.send(simp_framing.MESSAGE, "hi dave")
+        network.run(1.0)
+        assert bob.last == b"Message from alice: hi bob"
+        assert carol.last == b"Message from dave: hi carol"
+        assert dave.last == b"Message from carol: hi dave"
+        assert alice.last == b"Message from bob: bob accepted."
+
+        # a client leaving only ends its own chat
+        alice.send(simp_framing.QUIT)
+        network.run(1.0)
+        assert "alice" not in daemon1.clients
+        assert bob.last == b"CHAT_ENDED"
+        assert dave.client["session"].state == "started"
+        assert len(daemon1.sessions) == len(daemon2.sessions) == 1
+
+def test_unknown_user_is_rejected():
+    with SimNetwork() as network:
+        daemon1, daemon2 = network.daemon("127.0.0.1"), network.daemon("127.0.0.2")
+        alice = SimClient(daemon1, "alice")
+        SimClient(daemon2, "bob"), SimClient(daemon2, "carol")
+
+        alice.send(simp_framing.START_CHAT, "127.0.0.2 mallory")
+        network.run(1.0)
+        assert alice.last.startswith(b"DECLINED")
+        # without a username the request is ambiguous on a daemon with several users
+        alice.send(simp_framing.START_CHAT, "127.0.0.2")
+        network.run(1.0)
+        assert alice.last.startswith(b"DECLINED")
+        assert len(daemon2.sessions) == 0
+
+def test_outbound_queue():
+    daemon_side, client_side = socket.socketpair()
+    conn = FramedConnection(daemon_side)
+    for i in range(100):
+        conn.sendall(f"Message from bob: {i}".encode())
+    conn.close()
+    parser = FrameParser()
+    frames = []
+    client_side.settimeout(5)
+    while True:
+        data = client_side.recv(65535)
+        if not data:
+            break
+        frames += parser.feed(data)
+    assert frames == [(simp_framing.NOTIFY, f"Message from bob: {i}".encode()) for i in range(100)]
+
+    # a client that never reads is dropped once its queue is full
+    daemon_side, client_side = socket.socketpair()
+    conn = FramedConnection(daemon_side, max_queued=64 * 1024)
+    for _ in range(10000):
+        conn.sendall(b"x" * 1000)
+    assert conn.closed
+    conn.writer.join(5)
+    assert not conn.writer.is_alive()
+    client_side.close()
+
+def test_unsent_frames_are_given_back():
+    daemon_side, client_side = socket.socketpair()
+    conn = FramedConnection(daemon_side, max_queued=64 * 1024)
+    messages = [f"Message from bob: {i} ".encode() + b"x" * 1000 for i in range(1000)]
+    queued = [message for message in messages if conn.sendall(message)]
+    assert conn.closed and len(queued) < len(messages)
+    # the client never read, what the socket did not take comes back in order, up to the one that filled the queue
+    unsent = conn.abort()
+    assert unsent
+    assert unsent == queued[len(queued) - len(unsent):]
+    assert not conn.writer.is_alive() and conn.abort() == []
+    client_side.close()
+
+if __name__ == "__main__":
+    test_usernames_are_unique()
+    test_chats_routed_by_username()
+    test_unknown_user_is_rejected()
+    test_outbound_queue()
+    test_unsent_frames_are_given_back()
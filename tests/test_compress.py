@@ -0,0 +1,127 @@
+import random
+import string
+from Datagram import Datagram, CHAT_COMPRESSED, CHAT_FRAGMENT, CHAT_BATCH
+from simp_compress import compress, decompress, maybe_compress, negotiate, CODECS, COMPRESS_THRESHOLD
+from simp_batch import BATCH_DELAY
+from simp_daemon import Daemon
+from simp_timers import TimerWheel
+from helpers import FakeConn, connect, started_chat
+
+LOG_LINE = b"2024-05-01 12:00:00 ERROR connection refused by server, retrying request in 5 seconds\n"
+
+def test_codecs_round_trip():
+    for codec in CODECS:
+        for payload in (b"", b"hello", LOG_LINE * 50, bytes(range(256)) * 4):
+            assert decompress(codec, compress(codec, payload)) == payload
+        # a repetitive payload shrinks, a short or random one is sent raw
+        assert len(maybe_compress(codec, LOG_LINE * 50)) < len(LOG_LINE) * 2
+        assert maybe_compress(codec, b"x" * (COMPRESS_THRESHOLD - 1)) is None
+        assert maybe_compress(None, LOG_LINE * 50) is None
+
+def test_decompress_rejects_bad_payloads():
+    for codec in CODECS:
+        bomb = compress(codec, bytes(100000))
+        for payload, max_size in ((bomb, 1000), (bomb[:-2], 100000), (b"not compressed at all", 100000)):
+            try:
+                decompress(codec, payload, max_size)
+                assert False, "bad payload accepted"
+            except ValueError:
+                pass
+
+def test_negotiate():
+    assert negotiate("zlib,lzma", ("zlib",)) == "zlib"
+    assert negotiate("lzma,zlib", ("zlib", "lzma")) == "zlib"
+    assert negotiate("ZLIB", ("lzma", "zlib")) == "zlib"
+    assert negotiate("brotli", ("zlib",)) is None
+    assert negotiate(None, ("zlib",)) is None
+    assert negotiate("zlib", ()) is None
+
+def test_datagram_compression():
+    datagram = Datagram.trusted(2, 1, 0, b"alice", LOG_LINE * 10, 7, "zlib")
+    assert datagram.operation[0] & CHAT_COMPRESSED and len(datagram.payload) < len(LOG_LINE) * 2
+
+    received = Datagram.from_buffer(datagram.to_bytes())
+    assert received.strip_session() == 7
+    assert received.decompress("zlib") is True
+    assert received.operation[0] == 1 and received.payload == LOG_LINE * 10
+    assert int.from_bytes(received.length, "big") == len(LOG_LINE) * 10
+
+    # short payloads, control datagrams and fragments are left as they are
+    assert Datagram.trusted(2, 1, 0, b"alice", b"hi", None, "zlib").operation[0] == 1
+    assert Datagram.trusted(1, 2, 0, b"alice", LOG_LINE * 10, None, "zlib").payload == LOG_LINE * 10
+    fragment = Datagram.trusted(2, 1 | CHAT_FRAGMENT, 0, b"alice", LOG_LINE * 10, 7, "zlib")
+    assert fragment.operation[0] & 0x7F == 1 | CHAT_FRAGMENT and fragment.payload.endswith(LOG_LINE * 10)
+    fragment = Datagram.trusted(2, 1 | CHAT_FRAGMENT | CHAT_COMPRESSED, 0, b"alice", b"part of a message")
+    assert fragment.decompress("zlib") is False
+    try:
+        Datagram.trusted(2, 1, 0, b"alice", LOG_LINE * 10, None, "zlib").decompress(None)
+        assert False, "compressed payload accepted without a codec"
+    except ValueError:
+        pass
+
+def chat(compression1=("zlib",), compression2=("zlib",), batch_delay=0.0):
+    """Two daemons wired in memory with a started chat, returns (sender, session, datagrams sent, messages received)."""
+    daemon1 = Daemon(ip="127.0.0.1", batch_delay=batch_delay, compression=compression1)
+    daemon2 = Daemon(ip="127.0.0.2", compression=compression2)
+    daemon1.timers = TimerWheel(now=0.0)
+    connect(daemon1, daemon2)
+    datagrams, received = [], []
+    forward = daemon1.send_raw_to_daemon
+    def send1(data, ip, port):
+        datagrams.append(Datagram.from_buffer(data))
+        forward(data, ip, port)
+    daemon1.send_raw_to_daemon = send1
+    daemon2.clients["bob"] = {"conn": FakeConn(), "username": "bob"}
+    daemon2.forward_message_to_client = lambda session, sender, message: received.append(message) or True
+
+    session = started_chat(daemon1, daemon2)
+    assert daemon2.clients["bob"]["session"].codec == session.codec
+    del datagrams[:]
+    return daemon1, session, datagrams, received
+
+def test_chat_is_compressed():
+    daemon, session, datagrams, received = chat()
+    assert session.codec == "zlib"
+    messages = ["short", LOG_LINE.decode() * 5, LOG_LINE.decode() * 200]
+    for message in messages:
+        daemon.retransmit_message_to_other_daemon(session, message)
+    assert received == messages
+
+    # the large message is compressed before fragmenting, it fits in one datagram
+    operations = [datagram.operation[0] for datagram in datagrams if datagram.datagram_type[0] == 2]
+    assert len(operations) == 3
+    assert not operations[0] & CHAT_COMPRESSED
+    assert all(operation & CHAT_COMPRESSED and not operation & CHAT_FRAGMENT for operation in operations[1:])
+
+def test_compressed_fragments_and_batches():
+    daemon, session, datagrams, received = chat(("lzma", "zlib"), ("lzma", "zlib"), BATCH_DELAY)
+    assert session.codec == "lzma"
+    incompressible = bytes(range(32, 127)).decode() * 30
+    rng = random.Random(1)
+    random_text = "".join(rng.choice(string.printable) for _ in range(20000))
+    messages = [f"line {i}: {LOG_LINE.decode()}" for i in range(20)] + [random_text, incompressible]
+    for message in messages:
+        daemon.retransmit_message_to_other_daemon(session, message)
+    daemon.timers.advance(BATCH_DELAY + 0.02)
+    assert received == messages
+
+    operations = [datagram.operation[0] for datagram in datagrams if datagram.datagram_type[0] == 2]
+    assert any(operation & CHAT_BATCH and operation & CHAT_COMPRESSED for operation in operations)
+    assert any(operation & CHAT_FRAGMENT for operation in operations)
+
+def test_no_compression_unless_both_offer():
+    for compression1, compression2 in (((), ("zlib",)), (("zlib",), ()), (("lzma",), ("zlib",))):
+        daemon, session, datagrams, received = chat(compression1, compression2)
+        assert session.codec is None
+        daemon.retransmit_message_to_other_daemon(session, LOG_LINE.decode() * 5)
+        assert received == [LOG_LINE.decode() * 5]
+        assert not any(datagram.operation[0] & CHAT_COMPRESSED for datagram in datagrams)
+
+if __name__ == "__main__":
+    test_codecs_round_trip()
+    test_decompress_rejects_bad_payloads()
+    test_negotiate()
+    test_datagram_compression()
+    test_chat_is_compressed()
+    test_compressed_fragments_and_batches()
+    test_no_compression_unless_both_offer()
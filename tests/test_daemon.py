@@ -2,6 +2,7 @@ import threading
 import time
 from simp_daemon import Daemon
 from Datagram import Datagram
+from helpers import FakeConn
 
 daemon1 = None
 daemon2 = None
@@ -30,35 +31,53 @@ def teardown_daemons():
     daemon1_thread.join()
     daemon2_thread.join()
 
+def setup_module():
+    setup_daemons()
+
+def teardown_module():
+    teardown_daemons()
+
+def handshake(username):
+    """Handshake from a new client of Daemon1 to a new client of Daemon2, returns both sessions."""
+    daemon2.clients[username] = {"conn": FakeConn(), "username": username}
+    session1 = daemon1.open_session("127.0.0.2", 7777, {"conn": FakeConn(), "username": "tester"}, username)
+    assert daemon1.begin_handshake(session1).result(timeout=5), "Handshake should complete"
+    # a handshake resumed with a ticket completes before daemon2 has the SYN, and before its SYN+ACK gives
+    # daemon1 the id to put on the next datagrams
+    deadline = time.monotonic() + 5
+    session2 = daemon2.sessions.get_remote("127.0.0.1", 7777, session1.local_id)
+    while (session2 is None or session1.remote_id is None) and time.monotonic() < deadline:
+        time.sleep(0.01)
+        session2 = daemon2.sessions.get_remote("127.0.0.1", 7777, session1.local_id)
+    return session1, session2
 
 def test_handshake():
     """Test the handshake process between Daemon1 and Daemon2."""
     print("Running test_handshake...")
     
     # Initiating handshake
-    daemon1.handshake("127.0.0.2", 7777, is_initiator=True)
-    
-    # Check active connections on both sides
-    assert ("127.0.0.2", 7777) in daemon1.active_connections, "Daemon1 should have a connection to Daemon2"
-    assert ("127.0.0.1", 7777) in daemon2.active_connections, "Daemon2 should have a connection to Daemon1"
-    assert daemon1.active_connections[("127.0.0.2", 7777)]["state"] == "connected", "Daemon1 connection state should be 'connected'"
-    assert daemon2.active_connections[("127.0.0.1", 7777)]["state"] == "connected", "Daemon2 connection state should be 'connected'"
+    session1, session2 = handshake("receiver")
+
+    # Check the session on both sides
+    assert session2 is not None, "Daemon2 should have a session for Daemon1"
+    assert session1.remote_id == session2.local_id and session2.remote_id == session1.local_id
+    assert session1.state == "waiting_for_first_message", "Daemon1 should wait for the remote user"
+    assert session2.state == "pending_user_acceptance", "Daemon2 should ask its client"
     print("test_handshake passed!")
 
 def test_invalid_datagram():
     """Test handling of invalid datagrams."""
     print("Running test_invalid_datagram...")
     
-    invalid_datagram = Datagram(
-        datagram_type=3, 
-        operation=0,
-        sequence=0,
-        user="InvalidUser",
-        length=0,
-        payload=""
-    )
-    
     try:
+        invalid_datagram = Datagram(
+            datagram_type=3,
+            operation=0,
+            sequence=0,
+            user="InvalidUser",
+            length=0,
+            payload=""
+        )
         invalid_datagram.to_bytes()
         assert False, "Invalid datagram should raise ValueError"
     except ValueError:
@@ -70,24 +89,17 @@ def test_fin_termination():
     print("Running test_fin_termination...")
     
     # Establish a connection first
-    daemon1.handshake("127.0.0.2", 7777, is_initiator=True)
-    
-    # Send FIN to terminate the connection
-    fin_datagram = Datagram(
-        datagram_type=1,
-        operation=8,  # FIN
-        sequence=0,
-        user="TestUser",
-        length=0,
-        payload=""
-    )
-    daemon1.send_datagram_to_daemon(fin_datagram, "127.0.0.2", 7777)
-    
+    session1, session2 = handshake("fin_receiver")
+
+    # Send FIN to terminate the session
+    daemon1.send_session_control(session1, 8, 0)  # FIN
+    daemon1.close_session(session1, notify=False)
+
     time.sleep(1)
-    
-    # Check if the connection was removed on both sides
-    assert ("127.0.0.2", 7777) not in daemon1.active_connections, "Daemon1 should have removed the connection"
-    assert ("127.0.0.1", 7777) not in daemon2.active_connections, "Daemon2 should have removed the connection"
+
+    # Check if the session was removed on both sides
+    assert daemon1.sessions.get("127.0.0.2", 7777, session1.local_id) is None, "Daemon1 should have removed the session"
+    assert daemon2.sessions.get("127.0.0.1", 7777, session2.local_id) is None, "Daemon2 should have removed the session"
     print("test_fin_termination passed!")
 
 if __name__ == "__main__":
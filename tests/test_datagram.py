@@ -15,6 +15,91 @@ def test_serialise_and_deserialise():
     assert datagram.length == deserialised.length
     assert datagram.payload == deserialised.payload
     
+def test_from_buffer_is_zero_copy():
+    datagram = Datagram(datagram_type=2, operation=1, sequence=1, user="alice", payload="hi there", length=None)
+    data = datagram.to_bytes()
+    parsed = Datagram.from_buffer(data)
+
+    assert isinstance(parsed.payload, memoryview)
+    assert parsed.payload.obj is data
+    assert bytes(parsed.payload) == b"hi there"
+    assert parsed.user == b"alice"
+    assert parsed.sequence == b'\x01'
+    assert parsed.to_bytes() == data
+
+def test_from_buffer_rejects_invalid():
+    valid = Datagram.trusted(1, 2, 0, b"Daemon").to_bytes()
+    for broken in (valid[:10], b'\x03' + valid[1:], valid[:1] + b'\x03' + valid[2:], valid + b"x"):
+        try:
+            Datagram.from_buffer(broken)
+            assert False, "from_buffer should raise ValueError"
+        except ValueError:
+            pass
+
+def test_trusted_pack_into():
+    datagram = Datagram.trusted(2, 1, 0, b"bob", b"payload")
+    buffer = bytearray(100)
+    written = datagram.pack_into(buffer, 5)
+
+    assert written == len(datagram) == len(datagram.to_bytes())
+    assert bytes(buffer[5:5 + written]) == datagram.to_bytes()
+    parsed = Datagram.from_bytes(bytes(buffer[5:5 + written]))
+    assert parsed.payload == b"payload"
+    assert parsed.user.rstrip() == b"bob"
+
+def test_encode_and_decode_many():
+    datagrams = [Datagram.trusted(2, 1, i % 2, b"user%d" % i, b"message %d" % i) for i in range(5)]
+    buffer, offsets = Datagram.encode_many(datagrams)
+
+    assert list(offsets) == [sum(len(d) for d in datagrams[:i]) for i in range(5)]
+    for batch in (Datagram.decode_many(buffer), Datagram.decode_many(buffer, offsets)):
+        assert len(batch) == 5 and not batch.errors
+        assert list(batch.sequences) == [0, 1, 0, 1, 0]
+        assert batch.users[3] == b"user3"
+        assert bytes(batch.payloads[4]) == b"message 4"
+        assert batch.payloads[4].obj is buffer
+        assert [d.to_bytes() for d in batch.datagrams()] == [d.to_bytes() for d in datagrams]
+
+def test_decode_many_reports_invalid_rows():
+    good = Datagram.trusted(1, 2, 0, b"Daemon").to_bytes()
+    bad_type = b'\x07' + good[1:]
+    bad_length = good + b"extra"
+    batch = Datagram.decode_many([good, bad_type, good, bad_length, good[:5]])
+
+    assert len(batch) == 5
+    assert list(batch.valid) == [1, 0, 1, 0, 0]
+    assert [row for row, _ in batch.errors] == [1, 3, 4]
+    assert len(list(batch.datagrams())) == 2
+
+def test_to_numpy_is_a_copy():
+    try:
+        import numpy
+    except ImportError:  # numpy is optional
+        return
+    packets = [Datagram.trusted(2, 1, i % 2, b"user%d" % i, b"message %d" % i).to_bytes() for i in range(3)]
+    batch = Datagram.decode_many(packets[:2])
+    headers = batch.to_numpy()
+    # the batch still grows after it was exported
+    batch.add(memoryview(packets[2]), 0, len(packets[2]))
+    assert len(headers) == 2 and len(batch.to_numpy()) == 3
+    assert list(headers["sequence"]) == [0, 1] and headers["user"][1] == b"user1"
+    assert list(batch.to_numpy()["length"]) == [len(b"message %d" % i) for i in range(3)]
+
+def test_encode_many_reports_all_invalid_rows():
+    datagrams = [Datagram.trusted(3, 1, 0, b"x"), Datagram.trusted(2, 1, 0, b"x"), Datagram.trusted(2, 9, 0, b"x")]
+    try:
+        Datagram.encode_many(datagrams)
+        assert False, "encode_many should raise ValueError"
+    except ValueError as e:
+        assert "(0," in str(e) and "(2," in str(e)
+
 if __name__ == "__main__":
     test_serialise_and_deserialise()
+    test_from_buffer_is_zero_copy()
+    test_from_buffer_rejects_invalid()
+    test_trusted_pack_into()
+    test_encode_and_decode_many()
+    test_decode_many_reports_invalid_rows()
+    test_to_numpy_is_a_copy()
+    test_encode_many_reports_all_invalid_rows()
     print("All tests passed")
\ No newline at end of file
@@ -0,0 +1,92 @@
+import random
+import string
+import simp_framing
+from Datagram import Datagram, CHAT_FRAGMENT
+from simp_fragment import Reassembler, split_message, MAX_DATAGRAM_SIZE
+from simp_daemon import Daemon
+from simp_timers import TimerWheel
+from helpers import FakeConn, connect, started_chat, login, command
+
+def test_split_and_reassemble_out_of_order():
+    payload = bytes(random.Random(1).randrange(256) for _ in range(10000))
+    fragments = split_message(payload, 7)
+    for fragment in fragments:
+        datagram = Datagram.trusted(2, 1 | CHAT_FRAGMENT, 0, b"alice", fragment)
+        assert len(datagram.to_bytes()) <= MAX_DATAGRAM_SIZE
+        assert Datagram.from_buffer(datagram.to_bytes()).operation[0] == 1 | CHAT_FRAGMENT
+
+    reassembler = Reassembler()
+    shuffled = fragments[:]
+    random.Random(2).shuffle(shuffled)
+    shuffled = shuffled[:3] + shuffled  # with duplicates
+    results = [reassembler.add("peer", fragment) for fragment in shuffled]
+    complete = [result for result in results if result is not None]
+    assert len(complete) == 1 and complete[0] == payload
+    assert len(reassembler) == 0 and reassembler.used == 0
+
+def test_reassembly_memory_cap():
+    reassembler = Reassembler(max_bytes=5000)
+    first = split_message(b"a" * 4000, 1, max_data=1000)
+    second = split_message(b"b" * 4000, 2, max_data=1000)
+    assert reassembler.add("peer", first[0]) is None
+    try:
+        reassembler.add("peer", second[0])
+        assert False, "memory cap should reject the second message"
+    except ValueError:
+        pass
+    # the first message still completes
+    results = [reassembler.add("peer", fragment) for fragment in first[1:]]
+    assert results[-1] == b"a" * 4000
+
+def test_incomplete_message_expires():
+    wheel = TimerWheel(tick=0.01, now=0.0)
+    reassembler = Reassembler(wheel, timeout=5.0)
+    fragments = split_message(b"x" * 3000, 3, max_data=1000)
+    reassembler.add("peer", fragments[0])
+    wheel.advance(4.0)
+    assert len(reassembler) == 1
+    wheel.advance(6.0)
+    assert len(reassembler) == 0 and reassembler.used == 0
+
+def test_invalid_fragment():
+    fragment = split_message(b"y" * 3000, 4, max_data=1000)[0]
+    try:
+        Reassembler().add("peer", fragment[:-1])
+        assert False, "truncated fragment should raise ValueError"
+    except ValueError:
+        pass
+
+def test_dropped_message_is_not_acked():
+    daemon1, daemon2 = Daemon(ip="127.0.0.1"), Daemon(ip="127.0.0.2")
+    for daemon in (daemon1, daemon2):
+        daemon.timers = TimerWheel(now=0.0)
+    connect(daemon1, daemon2)
+    bob = daemon2.clients["bob"] = {"conn": FakeConn(), "username": "bob"}
+    alice = login(daemon1, "alice")
+    session = started_chat(daemon1, daemon2, alice)
+    bob["conn"].sent.clear()
+    rng = random.Random(3)
+    message = "".join(rng.choice(string.printable) for _ in range(5000))
+
+    # too long for the peer to reassemble, it never leaves
+    daemon1.reassembler.max_message = 4000
+    assert command(daemon1, alice, simp_framing.MESSAGE, message)
+    assert alice["conn"].sent[-1] == b"FAILED - Messages are at most 4000 bytes"
+    assert len(session.send_window) == 0 and not bob["conn"].sent
+
+    # the peer takes the fragments into its window but cannot keep the message: ERR, not ACK
+    daemon1.reassembler.max_message = daemon2.reassembler.max_message * 2
+    daemon2.reassembler.max_message = 1000
+    assert command(daemon1, alice, simp_framing.MESSAGE, message)
+    assert alice["conn"].sent[-1].startswith(b"FAILED - Message lost, bad fragment")
+    assert len(session.send_window) == 0 and not bob["conn"].sent
+    daemon1.timers.advance(10.0)
+    assert daemon1.metrics.retransmissions.value == 0 and session.state == "started"
+    assert daemon2.metrics.registry.get("simp_messages_dropped_total", "fragment") > 0
+
+if __name__ == "__main__":
+    test_split_and_reassemble_out_of_order()
+    test_reassembly_memory_cap()
+    test_incomplete_message_expires()
+    test_invalid_fragment()
+    test_dropped_message_is_not_acked()
@@ -0,0 +1,63 @@
+import simp_framing
+from simp_framing import FrameParser, encode_frame, FRAME_SIZE, MAX_FRAME
+from simp_daemon import Daemon
+from simp_sessions import Session
+from helpers import FakeConn
+
+def test_frames_split_and_coalesced():
+    stream = encode_frame(simp_framing.MESSAGE, "4 msg") + encode_frame(simp_framing.MESSAGE, "héllo") + encode_frame(simp_framing.QUIT)
+    # everything in one read
+    assert FrameParser().feed(stream) == [(4, b"4 msg"), (4, "héllo".encode("utf-8")), (0, b"")]
+
+    # one byte at a time
+    parser = FrameParser()
+    frames = []
+    for i in range(len(stream)):
+        frames += parser.feed(stream[i:i + 1])
+    assert frames == [(4, b"4 msg"), (4, "héllo".encode("utf-8")), (0, b"")]
+    assert len(parser) == 0
+
+    # a read ending in the middle of a header keeps it buffered
+    parser = FrameParser()
+    assert parser.feed(stream[:FRAME_SIZE + 5 + 2]) == [(4, b"4 msg")]
+    assert len(parser) == 2
+
+def test_oversized_frame():
+    parser = FrameParser()
+    try:
+        parser.feed(simp_framing.FRAME.pack(MAX_FRAME + 1, simp_framing.MESSAGE))
+        assert False, "oversized frame accepted"
+    except ValueError:
+        pass
+    try:
+        encode_frame(simp_framing.MESSAGE, b"x" * (MAX_FRAME + 1))
+        assert False, "oversized payload framed"
+    except ValueError:
+        pass
+
+def test_daemon_runs_pipelined_commands():
+    daemon = Daemon(ip="127.0.0.1")
+    sent = []
+    daemon.retransmit_message_to_other_daemon = lambda session, message: sent.append(message)
+    daemon.send_raw_to_daemon = lambda data, ip, port: None
+    conn = FakeConn()
+    client = {"conn": conn, "address": ("127.0.0.1", 1)}
+    client["session"] = Session("127.0.0.2", 7777, 1, "started", client)
+    parser = FrameParser()
+    pipeline = encode_frame(simp_framing.USERNAME, "alice") + b"".join(
+        encode_frame(simp_framing.MESSAGE, f"4 m{i}") for i in range(100))
+
+    # the whole pipeline arrives in arbitrary chunks
+    for start in range(0, len(pipeline), 700):
+        assert daemon.handle_client_data(parser, pipeline[start:start + 700], client)
+    assert daemon.clients["alice"] is client
+    assert conn.sent == [b"SUCCESS"]
+    assert sent == [f"4 m{i}" for i in range(100)]
+
+    assert not daemon.handle_client_data(parser, encode_frame(simp_framing.QUIT), client)
+    assert "alice" not in daemon.clients
+
+if __name__ == "__main__":
+    test_frames_split_and_coalesced()
+    test_oversized_frame()
+    test_daemon_runs_pipelined_commands()
@@ -0,0 +1,160 @@
+import time
+from Datagram import Datagram
+from simp_daemon import Daemon
+from simp_group import FanOut, MAX_BACKLOG
+from simp_timers import TimerWheel
+import simp_framing
+from helpers import FakeConn
+
+def test_fanout_shares_one_buffer():
+    fanout = FanOut(lambda peer, retries: 1.0 * 2 ** retries)
+    peers = [(f"10.0.0.{i}", 7777) for i in range(3)]
+    assert [fanout.add(peer) for peer in peers] == [0, 1, 2]
+    built = []
+    number, data, sent_to = fanout.send(lambda n: built.append(n) or b"message %d" % n, now=0.0)
+    assert number == 0 and built == [0] and sent_to == peers
+    fanout.send(lambda n: b"message %d" % n, now=0.0)
+
+    # the first member ACKs both, the second only the first message, the third nothing
+    assert fanout.ack(peers[0], 1, now=0.25) == 0.25
+    assert fanout.ack(peers[1], 0, now=0.5) == 0.5
+    assert fanout.ack(peers[1], 0, now=0.5) is None
+    assert len(fanout.messages) == 2
+    resend, dead, following = fanout.due(1.5, max_retries=2)
+    assert resend == [(peers[1], [b"message 1"]), (peers[2], [b"message 0", b"message 1"])]
+    assert dead == [] and following == 3.5
+    # a retransmitted message gives no RTT sample
+    assert fanout.ack(peers[2], 1, now=2.0) is None
+    fanout.due(3.5, max_retries=2)
+    resend, dead, _ = fanout.due(7.5, max_retries=2)
+    assert resend == [] and dead == [peers[1]]
+
+    fanout.remove(peers[1])
+    assert len(fanout.messages) == 0 and len(fanout) == 2
+    # the free slot goes to the next member, which starts with the next message
+    assert fanout.add(("10.0.0.9", 7777)) == 1
+    assert fanout.position(("10.0.0.9", 7777)) == 2
+
+def test_fanout_drops_lagging_member():
+    fanout = FanOut(lambda peer, retries: 1.0)
+    fanout.add(("10.0.0.1", 7777))
+    fanout.add(("10.0.0.2", 7777))
+    for i in range(MAX_BACKLOG + 2):
+        fanout.send(lambda n: b"x", now=0.0)
+        fanout.ack(("10.0.0.1", 7777), i, now=0.0)
+    _, dead, _ = fanout.due(1.0, max_retries=5)
+    assert dead == [("10.0.0.2", 7777)]
+
+def network(count: int):
+    """Daemons 127.0.0.1.. whose datagrams wait in a queue until deliver(), returns (daemons, sent, deliver)."""
+    daemons = [Daemon(ip=f"127.0.0.{i + 1}") for i in range(count)]
+    queue, sent = [], []
+    for daemon in daemons:
+        daemon.timers = TimerWheel(now=0.0)
+        def send(data, ip, port, source=daemon):
+            sent.append((source.ip_address, ip, data))
+            queue.append((daemons[int(ip.rsplit(".", 1)[1]) - 1], data, (source.ip_address, 7777)))
+        daemon.send_raw_to_daemon = send
+
+    def deliver():
+        while queue:
+            daemon, data, address = queue.pop(0)
+            if daemon is not None:
+                daemon.handle_incoming_datagram_from_daemon(bytes(data), address)
+    return daemons, sent, deliver
+
+def join(daemon, username, hub_ip, name):
+    client = daemon.clients[username] = {"conn": FakeConn(), "username": username, "address": ("test", 0)}
+    daemon.handle_client_command(simp_framing.GROUP, f"join {hub_ip} {name}", client)
+    return client
+
+def test_group_between_daemons():
+    (hub, member1, member2), sent, deliver = network(3)
+    alice = join(hub, "alice", "127.0.0.1", "room")
+    assert alice["conn"].sent == [b"SUCCESS - Joined group room"]
+    bob = join(member1, "bob", "127.0.0.1", "room")
+    carol = join(member1, "carol", "127.0.0.1", "room")
+    dave = join(member2, "dave", "127.0.0.1", "room")
+    deliver()
+    # one JOIN per member daemon, its answer tells every local client
+    assert bob["conn"].sent == carol["conn"].sent == dave["conn"].sent == [b"SUCCESS - Joined group room"]
+    assert len(hub.groups.names["room"].fanout) == 2
+
+    sent.clear()
+    hub.handle_client_command(simp_framing.GROUP, "say hello all", alice)
+    deliver()
+    relayed = [data for source, target, data in sent if source == "127.0.0.1" and Datagram.from_buffer(data).datagram_type[0] == 2]
+    # serialized once, the same bytes object for every member
+    assert len(relayed) == 2 and relayed[0] is relayed[1]
+    for client in (bob, carol, dave):
+        assert client["conn"].sent[-1] == b"Group message from alice in room: hello all"
+    assert alice["conn"].sent[-1] == b"SUCCESS - Joined group room"
+
+    # a member's message goes to the hub, which gives it its place and relays it to everyone
+    member1.handle_client_command(simp_framing.GROUP, "say hi from bob", bob)
+    deliver()
+    for client in (alice, carol, dave):
+        assert client["conn"].sent[-1] == b"Group message from bob in room: hi from bob"
+    assert bob["conn"].sent[-1] == b"Group message from alice in room: hello all"
+    metrics = hub.metrics.registry
+    assert metrics.get("simp_group_messages_total") == 2
+    assert metrics.get("simp_group_datagrams_fanned_out_total") == 4
+    assert all(len(daemon.groups.names["room"].fanout.messages) == 0 for daemon in (hub,))
+
+    # the last client of a member daemon leaves, the hub stops sending to it
+    member2.handle_client_command(simp_framing.GROUP, "leave", dave)
+    deliver()
+    assert dave["conn"].sent[-1] == b"LEFT group room" and len(member2.groups) == 0
+    assert len(hub.groups.names["room"].fanout) == 1
+    member1.disconnect_client(carol)
+    assert len(hub.groups.names["room"].fanout) == 1
+
+def test_lost_messages_and_dead_member():
+    (hub, member1, member2), sent, deliver = network(3)
+    alice = join(hub, "alice", "127.0.0.1", "room")
+    bob = join(member1, "bob", "127.0.0.1", "room")
+    dave = join(member2, "dave", "127.0.0.1", "room")
+    deliver()
+
+    # the first message to bob is lost, the next one waits for it
+    original = hub.send_raw_to_daemon
+    lost = []
+    hub.send_raw_to_daemon = lambda data, ip, port: lost.append(data) if ip == "127.0.0.2" and not lost else original(data, ip, port)
+    hub.handle_client_command(simp_framing.GROUP, "say one", alice)
+    hub.handle_client_command(simp_framing.GROUP, "say two", alice)
+    deliver()
+    assert bob["conn"].sent[-1] == b"SUCCESS - Joined group room"
+    assert dave["conn"].sent[-1] == b"Group message from alice in room: two"
+    room = hub.groups.names["room"]
+    now = time.monotonic()
+    hub.group_timeout(room, now + 2.0)
+    deliver()
+    assert bob["conn"].sent[-2:] == [b"Group message from alice in room: one", b"Group message from alice in room: two"]
+
+    # dave's daemon crashes, it is dropped once its retransmissions run out and the others go on
+    hub.send_raw_to_daemon = lambda data, ip, port: None if ip == "127.0.0.3" else original(data, ip, port)
+    hub.handle_client_command(simp_framing.GROUP, "say three", alice)
+    deliver()
+    for retries in range(hub.max_retries + 1):
+        now += 100.0
+        hub.group_timeout(room, now)
+        deliver()
+    assert len(hub.groups.names["room"].fanout) == 1
+    assert hub.metrics.registry.get("simp_group_members_dropped_total") == 1
+    assert bob["conn"].sent[-1] == b"Group message from alice in room: three"
+
+def test_unanswered_join():
+    (member,), sent, deliver = network(1)
+    member.send_raw_to_daemon = lambda data, ip, port: None
+    bob = join(member, "bob", "127.0.0.9", "room")
+    for step in range(1, 1000):
+        member.timers.advance(step / 10)
+    assert bob["conn"].sent[-1] == b"FAILED - No answer from the host of group room"
+    assert "group" not in bob and len(member.groups) == 0
+
+if __name__ == "__main__":
+    test_fanout_shares_one_buffer()
+    test_fanout_drops_lagging_member()
+    test_group_between_daemons()
+    test_lost_messages_and_dead_member()
+    test_unanswered_join()
@@ -0,0 +1,166 @@
+import os
+import tempfile
+import threading
+import simp_framing
+from simp_history import HistoryStore, parse_query, format_messages, INCOMING, OUTGOING, ENTRY
+from simp_daemon import Daemon
+from simp_timers import TimerWheel
+from helpers import FakeConn, connect, started_chat
+
+def texts(messages):
+    return [text for _, _, _, text in messages]
+
+def test_parse_query():
+    assert parse_query("last") == {"kind": "last", "count": 20, "peer": None, "before": None, "words": []}
+    assert parse_query("last 5 with bob before 12.5") == {"kind": "last", "count": 5, "peer": "bob", "before": 12.5, "words": []}
+    assert parse_query("search 3 Hello world")["words"] == ["Hello", "world"]
+    assert parse_query("last 100000")["count"] == 200
+    for args in ("", "first 3", "last 0", "search", "search 3 ...", "last 3 hello", "last before soon"):
+        try:
+            parse_query(args)
+            assert False, f"{args!r} accepted"
+        except ValueError:
+            pass
+
+def test_last_and_pages():
+    history = HistoryStore(tempfile.mkdtemp())
+    for i in range(50):
+        history.append("alice", "bob" if i % 2 else "carol", OUTGOING if i % 3 else INCOMING, f"message {i}")
+    history.append("dave", "bob", INCOMING, "not alice's")
+
+    page = history.last("alice", 10)
+    assert texts(page) == [f"message {i}" for i in range(40, 50)]
+    # the oldest time of a page is the cursor of the previous one
+    older = history.last("alice", 10, before=page[0][0])
+    assert texts(older) == [f"message {i}" for i in range(30, 40)]
+    assert texts(history.last("alice", 3, peer="bob")) == ["message 45", "message 47", "message 49"]
+    assert [peer for _, _, peer, _ in history.last("alice", 2)] == ["carol", "bob"]
+    assert [direction for _, direction, _, _ in history.last("alice", 3)] == [OUTGOING, INCOMING, OUTGOING]
+    assert texts(history.last("alice", 100, before=page[0][0] - 1000)) == []
+    assert texts(history.last("nobody", 10)) == []
+    assert texts(history.last("dave", 10)) == ["not alice's"]
+
+def test_search():
+    history = HistoryStore(tempfile.mkdtemp())
+    history.append("alice", "bob", OUTGOING, "Lunch tomorrow at noon?")
+    history.append("alice", "bob", INCOMING, "tomorrow works, noon is fine")
+    history.append("alice", "carol", INCOMING, "meeting tomorrow")
+    history.append("bob", "alice", INCOMING, "Lunch tomorrow at noon?")
+
+    assert texts(history.search("alice", ["tomorrow"], 10)) == ["Lunch tomorrow at noon?", "tomorrow works, noon is fine", "meeting tomorrow"]
+    assert texts(history.search("alice", ["NOON", "tomorrow"], 10)) == ["Lunch tomorrow at noon?", "tomorrow works, noon is fine"]
+    assert texts(history.search("alice", ["tomorrow"], 1)) == ["meeting tomorrow"]
+    assert texts(history.search("alice", ["tomorrow"], 10, peer="carol")) == ["meeting tomorrow"]
+    last = history.last("alice", 1)[0][0]
+    assert texts(history.search("alice", ["tomorrow"], 10, before=last)) == ["Lunch tomorrow at noon?", "tomorrow works, noon is fine"]
+    assert history.search("alice", ["dinner"], 10) == []
+    assert history.search("alice", ["lunch", "dinner"], 10) == []
+
+    words = HistoryStore(tempfile.mkdtemp(), words=False)
+    words.append("alice", "bob", OUTGOING, "no index")
+    assert words.search("alice", ["index"], 10) == []
+
+def test_reopen_and_torn_index():
+    directory = tempfile.mkdtemp()
+    history = HistoryStore(directory)
+    for i in range(5):
+        history.append("alice", "bob", OUTGOING, f"message {i}")
+    history.close()
+
+    # a crash in the middle of an index entry
+    path = history.user_path("alice", "all.idx")
+    with open(path, "ab") as f:
+        f.write(b"\x01\x02\x03")
+    history = HistoryStore(directory)
+    assert texts(history.last("alice", 10)) == [f"message {i}" for i in range(5)]
+    history.append("alice", "bob", OUTGOING, "message 5")
+    assert texts(history.last("alice", 2)) == ["message 4", "message 5"]
+    assert os.path.getsize(path) == 6 * ENTRY.size
+    assert texts(history.search("alice", ["message"], 10)) == [f"message {i}" for i in range(6)]
+    history.close()
+
+def test_many_messages():
+    history = HistoryStore(tempfile.mkdtemp())
+    for i in range(20000):
+        history.append("alice", f"peer{i % 100}", OUTGOING, f"message number {i} word{i % 1000}")
+    assert texts(history.last("alice", 3)) == [f"message number {i} word{i % 1000}" for i in range(19997, 20000)]
+    assert texts(history.last("alice", 2, peer="peer7")) == ["message number 19807 word807", "message number 19907 word907"]
+    assert texts(history.search("alice", ["word123"], 3)) == [f"message number {i} word123" for i in (17123, 18123, 19123)]
+    assert texts(history.search("alice", ["5000"], 10)) == ["message number 5000 word0"]
+
+    # a page reads its own index entries and records, whatever the number of messages with a word
+    page = history.search("alice", ["word123", "message"], 3)
+    reads = []
+    pread = os.pread
+    os.pread = lambda fd, length, offset: reads.append(length) or pread(fd, length, offset)
+    try:
+        older = history.search("alice", ["message", "word123"], 3, before=page[0][0])
+    finally:
+        os.pread = pread
+    assert texts(older) == [f"message number {i} word123" for i in (14123, 15123, 16123)]
+    assert sum(reads) < 4096
+    assert history.search("alice", ["message"], 0) == []
+
+def test_lookup_does_not_block_appends():
+    history = HistoryStore(tempfile.mkdtemp())
+    for i in range(10):
+        history.append("alice", "bob", INCOMING, f"message {i}")
+    read_records = history.read_records
+
+    def slow_read(owner, offsets):
+        # the datagram path appends while a lookup reads the disk
+        writer = threading.Thread(target=history.append, args=("alice", "bob", INCOMING, "message during lookup"))
+        writer.start()
+        writer.join(timeout=5)
+        assert not writer.is_alive(), "append waited for the lookup"
+        return read_records(owner, offsets)
+
+    history.read_records = slow_read
+    # what was appended after the lookup started is not part of it
+    assert texts(history.last("alice", 20)) == [f"message {i}" for i in range(10)]
+    assert texts(history.search("alice", ["message"], 20)) == [f"message {i}" for i in range(10)] + ["message during lookup"]
+    history.read_records = read_records
+    assert texts(history.last("alice", 2)) == ["message during lookup"] * 2
+
+def test_format_messages():
+    reply = format_messages([(12.5, OUTGOING, "bob", "two\nlines"), (13.0, INCOMING, "bob", "back\\slash")])
+    assert reply.split("\n") == ["HISTORY 2", "12.500000 > bob: two\\nlines", "13.000000 < bob: back\\\\slash"]
+    assert format_messages([]) == "HISTORY 0"
+
+def test_history_command():
+    daemon1 = Daemon(ip="127.0.0.1", history_dir=tempfile.mkdtemp())
+    daemon2 = Daemon(ip="127.0.0.2", history_dir=tempfile.mkdtemp())
+    daemon1.timers = TimerWheel(now=0.0)
+    connect(daemon1, daemon2)
+    alice = {"conn": FakeConn(), "username": "alice", "address": ("127.0.0.1", 50000)}
+    bob = daemon2.clients["bob"] = {"conn": FakeConn(), "username": "bob", "address": ("127.0.0.2", 50000)}
+    started_chat(daemon1, daemon2, alice)
+
+    daemon1.handle_client_command(simp_framing.MESSAGE, "hello bob", alice)
+    daemon2.handle_client_command(simp_framing.MESSAGE, "hello alice", bob)
+    daemon1.handle_client_command(simp_framing.HISTORY, "last 10", alice)
+    lines = alice["conn"].sent[-1].decode().split("\n")
+    assert lines[0] == "HISTORY 2"
+    assert lines[1].endswith(" > bob: hello bob") and lines[2].endswith(" < bob: hello alice")
+
+    daemon2.handle_client_command(simp_framing.HISTORY, "search alice", bob)
+    lines = bob["conn"].sent[-1].decode().split("\n")
+    assert lines[0] == "HISTORY 1" and lines[1].endswith(" > alice: hello alice")
+
+    daemon2.handle_client_command(simp_framing.HISTORY, "everything", bob)
+    assert bob["conn"].sent[-1].startswith(b"FAILED")
+    client = {"conn": FakeConn(), "username": "carol", "address": ("127.0.0.3", 50000)}
+    Daemon(ip="127.0.0.3").handle_client_command(simp_framing.HISTORY, "last", client)
+    assert client["conn"].sent[-1].startswith(b"FAILED")
+    daemon1.history.close()
+    daemon2.history.close()
+
+if __name__ == "__main__":
+    test_parse_query()
+    test_last_and_pages()
+    test_search()
+    test_reopen_and_torn_index()
+    test_many_messages()
+    test_lookup_does_not_block_appends()
+    test_format_messages()
+    test_history_command()
@@ -0,0 +1,122 @@
+import time
+from Datagram import Datagram
+from simp_daemon import Daemon
+from simp_liveness import PeerTable
+from simp_timers import TimerWheel
+from helpers import FakeConn, connect, started_chat
+
+PEER = ("127.0.0.2", 7777)
+
+def age(table, peer, seconds):
+    """Move everything the table knows of peer seconds into the past."""
+    state = table.peers[peer]
+    state.last_seen -= seconds
+    if state.last_probe is not None:
+        state.last_probe -= seconds
+    if state.probe_sent is not None:
+        state.probe_sent -= seconds
+
+def test_probes_only_silent_peers():
+    table = PeerTable(idle=2.0, max_probes=3)
+    table.track(PEER)
+    table.track(("127.0.0.3", 7777))
+    interval = lambda peer: 1.0
+    assert table.sweep(interval) == ([], [])
+
+    age(table, PEER, 2.5)
+    assert table.sweep(interval) == ([(PEER, 1)], [])
+    # one probe per interval
+    assert table.sweep(interval) == ([], [])
+    age(table, PEER, 1.0)
+    assert table.sweep(interval) == ([(PEER, 2)], [])
+
+    # traffic from the peer, it is not probed again until it goes quiet
+    table.seen(PEER)
+    assert table.sweep(interval) == ([], [])
+    assert table.peers[PEER].probes == 0
+
+def test_dead_after_unanswered_probes():
+    table = PeerTable(idle=2.0, max_probes=3)
+    table.track(PEER)
+    interval = lambda peer: 1.0
+    age(table, PEER, 2.0)
+    for sequence in (1, 2, 3):
+        assert table.sweep(interval) == ([(PEER, sequence)], [])
+        age(table, PEER, 1.0)
+    probes, dead = table.sweep(interval)
+    assert probes == [] and [peer for peer, _ in dead] == [PEER]
+    assert dead[0][1] >= 5.0
+    table.forget(PEER)
+    assert len(table) == 0
+
+def test_answer_gives_rtt_sample():
+    table = PeerTable(idle=2.0)
+    table.track(PEER)
+    age(table, PEER, 3.0)
+    now = time.monotonic()
+    [(_, sequence)], _ = table.sweep(lambda peer: 1.0, now)
+    # an answer to an older probe gives no sample
+    assert table.answered(PEER, sequence - 1, now + 0.05) is None
+    assert abs(table.answered(PEER, sequence, now + 0.05) - 0.05) < 1e-9
+    assert table.answered(PEER, sequence, now + 0.1) is None
+    assert table.answered(("127.0.0.9", 7777), 1) is None
+
+def chat():
+    """Two daemons wired in memory with a started chat, returns (daemon1, daemon2, session of daemon1)."""
+    daemon1 = Daemon(ip="127.0.0.1")
+    daemon2 = Daemon(ip="127.0.0.2")
+    daemon1.timers = TimerWheel(now=0.0)
+    daemon2.timers = TimerWheel(now=0.0)
+    connect(daemon1, daemon2)
+    daemon2.clients["bob"] = {"conn": FakeConn(), "username": "bob"}
+    return daemon1, daemon2, started_chat(daemon1, daemon2, {"conn": FakeConn(), "username": "alice"})
+
+def test_daemon_keepalive_and_dead_peer():
+    daemon1, daemon2, session = chat()
+    # both sides offered KEEPALIVE, each watches the other
+    assert PEER in daemon1.peers.peers and ("127.0.0.1", 7777) in daemon2.peers.peers
+
+    age(daemon1.peers, PEER, 3.0)
+    daemon1.sweep_peers()
+    metrics1 = daemon1.metrics.registry
+    assert daemon2.metrics.registry.get("simp_datagrams_received_total", "control", "KEEPALIVE") == 1
+    assert metrics1.get("simp_datagrams_received_total", "control", "KEEPALIVE_ACK") == 1
+    assert daemon1.rtt_estimators[PEER].srtt is not None
+    assert daemon1.peers.peers[PEER].probes == 0
+
+    # the peer crashes, nothing it is sent gets an answer
+    daemon1.send_raw_to_daemon = lambda data, ip, port: None
+    age(daemon1.peers, PEER, 2.0)
+    for _ in range(3):
+        daemon1.sweep_peers()
+        age(daemon1.peers, PEER, daemon1.probe_interval(PEER))
+    assert session.state == "started"
+    daemon1.sweep_peers()
+    assert session.state == "closed"
+    assert session.client["conn"].sent[-1] == b"CHAT_ENDED"
+    assert PEER not in daemon1.active_daemon_connection
+    assert PEER not in daemon1.rtt_estimators and len(daemon1.peers) == 0
+    assert metrics1.get("simp_peers_dead_total") == 1
+    assert metrics1.get("simp_peers_tracked") == 0
+
+def test_older_peers_are_not_watched():
+    daemon = Daemon(ip="127.0.0.1")
+    daemon.timers = TimerWheel(now=0.0)
+    daemon.send_raw_to_daemon = lambda data, ip, port: None
+    daemon.clients["bob"] = {"conn": FakeConn(), "username": "bob"}
+    # SYN of a daemon that does not know keepalives
+    daemon.handle_incoming_datagram_from_daemon(Datagram.trusted(1, 2, 0, b"bob", b"WINDOW=4").to_bytes(), PEER)
+    assert daemon.clients["bob"]["session"] is not None
+    assert len(daemon.peers) == 0
+
+    # closing the last chat with a peer forgets it
+    daemon1, daemon2, session = chat()
+    daemon1.close_session(session)
+    assert len(daemon1.peers) == 0
+
+if __name__ == "__main__":
+    test_probes_only_silent_peers()
+    test_dead_after_unanswered_probes()
+    test_answer_gives_rtt_sample()
+    test_daemon_keepalive_and_dead_peer()
+    test_older_peers_are_not_watched()
@@ -0,0 +1,29 @@
+import logging
+from logger import get_logger, set_level, configure_levels, TracePoint, TRACE
+
+def test_trace_point_is_lazy_when_disabled():
+    log = get_logger("test_lazy")
+    set_level("test_lazy", "INFO")
+    trace = TracePoint(log)
+
+    class Expensive:
+        formatted = False
+        def __str__(self):
+            Expensive.formatted = True
+            return "expensive"
+
+    assert not trace
+    if trace: trace("value: %s", Expensive())
+    log.log(TRACE, "value: %s", Expensive())
+    assert not Expensive.formatted
+
+def test_per_subsystem_levels():
+    configure_levels("test_a=TRACE, test_b=WARNING")
+    assert TracePoint(get_logger("test_a"))
+    assert not TracePoint(get_logger("test_b"), logging.INFO)
+    assert TracePoint(get_logger("test_b"), logging.WARNING)
+    assert get_logger("test_a").name == "SIMPDaemon.test_a"
+
+if __name__ == "__main__":
+    test_trace_point_is_lazy_when_disabled()
+    test_per_subsystem_levels()
@@ -0,0 +1,145 @@
+import os
+import socket
+import tempfile
+import threading
+import time
+import simp_framing
+from Datagram import Datagram
+from simp_daemon import Daemon
+from simp_metrics import MetricsRegistry, worker_target
+from simp_timers import TimerWheel
+from helpers import FakeConn, connect, started_chat
+
+def test_registry_render():
+    registry = MetricsRegistry()
+    requests = registry.counter("requests_total", "Requests.", ("kind",))
+    requests.labels("get").inc()
+    requests.labels("get").inc(2)
+    requests.labels("put").inc()
+    latency = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        latency.labels().observe(value)
+    assert registry.get("requests_total", "get") == 3
+    assert registry.get("requests_total", "delete") == 0
+
+    lines = registry.render().splitlines()
+    assert "# TYPE requests_total counter" in lines
+    assert 'requests_total{kind="get"} 3' in lines and 'requests_total{kind="put"} 1' in lines
+    # buckets are cumulative, a value on a bound counts in that bucket
+    assert 'latency_seconds_bucket{le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 3' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 4' in lines
+    assert "latency_seconds_sum 3.65" in lines and "latency_seconds_count 4" in lines
+
+    try:
+        requests.labels("get", "extra")
+        assert False, "wrong number of labels accepted"
+    except ValueError:
+        pass
+
+def chat():
+    """Two daemons wired in memory with a started chat, returns (daemon1, daemon2, session of daemon1)."""
+    daemon1 = Daemon(ip="127.0.0.1")
+    daemon2 = Daemon(ip="127.0.0.2")
+    daemon1.timers = TimerWheel(now=0.0)
+    connect(daemon1, daemon2)
+    daemon2.clients["bob"] = {"conn": FakeConn(), "username": "bob"}
+    return daemon1, daemon2, started_chat(daemon1, daemon2)
+
+def test_daemon_counts():
+    daemon1, daemon2, session = chat()
+    metrics1, metrics2 = daemon1.metrics.registry, daemon2.metrics.registry
+    assert metrics1.get("simp_handshakes_total", "outgoing", "success") == 1
+    assert metrics2.get("simp_handshakes_total", "incoming", "accepted") == 1
+    assert "simp_handshake_latency_seconds_count 1" in metrics1.render().splitlines()
+    assert metrics2.get("simp_datagrams_received_total", "control", "SYN") == 1
+    assert metrics1.get("simp_datagrams_received_total", "control", "SYN_ACK") == 1
+
+    for message in ("hello", "bob"):
+        daemon1.retransmit_message_to_other_daemon(session, message)
+    assert metrics2.get("simp_datagrams_received_total", "chat", "MESSAGE") == 2
+    assert metrics1.get("simp_datagrams_received_total", "control", "ACK") == 2
+    assert metrics2.get("simp_bytes_received_total", "chat") > 2 * 39
+
+    # a retransmitted datagram, one far ahead of the window, one for no session and one that does not parse
+    session2 = daemon2.clients["bob"]["session"]
+    duplicate = Datagram.trusted(2, 1, 0, b"alice", b"hello", session2.local_id).to_bytes()
+    daemon2.handle_incoming_datagram_from_daemon(duplicate, ("127.0.0.1", 7777))
+    ahead = Datagram.trusted(2, 1, 200, b"alice", b"late", session2.local_id).to_bytes()
+    daemon2.handle_incoming_datagram_from_daemon(ahead, ("127.0.0.1", 7777))
+    stray = Datagram.trusted(2, 1, 0, b"alice", b"stray", 999).to_bytes()
+    daemon2.handle_incoming_datagram_from_daemon(stray, ("127.0.0.1", 7777))
+    daemon2.handle_incoming_datagram_from_daemon(b"\x09", ("127.0.0.1", 7777))
+    assert metrics2.get("simp_sequence_mismatches_total", "duplicate") == 1
+    assert metrics2.get("simp_sequence_mismatches_total", "out_of_window") == 1
+    assert metrics2.get("simp_messages_dropped_total", "no_session") == 1
+    assert metrics2.get("simp_datagrams_invalid_total") == 1
+
+    # the client is gone but the chat is still open, the message waits in the outbox
+    del daemon2.clients["bob"]["conn"]
+    daemon1.retransmit_message_to_other_daemon(session, "anyone there?")
+    assert metrics2.get("simp_outbox_stored_total") == 1
+
+    # SYN for a user that is not connected
+    daemon2.handle_incoming_datagram_from_daemon(Datagram.trusted(1, 2, 0, b"carol").to_bytes(), ("127.0.0.3", 7777))
+    assert metrics2.get("simp_handshakes_total", "incoming", "rejected") == 1
+
+def test_stats_command():
+    daemon = Daemon(ip="127.0.0.1")
+    client = {"conn": FakeConn(), "address": ("127.0.0.1", 50000)}
+    # no username needed
+    assert daemon.handle_client_command(simp_framing.STATS, "", client)
+    snapshot = client["conn"].sent[-1].decode("utf-8")
+    assert "# TYPE simp_datagrams_received_total counter" in snapshot
+    assert "simp_clients_connected 0" in snapshot
+
+def test_worker_target():
+    assert worker_target("daemon.prom", 2) == "daemon.2.prom"
+    assert worker_target("/var/lib/simp/daemon", 0) == "/var/lib/simp/daemon.0"
+    assert worker_target("unix:/run/simp.sock", 1) == "unix:/run/simp.1.sock"
+    assert worker_target("127.0.0.1:9100", 3) == "127.0.0.1:9103"
+    assert worker_target(None, 3) is None
+
+def read_socket(port):
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+        data = b""
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return data.decode("utf-8")
+            data += chunk
+
+def test_export_over_loopback():
+    path = os.path.join(tempfile.mkdtemp(), "daemon.prom")
+    # addresses of their own, the daemons of other test modules may still hold 127.0.0.1 and 127.0.0.2
+    daemon1 = Daemon(ip="127.0.0.5", metrics_file=path, metrics_socket="127.0.0.1:9780")
+    daemon2 = Daemon(ip="127.0.0.6")
+    threads = [threading.Thread(target=daemon.start, daemon=True) for daemon in (daemon1, daemon2)]
+    for thread in threads:
+        thread.start()
+    time.sleep(1)
+    try:
+        # the first snapshot is written when the daemon starts
+        assert "simp_handshakes_total" in open(path).read()
+
+        daemon2.clients["bob"] = {"conn": FakeConn(), "username": "bob"}
+        session = daemon1.open_session("127.0.0.6", 7777, {"conn": FakeConn(), "username": "alice"}, "bob")
+        assert daemon1.begin_handshake(session).result(timeout=5)
+        snapshot = read_socket(9780).splitlines()
+        assert 'simp_datagrams_sent_total{type="control",operation="SYN"} 1' in snapshot
+        assert 'simp_handshakes_total{direction="outgoing",outcome="success"} 1' in snapshot
+        assert daemon2.metrics.registry.get("simp_datagrams_sent_total", "control", "SYN_ACK") == 1
+    finally:
+        for daemon in (daemon1, daemon2):
+            daemon.stop()
+        for thread in threads:
+            thread.join()
+    # stopping leaves the final snapshot
+    assert 'simp_datagrams_received_total{type="control",operation="SYN_ACK"} 1' in open(path).read().splitlines()
+
+if __name__ == "__main__":
+    test_registry_render()
+    test_daemon_counts()
+    test_stats_command()
+    test_worker_target()
+    test_export_over_loopback()
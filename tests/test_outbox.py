@@ -0,0 +1,201 @@
+import os
+import socket
+import tempfile
+import simp_framing
+import simp_outbox
+from simp_framing import FramedConnection
+from simp_outbox import Outbox, SEGMENT_SUFFIX
+from simp_daemon import Daemon
+from simp_timers import TimerWheel
+from simp_batch import BATCH_DELAY
+from helpers import FakeConn, connect, started_chat
+
+def replayed(outbox, user):
+    messages = []
+    outbox.replay(user, lambda sender, message: messages.append((sender, message)))
+    return messages
+
+def test_store_and_replay_in_order():
+    outbox = Outbox()
+    for i in range(100):
+        assert outbox.store("bob", "alice", f"message {i}")
+    assert outbox.store("carol", "alice", "héllo")
+    assert len(outbox) == 101
+    assert replayed(outbox, "bob") == [("alice", f"message {i}") for i in range(100)]
+    assert replayed(outbox, "bob") == []
+    assert replayed(outbox, "carol") == [("alice", "héllo")]
+    assert len(outbox) == 0
+
+def test_recovery_after_restart():
+    directory = tempfile.mkdtemp()
+    outbox = Outbox(directory)
+    for i in range(5):
+        outbox.store("bob", "alice", f"message {i}")
+    outbox.store("carol", "dave", "hi")
+
+    # the client goes away again after two messages, the others stay stored
+    delivered = []
+    def deliver(sender, message):
+        if len(delivered) == 2:
+            raise OSError("connection reset")
+        delivered.append(message)
+    assert outbox.replay("bob", deliver) == 2
+    outbox.close()
+
+    outbox = Outbox(directory)
+    assert replayed(outbox, "bob") == [("alice", f"message {i}") for i in range(2, 5)]
+    outbox.close()
+    outbox = Outbox(directory)
+    assert replayed(outbox, "bob") == []
+    assert replayed(outbox, "carol") == [("dave", "hi")]
+    outbox.close()
+
+def test_torn_write_is_ignored():
+    directory = tempfile.mkdtemp()
+    outbox = Outbox(directory)
+    outbox.store("bob", "alice", "kept")
+    outbox.store("bob", "alice", "torn")
+    offset = outbox.pending["bob"][-1][1]
+    outbox.close()
+
+    # a crash in the middle of the second record
+    path = os.path.join(directory, os.listdir(directory)[0])
+    with open(path, "r+b") as f:
+        f.seek(offset + simp_outbox.RECORD.size)
+        f.write(b"\xff\xff")
+    outbox = Outbox(directory)
+    assert len(outbox) == 1
+    # appends go on from the end of the last good record
+    outbox.store("bob", "alice", "after")
+    outbox.close()
+    assert replayed(Outbox(directory), "bob") == [("alice", "kept"), ("alice", "after")]
+
+def test_segments_roll_and_are_deleted():
+    size = simp_outbox.SEGMENT_SIZE
+    simp_outbox.SEGMENT_SIZE = 4096
+    try:
+        directory = tempfile.mkdtemp()
+        outbox = Outbox(directory, max_bytes=8 * 4096)
+        message = "x" * 1000
+        for _ in range(10):
+            assert outbox.store("bob", "alice", message)
+        assert outbox.store("carol", "alice", message)
+        assert len(os.listdir(directory)) == 3
+        # bob's messages fill the first segments, they go once he got them
+        assert len(replayed(outbox, "bob")) == 10
+        assert len(os.listdir(directory)) == 1
+
+        # every segment allowed is taken, nothing more is stored
+        while outbox.store("dave", "alice", message):
+            pass
+        assert len(outbox.segments) == 8
+        outbox.close()
+        outbox = Outbox(directory, max_bytes=8 * 4096)
+        assert replayed(outbox, "carol") == [("alice", message)]
+        # 4 messages per segment, the first one was shared with carol
+        assert len(replayed(outbox, "dave")) == 7 * 4
+        outbox.close()
+        assert all(name.endswith(SEGMENT_SUFFIX) for name in os.listdir(directory))
+    finally:
+        simp_outbox.SEGMENT_SIZE = size
+
+def test_per_user_limit():
+    outbox = Outbox(max_messages=3)
+    assert all(outbox.store("bob", "alice", str(i)) for i in range(3))
+    assert not outbox.store("bob", "alice", "3")
+    assert outbox.store("carol", "alice", "0")
+
+def test_syncs_are_batched():
+    scheduled = []
+    outbox = Outbox(tempfile.mkdtemp(), lambda delay, callback: scheduled.append(callback))
+    for i in range(10):
+        outbox.store("bob", "alice", str(i))
+    # one msync covers the ten appends
+    assert len(scheduled) == 1 and outbox.unsynced > 0
+    scheduled[0]()
+    assert outbox.unsynced == 0 and not outbox.dirty
+    outbox.store("bob", "alice", "10")
+    assert len(scheduled) == 2
+
+def chat(outbox=None):
+    """alice on 127.0.0.1 in a started chat with bob on 127.0.0.2, returns (daemon1, daemon2, session, bob)."""
+    daemon1 = Daemon(ip="127.0.0.1")
+    daemon2 = Daemon(ip="127.0.0.2", outbox_dir=tempfile.mkdtemp())
+    if outbox is not None:
+        daemon2.outbox.close()
+        daemon2.outbox = outbox
+    for daemon in (daemon1, daemon2):
+        daemon.timers = TimerWheel(now=0.0)
+    connect(daemon1, daemon2)
+    bob = daemon2.clients["bob"] = {"conn": FakeConn(), "username": "bob"}
+    return daemon1, daemon2, started_chat(daemon1, daemon2), bob
+
+def test_daemon_replays_on_reconnect():
+    daemon1, daemon2, session, bob = chat()
+    daemon_side, client_side = socket.socketpair()
+    client_side.close()
+    bob["conn"] = FramedConnection(daemon_side)
+
+    # bob's connection broke, the writer could not send the first message
+    daemon1.retransmit_message_to_other_daemon(session, "message 0")
+    bob["conn"].writer.join(5)
+    daemon2.disconnect_client(bob)
+    # the chat goes on, the messages are ACKed and stored
+    for i in range(1, 3):
+        daemon1.retransmit_message_to_other_daemon(session, f"message {i}")
+    assert session.state == "started" and len(session.send_window) == 0
+    assert len(daemon2.outbox) == 3 and "bob" in daemon2.parked
+
+    client = {"conn": FakeConn(), "address": ("127.0.0.2", 50000)}
+    daemon2.handle_client_command(simp_framing.USERNAME, "bob", client)
+    assert client["conn"].sent == [b"SUCCESS"] + [f"Stored message from alice: message {i}".encode() for i in range(3)] + [b"SUCCESS - Chat started.\n"]
+    assert daemon2.metrics.registry.get("simp_outbox_replayed_total") == 3
+    assert len(daemon2.outbox) == 0 and not daemon2.parked
+    daemon1.retransmit_message_to_other_daemon(session, "message 3")
+    assert client["conn"].sent[-1] == b"Message from alice: message 3"
+
+    # gone again and not back in time, the chat ends
+    daemon2.disconnect_client(client)
+    daemon2.timers.advance(simp_outbox.AWAY_TIMEOUT + 1)
+    assert session.state == "closed" and not daemon2.parked and len(daemon2.sessions) == 0
+    daemon2.outbox.close()
+
+def test_full_outbox_is_not_acked():
+    daemon1, daemon2, session, bob = chat(Outbox(max_messages=2))
+    daemon2.disconnect_client(bob)
+    for i in range(3):
+        daemon1.retransmit_message_to_other_daemon(session, f"message {i}")
+    # the third message had nowhere to go, it waits in alice's window
+    assert len(daemon2.outbox) == 2 and len(session.send_window) == 1
+    assert daemon2.metrics.registry.get("simp_messages_dropped_total", "outbox_full") == 1
+
+    client = {"conn": FakeConn(), "address": ("127.0.0.2", 50000)}
+    daemon2.handle_client_command(simp_framing.USERNAME, "bob", client)
+    daemon1.timers.advance(5.0)
+    assert client["conn"].sent[-1] == b"Message from alice: message 2"
+    assert len(session.send_window) == 0
+
+def test_message_dropped_after_the_window_is_not_acked():
+    daemon1, daemon2, session, bob = chat(Outbox(max_messages=2))
+    daemon2.disconnect_client(bob)
+    alice = session.client["conn"] = FakeConn()
+    daemon1.batch_delay = BATCH_DELAY
+    for i in range(3):
+        daemon1.retransmit_message_to_other_daemon(session, f"message {i}")
+    daemon1.timers.advance(BATCH_DELAY + 0.02)
+    # one batch datagram with room in the outbox for two of its messages: ERR in place of the ACK
+    assert len(daemon2.outbox) == 2 and len(session.send_window) == 0
+    assert alice.sent[-1] == b"FAILED - Message lost, outbox full"
+    daemon1.timers.advance(10.0)
+    assert daemon1.metrics.retransmissions.value == 0 and session.state == "started"
+
+if __name__ == "__main__":
+    test_store_and_replay_in_order()
+    test_recovery_after_restart()
+    test_torn_write_is_ignored()
+    test_segments_roll_and_are_deleted()
+    test_per_user_limit()
+    test_syncs_are_batched()
+    test_daemon_replays_on_reconnect()
+    test_full_outbox_is_not_acked()
+    test_message_dropped_after_the_window_is_not_acked()
@@ -0,0 +1,153 @@
+from Datagram import Datagram, encode_options
+from simp_daemon import Daemon
+from simp_relay import RoutingTable, wrap, inspect, forwarded, encode_routes, decode_routes, INFINITY, RELAY_OFFSET
+from simp_timers import TimerWheel
+from helpers import FakeConn
+
+A, B, C, D = (("127.0.0.1", 7777), ("127.0.0.2", 7777), ("127.0.0.3", 7777), ("127.0.0.4", 7777))
+
+def test_routing_table():
+    table = RoutingTable(A, [B], ttl=10.0)
+    assert table.next_hop(B) is None and table.next_hop(C) is None
+    assert table.learn(B, [(B, 0), (C, 2), (A, 1)], now=0.0) == 1
+    assert table.next_hop(C, now=1.0) == B and table.routes[C].hops == 3
+    # a shorter way through another neighbor wins, a longer one does not
+    table.learn(D, [(D, 0), (C, 1)], now=1.0)
+    assert table.next_hop(C, now=1.0) == D and table.routes[C].hops == 2
+    table.learn(B, [(C, 4)], now=2.0)
+    assert table.next_hop(C, now=2.0) == D
+
+    # what goes through a neighbor is announced back to it as unreachable
+    assert dict(table.advertise(D, now=2.0))[C] == INFINITY
+    assert dict(table.advertise(B, now=2.0))[C] == 2
+    assert dict(table.advertise(B, now=2.0))[A] == 0
+    # the neighbor we go through lost it
+    table.learn(D, [(C, INFINITY)], now=3.0)
+    assert C not in table.routes
+
+    # learned routes expire, a configured neighbor does not
+    assert table.expire(now=100.0) == 1
+    assert table.neighbors() == [B]
+    assert decode_routes(b"".join(encode_routes([(A, 0), (C, 3)]))) == [(A, 0), (C, 3)]
+
+def test_wrap_and_forward():
+    inner = Datagram.trusted(2, 1, 7, b"alice", b"hello", session_id=5).to_bytes()
+    relay = wrap(inner, C, A, ttl=4)
+    assert Datagram.from_buffer(relay).operation[0] == 9
+    assert inspect(relay) == (4, C, A)
+    out = forwarded(relay, 4)
+    assert inspect(out) == (3, C, A)
+    # only the hop limit changed, the relayed datagram passes through untouched
+    assert out[:2] == relay[:2] and out[3:] == relay[3:]
+    assert bytes(out[RELAY_OFFSET:]) == inner
+    for broken in (relay[:RELAY_OFFSET - 1], relay + b"x"):
+        try:
+            inspect(broken)
+            assert False, "inspect should raise ValueError"
+        except ValueError:
+            pass
+
+def mesh(links):
+    """Daemons 127.0.0.1-4, a datagram only gets through a link, returns (daemons, queue, deliver)."""
+    daemons = {peer: Daemon(ip=peer[0], neighbors=[other[0] for link in links for other in link if peer in link and other != peer])
+               for peer in (A, B, C, D)}
+    queue = []
+    for peer, daemon in daemons.items():
+        daemon.timers = TimerWheel(now=0.0)
+        def send(data, ip, port, source=peer):
+            if {source, (ip, port)} in links:
+                queue.append((daemons[ip, port], bytes(data), source))
+        daemon.sendto_daemon = send
+
+    def deliver():
+        while queue:
+            daemon, data, address = queue.pop(0)
+            daemon.handle_incoming_datagram_from_daemon(data, address)
+    return daemons, queue, deliver
+
+def test_chat_through_relays():
+    daemons, queue, deliver = mesh([{A, B}, {B, C}, {C, D}])
+    for _ in range(3):
+        for daemon in daemons.values():
+            daemon.announce_routes()
+        deliver()
+    alice_daemon, dave_daemon = daemons[A], daemons[D]
+    assert alice_daemon.routes.next_hop(D) == B and dave_daemon.routes.next_hop(A) == C
+    assert alice_daemon.routes.routes[D].hops == 3
+
+    dave = dave_daemon.clients["dave"] = {"conn": FakeConn(), "username": "dave"}
+    alice = {"conn": FakeConn(), "username": "alice"}
+    session = alice_daemon.open_session(D[0], 7777, alice, "dave")
+    future = alice_daemon.begin_handshake(session)
+    deliver()
+    assert future.result(timeout=0)
+    assert dave["conn"].sent[-1].startswith(b"Chat request from: 127.0.0.1 (alice)")
+    dave_daemon.handle_client_chat_decision("ACCEPT", dave)
+    deliver()
+    alice_daemon.retransmit_message_to_other_daemon(session, "hello over two relays")
+    deliver()
+    assert dave["conn"].sent[-1] == b"Message from alice: hello over two relays"
+    assert len(session.send_window) == 0
+    assert daemons[B].metrics.registry.get("simp_datagrams_relayed_total") > 0
+    assert daemons[C].metrics.registry.get("simp_datagrams_relayed_total") > 0
+
+def test_relay_drops():
+    daemons, queue, deliver = mesh([{A, B}, {B, C}])
+    inner = Datagram.trusted(1, 10, 1, b"Daemon").to_bytes()
+    relay = daemons[B]
+    # out of hops
+    relay.handle_incoming_datagram_from_daemon(wrap(inner, C, A, ttl=1), A)
+    # from a daemon that is not a neighbor of the relay
+    relay.handle_incoming_datagram_from_daemon(wrap(inner, C, D, ttl=4), D)
+    assert queue == []
+    metrics = relay.metrics.registry
+    assert metrics.get("simp_relay_dropped_total", "ttl") == 1
+    assert metrics.get("simp_relay_dropped_total", "not_neighbor") == 1
+
+    relay.handle_incoming_datagram_from_daemon(wrap(inner, C, A, ttl=4), A)
+    deliver()
+    # the KEEPALIVE reached C as if A sent it, its answer found the way back
+    assert daemons[C].metrics.registry.get("simp_datagrams_received_total", "control", "KEEPALIVE") == 1
+    assert daemons[A].metrics.registry.get("simp_datagrams_received_total", "control", "KEEPALIVE_ACK") == 1
+
+def test_untrusted_routes_and_relays():
+    X, attacker = ("10.0.0.5", 7777), ("6.6.6.6", 7777)
+    daemon = Daemon(ip=A[0], neighbors=[B[0]])
+    daemon.timers = TimerWheel(now=0.0)
+    sent = []
+    daemon.sendto_daemon = lambda data, ip, port: sent.append(((ip, port), bytes(data)))
+    daemon.clients["alice"] = {"conn": FakeConn(), "username": "alice"}
+    # a chat with X, which we reach directly
+    syn = Datagram.trusted(1, 2, 0, b"alice", encode_options({"SID": 3, "WINDOW": 4, "FROM": "xavier"}))
+    daemon.handle_incoming_datagram_from_daemon(syn.to_bytes(), X)
+    session = daemon.clients["alice"]["session"]
+
+    # announcements from a daemon we did not configure are not listened to
+    daemon.handle_incoming_datagram_from_daemon(Datagram.trusted(1, 5, 0, b"Daemon", b"".join(encode_routes([(attacker, 0), (X, 0)]))).to_bytes(), attacker)
+    assert daemon.routes.next_hop(X) is None and daemon.routes.neighbors() == [B]
+    assert daemon.metrics.registry.get("simp_admission_dropped_total", "not_neighbor") == 1
+
+    # nor its RELAY datagrams, delivered or to forward: no FIN in X's chat and no way back through it
+    fin = Datagram.trusted(1, 8, 0, b"Daemon", b"", session_id=session.local_id).to_bytes()
+    daemon.handle_incoming_datagram_from_daemon(wrap(fin, A, X), attacker)
+    daemon.handle_incoming_datagram_from_daemon(wrap(fin, C, X), attacker)
+    assert session.state == "pending_user_acceptance" and X not in daemon.routes
+    assert daemon.metrics.registry.get("simp_relay_dropped_total", "not_neighbor") == 2
+    sent.clear()
+    daemon.send_raw_to_daemon(b"data", *X)
+    assert sent == [(X, b"data")]
+
+    # a neighbor relaying for X does not take over the route of a daemon we talk to directly
+    keepalive = Datagram.trusted(1, 10, 1, b"Daemon").to_bytes()
+    daemon.handle_incoming_datagram_from_daemon(wrap(keepalive, A, X), B)
+    assert daemon.routes.next_hop(X) is None
+    # one we do not talk to gets its answers back through the neighbor
+    daemon.handle_incoming_datagram_from_daemon(wrap(keepalive, A, D), B)
+    assert daemon.routes.next_hop(D) == B
+
+if __name__ == "__main__":
+    test_routing_table()
+    test_wrap_and_forward()
+    test_chat_through_relays()
+    test_relay_drops()
+    test_untrusted_routes_and_relays()
@@ -0,0 +1,149 @@
+from simp_daemon import Daemon, HANDSHAKE_TIMEOUT
+from simp_resume import TicketStore, TicketCache, TICKETS_PER_PEER
+from simp_timers import TimerWheel
+from helpers import FakeConn, queued
+
+PEER = ("127.0.0.2", 7777)
+
+def test_ticket_store():
+    store = TicketStore(capacity=3)
+    ticket = store.issue("10.0.0.1", {"window": 8, "codec": "zlib"})
+    assert store.redeem(ticket, "10.0.0.2") is None
+    ticket = store.issue("10.0.0.1", {"window": 8, "codec": "zlib"})
+    assert store.redeem(ticket, "10.0.0.1") == {"window": 8, "codec": "zlib"}
+    # a ticket is redeemed once
+    assert store.redeem(ticket, "10.0.0.1") is None
+
+    tickets = [store.issue("10.0.0.1", {"window": i, "codec": None}) for i in range(4)]
+    assert len(store) == 3
+    assert store.redeem(tickets[0], "10.0.0.1") is None
+    assert store.redeem(tickets[3], "10.0.0.1") == {"window": 3, "codec": None}
+    expired = TicketStore(lifetime=-1.0)
+    assert expired.redeem(expired.issue("10.0.0.1", {}), "10.0.0.1") is None
+
+def test_ticket_cache():
+    cache = TicketCache(capacity=2)
+    for i in range(TICKETS_PER_PEER + 2):
+        cache.store(PEER, f"t{i}", {"window": i})
+    # newest first, only the last TICKETS_PER_PEER are kept
+    assert cache.take(PEER) == (f"t{TICKETS_PER_PEER + 1}", {"window": TICKETS_PER_PEER + 1})
+    taken = [cache.take(PEER) for _ in range(TICKETS_PER_PEER)]
+    assert taken[-1] is None and taken[-2] == ("t2", {"window": 2})
+
+    cache.store(("10.0.0.1", 7777), "a", {})
+    cache.store(("10.0.0.2", 7777), "b", {})
+    cache.store(("10.0.0.3", 7777), "c", {})
+    assert len(cache) == 2 and cache.take(("10.0.0.1", 7777)) is None
+    expired = TicketCache(lifetime=-1.0)
+    expired.store(PEER, "t", {})
+    assert expired.take(PEER) is None
+
+def daemons():
+    """Two daemons whose datagrams wait in a queue until deliver() is called, returns (daemon1, daemon2, queue, deliver)."""
+    daemon1 = Daemon(ip="127.0.0.1")
+    daemon2 = Daemon(ip="127.0.0.2")
+    for daemon in (daemon1, daemon2):
+        daemon.timers = TimerWheel(now=0.0)
+    queue, deliver = queued(daemon1, daemon2)
+    daemon2.clients["bob"] = {"conn": FakeConn(), "username": "bob"}
+    return daemon1, daemon2, queue, deliver
+
+def chat(daemon1, daemon2, deliver, client):
+    session = daemon1.open_session("127.0.0.2", 7777, client, "bob")
+    future = daemon1.begin_handshake(session)
+    done = future.done()
+    operations = deliver()
+    daemon2.handle_client_chat_decision("ACCEPT", daemon2.clients["bob"])
+    deliver()
+    assert session.state == "started"
+    daemon1.retransmit_message_to_other_daemon(session, "hello")
+    deliver()
+    assert daemon2.clients["bob"]["conn"].sent[-1] == b"Message from alice: hello"
+    return session, done, operations
+
+def test_second_chat_skips_the_handshake():
+    daemon1, daemon2, queue, deliver = daemons()
+    alice = {"conn": FakeConn(), "username": "alice"}
+
+    session, done, operations = chat(daemon1, daemon2, deliver, alice)
+    assert not done and operations == [2, 6, 4]  # SYN, SYN+ACK, ACK
+    assert len(daemon1.peer_tickets) == 1
+    daemon1.disconnect_client(alice, quit=True)
+    deliver()
+
+    alice = {"conn": FakeConn(), "username": "alice"}
+    session, done, operations = chat(daemon1, daemon2, deliver, alice)
+    # complete before anything came back, and no ACK
+    assert done and operations == [2, 6]
+    assert session.resumed and daemon2.clients["bob"]["session"].resumed
+    assert alice["conn"].sent[0].startswith(b"Transport handshake OK")
+    assert daemon1.metrics.registry.get("simp_handshakes_resumed_total", "outgoing") == 1
+    assert daemon2.metrics.registry.get("simp_handshakes_resumed_total", "incoming") == 1
+    assert [attempt["success"] for attempt in daemon1.handshake_attempts] == [True, True]
+    # the resumed SYN+ACK gave a new ticket
+    assert len(daemon1.peer_tickets.peers[PEER]) == 1
+
+def test_ticket_valid_after_acceptance():
+    daemon1, daemon2, queue, deliver = daemons()
+    alice = {"conn": FakeConn(), "username": "alice"}
+    session = daemon1.open_session("127.0.0.2", 7777, alice, "bob")
+    daemon1.begin_handshake(session)
+    deliver()
+    # the handshake completed, bob did not answer yet: the ticket daemon1 holds is not redeemable
+    assert len(daemon1.peer_tickets) == 1 and len(daemon2.tickets) == 0
+    daemon2.handle_client_chat_decision("DECLINE", daemon2.clients["bob"])
+    deliver()
+    assert len(daemon2.tickets) == 0
+
+    # the declined chat's ticket gets an ordinary handshake
+    alice = {"conn": FakeConn(), "username": "alice"}
+    session, done, operations = chat(daemon1, daemon2, deliver, alice)
+    assert done and operations == [2, 6, 4] and not session.resumed
+    assert len(daemon2.tickets) == 1
+
+def test_unknown_ticket_falls_back():
+    daemon1, daemon2, queue, deliver = daemons()
+    alice = {"conn": FakeConn(), "username": "alice"}
+    chat(daemon1, daemon2, deliver, alice)
+    daemon1.disconnect_client(alice, quit=True)
+    deliver()
+
+    # the peer restarted since, with a smaller window: it does not know the ticket and negotiates
+    restarted = Daemon(ip="127.0.0.2", window_size=4)
+    restarted.timers = TimerWheel(now=0.0)
+    restarted.send_raw_to_daemon = daemon2.send_raw_to_daemon
+    restarted.clients["bob"] = {"conn": FakeConn(), "username": "bob"}
+    daemon1.send_raw_to_daemon = lambda data, ip, port: queue.append((restarted, bytes(data), ("127.0.0.1", 7777)))
+
+    alice = {"conn": FakeConn(), "username": "alice"}
+    session, done, operations = chat(daemon1, restarted, deliver, alice)
+    assert done and operations == [2, 6, 4]
+    assert not session.resumed and session.window == 4
+    assert restarted.clients["bob"]["session"].window == 4
+
+def test_unanswered_resumption():
+    daemon1, daemon2, queue, deliver = daemons()
+    alice = {"conn": FakeConn(), "username": "alice"}
+    chat(daemon1, daemon2, deliver, alice)
+    daemon1.disconnect_client(alice, quit=True)
+    deliver()
+
+    # the peer is gone, the resumed chat closes when the handshake times out
+    alice = {"conn": FakeConn(), "username": "alice"}
+    session = daemon1.open_session("127.0.0.2", 7777, alice, "bob")
+    assert daemon1.begin_handshake(session).result(timeout=0)
+    queue.clear()
+    for step in range(int(HANDSHAKE_TIMEOUT * 10) + 1):
+        daemon1.timers.advance(step / 10 + 0.05)
+    assert session.state == "closed"
+    assert alice["conn"].sent[-1].startswith(b"DECLINED")
+    assert len(queue) > 1 and all(daemon is daemon2 for daemon, _, _ in queue)
+    assert daemon1.handshake_attempts[-1]["success"] is False
+
+if __name__ == "__main__":
+    test_ticket_store()
+    test_ticket_cache()
+    test_second_chat_skips_the_handshake()
+    test_ticket_valid_after_acceptance()
+    test_unknown_ticket_falls_back()
+    test_unanswered_resumption()
@@ -0,0 +1,135 @@
+from Datagram import Datagram, decode_options
+from simp_daemon import Daemon, HANDSHAKE_TIMEOUT
+from simp_timers import TimerWheel
+from simp_sessions import Session, SessionTable, LEGACY_SESSION_ID
+from helpers import FakeConn, connect
+
+def test_session_table():
+    table = SessionTable()
+    sessions = []
+    for i in range(1000):
+        session = Session(f"10.0.{i // 256}.{i % 256}", 7777, table.allocate_id(), "started", {})
+        session.remote_id = i
+        table.add(session)
+        sessions.append(session)
+    assert len(table) == 1000
+    assert len({session.local_id for session in sessions}) == 1000
+    assert LEGACY_SESSION_ID not in {session.local_id for session in sessions}
+
+    session = sessions[500]
+    assert table.get(session.peer_ip, 7777, session.local_id) is session
+    assert table.get_remote(session.peer_ip, 7777, 500) is session
+    assert table.for_peer(session.peer_ip, 7777) == [session]
+
+    table.remove(session)
+    assert table.get(session.peer_ip, 7777, session.local_id) is None
+    assert table.get_remote(session.peer_ip, 7777, 500) is None
+    assert len(table) == 999
+
+    # an older peer never sends an id, the session is moved to the legacy id
+    legacy = Session("10.1.0.1", 7777, table.allocate_id(), "syn_sent", {})
+    table.add(legacy)
+    table.set_remote_id(legacy, None)
+    assert legacy.local_id == LEGACY_SESSION_ID
+    assert table.get("10.1.0.1", 7777, LEGACY_SESSION_ID) is legacy
+
+def test_strip_session():
+    data = Datagram.trusted(1, 4, 3, b"Daemon", b"payload", session_id=513).to_bytes()
+    datagram = Datagram.from_buffer(data)
+    assert datagram.operation[0] == 4 | 0x80
+    assert datagram.strip_session() == 513
+    assert datagram.operation[0] == 4
+    assert bytes(datagram.payload) == b"payload"
+    assert int.from_bytes(datagram.length, "big") == 7
+
+    unflagged = Datagram.from_buffer(Datagram.trusted(2, 1, 0, b"bob", b"hi").to_bytes())
+    assert unflagged.strip_session() == LEGACY_SESSION_ID
+    assert bytes(unflagged.payload) == b"hi"
+
+def test_sessions_between_daemons():
+    daemon1 = Daemon(ip="127.0.0.1")
+    daemon2 = Daemon(ip="127.0.0.2")
+    connect(daemon1, daemon2)
+    bob = FakeConn()
+    daemon2.clients["bob"] = {"conn": bob, "username": "bob"}
+
+    alice = {"conn": FakeConn(), "username": "alice"}
+    session1 = daemon1.open_session("127.0.0.2", 7777, alice)
+    assert daemon1.begin_handshake(session1).result(timeout=0) is True
+    assert session1.state == "waiting_for_first_message"
+
+    session2 = daemon2.sessions.get_remote("127.0.0.1", 7777, session1.local_id)
+    assert session2.state == "pending_user_acceptance"
+    assert session2.handshake == "HANDSHAKE_COMPLETE"
+    assert session1.remote_id == session2.local_id
+    assert bob.sent[-1].startswith(b"Chat request from: 127.0.0.1")
+
+    # bob is busy, a second chat from the same daemon is rejected and only that session is closed.
+    # It is resumed with the ticket of the first one, so it completes at once and the ERR and FIN close it
+    carol = {"conn": FakeConn(), "username": "carol"}
+    rejected = daemon1.open_session("127.0.0.2", 7777, carol)
+    assert daemon1.begin_handshake(rejected).result(timeout=0) is True
+    assert rejected.state == "closed"
+    assert carol["conn"].sent[-1].startswith(b"DECLINED")
+    assert "session" not in carol
+    assert len(daemon1.sessions) == 1 and len(daemon2.sessions) == 1
+    assert [attempt["success"] for attempt in daemon1.handshake_attempts] == [True, False]
+    assert session1.handshake_latency is not None
+
+    daemon2.handle_client_chat_decision("ACCEPT", daemon2.clients["bob"])
+    assert session1.state == "started"
+    daemon1.retransmit_message_to_other_daemon(session1, "hello")
+    assert bob.sent[-1] == b"Message from alice: hello"
+    assert len(session1.send_window) == 0
+
+    daemon1.close_session(session1)
+    daemon2.handle_incoming_datagram_from_daemon(Datagram.trusted(1, 8, 0, b"Daemon", b"", session2.local_id).to_bytes(), ("127.0.0.1", 7777))
+    assert len(daemon1.sessions) == 0 and len(daemon2.sessions) == 0
+    assert bob.sent[-1] == b"CHAT_ENDED"
+
+def test_legacy_syn_ack():
+    daemon = Daemon(ip="127.0.0.1")
+    sent = []
+    daemon.send_raw_to_daemon = lambda data, ip, port: sent.append(Datagram.from_buffer(data))
+    session = daemon.open_session("127.0.0.2", 7777, {})
+    future = daemon.begin_handshake(session)
+    assert decode_options(sent[0].payload) == {"WINDOW": "16", "SID": str(session.local_id), "BATCH": "1", "KEEPALIVE": "1", "COMPRESS": "zlib"}
+
+    # an older daemon answers without session ids
+    daemon.handle_incoming_datagram_from_daemon(Datagram.trusted(1, 6, 0, b"Daemon", b"WINDOW=4").to_bytes(), ("127.0.0.2", 7777))
+    assert future.result(timeout=0) is True
+    assert session.handshake == "HANDSHAKE_COMPLETE"
+    assert session.local_id == LEGACY_SESSION_ID and session.remote_id is None
+    assert session.window == 4
+    assert session.codec is None
+    assert sent[-1].operation[0] == 4  # unflagged ACK
+
+def test_concurrent_handshakes_and_timeout():
+    daemon = Daemon(ip="127.0.0.1")
+    daemon.timers = TimerWheel(now=0.0)
+    sent = []
+    daemon.send_raw_to_daemon = lambda data, ip, port: sent.append((Datagram.from_buffer(data), ip))
+    clients = [{"conn": FakeConn(), "username": f"user{i}"} for i in range(100)]
+    sessions = [daemon.open_session(f"10.0.0.{i}", 7777, client) for i, client in enumerate(clients)]
+    futures = [daemon.begin_handshake(session) for session in sessions]
+    assert len(sent) == 100 and not any(future.done() for future in futures)
+
+    # every peer but the last answers, each handshake completes as soon as its SYN+ACK is handled
+    for session in sessions[:-1]:
+        syn_ack = Datagram.trusted(1, 6, 0, b"Daemon", b"WINDOW=8;SID=9", session.local_id).to_bytes()
+        daemon.handle_incoming_datagram_from_daemon(syn_ack, (session.peer_ip, 7777))
+    assert all(future.result(timeout=0) for future in futures[:-1])
+    assert not futures[-1].done()
+
+    daemon.timers.advance(HANDSHAKE_TIMEOUT + 0.1)
+    assert futures[-1].result(timeout=0) is False
+    assert clients[-1]["conn"].sent[-1].startswith(b"DECLINED")
+    assert len(daemon.sessions) == 99
+    assert sum(attempt["success"] for attempt in daemon.handshake_attempts) == 99
+
+if __name__ == "__main__":
+    test_session_table()
+    test_strip_session()
+    test_sessions_between_daemons()
+    test_legacy_syn_ack()
+    test_concurrent_handshakes_and_timeout()
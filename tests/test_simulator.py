@@ -0,0 +1,112 @@
+import time
+import simp_framing
+import simp_timers
+from simp_simulator import VirtualClock, SimNetwork, SimClient
+
+def test_virtual_clock():
+    clock = VirtualClock()
+    fired = []
+    clock.schedule(2.0, fired.append, "b")
+    cancelled = clock.schedule(1.0, fired.append, "x")
+    clock.schedule(1.0, fired.append, "a1")
+    clock.schedule(1.0, fired.append, "a2")
+    cancelled.cancel()
+    assert clock.run(until=1.5) == 2
+    # same deadline, scheduling order
+    assert fired == ["a1", "a2"] and clock() == 1.5
+    clock.schedule(0.0, fired.append, "now")
+    assert clock.run() == 2 and fired[-2:] == ["now", "b"] and clock() == 2.0
+
+def chat(seed: int, messages: int, **conditions):
+    """Alice on 127.0.0.1 chats with bob on 127.0.0.2, returns (network, alice, bob, virtual seconds to deliver all)."""
+    with SimNetwork(seed=seed, **conditions) as network:
+        daemon1 = network.daemon("127.0.0.1")
+        daemon2 = network.daemon("127.0.0.2")
+        alice = SimClient(daemon1, "alice")
+        bob = SimClient(daemon2, "bob")
+        alice.send(simp_framing.START_CHAT, "127.0.0.2 bob")
+        assert network.run_until(lambda: bob.notifications(b"Chat request from"), timeout=30.0)
+        bob.send(simp_framing.CHAT_DECISION, "ACCEPT")
+        assert network.run_until(lambda: alice.notifications(b"SUCCESS - Chat started"), timeout=30.0)
+        start = network.clock.now
+        for i in range(messages):
+            alice.send(simp_framing.MESSAGE, f"message {i}")
+        assert network.run_until(lambda: len(bob.notifications(b"Message from alice")) >= messages, timeout=600.0)
+        return network, alice, bob, network.clock.now - start
+
+def test_chat_on_a_bad_network():
+    started = time.monotonic()
+    network, alice, bob, elapsed = chat(seed=1, messages=200, loss=0.1, delay=0.02, jitter=0.01, duplicate=0.05, reorder=0.05)
+    # every message once and in order, whatever the network did
+    assert bob.notifications(b"Message from alice") == [b"Message from alice: message %d" % i for i in range(200)]
+    assert network.stats["lost"] > 0 and network.stats["duplicated"] > 0 and network.stats["reordered"] > 0
+    # the retransmissions took virtual time, not wall time
+    assert elapsed > 1.0 and time.monotonic() - started < elapsed
+    # the daemons are back on the real clock
+    assert simp_timers.clock is time.monotonic
+
+def test_same_seed_same_run():
+    first = chat(seed=7, messages=50, loss=0.2, jitter=0.05)
+    second = chat(seed=7, messages=50, loss=0.2, jitter=0.05)
+    other = chat(seed=8, messages=50, loss=0.2, jitter=0.05)
+    assert first[0].stats == second[0].stats and first[3] == second[3]
+    assert first[2].received == second[2].received
+    assert first[0].stats != other[0].stats
+
+def test_crashed_peer_times_out():
+    with SimNetwork(seed=3) as network:
+        daemon1 = network.daemon("127.0.0.1")
+        daemon2 = network.daemon("127.0.0.2")
+        alice = SimClient(daemon1, "alice")
+        bob = SimClient(daemon2, "bob")
+        alice.send(simp_framing.START_CHAT, "127.0.0.2 bob")
+        network.run(1.0)
+        bob.send(simp_framing.CHAT_DECISION, "ACCEPT")
+        network.run(1.0)
+        daemon2.stop()
+        # nothing tells alice's daemon, its keepalives find out
+        assert network.run_until(lambda: alice.last == b"CHAT_ENDED", timeout=300.0)
+        assert daemon1.metrics.registry.get("simp_peers_dead_total") == 1
+        assert len(daemon1.sessions) == 0
+
+def test_lost_fin_ends_the_chat():
+    with SimNetwork(seed=5) as network:
+        daemon1 = network.daemon("127.0.0.1")
+        daemon2 = network.daemon("127.0.0.2")
+        bob = SimClient(daemon2, "bob")
+
+        def chat(username):
+            client = SimClient(daemon1, username)
+            client.send(simp_framing.START_CHAT, "127.0.0.2 bob")
+            assert network.run_until(lambda: bob.last == f"Chat request from: 127.0.0.1 ({username})".encode(), timeout=10.0)
+            bob.send(simp_framing.CHAT_DECISION, "ACCEPT")
+            assert network.run_until(lambda: client.notifications(b"SUCCESS - Chat started"), timeout=10.0)
+            return client
+
+        # the link is down when alice quits, her FIN is sent again until it gets through
+        alice = chat("alice")
+        network.partition("127.0.0.1", "127.0.0.2")
+        alice.send(simp_framing.QUIT)
+        network.run(2.0)
+        network.heal("127.0.0.1", "127.0.0.2")
+        assert network.run_until(lambda: bob.last == b"CHAT_ENDED", timeout=60.0)
+        # and no more once it is ACKed
+        network.run(1.0)
+        assert not daemon1.closing
+
+        # every FIN of carol's chat is lost, bob's keepalives tell her daemon which chats bob still has
+        carol = chat("carol")
+        send = daemon1.sendto_daemon
+        daemon1.sendto_daemon = lambda data, ip, port=7777: None if data[0] == 1 and data[1] == 8 | 0x80 else send(data, ip, port)
+        carol.send(simp_framing.QUIT)
+        assert network.run_until(lambda: bob.last == b"CHAT_ENDED", timeout=120.0)
+        assert len(daemon2.sessions) == 0 and daemon2.metrics.registry.get("simp_peers_dead_total") == 0
+        # bob takes chats again
+        chat("dave")
+
+if __name__ == "__main__":
+    test_virtual_clock()
+    test_chat_on_a_bad_network()
+    test_same_seed_same_run()
+    test_crashed_peer_times_out()
+    test_lost_fin_ends_the_chat()
@@ -0,0 +1,61 @@
+from simp_timers import TimerWheel, RttEstimator
+
+def test_timer_wheel_fires_in_order():
+    wheel = TimerWheel(tick=0.01, now=0.0)
+    fired = []
+    for delay in (0.05, 0.7, 30.0, 100.0, 3000.0, 0.01):
+        wheel.schedule(delay, fired.append, delay)
+    assert len(wheel) == 6
+
+    now = 0.0
+    while now < 3001:
+        now += 0.5
+        wheel.advance(now)
+        # nothing fires early and nothing is late by more than one step
+        assert all(delay <= now + 1e-9 for delay in fired)
+        assert all(delay in fired for delay in (0.05, 0.7, 30.0, 100.0, 3000.0, 0.01) if delay <= now - 0.5)
+    assert fired == [0.01, 0.05, 0.7, 30.0, 100.0, 3000.0]
+    assert len(wheel) == 0
+
+def test_timer_wheel_cancel():
+    wheel = TimerWheel(tick=0.01, now=0.0)
+    fired = []
+    timer = wheel.schedule(1.0, fired.append, "cancelled")
+    wheel.schedule(1.0, fired.append, "kept")
+    timer.cancel()
+    wheel.advance(2.0)
+    assert fired == ["kept"]
+
+def test_timer_wheel_survives_a_failing_callback():
+    wheel = TimerWheel(tick=0.01, now=0.0)
+    fired = []
+    def fail():
+        raise OSError("No space left on device")
+    wheel.schedule(0.5, fired.append, "before")
+    wheel.schedule(1.0, fail)
+    wheel.schedule(1.0, fired.append, "same tick")
+    wheel.schedule(1.5, fired.append, "after")
+    assert wheel.advance(2.0) == 4
+    assert fired == ["before", "same tick", "after"]
+    # the wheel keeps running timers scheduled later
+    wheel.schedule(0.5, fired.append, "later")
+    wheel.advance(3.0)
+    assert fired[-1] == "later" and len(wheel) == 0
+
+def test_rtt_estimator():
+    rtt = RttEstimator(initial_rto=1.0, min_rto=0.2, max_rto=10.0)
+    assert rtt.rto == 1.0
+    rtt.sample(0.5)
+    assert rtt.srtt == 0.5 and rtt.rttvar == 0.25
+    assert abs(rtt.rto - 1.5) < 1e-9
+    for _ in range(50):
+        rtt.sample(0.001)
+    assert rtt.rto == 0.2
+    assert rtt.backoff(2) == 0.8
+    assert rtt.backoff(10) == 10.0
+
+if __name__ == "__main__":
+    test_timer_wheel_fires_in_order()
+    test_timer_wheel_cancel()
+    test_timer_wheel_survives_a_failing_callback()
+    test_rtt_estimator()
@@ -0,0 +1,62 @@
+from Datagram import decode_options, encode_options
+from simp_window import SendWindow, ReceiveWindow, window_params, negotiate_window, encode_sack, decode_sack, \
+    ACCEPTED, DUPLICATE, OUT_OF_WINDOW
+
+def test_negotiation():
+    assert negotiate_window(decode_options(encode_options({"WINDOW": 32})), 16) == 16
+    assert negotiate_window(decode_options(encode_options({"WINDOW": 8})), 16) == 8
+    # older daemons send an empty SYN payload
+    assert negotiate_window(decode_options(b""), 16) == 1
+    assert window_params(1) == (1, 2)
+    assert window_params(1000) == (64, 256)
+
+def test_stop_and_wait():
+    sender = SendWindow(*window_params(1))
+    receiver = ReceiveWindow(*window_params(1))
+
+    assert sender.submit("a") == [(0, "a")]
+    assert sender.submit("b") == []  # waits for the ACK of "a"
+    assert receiver.receive(0, "a") == (ACCEPTED, ["a"])
+    assert receiver.receive(0, "a") == (DUPLICATE, [])
+    acked, ready = sender.ack(0, *receiver.sack())
+    assert acked == ["a"] and ready == [(1, "b")]
+
+def test_selective_repeat_reorders_and_sacks():
+    sender = SendWindow(4, 256)
+    receiver = ReceiveWindow(4, 256)
+    ready = []
+    for item in "abcdef":
+        ready += sender.submit(item)
+    assert [seq for seq, _ in ready] == [0, 1, 2, 3]
+
+    # 1 is lost, 0, 2 and 3 arrive
+    assert receiver.receive(0, "a") == (ACCEPTED, ["a"])
+    assert receiver.receive(2, "c") == (ACCEPTED, [])
+    assert receiver.receive(3, "d") == (ACCEPTED, [])
+    assert receiver.receive(9, "x") == (OUT_OF_WINDOW, [])
+    cumulative, bitmap = decode_sack(encode_sack(*receiver.sack()))
+    assert (cumulative, bitmap) == (1, 0b11)
+
+    acked, ready = sender.ack(3, cumulative, bitmap)
+    assert sorted(acked) == ["a", "c", "d"]
+    assert ready == [(4, "e")]  # base is stuck on 1
+    assert receiver.receive(1, "b") == (ACCEPTED, ["b", "c", "d"])
+    acked, ready = sender.ack(1, *receiver.sack())
+    assert acked == ["b"] and ready == [(5, "f")]
+
+def test_sequence_wraps():
+    sender = SendWindow(2, 256)
+    receiver = ReceiveWindow(2, 256)
+    delivered = []
+    for i in range(600):
+        for seq, item in sender.submit(i):
+            status, items = receiver.receive(seq, item)
+            delivered += items
+            sender.ack(seq, *receiver.sack())
+    assert delivered == list(range(600))
+
+if __name__ == "__main__":
+    test_negotiation()
+    test_stop_and_wait()
+    test_selective_repeat_reorders_and_sacks()
+    test_sequence_wraps()
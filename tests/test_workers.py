@@ -0,0 +1,149 @@
+import socket
+import simp_framing
+from simp_daemon import Daemon
+from simp_timers import TimerWheel
+from simp_workers import ControlPlane, WorkerDaemon, peer_worker, bind_worker_sockets
+from helpers import FakeConn, login, command
+
+def pool(workers, *peers):
+    """Workers of a daemon on 127.0.0.1 and peer daemons wired in memory. Datagrams for the workers always reach
+    worker 0 first, like a kernel without steering, the workers forward them to the owner."""
+    control = ControlPlane(workers)
+    daemons = [WorkerDaemon("127.0.0.1", index, control) for index in range(workers)]
+    others = {ip: Daemon(ip=ip) for ip in peers}
+    for daemon in daemons + list(others.values()):
+        daemon.timers = TimerWheel(now=0.0)
+    for daemon in daemons:
+        daemon.send_raw_to_daemon = lambda data, ip, port: others[ip].handle_incoming_datagram_from_daemon(bytes(data), ("127.0.0.1", 7777))
+    for ip, daemon in others.items():
+        daemon.send_raw_to_daemon = lambda data, _ip, port, ip=ip: daemons[0].handle_incoming_datagram_from_daemon(bytes(data), (ip, 7777))
+    return control, daemons, others
+
+def pump(control, daemons):
+    """Run the inbox messages of every worker until none is left."""
+    while any(not inbox.empty() for inbox in control.inboxes):
+        for daemon, inbox in zip(daemons, control.inboxes):
+            while not inbox.empty():
+                daemon.handle_worker_message(inbox.get())
+
+def test_peer_worker():
+    assert [peer_worker(f"127.0.0.{i}", 2) for i in range(1, 5)] == [1, 0, 1, 0]
+    assert peer_worker("10.0.0.7", 1) == 0
+
+def test_usernames_unique_across_workers():
+    control, daemons, _ = pool(2)
+    alice = login(daemons[0], "alice")
+    other = {"conn": FakeConn(), "address": ("127.0.0.1", 99)}
+    command(daemons[1], other, simp_framing.USERNAME, "alice")
+    assert alice["conn"].sent == [b"SUCCESS"] and other["conn"].sent[-1].startswith(b"FAILED")
+    command(daemons[0], alice, simp_framing.USERNAME, "alicia")
+    assert control.users == {"alicia": 0}
+    daemons[0].disconnect_client(alice)
+    assert control.users == {}
+
+def test_chat_held_by_peer_owner():
+    control, daemons, others = pool(2, "127.0.0.2", "127.0.0.3")
+    bob = login(others["127.0.0.3"], "bob")
+    carol = login(others["127.0.0.2"], "carol")
+    alice = login(daemons[0], "alice")
+
+    # 127.0.0.3 is owned by worker 1, the chat runs there for alice connected to worker 0
+    command(daemons[0], alice, simp_framing.START_CHAT, "127.0.0.3 bob")
+    pump(control, daemons)
+    assert len(daemons[1].sessions) == 1 and len(daemons[0].sessions) == 0
+    assert bob["conn"].sent[-1] == b"Chat request from: 127.0.0.1 (alice)"
+    command(others["127.0.0.3"], bob, simp_framing.CHAT_DECISION, "ACCEPT")
+    pump(control, daemons)
+    assert alice["chat_worker"] == 1
+    assert alice["conn"].sent[-1] == b"Message from bob: bob accepted."
+
+    command(daemons[0], alice, simp_framing.MESSAGE, "hi bob")
+    pump(control, daemons)
+    assert bob["conn"].sent[-1] == b"Message from alice: hi bob"
+
+    # alice is busy on worker 1, a request reaching worker 0 is refused
+    carol_session = others["127.0.0.2"].open_session("127.0.0.1", 7777, carol, "alice")
+    others["127.0.0.2"].begin_handshake(carol_session)
+    pump(control, daemons)
+    assert carol_session.state == "closed" and len(daemons[0].sessions) == 0
+
+    command(daemons[0], alice, simp_framing.QUIT)
+    pump(control, daemons)
+    assert bob["conn"].sent[-1] == b"CHAT_ENDED"
+    assert len(daemons[1].sessions) == 0 and daemons[1].remote_clients == {}
+    assert control.users == {} and control.chats == {}
+
+def test_incoming_chat_for_client_on_other_worker():
+    control, daemons, others = pool(2, "127.0.0.2")
+    dave = login(others["127.0.0.2"], "dave")
+    erin = login(daemons[1], "erin")
+
+    # 127.0.0.2 is owned by worker 0, erin's answer and messages are forwarded there
+    command(others["127.0.0.2"], dave, simp_framing.START_CHAT, "127.0.0.1 erin")
+    pump(control, daemons)
+    assert erin["conn"].sent[-1] == b"Chat request from: 127.0.0.2 (dave)"
+    assert erin["chat_worker"] == 0
+    command(daemons[1], erin, simp_framing.CHAT_DECISION, "ACCEPT")
+    pump(control, daemons)
+    command(others["127.0.0.2"], dave, simp_framing.MESSAGE, "hi erin")
+    pump(control, daemons)
+    assert erin["conn"].sent[-1] == b"Message from dave: hi erin"
+
+    command(others["127.0.0.2"], dave, simp_framing.QUIT)
+    pump(control, daemons)
+    assert erin["conn"].sent[-1] == b"CHAT_ENDED"
+    assert erin.get("chat_worker") is None and control.chats == {}
+
+def test_chat_kept_while_client_is_away():
+    control, daemons, others = pool(2, "127.0.0.3")
+    bob = login(others["127.0.0.3"], "bob")
+    alice = login(daemons[0], "alice")
+    command(daemons[0], alice, simp_framing.START_CHAT, "127.0.0.3 bob")
+    pump(control, daemons)
+    command(others["127.0.0.3"], bob, simp_framing.CHAT_DECISION, "ACCEPT")
+    pump(control, daemons)
+
+    # alice's connection broke, worker 1 keeps the chat and her messages
+    daemons[0].disconnect_client(alice)
+    pump(control, daemons)
+    assert "alice" in daemons[1].parked and control.users == {}
+    command(others["127.0.0.3"], bob, simp_framing.MESSAGE, "still there?")
+    pump(control, daemons)
+    assert bob["session"].state == "started" and len(daemons[1].outbox) == 1
+
+    # back on worker 0, worker 1 gives her the message and the chat
+    alice = login(daemons[0], "alice")
+    pump(control, daemons)
+    assert alice["conn"].sent == [b"SUCCESS", b"Stored message from bob: still there?", b"SUCCESS - Chat started.\n"]
+    assert alice["chat_worker"] == 1 and not daemons[1].parked
+    command(daemons[0], alice, simp_framing.MESSAGE, "back")
+    pump(control, daemons)
+    assert bob["conn"].sent[-1] == b"Message from alice: back"
+
+    command(daemons[0], alice, simp_framing.QUIT)
+    pump(control, daemons)
+    assert bob["conn"].sent[-1] == b"CHAT_ENDED" and control.chats == {}
+
+def test_kernel_steers_by_peer():
+    """With the steering program, each peer's datagrams reach the worker socket peer_worker picks."""
+    sockets = bind_worker_sockets("127.0.0.1", 3, 9779)
+    try:
+        for sock in sockets:
+            sock.settimeout(0.2)
+        for i in range(2, 8):
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sender.bind((f"127.0.0.{i}", 0))
+            sender.sendto(b"ping", ("127.0.0.1", 9779))
+            sender.close()
+            assert sockets[peer_worker(f"127.0.0.{i}", 3)].recvfrom(16)[0] == b"ping"
+    finally:
+        for sock in sockets:
+            sock.close()
+
+if __name__ == "__main__":
+    test_peer_worker()
+    test_usernames_unique_across_workers()
+    test_chat_held_by_peer_owner()
+    test_incoming_chat_for_client_on_other_worker()
+    test_chat_kept_while_client_is_away()
+    test_kernel_steers_by_peer()